@@ -4,7 +4,9 @@
 Shared flocker components.
 """
 
-__all__ = ['INode', 'FakeNode', 'ProcessNode', 'gather_deferreds']
+__all__ = ['INode', 'FakeNode', 'ProcessNode', 'gather_deferreds',
+           'LRUCache', 'IdentityLRUCache']
 
 from ._ipc import INode, FakeNode, ProcessNode
 from ._defer import gather_deferreds
+from ._cache import LRUCache, IdentityLRUCache
@@ -0,0 +1,102 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Small caches of recently used values.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A mapping of limited size which evicts the least recently used entry
+    when a new one doesn't fit.
+
+    :ivar OrderedDict _entries: Map keys to values, least recently used
+        first.
+    """
+    def __init__(self, size):
+        """
+        :param int size: The maximum number of entries to keep.
+        """
+        self._size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, marking it as the most recently used.
+
+        :param key: The key the entry was stored with.
+        :param default: The result if there is no such entry.
+
+        :return: The value of the entry, or ``default``.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def set(self, key, value):
+        """
+        Store an entry as the most recently used, evicting the least
+        recently used entry if there are too many.
+
+        :param key: The key to store the entry with.
+        :param value: The value of the entry.
+        """
+        self._entries.pop(key, None)
+        if len(self._entries) >= self._size:
+            self._entries.popitem(last=False)
+        self._entries[key] = value
+
+
+class IdentityLRUCache(object):
+    """
+    A ``LRUCache`` of values derived from immutable objects, looked up by
+    the identity of the object rather than by (possibly expensive)
+    equality.
+
+    The cache keeps a reference to each object so its identity can't be
+    reused by another object while it is cached.
+
+    :ivar LRUCache _entries: Map ``id()`` of objects to a tuple of the
+        object and its value.
+    """
+    def __init__(self, size):
+        """
+        :param int size: The maximum number of objects to keep values for.
+        """
+        self._entries = LRUCache(size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, obj, default=None):
+        """
+        Look up the value for an object, marking it as the most recently
+        used.
+
+        :param obj: The object.
+        :param default: The result if there is no value for ``obj``.
+
+        :return: The value for ``obj``, or ``default``.
+        """
+        entry = self._entries.get(id(obj))
+        if entry is None:
+            return default
+        return entry[1]
+
+    def set(self, obj, value):
+        """
+        Store the value for an object as the most recently used, evicting
+        the least recently used value if there are too many.
+
+        :param obj: The object.
+        :param value: The value for ``obj``.
+        """
+        self._entries.set(id(obj), (obj, value))
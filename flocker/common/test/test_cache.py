@@ -0,0 +1,91 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.common._cache``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._cache import LRUCache, IdentityLRUCache
+
+
+class LRUCacheTests(SynchronousTestCase):
+    """
+    Tests for ``LRUCache``.
+    """
+    def test_get(self):
+        """
+        A stored value is returned by ``get``.
+        """
+        cache = LRUCache(2)
+        cache.set(u"key", b"value")
+        self.assertEqual(b"value", cache.get(u"key"))
+
+    def test_missing(self):
+        """
+        ``get`` returns the given default for a key which isn't stored.
+        """
+        cache = LRUCache(2)
+        self.assertEqual((None, 0), (cache.get(u"key"), cache.get(u"key", 0)))
+
+    def test_replace(self):
+        """
+        Storing a value for a key which is already stored replaces it.
+        """
+        cache = LRUCache(2)
+        cache.set(u"key", b"1")
+        cache.set(u"key", b"2")
+        self.assertEqual((1, b"2"), (len(cache), cache.get(u"key")))
+
+    def test_evict_least_recently_used(self):
+        """
+        Storing more than the given number of entries evicts the least
+        recently used entry.
+        """
+        cache = LRUCache(2)
+        cache.set(u"a", b"1")
+        cache.set(u"b", b"2")
+        cache.get(u"a")
+        cache.set(u"c", b"3")
+        self.assertEqual(
+            (2, b"1", None, b"3"),
+            (len(cache), cache.get(u"a"), cache.get(u"b"), cache.get(u"c")))
+
+
+class IdentityLRUCacheTests(SynchronousTestCase):
+    """
+    Tests for ``IdentityLRUCache``.
+    """
+    def test_by_identity(self):
+        """
+        Values are looked up by the identity of the object, not equality.
+        """
+        cache = IdentityLRUCache(2)
+        key = (1, 2)
+        cache.set(key, b"value")
+        self.assertEqual((b"value", None),
+                         (cache.get(key), cache.get(tuple([1, 2]))))
+
+    def test_identity_not_reused(self):
+        """
+        The cache keeps its objects alive, so another object can't get the
+        identity of a cached one.
+        """
+        cache = IdentityLRUCache(2)
+        cache.set([1], b"value")
+        self.assertEqual(None, cache.get([2]))
+
+    def test_evict_least_recently_used(self):
+        """
+        Storing values for more than the given number of objects evicts the
+        least recently used value.
+        """
+        a, b, c = object(), object(), object()
+        cache = IdentityLRUCache(2)
+        cache.set(a, 1)
+        cache.set(b, 2)
+        cache.get(a)
+        cache.set(c, 3)
+        self.assertEqual(
+            (2, 1, None, 3),
+            (len(cache), cache.get(a), cache.get(b), cache.get(c)))
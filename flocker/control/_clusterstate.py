@@ -4,9 +4,20 @@
 Combine and retrieve current cluster state.
 """
 
+from math import ceil
+
 from twisted.application.service import Service
 
-from ._model import DeploymentState
+from eliot import Logger, write_traceback
+
+from ._model import DeploymentState, NodeState
+
+
+# The granularity, in seconds, with which node state is expired:
+_EXPIRY_TICK = 1.0
+
+# The ``NodeState`` fields which agents report, any subset at a time:
+_NODE_FIELDS = (u"applications", u"used_ports", u"manifestations", u"paths")
 
 
 class ClusterStateService(Service):
@@ -14,15 +25,82 @@ class ClusterStateService(Service):
     Store known current cluster state, and combine partial updates with
     the existing known state.
 
-    https://clusterhq.atlassian.net/browse/FLOC-1269 will deal with
-    semantics of expiring data, which should happen so stale information
-    isn't treated as correct.
+    If an expiry is given, node state which hasn't been reported for that
+    long is replaced with ignorance, so stale information isn't treated as
+    correct.  Several agents on one node each report some of its fields,
+    so updates are tracked per reporter: a hostname and the set of fields
+    reported.  When a reporter expires only the fields no other live
+    reporter for that node covers are forgotten, and a node whose fields
+    are all unknown is dropped altogether.  Reporters are kept in a timer
+    wheel: a ring of slots, one per tick, each holding the reporters due
+    to expire at that tick.  Each tick only looks at the reporters in one
+    slot, and the ticks only run while some state may expire.
 
     :ivar DeploymentState _deployment_state: The current known cluster
         state.
+    :ivar int _generation: Incremented every time the cluster state
+        changes.
+    :ivar dict _last_update: Map reporters, ``(hostname, fields)`` tuples
+        where ``fields`` is a ``frozenset`` of the names of the fields
+        reported, to the time they last reported.
+    :ivar dict _reporters: Map hostnames to the ``set`` of reporters for
+        that node.
+    :ivar list _wheel: ``set``\ s of reporters whose state is due to
+        expire, indexed by the number of the tick at which they expire
+        modulo the number of slots.
+    :ivar dict _slots: Map reporters to their index in ``_wheel``.
+    :ivar int _cursor: The number of the last tick processed.
+    :ivar _ticking: The ``IDelayedCall`` for the next tick, or ``None``.
     """
-    def __init__(self):
+    logger = Logger()
+
+    def __init__(self, reactor=None, expiry=None, tick=_EXPIRY_TICK):
+        """
+        :param IReactorTime reactor: Reactor used to timestamp updates and
+            to schedule expiry.  If ``None`` nothing is ever expired.
+        :param float expiry: The number of seconds after which the state of
+            a node which hasn't been reported again expires, or ``None`` to
+            never expire it.
+        :param float tick: The granularity of expiry in seconds.
+        """
         self._deployment_state = DeploymentState()
+        self._generation = 0
+        self._change_callbacks = []
+        self._reactor = reactor
+        self._expiry = expiry if reactor is not None else None
+        self._tick = tick
+        self._last_update = {}
+        self._reporters = {}
+        self._wheel = []
+        if self._expiry is not None:
+            self._wheel = [
+                set() for _ in range(int(ceil(self._expiry / tick)) + 2)]
+        self._slots = {}
+        self._cursor = None
+        self._ticking = None
+
+    def stopService(self):
+        if self._ticking is not None:
+            self._ticking.cancel()
+            self._ticking = None
+        return Service.stopService(self)
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever the cluster state changes.
+
+        :param change_callback: Callable that takes no arguments, will be
+            called when the cluster state changes.
+        """
+        self._change_callbacks.append(change_callback)
+
+    def unregister(self, change_callback):
+        """
+        Stop calling a function registered with ``register``.
+
+        :param change_callback: The registered callable.
+        """
+        self._change_callbacks.remove(change_callback)
 
     def manifestation_path(self, hostname, dataset_id):
         """
@@ -44,6 +122,122 @@ class ClusterStateService(Service):
         """
         return self._deployment_state
 
+    def generation(self):
+        """
+        Retrieve the generation of the current cluster state.
+
+        :return int: A number which is incremented every time the cluster
+            state changes.
+        """
+        return self._generation
+
+    def last_update(self, hostname):
+        """
+        Retrieve the time the state of a node was last reported.
+
+        :param unicode hostname: The name of the host.
+
+        :return: The time in seconds since the epoch, or ``None`` if the
+            node's state has not been reported (or no reactor was given).
+        """
+        reporters = self._reporters.get(hostname)
+        if not reporters:
+            return None
+        return max(self._last_update[reporter] for reporter in reporters)
+
+    def _changed(self):
+        """
+        Record a change to the cluster state and tell the registered
+        callbacks about it.
+        """
+        self._generation += 1
+        for callback in self._change_callbacks:
+            try:
+                callback()
+            except:
+                write_traceback(self.logger, u"")
+
+    def _touch(self, node_state):
+        """
+        Record that some of the state of a node was reported, rescheduling
+        the expiry of the fields reported.
+
+        :param NodeState node_state: The reported state.
+        """
+        fields = frozenset(
+            name for name in _NODE_FIELDS if node_state[name] is not None)
+        if not fields:
+            return
+        reporter = (node_state.hostname, fields)
+        now = self._reactor.seconds()
+        self._last_update[reporter] = now
+        self._reporters.setdefault(node_state.hostname, set()).add(reporter)
+        if self._expiry is None:
+            return
+        slot = int(ceil((now + self._expiry) / self._tick)) % len(self._wheel)
+        previous = self._slots.get(reporter)
+        if previous != slot:
+            if previous is not None:
+                self._wheel[previous].discard(reporter)
+            self._wheel[slot].add(reporter)
+            self._slots[reporter] = slot
+        if self._ticking is None:
+            self._cursor = int(now // self._tick)
+            self._schedule_tick(now)
+
+    def _schedule_tick(self, now):
+        """
+        Schedule the tick after ``_cursor``.
+
+        :param float now: The current time.
+        """
+        self._ticking = self._reactor.callLater(
+            max(0, (self._cursor + 1) * self._tick - now), self._run_tick)
+
+    def _run_tick(self):
+        """
+        Expire the state of the reporters in the slots of all ticks since
+        the last one processed.  A late tick processes each slot at most
+        once; reporters heard from again since they were put in a slot are
+        left alone.
+        """
+        self._ticking = None
+        now = self._reactor.seconds()
+        current = int(now // self._tick)
+        first = max(self._cursor + 1, current - len(self._wheel) + 1)
+        expired = {}
+        for number in range(first, current + 1):
+            slot = self._wheel[number % len(self._wheel)]
+            for reporter in list(slot):
+                if self._last_update[reporter] + self._expiry <= now:
+                    slot.remove(reporter)
+                    del self._slots[reporter]
+                    del self._last_update[reporter]
+                    hostname, fields = reporter
+                    self._reporters[hostname].remove(reporter)
+                    expired.setdefault(hostname, set()).update(fields)
+        self._cursor = current
+        nodes = self._deployment_state.nodes
+        for hostname, fields in expired.items():
+            for _, live in self._reporters[hostname]:
+                fields -= live
+            if not self._reporters[hostname]:
+                del self._reporters[hostname]
+            node = nodes.get(hostname)
+            if node is None or not fields:
+                continue
+            node = node.update({name: None for name in fields})
+            if all(node[name] is None for name in _NODE_FIELDS):
+                nodes = nodes.remove(hostname)
+            else:
+                nodes = nodes.set(hostname, node)
+        if nodes is not self._deployment_state.nodes:
+            self._deployment_state = self._deployment_state.set(
+                nodes=nodes)
+            self._changed()
+        if self._slots:
+            self._schedule_tick(now)
+
     def apply_changes(self, changes):
         """
         Apply some changes to the cluster state.
@@ -54,7 +248,12 @@ class ClusterStateService(Service):
         # XXX: Multiple nodes may report being primary for a dataset. Enforce
         # consistency here. See
         # https://clusterhq.atlassian.net/browse/FLOC-1303
+        original = self._deployment_state
         for change in changes:
             self._deployment_state = change.update_cluster_state(
                 self._deployment_state
             )
+            if self._reactor is not None and isinstance(change, NodeState):
+                self._touch(change)
+        if self._deployment_state is not original:
+            self._changed()
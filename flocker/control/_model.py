@@ -14,6 +14,8 @@ There are different categories of classes:
 3. Configuration-specific classes, none implemented yet.
 """
 
+from collections import Mapping
+
 from characteristic import attributes
 
 from twisted.python.filepath import FilePath
@@ -347,6 +349,43 @@ def _keys_match(attribute):
 _keys_match_dataset_id = _keys_match("dataset_id")
 
 
+class NodeMap(CheckedPMap):
+    """
+    Base class for the types of ``node_map_field`` fields, mapping node
+    hostnames to nodes.
+    """
+
+
+def node_map_field(node_type):
+    """
+    Create a field holding a ``PMap`` of nodes keyed by their hostname.
+
+    The field can also be set from any other iterable of nodes, e.g. a
+    ``list`` or ``frozenset``. Such maps are serialized as a list of nodes.
+
+    The keys are not checked against the hostnames of the nodes when the
+    field is set, since that would make every update proportional to the
+    number of nodes. Use ``PMap.set(node.hostname, node)`` to add nodes.
+
+    :param node_type: The type of the nodes, e.g. ``Node``.
+
+    :return: A ``field`` containing a ``NodeMap``.
+    """
+    class TheMap(NodeMap):
+        __key_type__ = unicode
+        __value_type__ = node_type
+    TheMap.__name__ = "Unicode" + node_type.__name__ + "PMap"
+
+    def factory(argument):
+        if isinstance(argument, TheMap):
+            return argument
+        if not isinstance(argument, Mapping):
+            argument = {node.hostname: node for node in argument}
+        return TheMap(argument)
+    return field(mandatory=True, initial=TheMap(), type=TheMap,
+                 factory=factory)
+
+
 class Node(PRecord):
     """
     Configuration for a single node on which applications will be managed
@@ -399,12 +438,10 @@ def _get_node(default_factory):
              is found.
     """
     def get_node(deployment, hostname):
-        nodes = list(
-            node for node in deployment.nodes if node.hostname == hostname
-        )
-        if len(nodes) == 0:
+        node = deployment.nodes.get(hostname)
+        if node is None:
             return default_factory(hostname=hostname)
-        return nodes[0]
+        return node
     return get_node
 
 
@@ -413,10 +450,10 @@ class Deployment(PRecord):
     A ``Deployment`` describes the configuration of a number of applications on
     a number of cooperating nodes.
 
-    :ivar PSet nodes: A set containing ``Node`` instances
+    :ivar PMap nodes: A mapping from hostnames to ``Node`` instances
         describing the configuration of each cooperating node.
     """
-    nodes = pset_field(Node)
+    nodes = node_map_field(Node)
 
     get_node = _get_node(Node)
 
@@ -426,7 +463,7 @@ class Deployment(PRecord):
 
         :return: Iterable returning all applications.
         """
-        for node in self.nodes:
+        for node in self.nodes.itervalues():
             for application in node.applications:
                 yield application
 
@@ -441,9 +478,7 @@ class Deployment(PRecord):
 
         :return Deployment: Updated with new ``Node``.
         """
-        return Deployment(nodes=frozenset(
-            list(n for n in self.nodes if n.hostname != node.hostname) +
-            [node]))
+        return self.set(nodes=self.nodes.set(node.hostname, node))
 
     def move_application(self, application, target_node):
         """
@@ -458,7 +493,7 @@ class Deployment(PRecord):
         :return Deployment: Updated to reflect the new desired state.
         """
         deployment = self
-        for node in deployment.nodes:
+        for node in deployment.nodes.values():
             for container in node.applications:
                 if container.name == application.name:
                     # We only need to perform a move if the node currently
@@ -587,8 +622,8 @@ class DeploymentState(PRecord):
     """
     A ``DeploymentState`` describes the state of the nodes in the cluster.
 
-    :ivar PSet nodes: A set containing ``NodeState`` instances describing the
-        state of each cooperating node.
+    :ivar PMap nodes: A mapping from hostnames to ``NodeState`` instances
+        describing the state of each cooperating node.
     :ivar PMap nonmanifest_datasets: A mapping from dataset identifiers (as
         ``unicode``) to corresponding ``Dataset`` instances.  This mapping
         describes every ``Dataset`` which is known to exist as part of the
@@ -603,7 +638,7 @@ class DeploymentState(PRecord):
         initialized to meaningful values (see
         https://clusterhq.atlassian.net/browse/FLOC-1247).
     """
-    nodes = pset_field(NodeState)
+    nodes = node_map_field(NodeState)
 
     get_node = _get_node(NodeState)
 
@@ -621,21 +656,30 @@ class DeploymentState(PRecord):
         The given ``NodeState`` will simply be added if no existing ones
         have matching hostname.
 
+        All changed attributes are applied in one pass, unchanged ones keep
+        their existing values, and if nothing differs ``self`` is returned
+        so callers can tell nothing changed with an identity check.
+
         :param NodeState node: An update for ``NodeState`` with same
              hostname in this ``DeploymentState``.
 
         :return DeploymentState: Updated with new ``NodeState``.
         """
-        nodes = {n for n in self.nodes if n.hostname == node_state.hostname}
-        if not nodes:
-            return self.transform(["nodes"], lambda s: s.add(node_state))
-        [original_node] = nodes
-        updated_node = original_node
-        for key, value in node_state.items():
-            if value is not None:
-                updated_node = updated_node.set(key, value)
+        original_node = self.nodes.get(node_state.hostname)
+        if original_node is None:
+            updated_node = node_state
+        else:
+            evolver = None
+            for key, value in node_state.items():
+                if value is not None and value != original_node.get(key):
+                    if evolver is None:
+                        evolver = original_node.evolver()
+                    evolver.set(key, value)
+            if evolver is None:
+                return self
+            updated_node = evolver.persistent()
         return self.set(
-            "nodes", self.nodes.discard(original_node).add(updated_node))
+            "nodes", self.nodes.set(updated_node.hostname, updated_node))
 
 
 @implementer(IClusterStateChange)
@@ -650,9 +694,135 @@ class NonManifestDatasets(PRecord):
         return cluster_state.set(nonmanifest_datasets=self.datasets)
 
 
+def _diff_nodes(original, updated):
+    """
+    Find the nodes which differ between two deployments.
+
+    :param original: A ``Deployment`` or ``DeploymentState``.
+    :param updated: An object of the same type as ``original``.
+
+    :return: Tuple of a ``set`` of nodes which are new or changed in
+        ``updated`` and a ``set`` of the hostnames of nodes which only
+        exist in ``original``.
+    """
+    original_nodes = original.nodes
+    changed_nodes = set()
+    for hostname, node in updated.nodes.iteritems():
+        previous = original_nodes.get(hostname)
+        # Unchanged nodes are typically shared between the two objects, so
+        # the identity check avoids most of the (deep) equality checks:
+        if previous is not node and previous != node:
+            changed_nodes.add(node)
+    updated_nodes = updated.nodes
+    removed_hostnames = set(hostname for hostname in original_nodes
+                            if hostname not in updated_nodes)
+    return changed_nodes, removed_hostnames
+
+
+def _apply_node_diff(nodes, changed_nodes, removed_hostnames):
+    """
+    Apply node changes found by ``_diff_nodes``.
+
+    :param nodes: The nodes of the original object.
+    :param changed_nodes: Nodes which are new or changed.
+    :param removed_hostnames: Hostnames of nodes to remove.
+
+    :return: The updated nodes, of the same type as ``nodes``.
+    """
+    nodes = nodes.evolver()
+    for hostname in removed_hostnames:
+        if hostname in nodes:
+            del nodes[hostname]
+    for node in changed_nodes:
+        nodes[node.hostname] = node
+    return nodes.persistent()
+
+
+class DeploymentDiff(PRecord):
+    """
+    The differences between two ``Deployment`` instances, allowing the
+    updated one to be reconstructed from the original.
+
+    :ivar PSet changed_nodes: ``Node`` instances which are new or have
+        changed.
+    :ivar PSet removed_hostnames: The hostnames of nodes which have been
+        removed.
+    """
+    changed_nodes = pset_field(Node)
+    removed_hostnames = pset_field(unicode)
+
+    def apply(self, deployment):
+        """
+        Apply the differences to a ``Deployment``.
+
+        :param Deployment deployment: The original deployment.
+
+        :return Deployment: The updated deployment.
+        """
+        return deployment.set(nodes=_apply_node_diff(
+            deployment.nodes, self.changed_nodes, self.removed_hostnames))
+
+
+class DeploymentStateDiff(PRecord):
+    """
+    The differences between two ``DeploymentState`` instances, allowing the
+    updated one to be reconstructed from the original.
+
+    :ivar PSet changed_nodes: ``NodeState`` instances which are new or have
+        changed.
+    :ivar PSet removed_hostnames: The hostnames of nodes which have been
+        removed.
+    :ivar PMap nonmanifest_datasets: The new non-manifest datasets, or
+        ``None`` if they have not changed.
+    """
+    changed_nodes = pset_field(NodeState)
+    removed_hostnames = pset_field(unicode)
+    nonmanifest_datasets = pmap_field(unicode, Dataset, optional=True)
+
+    def apply(self, deployment_state):
+        """
+        Apply the differences to a ``DeploymentState``.
+
+        :param DeploymentState deployment_state: The original state.
+
+        :return DeploymentState: The updated state.
+        """
+        deployment_state = deployment_state.set(nodes=_apply_node_diff(
+            deployment_state.nodes, self.changed_nodes,
+            self.removed_hostnames))
+        if self.nonmanifest_datasets is not None:
+            deployment_state = deployment_state.set(
+                nonmanifest_datasets=self.nonmanifest_datasets)
+        return deployment_state
+
+
+def create_diff(original, updated):
+    """
+    Calculate the differences between two ``Deployment`` or two
+    ``DeploymentState`` instances.
+
+    :param original: The original ``Deployment`` or ``DeploymentState``.
+    :param updated: The updated object, of the same type as ``original``.
+
+    :return: A ``DeploymentDiff`` or ``DeploymentStateDiff`` whose
+        ``apply`` method converts ``original`` into ``updated``.
+    """
+    changed_nodes, removed_hostnames = _diff_nodes(original, updated)
+    if isinstance(updated, Deployment):
+        return DeploymentDiff(changed_nodes=changed_nodes,
+                              removed_hostnames=removed_hostnames)
+    nonmanifest_datasets = updated.nonmanifest_datasets
+    if nonmanifest_datasets == original.nonmanifest_datasets:
+        nonmanifest_datasets = None
+    return DeploymentStateDiff(changed_nodes=changed_nodes,
+                               removed_hostnames=removed_hostnames,
+                               nonmanifest_datasets=nonmanifest_datasets)
+
+
 # Classes that can be serialized to disk or sent over the network:
 SERIALIZABLE_CLASSES = [
     Deployment, Node, DockerImage, Port, Link, RestartNever, RestartAlways,
     RestartOnFailure, Application, Dataset, Manifestation, AttachedVolume,
-    NodeState, DeploymentState, NonManifestDatasets,
+    NodeState, DeploymentState, NonManifestDatasets, DeploymentDiff,
+    DeploymentStateDiff,
 ]
@@ -4,17 +4,23 @@
 Persistence of cluster configuration.
 """
 
+from functools import partial
 from json import dumps, loads, JSONEncoder
+from os import O_RDONLY, close, fsync, open as os_open
 
-from eliot import Logger, write_traceback, MessageType, Field, ActionType
+from eliot import (
+    Logger, write_traceback, write_failure, MessageType, Field, ActionType,
+)
 
 from pyrsistent import PRecord, PVector, PMap, PSet
 
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
 
-from ._model import SERIALIZABLE_CLASSES, Deployment
+from ..common import IdentityLRUCache
+from ._model import SERIALIZABLE_CLASSES, Deployment, NodeMap, create_diff
 
 
 # Serialization marker storing the class name:
@@ -30,6 +36,9 @@ class _ConfigurationEncoder(JSONEncoder):
             result = dict(obj)
             result[_CLASS_MARKER] = obj.__class__.__name__
             return result
+        elif isinstance(obj, NodeMap):
+            # Nodes were originally stored in a set:
+            return list(obj.values())
         elif isinstance(obj, PMap):
             return dict(obj)
         elif isinstance(obj, (PSet, PVector, set)):
@@ -40,13 +49,20 @@ class _ConfigurationEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
-def wire_encode(obj):
+def wire_encode(obj, compact=False):
     """
     Encode the given configuration object into bytes.
 
     :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :param bool compact: If true, use the compact format, which is faster to
+        encode and decode but which depends on the exact definition of the
+        model classes, and so is only suitable for communication between
+        processes running the same version of Flocker.
     :return bytes: Encoded object.
     """
+    if compact:
+        return _COMPACT_MARKER + dumps(
+            _compact_encode(obj), separators=(",", ":"))
     return dumps(obj, cls=_ConfigurationEncoder)
 
 
@@ -54,10 +70,14 @@ def wire_decode(data):
     """
     Decode the given configuration object from bytes.
 
+    Both the default and the compact format are supported.
+
     :param bytes data: Encoded object.
-    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :return: An object from the configuration model, e.g. ``Deployment``.
     """
-    classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+    if data.startswith(_COMPACT_MARKER):
+        return _get_codec().decode(loads(data[len(_COMPACT_MARKER):]))
+    classes = _get_codec().classes
 
     def decode_object(dictionary):
         class_name = dictionary.get(_CLASS_MARKER, None)
@@ -72,18 +92,359 @@ def wire_decode(data):
     return loads(data, object_hook=decode_object)
 
 
+# The compact format is ``_COMPACT_MARKER`` followed by JSON in which:
+#
+# * ``PRecord`` instances are arrays of the class name followed by the
+#   values of all fields, in the order of the sorted field names. Missing
+#   fields are ``[_MISSING]``.
+# * ``FilePath`` instances are ``["FilePath", path]``.
+# * Sets, vectors and lists are arrays of ``_SEQUENCE`` followed by the
+#   items.
+# * Mappings are JSON objects.
+#
+# The marker can't be the start of a JSON document, so the two formats are
+# distinguishable.
+_COMPACT_MARKER = b"C"
+_SEQUENCE = 0
+_MISSING = 1
+
+
+def _compact_encode(obj):
+    """
+    Convert an object from the configuration model into the structure of
+    plain lists, dictionaries and scalars of the compact format.
+
+    :param obj: An object from the configuration model.
+    :return: The structure to encode as JSON.
+    """
+    obj_type = type(obj)
+    try:
+        encoder = _ENCODERS[obj_type]
+    except KeyError:
+        encoder = _ENCODERS[obj_type] = _create_encoder(obj_type)
+    return encoder(obj)
+
+
+def _create_encoder(obj_type):
+    """
+    Create a function that converts objects of the given type into the
+    compact format.
+
+    :param type obj_type: The type of objects to convert.
+
+    :return: A one-argument callable.
+    """
+    if issubclass(obj_type, (type(None), unicode, bytes, bool, int, long,
+                             float)):
+        return lambda obj: obj
+    elif issubclass(obj_type, PRecord):
+        class_name = obj_type.__name__
+        names = _record_field_names(obj_type)
+
+        def encode_record(obj):
+            values = dict(obj.iteritems())
+            result = [class_name]
+            for name in names:
+                value = values.get(name, _MISSING_FIELD)
+                if value is _MISSING_FIELD:
+                    result.append([_MISSING])
+                else:
+                    result.append(_compact_encode(value))
+            return result
+        return encode_record
+    elif issubclass(obj_type, (PMap, dict)):
+        return lambda obj: {key: _compact_encode(value)
+                            for key, value in obj.iteritems()}
+    elif issubclass(obj_type, (PSet, PVector, set, frozenset, list, tuple)):
+        def encode_sequence(obj):
+            result = [_SEQUENCE]
+            result.extend(_compact_encode(item) for item in obj)
+            return result
+        return encode_sequence
+    elif issubclass(obj_type, FilePath):
+        return lambda obj: [u"FilePath", obj.path.decode("utf-8")]
+
+    def unsupported(obj):
+        raise TypeError("{!r} can't be encoded".format(obj))
+    return unsupported
+
+
+_MISSING_FIELD = object()
+
+# Map types to the functions that convert them into the compact format:
+_ENCODERS = {}
+
+# Map ``PRecord`` subclasses to their sorted field names:
+_FIELD_NAMES = {}
+
+
+def _record_field_names(cls):
+    """
+    :param cls: A ``PRecord`` subclass.
+    :return: A ``list`` of the sorted field names of the class.
+    """
+    try:
+        return _FIELD_NAMES[cls]
+    except KeyError:
+        names = _FIELD_NAMES[cls] = sorted(cls._precord_fields)
+        return names
+
+
+class _CompactCodec(object):
+    """
+    Decoder for the compact format for a particular set of serializable
+    classes.
+
+    :ivar dict classes: Map class names to serializable classes.
+    """
+    def __init__(self, classes):
+        """
+        :param classes: The serializable ``PRecord`` subclasses.
+        """
+        self.classes = {cls.__name__: cls for cls in classes}
+
+    def decode(self, value):
+        """
+        Convert a value from the compact format into model objects, checking
+        field types and invariants.
+
+        :param value: The value loaded from JSON.
+
+        :return: The decoded value.
+        """
+        if isinstance(value, list):
+            tag = value[0]
+            if tag == _SEQUENCE and type(tag) is int:
+                return [self.decode(item) for item in value[1:]]
+            cls = self.classes.get(tag)
+            if cls is None:
+                return self._decode_special(value)
+            return cls.create({
+                name: self.decode(item)
+                for name, item in zip(_record_field_names(cls), value[1:])
+                if item != [_MISSING]})
+        elif isinstance(value, dict):
+            return {key: self.decode(item) for key, item in value.items()}
+        return value
+
+    def _decode_special(self, value):
+        """
+        Decode a tagged array that isn't a serializable class.
+
+        :param list value: The array.
+
+        :return: A ``FilePath`` or, for unknown tags, ``value`` unchanged.
+        """
+        if value[0] == u"FilePath":
+            return FilePath(value[1].encode("utf-8"))
+        return value
+
+
+_CODECS = {}
+
+
+def _get_codec():
+    """
+    :return: The ``_CompactCodec`` for the current ``SERIALIZABLE_CLASSES``.
+    """
+    key = tuple(SERIALIZABLE_CLASSES)
+    try:
+        return _CODECS[key]
+    except KeyError:
+        codec = _CODECS[key] = _CompactCodec(key)
+        return codec
+
+
+class WireEncodeCache(object):
+    """
+    A cache of the encoded form of configuration objects, so that an
+    object sent to many convergence agents is only encoded once.
+
+    Objects are cached by identity. Only ``PRecord`` instances, which are
+    immutable, are cached; other objects are encoded every time.
+
+    :ivar IdentityLRUCache _cache: The encoded forms of recently used
+        objects.
+    """
+    def __init__(self, size, encode=wire_encode):
+        """
+        :param int size: The maximum number of objects to cache.
+        :param encode: The function to encode objects with.
+        """
+        self._encode = encode
+        self._cache = IdentityLRUCache(size)
+
+    def encode(self, obj):
+        """
+        Encode the given configuration object into bytes, using the cached
+        encoding if there is one.
+
+        :param obj: An object from the configuration model, e.g.
+            ``Deployment``.
+        :return bytes: Encoded object.
+        """
+        if not isinstance(obj, PRecord):
+            return self._encode(obj)
+        encoded = self._cache.get(obj)
+        if encoded is None:
+            encoded = self._encode(obj)
+            self._cache.set(obj, encoded)
+        return encoded
+
+
+_WIRE_ENCODE_CACHE = WireEncodeCache(
+    32, encode=partial(wire_encode, compact=True))
+
+
+def cached_wire_encode(obj):
+    """
+    Encode the given configuration object into bytes in the compact format,
+    only encoding any given immutable object once while it is recently
+    used.
+
+    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :return bytes: Encoded object.
+    """
+    return _WIRE_ENCODE_CACHE.encode(obj)
+
+
 _DEPLOYMENT_FIELD = Field(u"configuration", repr)
 _LOG_STARTUP = MessageType(u"flocker-control:persistence:startup",
                            [_DEPLOYMENT_FIELD])
 _LOG_SAVE = ActionType(u"flocker-control:persistence:save",
                        [_DEPLOYMENT_FIELD], [])
 
+# The file configuration was stored in before the change log was
+# introduced; it is still loaded if there is no change log:
+_V1_CONFIGURATION = b"current_configuration.v1.json"
+_CHANGE_LOG = b"current_configuration.v2.log"
+
+
+class _ChangeLog(object):
+    """
+    An append-only log of configuration changes on disk.
+
+    The first record in the log is a ``Deployment`` and each later record is
+    the ``DeploymentDiff`` made by one call to
+    ``ConfigurationPersistenceService.save``.  Records are in the default
+    wire format, one per line, since unlike the compact format it doesn't
+    depend on the exact definition of the model classes and so can be read
+    by later versions of Flocker.  Once the records appended to the log are
+    larger than the ``Deployment`` it starts with, it is compacted by
+    replacing it with a log containing just the latest ``Deployment``.
+
+    Only one method may run at a time, but they need not all run in the same
+    thread.
+
+    :ivar FilePath _path: The log file.
+    :ivar int _snapshot_size: The size of the first record in bytes.
+    :ivar _appended_size: The size in bytes of the records after the first,
+        or ``None`` if a failed write may have left a partial record in the
+        log so it must be compacted before anything else is appended.
+    """
+    def __init__(self, path):
+        """
+        :param FilePath path: The log file.
+        """
+        self._path = path
+        self._snapshot_size = 0
+        self._appended_size = 0
+
+    def exists(self):
+        """
+        :return bool: Whether the log file exists.
+        """
+        return self._path.exists()
+
+    def load(self):
+        """
+        Load the configuration by replaying the log.
+
+        A partial last record, left by a write which was interrupted, is
+        ignored.
+
+        :return Deployment: The configuration.
+        """
+        lines = self._path.getContent().split(b"\n")
+        # The last element is empty unless the last record is incomplete:
+        records = (wire_decode(line) for line in lines[:-1])
+        deployment = next(records)
+        for diff in records:
+            deployment = diff.apply(deployment)
+        return deployment
+
+    def compact(self, deployment):
+        """
+        Atomically replace the log with one containing just the given
+        configuration.
+
+        :param Deployment deployment: The configuration.
+        """
+        data = wire_encode(deployment) + b"\n"
+        temporary = self._path.temporarySibling()
+        with temporary.open("wb") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        temporary.moveTo(self._path)
+        # Make the rename itself durable:
+        directory = os_open(self._path.parent().path, O_RDONLY)
+        try:
+            fsync(directory)
+        finally:
+            close(directory)
+        self._snapshot_size = len(data)
+        self._appended_size = 0
+
+    def write(self, original, deployments):
+        """
+        Durably record a sequence of changes to the configuration, with a
+        single flush to disk.
+
+        The log is compacted instead of appended to if it has grown large.
+
+        :param Deployment original: The configuration as of the end of the
+            log.
+        :param list deployments: The ``Deployment`` made by each change, in
+            order.
+        """
+        # Until the write succeeds the log may end with a partial record:
+        appended_size, self._appended_size = self._appended_size, None
+        if appended_size is None or appended_size > self._snapshot_size:
+            self.compact(deployments[-1])
+            return
+        data = b"".join(
+            wire_encode(create_diff(previous, deployment)) + b"\n"
+            for previous, deployment in zip(
+                [original] + deployments, deployments))
+        with self._path.open("ab") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        self._appended_size = appended_size + len(data)
+
 
 class ConfigurationPersistenceService(Service):
     """
     Persist configuration to disk, and load it back.
 
+    Changes are appended to a ``_ChangeLog`` in a thread, so saving doesn't
+    block the reactor.  Changes saved while an earlier write is in progress
+    are written together afterwards, with a single flush to disk.  If a
+    write fails the configuration reverts to the last one written, and the
+    changes saved since, which build on the failed ones, fail too.
+
     :ivar Deployment _deployment: The current desired deployment configuration.
+    :ivar int _generation: Incremented every time the configuration
+        changes.
+    :ivar Deployment _written: The configuration as of the last change
+        given to the change log.
+    :ivar list _pending: ``(Deployment, Deferred)`` tuples for changes which
+        have not yet been given to the change log, and ``Deferred``
+        instances to fire once they are written.
+    :ivar bool _writing: Whether a write is in progress.
+    :ivar list _idle_waiters: ``Deferred`` instances to fire once there are
+        no changes left to write.
     """
     logger = Logger()
 
@@ -93,21 +454,44 @@ class ConfigurationPersistenceService(Service):
         :param FilePath path: Directory where desired deployment will be
             persisted.
         """
+        self._reactor = reactor
         self._path = path
         self._change_callbacks = []
+        self._generation = 0
+        self._pending = []
+        self._writing = False
+        self._idle_waiters = []
 
     def startService(self):
+        Service.startService(self)
         if not self._path.exists():
             self._path.makedirs()
-        self._config_path = self._path.child(b"current_configuration.v1.json")
-        if self._config_path.exists():
-            self._deployment = wire_decode(
-                self._config_path.getContent())
+        self._log = _ChangeLog(self._path.child(_CHANGE_LOG))
+        v1_path = self._path.child(_V1_CONFIGURATION)
+        if self._log.exists():
+            self._deployment = self._log.load()
+        elif v1_path.exists():
+            self._deployment = wire_decode(v1_path.getContent())
         else:
             self._deployment = Deployment(nodes=frozenset())
-            self._sync_save(self._deployment)
+        # Start with a fresh log, which also discards any partial record:
+        self._log.compact(self._deployment)
+        self._written = self._deployment
         _LOG_STARTUP(configuration=self.get()).write(self.logger)
 
+    def stopService(self):
+        """
+        Stop the service once all saved changes are written.
+
+        :return Deferred: Fires when all saved changes are written.
+        """
+        Service.stopService(self)
+        if not self._writing:
+            return succeed(None)
+        waiting = Deferred()
+        self._idle_waiters.append(waiting)
+        return waiting
+
     def register(self, change_callback):
         """
         Register a function to be called whenever the configuration changes.
@@ -117,32 +501,80 @@ class ConfigurationPersistenceService(Service):
         """
         self._change_callbacks.append(change_callback)
 
-    def _sync_save(self, deployment):
+    def _write(self):
+        """
+        Write all pending changes in a thread, unless a write is already in
+        progress, in which case they will be written once it finishes.
+        """
+        if self._writing:
+            return
+        if not self._pending:
+            waiters, self._idle_waiters = self._idle_waiters, []
+            for waiting in waiters:
+                waiting.callback(None)
+            return
+        pending, self._pending = self._pending, []
+        deployments = [deployment for deployment, _ in pending]
+        original, self._written = self._written, deployments[-1]
+        self._writing = True
+        writing = deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(),
+            self._log.write, original, deployments)
+
+        def written(result):
+            self._writing = False
+            for _, saved in pending:
+                saved.callback(None)
+            self._write()
+
+        def failed(reason):
+            write_failure(reason, self.logger, u"")
+            self._writing = False
+            failed_saves = pending + self._pending
+            self._pending = []
+            self._written = original
+            self._deployment = original
+            self._changed()
+            for _, saved in failed_saves:
+                saved.errback(reason)
+            self._write()
+        writing.addCallbacks(written, failed)
+
+    def _changed(self):
         """
-        Save and flush new deployment to disk synchronously.
+        Record a change to the configuration and tell the registered
+        callbacks about it.
         """
-        self._config_path.setContent(wire_encode(deployment))
+        self._generation += 1
+        for callback in self._change_callbacks:
+            try:
+                callback()
+            except:
+                # Second argument will be ignored in next Eliot release, so
+                # not bothering with particular value.
+                write_traceback(self.logger, u"")
 
     def save(self, deployment):
         """
         Save and flush new deployment to disk.
 
+        The new deployment is returned by ``get`` and registered callbacks
+        are called immediately, without waiting for the write.  If the write
+        fails the configuration reverts to the last one written, with a new
+        generation, and the callbacks are called again.
+
         :return Deferred: Fires when write is finished.
         """
         with _LOG_SAVE(self.logger, configuration=deployment):
-            self._sync_save(deployment)
+            saved = Deferred()
+            self._pending.append((deployment, saved))
             self._deployment = deployment
             # At some future point this will likely involve talking to a
             # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
             # guarantee immediate saving of the data.
-            for callback in self._change_callbacks:
-                try:
-                    callback()
-                except:
-                    # Second argument will be ignored in next Eliot release, so
-                    # not bothering with particular value.
-                    write_traceback(self.logger, u"")
-            return succeed(None)
+            self._changed()
+            self._write()
+            return saved
 
     def get(self):
         """
@@ -153,3 +585,12 @@ class ConfigurationPersistenceService(Service):
         :return Deployment: The current desired configuration.
         """
         return self._deployment
+
+    def generation(self):
+        """
+        Retrieve the generation of the current configuration.
+
+        :return int: A number which is incremented every time the
+            configuration changes.
+        """
+        return self._generation
@@ -11,7 +11,7 @@ Interactions:
 
 * The control service knows the desired configuration for the cluster.
   Every time it changes it notifies the convergence agents using the
-  ClusterStatusCommand.
+  ClusterStatusCommand or ClusterStatusDiffCommand.
 * The convergence agents know the state of nodes. Whenever node state
   changes they notify the control service with a NodeStateCommand.
 * The control service caches the current state of all nodes. Whenever the
@@ -19,12 +19,20 @@ Interactions:
   NodeStateCommand, the control service then aggregates that update with
   the rest of the nodes' state and sends a ClusterStatusCommand to all
   convergence agents.
+* Configuration and state each have a generation number. A newly connected
+  agent is sent the full configuration and state along with their
+  generations. Afterwards the control service only sends the differences
+  from the generations it last sent, using ClusterStatusDiffCommand. If the
+  agent doesn't hold the generations the differences are based on it
+  refuses the command and is sent the full configuration and state again.
 
 Eliot contexts are transferred along with AMP commands, allowing tracing
 of logged actions across processes (see
 http://eliot.readthedocs.org/en/0.6.0/threads.html).
 """
 
+from zlib import compress, decompressobj
+
 from eliot import Logger, ActionType, Action, Field
 from eliot.twisted import DeferredContext
 
@@ -34,19 +42,28 @@ from zope.interface import Interface, Attribute
 
 from twisted.application.service import Service
 from twisted.protocols.amp import (
-    Argument, Command, Integer, CommandLocator, AMP, Unicode, ListOf,
+    Argument, Command, Integer, CommandLocator, AMP, Unicode,
+    MAX_VALUE_LENGTH, TooLong,
 )
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import wire_encode, wire_decode
-from ._model import Deployment, NodeState, DeploymentState, NonManifestDatasets
+from ._persistence import wire_encode, cached_wire_encode, wire_decode
+from ._model import (
+    Deployment, NodeState, DeploymentState, NonManifestDatasets,
+    DeploymentDiff, DeploymentStateDiff, create_diff,
+)
 
 
 class SerializableArgument(Argument):
     """
     AMP argument that takes an object that can be serialized by the
     configuration persistence layer.
+
+    The compact format is used.  Decoded objects are created through the
+    model's normal constructors, so their field types and invariants are
+    checked: the other side of the connection may be an agent, whose input
+    the control service shouldn't trust.
     """
     def __init__(self, *classes):
         """
@@ -69,7 +86,98 @@ class SerializableArgument(Argument):
             raise TypeError(
                 "{} is none of {}".format(obj, self._expected_classes)
             )
-        return wire_encode(obj)
+        return cached_wire_encode(obj)
+
+
+class SerializableListArgument(SerializableArgument):
+    """
+    AMP argument that takes a list of objects that can be serialized by the
+    configuration persistence layer.
+
+    Unlike ``ListOf(SerializableArgument(...))`` the list is serialized as
+    a single value, so no individual element is limited to the maximum
+    size of an AMP value when combined with ``Big``.
+    """
+    def fromString(self, in_bytes):
+        objs = wire_decode(in_bytes)
+        if not isinstance(objs, list):
+            raise TypeError("{} is not a list".format(objs))
+        for obj in objs:
+            if not isinstance(obj, self._expected_classes):
+                raise TypeError(
+                    "{} is none of {}".format(obj, self._expected_classes)
+                )
+        return objs
+
+    def toString(self, objs):
+        for obj in objs:
+            if not isinstance(obj, self._expected_classes):
+                raise TypeError(
+                    "{} is none of {}".format(obj, self._expected_classes)
+                )
+        return wire_encode(list(objs), compact=True)
+
+
+# The largest size in bytes a compressed ``Big`` value received from a peer
+# may decompress to, so a small message can't make this process allocate
+# without bound:
+_MAX_DECOMPRESSED_LENGTH = 64 * 1024 * 1024
+
+
+class Big(Argument):
+    """
+    AMP argument that wraps another argument, allowing values that are
+    larger than the maximum size of an AMP value.
+
+    The encoded value is split into chunks of at most ``MAX_VALUE_LENGTH``
+    bytes which are stored under the keys ``<name>.1``, ``<name>.2`` and
+    so on, and joined back together when the box is received.
+    """
+    def __init__(self, argument, compression=False,
+                 max_length=_MAX_DECOMPRESSED_LENGTH):
+        """
+        :param Argument argument: The argument to use to encode and decode
+            the value.
+        :param bool compression: If true, the encoded value is compressed
+            with zlib before being split into chunks. Both sides of a
+            connection must agree on this, which they do as long as they
+            use the same command definition.
+        :param int max_length: If ``compression`` is true, the largest size
+            in bytes a received value may decompress to.  Larger values are
+            rejected with ``TooLong``.
+        """
+        Argument.__init__(self)
+        self.argument = argument
+        self.compression = compression
+        self.max_length = max_length
+
+    def toBox(self, name, strings, objects, proto):
+        value = self.argument.toStringProto(objects[name], proto)
+        if self.compression:
+            value = compress(value)
+        # Always send at least one chunk, so empty values round-trip:
+        chunks = range(0, len(value), MAX_VALUE_LENGTH) or [0]
+        for counter, start in enumerate(chunks, 1):
+            strings[b"%s.%d" % (name, counter)] = (
+                value[start:start + MAX_VALUE_LENGTH])
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = []
+        counter = 1
+        while True:
+            key = b"%s.%d" % (name, counter)
+            if key not in strings:
+                break
+            chunks.append(strings.pop(key))
+            counter += 1
+        value = b"".join(chunks)
+        if self.compression:
+            decompressor = decompressobj()
+            decompressed = decompressor.decompress(value, self.max_length)
+            if decompressor.unconsumed_tail:
+                raise TooLong(False, False, decompressed, name)
+            value = decompressed
+        objects[name] = self.argument.fromStringProto(value, proto)
 
 
 class _EliotActionArgument(Unicode):
@@ -95,6 +203,13 @@ class VersionCommand(Command):
     response = [('major', Integer())]
 
 
+class GenerationMismatch(Exception):
+    """
+    The convergence agent does not have the configuration or state
+    generation that a ``ClusterStatusDiffCommand`` is based on.
+    """
+
+
 class ClusterStatusCommand(Command):
     """
     Used by the control service to inform a convergence agent of the
@@ -102,11 +217,41 @@ class ClusterStatusCommand(Command):
 
     Having both as a single command simplifies the decision making process
     in the convergence agent during startup.
+
+    The response acknowledges the generations the agent now holds.
     """
-    arguments = [('configuration', SerializableArgument(Deployment)),
-                 ('state', SerializableArgument(DeploymentState)),
+    arguments = [('configuration', Big(SerializableArgument(Deployment),
+                                       compression=True)),
+                 ('configuration_generation', Integer()),
+                 ('state', Big(SerializableArgument(DeploymentState),
+                               compression=True)),
+                 ('state_generation', Integer()),
                  ('eliot_context', _EliotActionArgument())]
-    response = []
+    response = [('configuration_generation', Integer()),
+                ('state_generation', Integer())]
+
+
+class ClusterStatusDiffCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of changes
+    to the cluster state and desired configuration since the generations
+    previously sent to it.
+
+    The response acknowledges the generations the agent now holds.
+    """
+    arguments = [('configuration_diff',
+                  Big(SerializableArgument(DeploymentDiff),
+                      compression=True)),
+                 ('start_configuration_generation', Integer()),
+                 ('end_configuration_generation', Integer()),
+                 ('state_diff', Big(SerializableArgument(DeploymentStateDiff),
+                                    compression=True)),
+                 ('start_state_generation', Integer()),
+                 ('end_state_generation', Integer()),
+                 ('eliot_context', _EliotActionArgument())]
+    response = [('configuration_generation', Integer()),
+                ('state_generation', Integer())]
+    errors = {GenerationMismatch: b"GENERATION_MISMATCH"}
 
 
 class NodeStateCommand(Command):
@@ -115,8 +260,9 @@ class NodeStateCommand(Command):
     status of a particular node.
     """
     arguments = [
-        ('state_changes', ListOf(
-            SerializableArgument(NodeState, NonManifestDatasets))),
+        ('state_changes', Big(
+            SerializableListArgument(NodeState, NonManifestDatasets),
+            compression=True)),
         ('eliot_context', _EliotActionArgument())]
     response = []
 
@@ -182,6 +328,9 @@ LOG_SEND_CLUSTER_STATE = ActionType(
 
 AGENT = Field(u"agent", repr, u"The agent we're sending to")
 
+# How long to wait for more changes before sending changes to agents:
+DEFAULT_BROADCAST_WINDOW = 1.0
+
 LOG_SEND_TO_AGENT = ActionType(
     "flocker:controlservice:send_state_to_agent",
     [AGENT],
@@ -189,62 +338,186 @@ LOG_SEND_TO_AGENT = ActionType(
     "Send the configuration and state of the cluster to a specific agent.")
 
 
+def _is_empty_diff(configuration_diff, state_diff):
+    """
+    :param DeploymentDiff configuration_diff: Changes to the configuration.
+    :param DeploymentStateDiff state_diff: Changes to the cluster state.
+
+    :return bool: Whether neither configuration nor state has changed.
+    """
+    return not (configuration_diff.changed_nodes or
+                configuration_diff.removed_hostnames or
+                state_diff.changed_nodes or
+                state_diff.removed_hostnames or
+                state_diff.nonmanifest_datasets is not None)
+
+
 class ControlAMPService(Service):
     """
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    Changes to the configuration or cluster state are not sent immediately.
+    Instead a broadcast is scheduled ``broadcast_window`` seconds later, so
+    that all the changes that happen in the meantime (e.g. a burst of
+    agents reporting their state) are sent together.
+
+    :ivar dict _last_sent: Map ``ControlAMP`` connections to a tuple of the
+        configuration generation, configuration, state generation and
+        state last sent to them. Connections with no entry are sent the
+        full configuration and state.
+    :ivar _broadcast_call: The ``IDelayedCall`` for the scheduled broadcast,
+        or ``None`` if none is scheduled.
     """
     logger = Logger()
 
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    def __init__(self, reactor, cluster_state, configuration_service,
+                 endpoint, broadcast_window=DEFAULT_BROADCAST_WINDOW):
         """
+        :param reactor: An ``IReactorTime`` provider used to schedule
+            broadcasts.
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param float broadcast_window: How many seconds to wait after a
+            change before sending changes to connected agents.
         """
         self.connections = set()
+        self._last_sent = {}
+        self._reactor = reactor
+        self._broadcast_window = broadcast_window
+        self._broadcast_call = None
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
             endpoint, ServerFactory.forProtocol(lambda: ControlAMP(self)))
-        # When configuration changes, notify all connected clients:
-        self.configuration_service.register(
-            lambda: self._send_state_to_connections(self.connections))
+        # When configuration or cluster state changes, including when the
+        # state of a node expires, notify all connected clients:
+        self.configuration_service.register(self._schedule_broadcast)
+        self.cluster_state.register(self._schedule_broadcast)
 
     def startService(self):
         self.endpoint_service.startService()
 
     def stopService(self):
+        self.cluster_state.unregister(self._schedule_broadcast)
+        if self._broadcast_call is not None:
+            self._broadcast_call.cancel()
+            self._broadcast_call = None
         self.endpoint_service.stopService()
         for connection in self.connections:
             connection.transport.loseConnection()
 
+    def _schedule_broadcast(self):
+        """
+        Send the configuration and cluster state to all connections at the
+        end of the current broadcast window, starting a new window if
+        necessary.
+        """
+        if self._broadcast_call is None:
+            self._broadcast_call = self._reactor.callLater(
+                self._broadcast_window, self._broadcast)
+
+    def _broadcast(self):
+        """
+        Send the configuration and cluster state to all connections.
+        """
+        self._broadcast_call = None
+        self._send_state_to_connections(self.connections)
+
     def _send_state_to_connections(self, connections):
         """
         Send desired configuration and cluster state to all given connections.
 
+        Connections which were previously sent a configuration and state
+        are only sent the differences, and nothing is sent to them if
+        nothing has changed.
+
         :param connections: A collection of ``AMP`` instances.
         """
         configuration = self.configuration_service.get()
+        configuration_generation = self.configuration_service.generation()
         state = self.cluster_state.as_deployment()
+        state_generation = self.cluster_state.generation()
+        # Most connections were sent the same previous generations, so
+        # share the calculated differences between them:
+        diffs = {}
         with LOG_SEND_CLUSTER_STATE(self.logger,
                                     configuration=configuration,
                                     state=state):
             for connection in connections:
+                last_sent = self._last_sent.get(connection)
+                if last_sent is not None:
+                    (last_configuration_generation, last_configuration,
+                     last_state_generation, last_state) = last_sent
+                    key = (last_configuration_generation,
+                           last_state_generation)
+                    if key == (configuration_generation, state_generation):
+                        continue
+                    if key not in diffs:
+                        diffs[key] = (
+                            create_diff(last_configuration, configuration),
+                            create_diff(last_state, state))
+                    configuration_diff, state_diff = diffs[key]
+                    if _is_empty_diff(configuration_diff, state_diff):
+                        # Leave _last_sent alone, since that is still what
+                        # the agent holds:
+                        continue
                 action = LOG_SEND_TO_AGENT(self.logger, agent=connection)
                 with action.context():
-                    d = DeferredContext(connection.callRemote(
-                        ClusterStatusCommand,
-                        configuration=configuration,
-                        state=state,
-                        eliot_context=action
-                    ))
+                    self._last_sent[connection] = (
+                        configuration_generation, configuration,
+                        state_generation, state)
+                    if last_sent is None:
+                        sending = connection.callRemote(
+                            ClusterStatusCommand,
+                            configuration=configuration,
+                            configuration_generation=configuration_generation,
+                            state=state,
+                            state_generation=state_generation,
+                            eliot_context=action
+                        )
+                    else:
+                        sending = connection.callRemote(
+                            ClusterStatusDiffCommand,
+                            configuration_diff=configuration_diff,
+                            start_configuration_generation=(
+                                last_configuration_generation),
+                            end_configuration_generation=(
+                                configuration_generation),
+                            state_diff=state_diff,
+                            start_state_generation=last_state_generation,
+                            end_state_generation=state_generation,
+                            eliot_context=action
+                        )
+                    sending.addErrback(self._send_failed, connection)
+                    d = DeferredContext(sending)
                     d.addActionFinish()
                     d.result.addErrback(lambda _: None)
 
+    def _send_failed(self, reason, connection):
+        """
+        Sending configuration and state to a connection failed.
+
+        The connection is forgotten so that it is sent the full
+        configuration and state next time, immediately if the failure was
+        because it didn't have the generations the differences were based
+        on.
+
+        :param Failure reason: The reason the send failed.
+        :param ControlAMP connection: The connection it failed on.
+
+        :return: ``reason``, so the failure is logged.
+        """
+        self._last_sent.pop(connection, None)
+        if (reason.check(GenerationMismatch) and
+                connection in self.connections):
+            self._send_state_to_connections([connection])
+        return reason
+
     def connected(self, connection):
         """
         A new connection has been made to the server.
@@ -261,6 +534,7 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._last_sent.pop(connection, None)
 
     def node_changed(self, state_changes):
         """
@@ -271,7 +545,6 @@ class ControlAMPService(Service):
             providers representing the state change which has taken place.
         """
         self.cluster_state.apply_changes(state_changes)
-        self._send_state_to_connections(self.connections)
 
 
 class IConvergenceAgent(Interface):
@@ -310,6 +583,13 @@ class IConvergenceAgent(Interface):
 class _AgentLocator(CommandLocator):
     """
     Command locator for convergence agent.
+
+    :ivar _configuration: The latest ``Deployment`` received from the control
+        service, or ``None`` if none has been received yet.
+    :ivar _configuration_generation: The generation of ``_configuration``.
+    :ivar _state: The latest ``DeploymentState`` received from the control
+        service, or ``None`` if none has been received yet.
+    :ivar _state_generation: The generation of ``_state``.
     """
     def __init__(self, agent):
         """
@@ -317,6 +597,10 @@ class _AgentLocator(CommandLocator):
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self._configuration = None
+        self._configuration_generation = None
+        self._state = None
+        self._state_generation = None
 
     @property
     def logger(self):
@@ -325,11 +609,47 @@ class _AgentLocator(CommandLocator):
         """
         return self.agent.logger
 
+    def _update(self, configuration, configuration_generation,
+                state, state_generation):
+        """
+        Store new configuration and state and notify the agent.
+
+        :return: The response acknowledging the new generations.
+        """
+        self._configuration = configuration
+        self._configuration_generation = configuration_generation
+        self._state = state
+        self._state_generation = state_generation
+        self.agent.cluster_updated(configuration, state)
+        return {"configuration_generation": configuration_generation,
+                "state_generation": state_generation}
+
     @ClusterStatusCommand.responder
-    def cluster_updated(self, eliot_context, configuration, state):
+    def cluster_updated(self, eliot_context, configuration,
+                        configuration_generation, state, state_generation):
         with eliot_context:
-            self.agent.cluster_updated(configuration, state)
-            return {}
+            return self._update(configuration, configuration_generation,
+                                state, state_generation)
+
+    @ClusterStatusDiffCommand.responder
+    def cluster_diff_received(
+            self, eliot_context, configuration_diff,
+            start_configuration_generation, end_configuration_generation,
+            state_diff, start_state_generation, end_state_generation):
+        with eliot_context:
+            if ((start_configuration_generation, start_state_generation) !=
+                    (self._configuration_generation, self._state_generation)):
+                raise GenerationMismatch(
+                    "Have generations {}, differences are from {}".format(
+                        (self._configuration_generation,
+                         self._state_generation),
+                        (start_configuration_generation,
+                         start_state_generation)))
+            return self._update(
+                configuration_diff.apply(self._configuration),
+                end_configuration_generation,
+                state_diff.apply(self._state),
+                end_state_generation)
 
 
 class AgentAMP(AMP):
@@ -0,0 +1,105 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Let clients wait for changes to the cluster configuration or state.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, succeed
+
+
+# The number of recent versions to remember, so clients can be told what
+# changed since a version they know:
+_HISTORY_SIZE = 100
+
+
+class ChangeHistory(object):
+    """
+    The recent versions of some immutable data which is given a new
+    generation number every time it changes, e.g. the configuration or the
+    cluster state.
+
+    ``changed`` must be called every time the data changes, e.g. by
+    registering it with ``ConfigurationPersistenceService.register``.  The
+    data isn't retrieved until the first change or wait, so the history can
+    be created before the service providing the data is started.
+
+    :ivar OrderedDict _versions: Map generations to the data at that
+        generation, oldest first.
+    :ivar list _waiting: ``Deferred`` instances to fire on the next change.
+    """
+    def __init__(self, reactor, get_generation, get, size=_HISTORY_SIZE):
+        """
+        :param IReactorTime reactor: Reactor used for timeouts.
+        :param get_generation: A no-argument callable returning the current
+            generation of the data.
+        :param get: A no-argument callable returning the current data.
+        :param int size: The number of versions to remember.
+        """
+        self._reactor = reactor
+        self._get_generation = get_generation
+        self._get = get
+        self._size = size
+        self._versions = OrderedDict()
+        self._waiting = []
+
+    def changed(self):
+        """
+        Record the current version of the data and wake up anyone waiting
+        for a change.
+        """
+        generation = self._get_generation()
+        if generation in self._versions:
+            return
+        self._versions[generation] = self._get()
+        while len(self._versions) > self._size:
+            self._versions.popitem(last=False)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def _since(self, since):
+        """
+        :param int since: A generation.
+
+        :return: A tuple of the data at ``since``, or ``None`` if it is not
+            remembered, the current generation and the current data.
+        """
+        generation = next(reversed(self._versions))
+        return (self._versions.get(since), generation,
+                self._versions[generation])
+
+    def wait(self, since, timeout):
+        """
+        Wait until the data is newer than a given generation.
+
+        :param int since: The generation the caller already knows about.
+            If it is not a remembered generation other than the current one,
+            e.g. a generation from before the control service restarted, the
+            result is available immediately.
+        :param float timeout: The number of seconds after which to give up
+            waiting for a change.
+
+        :return Deferred: Fires with a tuple of the data at ``since``, or
+            ``None`` if it is not remembered, the current generation and the
+            current data.  If the timeout passes first the current
+            generation is ``since``.
+        """
+        self.changed()
+        if since != self._get_generation():
+            return succeed(self._since(since))
+        waiting = Deferred()
+        self._waiting.append(waiting)
+
+        def timed_out():
+            self._waiting.remove(waiting)
+            waiting.callback(None)
+        delayed = self._reactor.callLater(timeout, timed_out)
+
+        def woken(_):
+            if delayed.active():
+                delayed.cancel()
+            return self._since(since)
+        waiting.addCallback(woken)
+        return waiting
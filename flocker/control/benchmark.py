@@ -0,0 +1,454 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Benchmarks for the control service.
+
+Run with::
+
+    python -m flocker.control.benchmark [--size=<datasets>] [<benchmark>...]
+"""
+
+import sys
+from itertools import cycle
+from json import dumps
+from tempfile import mkdtemp
+from time import time
+from uuid import uuid4
+
+from twisted.python.filepath import FilePath
+from twisted.python.usage import Options, UsageError
+from twisted.protocols.amp import AmpBox, parseString
+from twisted.web.http import OK, NOT_FOUND
+from twisted.web.http_headers import Headers
+from twisted.web.resource import getChildForRequest
+
+from ..restapi.testtools import dummyRequest, render
+from ..testtools import FakeThreadsReactor
+
+from ._model import (
+    Application, Dataset, DockerImage, Manifestation, Node, NodeState, Port,
+    Deployment, DeploymentState,
+)
+from ._persistence import (
+    ConfigurationPersistenceService, wire_encode, wire_decode,
+)
+from ._protocol import Big, SerializableArgument
+from ._clusterstate import ClusterStateService
+from .httpapi import ConfigurationAPIUserV1
+
+
+def _make_nodes(node_type, datasets, datasets_per_node):
+    """
+    Create nodes with the given number of datasets between them.
+
+    :param node_type: ``Node`` or ``NodeState``.
+    :param int datasets: The total number of datasets.
+    :param int datasets_per_node: How many datasets each node has.
+
+    :return: A ``list`` of ``node_type`` instances.
+    """
+    nodes = []
+    for node_index in range(0, datasets, datasets_per_node):
+        manifestations = {}
+        for i in range(node_index,
+                       min(datasets, node_index + datasets_per_node)):
+            manifestation = Manifestation(
+                dataset=Dataset(dataset_id=unicode(uuid4()),
+                                metadata={u"name": u"dataset-%d" % (i,)}),
+                primary=True)
+            manifestations[manifestation.dataset_id] = manifestation
+        nodes.append(node_type(
+            # IPv4 addresses, as the REST API requires:
+            hostname=u"10.0.%d.%d" % divmod(
+                node_index // datasets_per_node, 256),
+            manifestations=manifestations))
+    return nodes
+
+
+def make_deployment_state(datasets, datasets_per_node=100):
+    """
+    Create a ``DeploymentState`` with the given number of datasets.
+
+    :param int datasets: The total number of datasets.
+    :param int datasets_per_node: How many datasets each node has.
+
+    :return DeploymentState: The state.
+    """
+    return DeploymentState(
+        nodes=_make_nodes(NodeState, datasets, datasets_per_node))
+
+
+def make_deployment(datasets, datasets_per_node=100):
+    """
+    Create a ``Deployment`` with the given number of datasets.
+
+    :param int datasets: The total number of datasets.
+    :param int datasets_per_node: How many datasets each node has.
+
+    :return Deployment: The configuration.
+    """
+    return Deployment(nodes=_make_nodes(Node, datasets, datasets_per_node))
+
+
+def measure(function, repeat=3):
+    """
+    Call a function several times and measure the fastest call.
+
+    :param function: A no-argument callable.
+    :param int repeat: How many times to call it.
+
+    :return: A tuple of the duration of the fastest call in seconds and
+        the result of the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time()
+        result = function()
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def benchmark_big_argument(size):
+    """
+    Measure the throughput of sending a cluster state through a ``Big``
+    AMP argument, with and without compression.
+
+    :param int size: The number of datasets in the cluster state.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    nodes = make_deployment_state(size).nodes
+    results = []
+    for compression in (False, True):
+        argument = Big(SerializableArgument(DeploymentState),
+                       compression=compression)
+
+        def encode():
+            # A new object every time, so the encoding isn't cached:
+            state = DeploymentState(nodes=nodes)
+            box = AmpBox()
+            argument.toBox(b"state", box, {b"state": state}, None)
+            return box.serialize()
+
+        def decode():
+            [box] = parseString(data)
+            objects = {}
+            argument.fromBox(b"state", box, objects, None)
+            return objects[b"state"]
+
+        encode_time, data = measure(encode)
+        decode_time, _ = measure(decode)
+        label = u"compressed" if compression else u"uncompressed"
+        results.extend([
+            (u"%s size" % (label,), len(data), u"bytes"),
+            (u"%s encode" % (label,), size / encode_time, u"datasets/s"),
+            (u"%s decode" % (label,), size / decode_time, u"datasets/s"),
+        ])
+    return results
+
+
+def benchmark_broadcast_encode(size, agents=50):
+    """
+    Measure the cost of encoding the cluster state for a broadcast to many
+    agents, for a range of cluster sizes.
+
+    :param int size: The number of datasets in the largest cluster state.
+    :param int agents: The number of agents the state is sent to.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    results = []
+    for datasets in (size // 100, size // 10, size):
+        argument = SerializableArgument(DeploymentState)
+
+        def broadcast():
+            # A new object every time, as on each change of state:
+            state = DeploymentState(nodes=nodes)
+            for _ in range(agents):
+                argument.toString(state)
+
+        def uncached_broadcast():
+            state = DeploymentState(nodes=nodes)
+            for _ in range(agents):
+                wire_encode(state)
+
+        nodes = make_deployment_state(datasets).nodes
+        cached_time, _ = measure(broadcast)
+        uncached_time, _ = measure(uncached_broadcast)
+        results.extend([
+            (u"%d datasets, %d agents, cached" % (datasets, agents),
+             cached_time * 1000, u"ms/broadcast"),
+            (u"%d datasets, %d agents, uncached" % (datasets, agents),
+             uncached_time * 1000, u"ms/broadcast"),
+        ])
+    return results
+
+
+def benchmark_codec(size):
+    """
+    Measure the speed and size of the default and compact encoding formats
+    for a cluster state.
+
+    :param int size: The number of datasets in the cluster state.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    state = make_deployment_state(size)
+    results = []
+    for label, compact in [(u"default", False), (u"compact", True)]:
+        encode_time, data = measure(lambda: wire_encode(state, compact))
+        decode_time, decoded = measure(lambda: wire_decode(data))
+        if decoded != state:
+            raise AssertionError("{} did not round-trip".format(label))
+        results.extend([
+            (u"%s size" % (label,), len(data), u"bytes"),
+            (u"%s encode" % (label,), size / encode_time, u"datasets/s"),
+            (u"%s decode" % (label,), size / decode_time, u"datasets/s"),
+        ])
+    return results
+
+
+def benchmark_nodes(size):
+    """
+    Measure the cost of looking up and updating nodes in a ``Deployment``
+    and a ``DeploymentState``.
+
+    :param int size: The number of datasets; the deployments have a node
+        for every ten datasets, e.g. 1,000 nodes for 10,000 datasets.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    hostnames = [u"node%d.example.com" % (i,) for i in range(size // 10)]
+    deployment = Deployment(nodes=[Node(hostname=hostname)
+                                   for hostname in hostnames])
+    state = DeploymentState(nodes=[NodeState(hostname=hostname)
+                                   for hostname in hostnames])
+
+    def get_nodes():
+        for hostname in hostnames:
+            deployment.get_node(hostname)
+            state.get_node(hostname)
+
+    node_updates = [Node(hostname=hostname, applications=[])
+                    for hostname in hostnames]
+    node_state_updates = [NodeState(hostname=hostname, used_ports=[80])
+                          for hostname in hostnames]
+
+    def update_nodes():
+        updated_deployment = deployment
+        updated_state = state
+        for node, node_state in zip(node_updates, node_state_updates):
+            updated_deployment = updated_deployment.update_node(node)
+            updated_state = updated_state.update_node(node_state)
+
+    operations = len(hostnames) * 2
+    get_time, _ = measure(get_nodes)
+    update_time, _ = measure(update_nodes)
+    return [
+        (u"%d nodes get_node" % (len(hostnames),),
+         get_time / operations * 1000000, u"us/call"),
+        (u"%d nodes update_node" % (len(hostnames),),
+         update_time / operations * 1000000, u"us/call"),
+    ]
+
+
+def benchmark_apply_changes(size):
+    """
+    Measure the cost of applying node state reports to a
+    ``ClusterStateService``, both when they change the state and when they
+    repeat what is already known.
+
+    :param int size: The number of datasets; there is a node for every ten
+        datasets, e.g. 1,000 nodes for 10,000 datasets.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    nodes = make_deployment_state(size, datasets_per_node=10).nodes.values()
+    changed = [node.set(used_ports=[80]) for node in nodes]
+    service = ClusterStateService()
+
+    def apply_unchanged():
+        service.apply_changes(nodes)
+
+    def apply_changed():
+        # Alternate between the two states, so every report is a change:
+        service.apply_changes(changed)
+        service.apply_changes(nodes)
+
+    service.apply_changes(nodes)
+    unchanged_time, _ = measure(apply_unchanged)
+    changed_time, _ = measure(apply_changed)
+    return [
+        (u"%d nodes unchanged" % (len(nodes),),
+         unchanged_time / len(nodes) * 1000000, u"us/node"),
+        (u"%d nodes changed" % (len(nodes),),
+         changed_time / (2 * len(nodes)) * 1000000, u"us/node"),
+    ]
+
+
+def benchmark_dataset_api(size, requests=20):
+    """
+    Measure the latency of dataset configuration REST API requests,
+    including writing the changed configuration to disk.
+
+    :param int size: The number of datasets in the configuration.
+    :param int requests: The number of requests of each kind to make.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    path = FilePath(mkdtemp())
+    # Writes are run in the current thread so they are measured:
+    reactor = FakeThreadsReactor()
+    try:
+        persistence_service = ConfigurationPersistenceService(
+            reactor, path.child(b"persistence"))
+        persistence_service.startService()
+        persistence_service.save(make_deployment(size))
+        reactor.threadpool.run_pending()
+        api = ConfigurationAPIUserV1(
+            persistence_service, ClusterStateService()).app.resource()
+        dataset_ids = [
+            dataset_id for node in persistence_service.get().nodes.values()
+            for dataset_id in node.manifestations][:requests]
+
+        def request(method, path, body, expected_code):
+            request = dummyRequest(
+                method, path,
+                Headers({b"content-type": [b"application/json"]}),
+                dumps(body))
+            render(getChildForRequest(api, request), request)
+            reactor.threadpool.run_pending()
+            if request.code != expected_code:
+                raise AssertionError(
+                    "{} {} failed: {}".format(method, path, request.code))
+
+        def update_datasets():
+            for i, dataset_id in enumerate(dataset_ids):
+                request(b"POST", b"/configuration/datasets/" +
+                        dataset_id.encode("ascii"),
+                        {u"maximum_size": 1024 * 1024 * (64 + i)}, OK)
+
+        def find_unknown_datasets():
+            for _ in dataset_ids:
+                request(b"DELETE", b"/configuration/datasets/" +
+                        unicode(uuid4()).encode("ascii"), {}, NOT_FOUND)
+
+        update_time, _ = measure(update_datasets)
+        unknown_time, _ = measure(find_unknown_datasets)
+        persistence_service.stopService()
+    finally:
+        path.remove()
+    return [
+        (u"%d datasets update" % (size,),
+         update_time / len(dataset_ids) * 1000, u"ms/request"),
+        (u"%d datasets unknown dataset" % (size,),
+         unknown_time / len(dataset_ids) * 1000, u"ms/request"),
+    ]
+
+
+def benchmark_state_api(size, requests=5):
+    """
+    Measure the latency of the REST API endpoints which describe the whole
+    cluster state, validating every response against its schema and
+    validating one in 100 responses.
+
+    :param int size: The number of datasets in the cluster state; there is
+        a container for every ten datasets.
+    :param int requests: The number of requests to make to each endpoint.
+
+    :return: A list of ``(description, value, unit)`` tuples.
+    """
+    nodes = []
+    for node in make_deployment_state(size).nodes.values():
+        dataset_ids = sorted(node.manifestations)
+        nodes.append(node.set(
+            paths=dict((dataset_id, FilePath(b"/flocker/" + dataset_id))
+                       for dataset_id in dataset_ids),
+            applications=[
+                Application(
+                    name=u"application-" + dataset_id,
+                    image=DockerImage.from_string(u"nginx"),
+                    ports=[Port(internal_port=80, external_port=8080)],
+                    environment={u"KEY": u"value"})
+                for dataset_id in dataset_ids[::10]]))
+    cluster_state_service = ClusterStateService()
+    cluster_state_service.apply_changes(nodes)
+    # Alternate between these to change the generation of the cluster state,
+    # so responses aren't cached:
+    changes = cycle([NodeState(hostname=u"10.255.255.255", used_ports=[]),
+                     NodeState(hostname=u"10.255.255.255", used_ports=[1])])
+
+    reactor = FakeThreadsReactor()
+    # Never started, since the configuration isn't used, so nothing is
+    # written to this path:
+    persistence_service = ConfigurationPersistenceService(
+        reactor, FilePath(b"/nonexistent"))
+
+    results = []
+    for interval in (1, 100):
+        api = ConfigurationAPIUserV1(
+            persistence_service, cluster_state_service, reactor,
+            output_validation_interval=interval).app.resource()
+        for path in (b"/state/datasets", b"/state/containers"):
+            def get():
+                for _ in range(requests):
+                    cluster_state_service.apply_changes([next(changes)])
+                    request = dummyRequest(b"GET", path, Headers())
+                    render(getChildForRequest(api, request), request)
+                    if request.code != OK:
+                        raise AssertionError(
+                            "GET {} failed: {}".format(path, request.code))
+
+            duration, _ = measure(get)
+            results.append((
+                u"%d datasets %s, validating 1 in %d" % (
+                    size, path.decode("ascii"), interval),
+                duration / requests * 1000, u"ms/request"))
+    return results
+
+
+BENCHMARKS = {
+    u"apply_changes": benchmark_apply_changes,
+    u"big_argument": benchmark_big_argument,
+    u"broadcast_encode": benchmark_broadcast_encode,
+    u"codec": benchmark_codec,
+    u"dataset_api": benchmark_dataset_api,
+    u"nodes": benchmark_nodes,
+    u"state_api": benchmark_state_api,
+}
+
+
+class BenchmarkOptions(Options):
+    """
+    Command line options for the control service benchmarks.
+    """
+    optParameters = [
+        ["size", None, 10000, "The number of datasets to use.", int],
+    ]
+
+    def parseArgs(self, *benchmarks):
+        for name in benchmarks:
+            if name not in BENCHMARKS:
+                raise UsageError("Unknown benchmark: {}".format(name))
+        self["benchmarks"] = sorted(benchmarks or BENCHMARKS)
+
+
+def main(argv, stdout):
+    """
+    Run the benchmarks and write the results.
+
+    :param list argv: Command line arguments.
+    :param stdout: File to write the results to.
+    """
+    options = BenchmarkOptions()
+    options.parseOptions(argv)
+    for name in options["benchmarks"]:
+        for description, value, unit in BENCHMARKS[name](options["size"]):
+            line = u"%s: %s: %.1f %s\n" % (name, description, value, unit)
+            stdout.write(line.encode("utf-8"))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:], sys.stdout)
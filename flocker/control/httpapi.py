@@ -4,6 +4,9 @@ A HTTP REST API for controlling the Dataset Manager.
 """
 
 import yaml
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from urllib import urlencode
 from uuid import uuid4
 
 from pyrsistent import pmap, thaw
@@ -15,19 +18,25 @@ from twisted.web.http import (
 )
 from twisted.web.server import Site
 from twisted.web.resource import Resource
-from twisted.application.internet import StreamServerEndpointService
+from twisted.application.internet import (
+    StreamServerEndpointService, TimerService)
+from twisted.application.service import MultiService
 
 from klein import Klein
 
 from pyrsistent import discard
 
+from ..common import IdentityLRUCache
 from ..restapi import (
-    EndpointResponse, structured, user_documentation, make_bad_request
+    EndpointResponse, structured, conditional, user_documentation,
+    make_bad_request, BadRequest, ResponseCache,
 )
 from . import (
     Dataset, Manifestation, Application, DockerImage, Port,
     AttachedVolume, Link
 )
+from ._model import create_diff
+from ._watch import ChangeHistory
 from ._config import (
     ApplicationMarshaller, FLOCKER_RESTART_POLICY_NAME_TO_POLICY,
     model_from_configuration, FigConfiguration, FlockerConfiguration,
@@ -80,6 +89,32 @@ DATASET_IN_USE = make_bad_request(
 
 _UNDEFINED_MAXIMUM_SIZE = object()
 
+# The number of seconds a request for changes waits before returning
+# without any:
+_WATCH_TIMEOUT = 30
+
+# The number of seconds between logging the statistics of the response
+# cache:
+_RESPONSE_CACHE_LOG_INTERVAL = 60
+
+
+def _configuration_generation(api):
+    """
+    :param ConfigurationAPIUserV1 api: The API.
+
+    :return int: The generation of the cluster configuration.
+    """
+    return api.persistence_service.generation()
+
+
+def _state_generation(api):
+    """
+    :param ConfigurationAPIUserV1 api: The API.
+
+    :return int: The generation of the cluster state.
+    """
+    return api.cluster_state_service.generation()
+
 
 class ConfigurationAPIUserV1(object):
     """
@@ -88,19 +123,61 @@ class ConfigurationAPIUserV1(object):
     The APIs exposed here typically operate on cluster configuration.  They
     frequently return success results when a configuration change has been made
     durable but has not yet been deployed onto the cluster.
+
+    :ivar ResponseCache response_cache: The encoded responses of the
+        configuration and state endpoints, which are only used until the
+        configuration or state changes.  Its hit and miss counts can be used
+        to monitor how effective it is.
     """
     app = Klein()
 
-    def __init__(self, persistence_service, cluster_state_service):
+    def __init__(self, persistence_service, cluster_state_service,
+                 reactor=None, output_validation_interval=1):
         """
         :param ConfigurationPersistenceService persistence_service: Service
             for retrieving and setting desired configuration.
 
         :param ClusterStateService cluster_state_service: Service that
             knows about the current state of the cluster.
+
+        :param IReactorTime reactor: Reactor used to time out requests
+            waiting for changes, by default the global reactor.
+
+        :param int output_validation_interval: Validate one in this many
+            responses of each endpoint against its output schema.
         """
+        if reactor is None:
+            from twisted.internet import reactor
         self.persistence_service = persistence_service
         self.cluster_state_service = cluster_state_service
+        self.output_validation_interval = output_validation_interval
+        self.response_cache = ResponseCache()
+        self._configuration_history = ChangeHistory(
+            reactor, persistence_service.generation, persistence_service.get)
+        persistence_service.register(self._configuration_history.changed)
+        self._state_history = ChangeHistory(
+            reactor, cluster_state_service.generation,
+            cluster_state_service.as_deployment)
+        cluster_state_service.register(self._state_history.changed)
+
+    def _apply(self, code, operation, **arguments):
+        """
+        Apply an operation to the configuration and save the result.
+
+        :param int code: The HTTP response code to use if the operation
+            succeeds.
+        :param operation: One of the functions in ``_BATCH_OPERATIONS``.
+        :param arguments: The operation's arguments.
+
+        :return: A ``Deferred`` that fires with an ``EndpointResponse`` with
+            the operation's result once the changed configuration is saved.
+        """
+        deployment = self.persistence_service.get()
+        new_deployment, result = operation(deployment, **arguments)
+        _derive_index(deployment, new_deployment)
+        saving = self.persistence_service.save(new_deployment)
+        saving.addCallback(lambda _: EndpointResponse(code, result))
+        return saving
 
     @app.route("/version", methods=['GET'])
     @user_documentation("""
@@ -121,25 +198,47 @@ class ConfigurationAPIUserV1(object):
     @user_documentation(
         """
         Get the cluster's dataset configuration.
+
+        Datasets are listed in order of their identifiers.  A large
+        configuration can be fetched a page at a time using the ``limit``
+        query argument; the ``Link`` header then gives the URL of the next
+        page.
         """,
-        examples=[u"get configured datasets"],
+        examples=[u"get configured datasets",
+                  u"get configured datasets page"],
     )
+    @conditional(_configuration_generation)
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref':
+            '/v1/endpoints.json#/definitions/configuration_datasets_query'},
         outputSchema={
             '$ref':
             '/v1/endpoints.json#/definitions/configuration_datasets_list',
         },
         schema_store=SCHEMAS,
     )
-    def get_dataset_configuration(self):
+    def get_dataset_configuration(self, primary=None, after=None,
+                                  limit=None, fields=None):
         """
         Get the configured datasets.
 
-        :return: A ``list`` of ``dict`` representing each of dataset
-            that is configured to exist anywhere on the cluster.
+        :param unicode primary: If not ``None``, only datasets whose primary
+            manifestation is on the node with this address are listed.
+        :param unicode after: If not ``None``, only datasets with greater
+            identifiers are listed.
+        :param unicode limit: If not ``None``, the maximum number of datasets
+            to list.
+        :param unicode fields: If not ``None``, a comma-separated list of
+            the properties to include for each dataset.
+
+        :return: An ``EndpointResponse`` with a ``list`` of ``dict``
+            representing each of dataset that is configured to exist
+            anywhere on the cluster.
         """
-        return list(datasets_from_deployment(self.persistence_service.get()))
+        return _list_page(
+            _primary_manifestations(self.persistence_service.get(), primary),
+            _configuration_dataset, after, limit, fields, primary=primary)
 
     @app.route("/configuration/datasets", methods=['POST'])
     @user_documentation(
@@ -193,44 +292,9 @@ class ConfigurationAPIUserV1(object):
             cluster configuration or giving error information if this is not
             possible.
         """
-        if dataset_id is None:
-            dataset_id = unicode(uuid4())
-        dataset_id = dataset_id.lower()
-
-        if metadata is None:
-            metadata = {}
-
-        # Use persistence_service to get a Deployment for the cluster
-        # configuration.
-        deployment = self.persistence_service.get()
-        for node in deployment.nodes:
-            for manifestation in node.manifestations.values():
-                if manifestation.dataset.dataset_id == dataset_id:
-                    raise DATASET_ID_COLLISION
-
-        # XXX Check cluster state to determine if the given primary node
-        # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
-        # See FLOC-1278
-
-        dataset = Dataset(
-            dataset_id=dataset_id,
-            maximum_size=maximum_size,
-            metadata=pmap(metadata)
-        )
-        manifestation = Manifestation(dataset=dataset, primary=True)
-
-        primary_node = deployment.get_node(primary)
-
-        new_node_config = primary_node.transform(
-            ("manifestations", manifestation.dataset_id), manifestation)
-        new_deployment = deployment.update_node(new_node_config)
-        saving = self.persistence_service.save(new_deployment)
-
-        def saved(ignored):
-            result = api_dataset_from_dataset_and_node(dataset, primary)
-            return EndpointResponse(CREATED, result)
-        saving.addCallback(saved)
-        return saving
+        return self._apply(
+            CREATED, _create_dataset, primary=primary, dataset_id=dataset_id,
+            maximum_size=maximum_size, metadata=metadata)
 
     @app.route("/configuration/datasets/<dataset_id>", methods=['DELETE'])
     @user_documentation(
@@ -263,27 +327,7 @@ class ConfigurationAPIUserV1(object):
             as deleted in the cluster configuration or giving error
             information if this is not possible.
         """
-        # Get the current configuration.
-        deployment = self.persistence_service.get()
-
-        # XXX this doesn't handle replicas
-        # https://clusterhq.atlassian.net/browse/FLOC-1240
-        old_manifestation, origin_node = _find_manifestation_and_node(
-            deployment, dataset_id)
-
-        new_node = origin_node.transform(
-            ("manifestations", dataset_id, "dataset", "deleted"), True)
-        deployment = deployment.update_node(new_node)
-
-        saving = self.persistence_service.save(deployment)
-
-        def saved(ignored):
-            result = api_dataset_from_dataset_and_node(
-                new_node.manifestations[dataset_id].dataset, new_node.hostname,
-            )
-            return EndpointResponse(OK, result)
-        saving.addCallback(saved)
-        return saving
+        return self._apply(OK, _delete_dataset, dataset_id=dataset_id)
 
     @app.route("/configuration/datasets/<dataset_id>", methods=['POST'])
     @user_documentation(
@@ -333,70 +377,40 @@ class ConfigurationAPIUserV1(object):
             cluster configuration or giving error information if this is not
             possible.
         """
-        # Get the current configuration.
-        deployment = self.persistence_service.get()
-
-        # Raises DATASET_NOT_FOUND if the ``dataset_id`` is not found.
-        primary_manifestation, current_node = _find_manifestation_and_node(
-            deployment, dataset_id
-        )
-
-        if primary_manifestation.dataset.deleted:
-            raise DATASET_DELETED
-
-        if primary is not None:
-            deployment = _update_dataset_primary(
-                deployment, dataset_id, primary
-            )
-
-        if maximum_size is not _UNDEFINED_MAXIMUM_SIZE:
-            deployment = _update_dataset_maximum_size(
-                deployment, dataset_id, maximum_size
-            )
-
-        saving = self.persistence_service.save(deployment)
-
-        primary_manifestation, current_node = _find_manifestation_and_node(
-            deployment, dataset_id
-        )
-
-        # Return an API response dictionary containing the dataset with updated
-        # primary address.
-        def saved(ignored):
-            result = api_dataset_from_dataset_and_node(
-                primary_manifestation.dataset,
-                current_node.hostname,
-            )
-            return EndpointResponse(OK, result)
-        saving.addCallback(saved)
-        return saving
+        return self._apply(
+            OK, _update_dataset, dataset_id=dataset_id, primary=primary,
+            maximum_size=maximum_size)
 
     @app.route("/state/datasets", methods=['GET'])
     @user_documentation("""
         Get current cluster datasets.
+
+        Datasets are listed in order of their identifiers and can be fetched
+        a page at a time using the ``limit`` query argument.
         """, examples=[u"get state datasets"])
+    @conditional(_state_generation)
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/state_datasets_query'},
         outputSchema={
-            '$ref': '/v1/endpoints.json#/definitions/state_datasets_array'
+            '$ref': '/v1/endpoints.json#/definitions/state_datasets_selection'
             },
         schema_store=SCHEMAS
     )
-    def state_datasets(self):
+    def state_datasets(self, primary=None, after=None, limit=None,
+                       fields=None):
         """
         Return the current primary datasets in the cluster.
 
-        :return: A ``list`` containing all datasets in the cluster.
+        The arguments are the same as those of ``get_dataset_configuration``.
+
+        :return: An ``EndpointResponse`` with a ``list`` containing all
+            datasets in the cluster.
         """
-        deployment = self.cluster_state_service.as_deployment()
-        datasets = list(datasets_from_deployment(deployment))
-        for dataset in datasets:
-            dataset[u"path"] = self.cluster_state_service.manifestation_path(
-                dataset[u"primary"], dataset[u"dataset_id"]).path.decode(
-                    "utf-8")
-            del dataset[u"metadata"]
-            del dataset[u"deleted"]
-        return datasets
+        return _list_page(
+            _primary_manifestations(
+                self.cluster_state_service.as_deployment(), primary),
+            _state_dataset, after, limit, fields, primary=primary)
 
     @app.route("/configuration/containers", methods=['GET'])
     @user_documentation(
@@ -407,6 +421,7 @@ class ConfigurationAPIUserV1(object):
         """,
         examples=[u"get configured containers"],
     )
+    @conditional(_configuration_generation)
     @structured(
         inputSchema={},
         outputSchema={
@@ -428,62 +443,41 @@ class ConfigurationAPIUserV1(object):
     @user_documentation(
         """
         Get the cluster's actual containers.
+
+        Containers are listed in order of their names and can be fetched a
+        page at a time using the ``limit`` query argument.
         """,
         examples=[u"get actual containers"],
     )
+    @conditional(_state_generation)
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/state_containers_query'},
         outputSchema={
             '$ref':
             '/v1/endpoints.json#/definitions/state_containers_array',
         },
         schema_store=SCHEMAS,
     )
-    def get_containers_state(self):
+    def get_containers_state(self, node=None, after=None, limit=None):
         """
         Get the containers present in the cluster.
 
-        :return: A ``list`` of ``dict`` representing each of the containers
-            that are configured to exist anywhere on the cluster.
-        """
-        result = []
-        deployment = self.cluster_state_service.as_deployment()
-        for node in deployment.nodes:
-            for application in node.applications:
-                container = container_configuration_response(
-                    application, node.hostname)
-                container[u"running"] = application.running
-                result.append(container)
-        return result
-
-    def _get_attached_volume(self, host, volume):
-        """
-        Create an ``AttachedVolume`` given a volume dictionary.
-
-        :param unicode host: The host where the volume should be.
-        :param dict volume: Parameters for specific volume passed to creation
-            endpoint.
+        :param unicode node: If not ``None``, only containers on the node
+            with this address are listed.
+        :param unicode after: If not ``None``, only containers with greater
+            names are listed.
+        :param unicode limit: If not ``None``, the maximum number of
+            containers to list.
 
-        :return AttachedVolume: Corresponding instance.
+        :return: An ``EndpointResponse`` with a generator of ``dict``
+            representing each of the containers that are configured to exist
+            anywhere on the cluster, so that they are encoded one at a time.
         """
-        deployment = self.persistence_service.get()
-
-        instances = list(manifestations_from_deployment(
-            deployment, volume[u"dataset_id"]))
-
-        if not any(m for (m, _) in instances if not m.dataset.deleted):
-            raise DATASET_NOT_FOUND
-        if not any(n for (_, n) in instances if n.hostname == host):
-            raise DATASET_ON_DIFFERENT_NODE
-        if any(app for app in deployment.applications() if
-                app.volume and
-                app.volume.manifestation.dataset_id == volume[u"dataset_id"]):
-            raise DATASET_IN_USE
-
-        return AttachedVolume(
-            manifestation=[m for (m, node) in instances
-                           if node.hostname == host and m.primary][0],
-            mountpoint=FilePath(volume[u"mountpoint"].encode("utf-8")))
+        return _list_page(
+            _node_applications(
+                self.cluster_state_service.as_deployment(), node),
+            _state_container, after, limit, stream=True, node=node)
 
     @app.route("/configuration/containers", methods=['POST'])
     @user_documentation(
@@ -560,98 +554,11 @@ class ConfigurationAPIUserV1(object):
         :return: An ``EndpointResponse`` describing the container which has
             been added to the cluster configuration.
         """
-        deployment = self.persistence_service.get()
-
-        # Check if container by this name already exists, if it does
-        # return error.
-        for node in deployment.nodes:
-            for application in node.applications:
-                if application.name == name:
-                    raise CONTAINER_NAME_COLLISION
-
-        # Find the volume, if any; currently we only support one volume
-        # https://clusterhq.atlassian.net/browse/FLOC-49
-        attached_volume = None
-        if volumes:
-            attached_volume = self._get_attached_volume(host, volumes[0])
-
-        # Find the node.
-        node = deployment.get_node(host)
-
-        # Check if we have any ports in the request. If we do, check existing
-        # external ports exposed to ensure there is no conflict. If there is a
-        # conflict, return an error.
-        for port in ports:
-            for current_node in deployment.nodes:
-                for application in current_node.applications:
-                    for application_port in application.ports:
-                        if application_port.external_port == port['external']:
-                            raise CONTAINER_PORT_COLLISION
-
-        # If links are present, check that there are no conflicts in local
-        # ports or alias names.
-        link_aliases = set()
-        link_local_ports = set()
-        application_links = set()
-        for link in links:
-            if link['alias'] in link_aliases:
-                raise LINK_ALIAS_COLLISION
-            if link['local_port'] in link_local_ports:
-                raise LINK_PORT_COLLISION
-            link_aliases.add(link['alias'])
-            link_local_ports.add(link['local_port'])
-            application_links.add(
-                Link(
-                    alias=link['alias'], local_port=link['local_port'],
-                    remote_port=link['remote_port']
-                )
-            )
-
-        # If we have ports specified, add these to the Application instance.
-        application_ports = []
-        for port in ports:
-            application_ports.append(Port(
-                internal_port=port['internal'],
-                external_port=port['external']
-            ))
-
-        if environment is not None:
-            environment = frozenset(environment.items())
-
-        if restart_policy is None:
-            restart_policy = dict(name=u"never")
-
-        policy_name = restart_policy.pop("name")
-        policy_factory = FLOCKER_RESTART_POLICY_NAME_TO_POLICY[policy_name]
-        policy = policy_factory(**restart_policy)
-
-        # Create Application object, add to Deployment, save.
-        application = Application(
-            name=name,
-            image=DockerImage.from_string(image),
-            ports=frozenset(application_ports),
-            environment=environment,
-            volume=attached_volume,
-            restart_policy=policy,
-            cpu_shares=cpu_shares,
-            memory_limit=memory_limit,
-            links=application_links
-        )
-
-        new_node_config = node.transform(
-            ["applications"],
-            lambda s: s.add(application)
-        )
-
-        new_deployment = deployment.update_node(new_node_config)
-        saving = self.persistence_service.save(new_deployment)
-
-        # Return passed in dictionary with CREATED response code.
-        def saved(_):
-            result = container_configuration_response(application, host)
-            return EndpointResponse(CREATED, result)
-        saving.addCallback(saved)
-        return saving
+        return self._apply(
+            CREATED, _create_container, host=host, name=name, image=image,
+            ports=ports, environment=environment,
+            restart_policy=restart_policy, cpu_shares=cpu_shares,
+            memory_limit=memory_limit, links=links, volumes=volumes)
 
     @app.route("/configuration/containers/<name>", methods=['POST'])
     @user_documentation(
@@ -688,27 +595,7 @@ class ConfigurationAPIUserV1(object):
         :return: An ``EndpointResponse`` describing the container which has
             been updated.
         """
-        deployment = self.persistence_service.get()
-        target_node = deployment.get_node(host)
-        for node in deployment.nodes:
-            for application in node.applications:
-                if application.name == name:
-                    deployment = deployment.move_application(
-                        application, target_node
-                    )
-                    saving = self.persistence_service.save(deployment)
-
-                    def saved(_):
-                        result = container_configuration_response(
-                            application, host
-                        )
-                        return EndpointResponse(OK, result)
-
-                    saving.addCallback(saved)
-                    return saving
-
-        # Didn't find the application:
-        raise CONTAINER_NOT_FOUND
+        return self._apply(OK, _update_container, name=name, host=host)
 
     @app.route("/configuration/containers/<name>", methods=['DELETE'])
     @user_documentation(
@@ -738,33 +625,158 @@ class ConfigurationAPIUserV1(object):
 
         :return: An ``EndpointResponse``.
         """
+        return self._apply(OK, _delete_container, name=name)
+
+    @app.route("/configuration/batch", methods=['POST'])
+    @user_documentation(
+        """
+        Make several changes to the configuration at once.
+
+        The operations are applied in order, each to the configuration as
+        changed by the operations before it.  Either all of the operations
+        succeed and the changed configuration is saved once, or the
+        configuration is left unchanged and the error response of the first
+        operation which failed is returned, with the index of the failed
+        operation added as ``operation``.
+        """,
+        examples=[
+            u"batch",
+            u"batch with failing operation",
+        ]
+    )
+    @structured(
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/configuration_batch'},
+        outputSchema={
+            '$ref':
+            '/v1/endpoints.json#/definitions/configuration_batch_results'},
+        schema_store=SCHEMAS
+    )
+    def batch_configuration(self, operations):
+        """
+        Apply a sequence of operations to the cluster configuration.
+
+        :param list operations: A ``list`` of ``dict`` objects, each with an
+            ``operation`` key naming one of ``_BATCH_OPERATIONS`` and an
+            ``arguments`` key giving the ``dict`` of arguments for it, as
+            for the corresponding single operation endpoint.
+
+        :return: An ``EndpointResponse`` with a ``dict`` whose ``results``
+            are a ``list`` of the results of the operations.
+        """
         deployment = self.persistence_service.get()
+        results = []
+        for index, operation in enumerate(operations):
+            apply_operation = _BATCH_OPERATIONS[operation[u"operation"]]
+            try:
+                new_deployment, result = apply_operation(
+                    deployment, **operation[u"arguments"])
+            except BadRequest as e:
+                raise BadRequest(e.code, dict(e.result, operation=index))
+            _derive_index(deployment, new_deployment)
+            deployment = new_deployment
+            results.append(result)
+        if not operations:
+            return EndpointResponse(OK, {u"results": results})
+        saving = self.persistence_service.save(deployment)
+        saving.addCallback(
+            lambda _: EndpointResponse(OK, {u"results": results}))
+        return saving
 
-        for node in deployment.nodes:
-            for application in node.applications:
-                if application.name == name:
-                    updated_node = node.transform(
-                        ["applications"], lambda s: s.remove(application))
-                    d = self.persistence_service.save(
-                        deployment.update_node(updated_node))
-                    d.addCallback(lambda _: None)
-                    return d
-
-        # Didn't find the application:
-        raise CONTAINER_NOT_FOUND
+    @app.route("/configuration/changes", methods=['GET'])
+    @user_documentation(
+        """
+        Wait for the cluster's configuration to change.
+
+        The response has the datasets and containers which were added or
+        changed since the configuration generation given by the ``since``
+        query argument, and the identifiers of those which were removed.  If
+        there were no changes the response is delayed until there are, or
+        until 30 seconds have passed.  Every response includes the current
+        generation to use as ``since`` in the next request.
+
+        If ``since`` is not given or is too old to be known, the response has
+        the whole configuration and ``complete`` is true.
+        """,
+        examples=[u"watch configuration"],
+    )
+    @structured(
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/changes_query'},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/configuration_changes'},
+        schema_store=SCHEMAS
+    )
+    def watch_configuration(self, since=None):
+        """
+        Wait for the configuration to change.
+
+        :param unicode since: The generation the client knows, if any.
+
+        :return: A ``Deferred`` that fires with a ``dict`` describing the
+            changed datasets and containers.
+        """
+        waiting = self._configuration_history.wait(
+            _generation_argument(since), _WATCH_TIMEOUT)
+        waiting.addCallback(
+            _describe_changes,
+            lambda deployment: list(datasets_from_deployment(deployment)),
+            lambda deployment: list(containers_from_deployment(deployment)))
+        return waiting
+
+    @app.route("/state/changes", methods=['GET'])
+    @user_documentation(
+        """
+        Wait for the cluster's state to change.
+
+        The response has the datasets and containers which were added or
+        changed since the state generation given by the ``since`` query
+        argument, and the identifiers of those which were removed.  If there
+        were no changes the response is delayed until there are, or until 30
+        seconds have passed.  Every response includes the current generation
+        to use as ``since`` in the next request.
+
+        If ``since`` is not given or is too old to be known, the response has
+        the whole state and ``complete`` is true.
+        """,
+        examples=[u"watch state"],
+    )
+    @structured(
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/changes_query'},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/state_changes'},
+        schema_store=SCHEMAS
+    )
+    def watch_state(self, since=None):
+        """
+        Wait for the cluster state to change.
+
+        :param unicode since: The generation the client knows, if any.
+
+        :return: A ``Deferred`` that fires with a ``dict`` describing the
+            changed datasets and containers.
+        """
+        waiting = self._state_history.wait(
+            _generation_argument(since), _WATCH_TIMEOUT)
+        waiting.addCallback(
+            _describe_changes, _state_datasets, _state_containers)
+        return waiting
 
     @app.route("/state/nodes", methods=['GET'])
     # To be done in https://clusterhq.atlassian.net/browse/FLOC-1632
     # @user_documentation(...)
     @structured(
-        inputSchema={},
+        inputSchema={"$ref":
+                     '/v1/endpoints.json#/definitions/nodes_query'},
         outputSchema={"$ref":
                       '/v1/endpoints.json#/definitions/nodes_array'},
         schema_store=SCHEMAS
     )
-    def list_current_nodes(self):
-        return [{u"hostname": node.hostname} for node in
-                self.cluster_state_service.as_deployment().nodes]
+    def list_current_nodes(self, after=None, limit=None):
+        return _list_page(
+            _node_hostnames(self.cluster_state_service.as_deployment()),
+            lambda hostname: {u"hostname": hostname}, after, limit)
 
     @app.route("/configuration/_compose", methods=['POST'])
     @user_documentation(
@@ -805,6 +817,511 @@ class ConfigurationAPIUserV1(object):
             raise make_bad_request(code=BAD_REQUEST, description=unicode(e))
 
 
+class DeploymentIndex(object):
+    """
+    Indexes of the datasets and applications in a ``Deployment`` or
+    ``DeploymentState``, so they can be looked up without walking every
+    node.
+
+    Use ``deployment_index`` to get the index of a ``Deployment`` or
+    ``DeploymentState``.  The maps are persistent, so an updated index
+    shares everything but the entries for the changed nodes with the index
+    it was derived from.  Nodes whose datasets or applications are unknown
+    contribute none.
+
+    :ivar PMap manifestations: Map dataset IDs to a ``tuple`` of
+        ``(Manifestation, Node)`` tuples, one for each node the dataset has a
+        manifestation on.
+    :ivar PMap applications: Map application names to a tuple of the
+        ``Application`` and the ``Node`` it is on.
+    :ivar PMap volumes: Map dataset IDs to the ``Application`` the dataset
+        is attached to.
+    :ivar PMap external_ports: Map external ports to the number of
+        applications using them.
+    :ivar dict _listings: Map the identifiers of listings built by
+        ``listing`` to the listing.
+    """
+    def __init__(self, manifestations, applications, volumes,
+                 external_ports):
+        self.manifestations = manifestations
+        self.applications = applications
+        self.volumes = volumes
+        self.external_ports = external_ports
+        self._listings = {}
+
+    @classmethod
+    def from_deployment(cls, deployment):
+        """
+        Index a ``Deployment``.
+
+        :param deployment: The ``Deployment`` or ``DeploymentState`` to
+            index.
+
+        :return DeploymentIndex: The index of the deployment.
+        """
+        evolving = _EMPTY_INDEX._evolver()
+        for node in deployment.nodes.values():
+            evolving._add_node(node)
+        return evolving._persistent()
+
+    def updated(self, original, updated):
+        """
+        Index a ``Deployment`` by re-indexing only the nodes that differ from
+        the one indexed by this index.
+
+        :param Deployment original: The configuration this is the index of.
+        :param Deployment updated: The configuration to index.
+
+        :return DeploymentIndex: The index of ``updated``.
+        """
+        diff = create_diff(original, updated)
+        evolving = self._evolver()
+        for hostname in diff.removed_hostnames:
+            evolving._remove_node(original.nodes[hostname])
+        for node in diff.changed_nodes:
+            previous = original.nodes.get(node.hostname)
+            if previous is not None:
+                evolving._remove_node(previous)
+            evolving._add_node(node)
+        return evolving._persistent()
+
+    def listing(self, name, entries):
+        """
+        Get a listing of some of the items of the indexed deployment, sorted
+        by key, building it the first time it is needed.
+
+        :param name: A hashable value identifying the listing.
+        :param entries: A no-argument callable returning an iterable of
+            tuples of the key of an item and the item, used to build the
+            listing.  Keys are unique.
+
+        :return: A tuple of a ``list`` of the sorted keys and a ``list`` of
+            the corresponding items.
+        """
+        listing = self._listings.get(name)
+        if listing is None:
+            listing = self._listings[name] = _sorted_listing(entries())
+        return listing
+
+    def _evolver(self):
+        """
+        :return: A ``DeploymentIndex`` whose maps are evolvers of this
+            index's maps, for ``_add_node`` and ``_remove_node`` to change.
+        """
+        return DeploymentIndex(
+            self.manifestations.evolver(), self.applications.evolver(),
+            self.volumes.evolver(), self.external_ports.evolver())
+
+    def _persistent(self):
+        """
+        :return: A ``DeploymentIndex`` of the persistent maps of this index
+            made by ``_evolver``.
+        """
+        return DeploymentIndex(
+            self.manifestations.persistent(), self.applications.persistent(),
+            self.volumes.persistent(), self.external_ports.persistent())
+
+    def _add_node(self, node):
+        """
+        Add a node's datasets and applications to an index made by
+        ``_evolver``.
+
+        :param node: The ``Node`` or ``NodeState`` to add.
+        """
+        for dataset_id, manifestation in (node.manifestations or {}).items():
+            self.manifestations[dataset_id] = _get(
+                self.manifestations, dataset_id, ()) + ((manifestation, node),)
+        for application in node.applications or ():
+            self.applications[application.name] = (application, node)
+            if application.volume is not None:
+                dataset_id = application.volume.manifestation.dataset_id
+                self.volumes[dataset_id] = application
+            for port in application.ports:
+                self.external_ports[port.external_port] = (
+                    _get(self.external_ports, port.external_port, 0) + 1)
+
+    def _remove_node(self, node):
+        """
+        Remove a node's datasets and applications from an index made by
+        ``_evolver``.
+
+        :param node: The ``Node`` or ``NodeState`` to remove, which must
+            have been added.
+        """
+        for dataset_id in node.manifestations or ():
+            remaining = tuple(
+                (manifestation, other_node) for (manifestation, other_node)
+                in self.manifestations[dataset_id] if other_node is not node)
+            if remaining:
+                self.manifestations[dataset_id] = remaining
+            else:
+                del self.manifestations[dataset_id]
+        for application in node.applications or ():
+            indexed = _get(self.applications, application.name)
+            if indexed is not None and indexed[1] is node:
+                del self.applications[application.name]
+            if application.volume is not None:
+                dataset_id = application.volume.manifestation.dataset_id
+                if _get(self.volumes, dataset_id) is application:
+                    del self.volumes[dataset_id]
+            for port in application.ports:
+                count = self.external_ports[port.external_port] - 1
+                if count:
+                    self.external_ports[port.external_port] = count
+                else:
+                    del self.external_ports[port.external_port]
+
+
+_EMPTY_INDEX = DeploymentIndex(pmap(), pmap(), pmap(), pmap())
+
+
+def _get(evolver, key, default=None):
+    """
+    Look up a key in a ``PMap`` evolver, which has no ``get`` method.
+
+    :param evolver: The evolver.
+    :param key: The key to look up.
+    :param default: The value if ``key`` is missing.
+
+    :return: The value of ``key``, or ``default``.
+    """
+    if key in evolver:
+        return evolver[key]
+    return default
+
+
+def _sorted_listing(entries):
+    """
+    :param entries: An iterable of tuples of the unique key of an item and
+        the item.
+
+    :return: A tuple of a ``list`` of the sorted keys and a ``list`` of the
+        corresponding items.
+    """
+    entries = sorted(entries, key=itemgetter(0))
+    return [key for key, _ in entries], [item for _, item in entries]
+
+
+# The number of recently used configurations and cluster states whose index
+# is kept:
+_DEPLOYMENT_INDEX_CACHE_SIZE = 8
+
+# The indexes of recently used deployments:
+_DEPLOYMENT_INDEXES = IdentityLRUCache(_DEPLOYMENT_INDEX_CACHE_SIZE)
+
+
+def deployment_index(deployment):
+    """
+    Get the index of a ``Deployment`` or ``DeploymentState``.
+
+    The index is built the first time it is needed and reused while the
+    deployment is one of the few most recently used.  Since a
+    ``Deployment`` is immutable its index never needs to be invalidated; a
+    changed configuration is a new ``Deployment`` with its own index.
+
+    :param deployment: The ``Deployment`` or ``DeploymentState`` to index.
+
+    :return DeploymentIndex: The index of the deployment.
+    """
+    index = _DEPLOYMENT_INDEXES.get(deployment)
+    if index is None:
+        index = DeploymentIndex.from_deployment(deployment)
+        _DEPLOYMENT_INDEXES.set(deployment, index)
+    return index
+
+
+def _derive_index(original, updated):
+    """
+    Index a changed ``Deployment`` incrementally, if the index of the one it
+    was changed from is known.
+
+    :param Deployment original: The configuration before the change.
+    :param Deployment updated: The configuration after the change.
+    """
+    index = _DEPLOYMENT_INDEXES.get(original)
+    if index is not None and updated is not original:
+        _DEPLOYMENT_INDEXES.set(updated, index.updated(original, updated))
+
+
+def _create_dataset(deployment, primary, dataset_id=None, maximum_size=None,
+                    metadata=None):
+    """
+    Add a new dataset to the configuration.
+
+    :param Deployment deployment: The configuration to change.
+
+    The other parameters are as for
+    ``ConfigurationAPIUserV1.create_dataset_configuration``.
+
+    :return: Tuple of the changed ``Deployment`` and a ``dict`` describing
+        the new dataset.
+    """
+    if dataset_id is None:
+        dataset_id = unicode(uuid4())
+    dataset_id = dataset_id.lower()
+
+    if metadata is None:
+        metadata = {}
+
+    if dataset_id in deployment_index(deployment).manifestations:
+        raise DATASET_ID_COLLISION
+
+    # XXX Check cluster state to determine if the given primary node
+    # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
+    # See FLOC-1278
+
+    dataset = Dataset(
+        dataset_id=dataset_id,
+        maximum_size=maximum_size,
+        metadata=pmap(metadata)
+    )
+    manifestation = Manifestation(dataset=dataset, primary=True)
+
+    primary_node = deployment.get_node(primary)
+
+    new_node_config = primary_node.transform(
+        ("manifestations", manifestation.dataset_id), manifestation)
+    new_deployment = deployment.update_node(new_node_config)
+    return new_deployment, api_dataset_from_dataset_and_node(dataset, primary)
+
+
+def _delete_dataset(deployment, dataset_id):
+    """
+    Mark a dataset as deleted in the configuration.
+
+    :param Deployment deployment: The configuration to change.
+    :param unicode dataset_id: The unique identifier of the dataset.
+
+    :return: Tuple of the changed ``Deployment`` and a ``dict`` describing
+        the deleted dataset.
+    """
+    # XXX this doesn't handle replicas
+    # https://clusterhq.atlassian.net/browse/FLOC-1240
+    old_manifestation, origin_node = _find_manifestation_and_node(
+        deployment, dataset_id)
+
+    new_node = origin_node.transform(
+        ("manifestations", dataset_id, "dataset", "deleted"), True)
+    deployment = deployment.update_node(new_node)
+    return deployment, api_dataset_from_dataset_and_node(
+        new_node.manifestations[dataset_id].dataset, new_node.hostname,
+    )
+
+
+def _update_dataset(deployment, dataset_id, primary=None,
+                    maximum_size=_UNDEFINED_MAXIMUM_SIZE):
+    """
+    Change the configuration of a dataset.
+
+    :param Deployment deployment: The configuration to change.
+
+    The other parameters are as for ``ConfigurationAPIUserV1.update_dataset``.
+
+    :return: Tuple of the changed ``Deployment`` and a ``dict`` describing
+        the updated dataset.
+    """
+    # Raises DATASET_NOT_FOUND if the ``dataset_id`` is not found.
+    primary_manifestation, current_node = _find_manifestation_and_node(
+        deployment, dataset_id
+    )
+
+    if primary_manifestation.dataset.deleted:
+        raise DATASET_DELETED
+
+    if primary is not None:
+        deployment = _update_dataset_primary(
+            deployment, dataset_id, primary
+        )
+        current_node = deployment.get_node(primary)
+
+    if maximum_size is not _UNDEFINED_MAXIMUM_SIZE:
+        deployment = _update_dataset_maximum_size(
+            deployment, current_node.hostname, dataset_id, maximum_size
+        )
+        current_node = deployment.get_node(current_node.hostname)
+
+    primary_manifestation = current_node.manifestations[dataset_id]
+    return deployment, api_dataset_from_dataset_and_node(
+        primary_manifestation.dataset,
+        current_node.hostname,
+    )
+
+
+def _get_attached_volume(deployment, host, volume):
+    """
+    Create an ``AttachedVolume`` given a volume dictionary.
+
+    :param Deployment deployment: The configuration the volume's dataset is
+        in.
+    :param unicode host: The host where the volume should be.
+    :param dict volume: Parameters for specific volume passed to creation
+        endpoint.
+
+    :return AttachedVolume: Corresponding instance.
+    """
+    instances = list(manifestations_from_deployment(
+        deployment, volume[u"dataset_id"]))
+
+    if not any(m for (m, _) in instances if not m.dataset.deleted):
+        raise DATASET_NOT_FOUND
+    if not any(n for (_, n) in instances if n.hostname == host):
+        raise DATASET_ON_DIFFERENT_NODE
+    if volume[u"dataset_id"] in deployment_index(deployment).volumes:
+        raise DATASET_IN_USE
+
+    return AttachedVolume(
+        manifestation=[m for (m, node) in instances
+                       if node.hostname == host and m.primary][0],
+        mountpoint=FilePath(volume[u"mountpoint"].encode("utf-8")))
+
+
+def _create_container(deployment, host, name, image, ports=(),
+                      environment=None, restart_policy=None, cpu_shares=None,
+                      memory_limit=None, links=(), volumes=()):
+    """
+    Add a new container to the configuration.
+
+    :param Deployment deployment: The configuration to change.
+
+    The other parameters are as for
+    ``ConfigurationAPIUserV1.create_container_configuration``.
+
+    :return: Tuple of the changed ``Deployment`` and a ``dict`` describing
+        the new container.
+    """
+    index = deployment_index(deployment)
+
+    # Check if container by this name already exists, if it does
+    # return error.
+    if name in index.applications:
+        raise CONTAINER_NAME_COLLISION
+
+    # Find the volume, if any; currently we only support one volume
+    # https://clusterhq.atlassian.net/browse/FLOC-49
+    attached_volume = None
+    if volumes:
+        attached_volume = _get_attached_volume(deployment, host, volumes[0])
+
+    # Find the node.
+    node = deployment.get_node(host)
+
+    # Check if we have any ports in the request. If we do, check existing
+    # external ports exposed to ensure there is no conflict. If there is a
+    # conflict, return an error.
+    for port in ports:
+        if port['external'] in index.external_ports:
+            raise CONTAINER_PORT_COLLISION
+
+    # If links are present, check that there are no conflicts in local
+    # ports or alias names.
+    link_aliases = set()
+    link_local_ports = set()
+    application_links = set()
+    for link in links:
+        if link['alias'] in link_aliases:
+            raise LINK_ALIAS_COLLISION
+        if link['local_port'] in link_local_ports:
+            raise LINK_PORT_COLLISION
+        link_aliases.add(link['alias'])
+        link_local_ports.add(link['local_port'])
+        application_links.add(
+            Link(
+                alias=link['alias'], local_port=link['local_port'],
+                remote_port=link['remote_port']
+            )
+        )
+
+    # If we have ports specified, add these to the Application instance.
+    application_ports = []
+    for port in ports:
+        application_ports.append(Port(
+            internal_port=port['internal'],
+            external_port=port['external']
+        ))
+
+    if environment is not None:
+        environment = frozenset(environment.items())
+
+    if restart_policy is None:
+        restart_policy = dict(name=u"never")
+
+    policy_name = restart_policy.pop("name")
+    policy_factory = FLOCKER_RESTART_POLICY_NAME_TO_POLICY[policy_name]
+    policy = policy_factory(**restart_policy)
+
+    # Create Application object, add to Deployment.
+    application = Application(
+        name=name,
+        image=DockerImage.from_string(image),
+        ports=frozenset(application_ports),
+        environment=environment,
+        volume=attached_volume,
+        restart_policy=policy,
+        cpu_shares=cpu_shares,
+        memory_limit=memory_limit,
+        links=application_links
+    )
+
+    new_node_config = node.transform(
+        ["applications"],
+        lambda s: s.add(application)
+    )
+
+    new_deployment = deployment.update_node(new_node_config)
+    return new_deployment, container_configuration_response(application, host)
+
+
+def _update_container(deployment, name, host):
+    """
+    Move a container to another node.
+
+    :param Deployment deployment: The configuration to change.
+    :param unicode name: The name of the container.
+    :param unicode host: The address of the node on which the container
+        will run.
+
+    :return: Tuple of the changed ``Deployment`` and a ``dict`` describing
+        the container.
+    """
+    target_node = deployment.get_node(host)
+    try:
+        application, _ = deployment_index(deployment).applications[name]
+    except KeyError:
+        raise CONTAINER_NOT_FOUND
+    deployment = deployment.move_application(application, target_node)
+    return deployment, container_configuration_response(application, host)
+
+
+def _delete_container(deployment, name):
+    """
+    Remove a container from the configuration.
+
+    :param Deployment deployment: The configuration to change.
+    :param unicode name: The name of the container.
+
+    :return: Tuple of the changed ``Deployment`` and ``None``.
+    """
+    try:
+        application, node = deployment_index(deployment).applications[name]
+    except KeyError:
+        raise CONTAINER_NOT_FOUND
+    updated_node = node.transform(
+        ["applications"], lambda s: s.remove(application))
+    return deployment.update_node(updated_node), None
+
+
+# The operations which can be applied by a batch, and the functions which
+# apply them:
+_BATCH_OPERATIONS = {
+    u"create_dataset": _create_dataset,
+    u"update_dataset": _update_dataset,
+    u"delete_dataset": _delete_dataset,
+    u"create_container": _create_container,
+    u"update_container": _update_container,
+    u"delete_container": _delete_container,
+}
+
+
 def _find_manifestation_and_node(deployment, dataset_id):
     """
     Given the ID of a dataset, find its primary manifestation and the node
@@ -870,25 +1387,26 @@ def _update_dataset_primary(deployment, dataset_id, primary):
     return deployment
 
 
-def _update_dataset_maximum_size(deployment, dataset_id, maximum_size):
+def _update_dataset_maximum_size(deployment, hostname, dataset_id,
+                                 maximum_size):
     """
     Update the ``deployment`` so that the ``Dataset`` with the supplied
     ``dataset_id`` has the supplied ``maximum_size``.
 
     :param Deployment deployment: The deployment containing the dataset to be
         updated.
+    :param unicode hostname: The hostname of the node with the primary
+        manifestation of the dataset.
     :param unicode dataset_id: The ID of the dataset to be updated.
     :param maximum_size: The new size of the dataset or ``None`` to remove the
         size limit.
     :returns: An updated ``Deployment``.
     """
-    manifestation, node = _find_manifestation_and_node(deployment, dataset_id)
-    deployment = deployment.set(nodes=deployment.nodes.discard(node))
-    node = node.transform(
+    node = deployment.get_node(hostname).transform(
         ['manifestations', dataset_id, 'dataset', 'maximum_size'],
         maximum_size
     )
-    return deployment.set(nodes=deployment.nodes.add(node))
+    return deployment.update_node(node)
 
 
 def manifestations_from_deployment(deployment, dataset_id):
@@ -903,9 +1421,8 @@ def manifestations_from_deployment(deployment, dataset_id):
     :return: Iterable returning all manifestations of the supplied
         ``dataset_id``.
     """
-    for node in deployment.nodes:
-        if dataset_id in node.manifestations:
-                yield node.manifestations[dataset_id], node
+    return iter(deployment_index(deployment).manifestations.get(
+        dataset_id, []))
 
 
 def datasets_from_deployment(deployment):
@@ -921,7 +1438,7 @@ def datasets_from_deployment(deployment):
 
     :return: Iterable returning all datasets.
     """
-    for node in deployment.nodes:
+    for node in deployment.nodes.values():
         for manifestation in node.manifestations.values():
             if manifestation.primary:
                 # There may be multiple datasets marked as primary until we
@@ -942,11 +1459,321 @@ def containers_from_deployment(deployment):
 
     :return: Iterable returning all containers.
     """
-    for node in deployment.nodes:
+    for node in deployment.nodes.values():
         for application in node.applications:
             yield container_configuration_response(application, node.hostname)
 
 
+def _selected_nodes(deployment, hostname):
+    """
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+    :param hostname: The address of a node, or ``None``.
+
+    :return: A ``list`` of the node with the given address, looked up
+        directly rather than by searching all nodes, or of all nodes if
+        ``hostname`` is ``None``.
+    """
+    if hostname is None:
+        return deployment.nodes.values()
+    node = deployment.nodes.get(hostname)
+    if node is None:
+        return []
+    return [node]
+
+
+def _primary_manifestations(deployment, primary=None):
+    """
+    Find the primary manifestations in a configuration or state.
+
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+    :param primary: If not ``None``, the address of the only node to look
+        at.
+
+    :return: A listing, as returned by ``DeploymentIndex.listing``, of
+        tuples of the primary ``Manifestation`` of a dataset and the node
+        it is on.  The key is a tuple of the dataset identifier and the
+        node's address, which is unique even if several nodes report being
+        primary for the same dataset.  Nodes whose manifestations are
+        unknown are skipped.  The listing is only built once for each
+        deployment and node.
+    """
+    return deployment_index(deployment).listing(
+        (u"primary_manifestations", primary), lambda: (
+            ((manifestation.dataset_id, node.hostname),
+             (manifestation, node))
+            for node in _selected_nodes(deployment, primary)
+            if node.manifestations is not None
+            for manifestation in node.manifestations.values()
+            if manifestation.primary))
+
+
+def _node_applications(deployment, hostname=None):
+    """
+    Find the applications in a configuration or state.
+
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+    :param hostname: If not ``None``, the address of the only node to look
+        at.
+
+    :return: A listing, as returned by ``DeploymentIndex.listing``, of
+        tuples of an ``Application`` and the node it is on.  The key is a
+        tuple of the application name and the node's address, which is
+        unique even while an application is on several nodes.  Nodes whose
+        applications are unknown are skipped.  The listing is only built
+        once for each deployment and node.
+    """
+    return deployment_index(deployment).listing(
+        (u"node_applications", hostname), lambda: (
+            ((application.name, node.hostname), (application, node))
+            for node in _selected_nodes(deployment, hostname)
+            if node.applications is not None
+            for application in node.applications))
+
+
+def _node_hostnames(deployment):
+    """
+    Find the addresses of the nodes in a configuration or state.
+
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+
+    :return: A listing, as returned by ``DeploymentIndex.listing``, of
+        one-element tuples of the address of each node.  The key is also a
+        one-element tuple of the address.  The listing is only built once
+        for each deployment.
+    """
+    return deployment_index(deployment).listing(
+        u"node_hostnames", lambda: (
+            ((hostname,), (hostname,)) for hostname in deployment.nodes))
+
+
+def _configuration_dataset(manifestation, node):
+    """
+    :return: A ``dict`` describing the configuration of the dataset of a
+        primary manifestation on a node.
+    """
+    return api_dataset_from_dataset_and_node(
+        manifestation.dataset, node.hostname)
+
+
+def _state_dataset(manifestation, node):
+    """
+    :return: A ``dict`` describing the state of the dataset of a primary
+        manifestation on a node.
+    """
+    result = {
+        u"dataset_id": manifestation.dataset_id,
+        u"primary": node.hostname,
+        u"path": node.paths[manifestation.dataset_id].path.decode("utf-8"),
+    }
+    if manifestation.dataset.maximum_size is not None:
+        result[u"maximum_size"] = manifestation.dataset.maximum_size
+    return result
+
+
+def _state_container(application, node):
+    """
+    :return: A ``dict`` describing the state of an application on a node.
+    """
+    container = container_configuration_response(application, node.hostname)
+    container[u"running"] = application.running
+    return container
+
+
+def _list_page(listing, describe, after=None, limit=None, fields=None,
+               stream=False, **filters):
+    """
+    Describe one page of a list of items for a list endpoint.
+
+    Only the items on the page are described, so the cost of a request for
+    a page does not depend on the size of the descriptions of the other
+    items.
+
+    :param listing: A listing, as returned by ``DeploymentIndex.listing``,
+        of tuples of the arguments to pass to ``describe`` to describe each
+        item.  Keys are unique tuples of ``unicode``, all of the same
+        length.
+    :param describe: Callable returning a ``dict`` describing an item.
+    :param unicode after: If not ``None``, only items with greater keys are
+        included; see ``_after_index``.
+    :param unicode limit: If not ``None``, the maximum number of items to
+        include, as a decimal string.
+    :param unicode fields: If not ``None``, a comma-separated list of the
+        keys of the descriptions to include.
+    :param bool stream: If true, describe the items as they are written to
+        the response rather than all at once.  Such responses can't be
+        cached by ``conditional``.
+    :param filters: The other query arguments of the request, with ``None``
+        for those which were not given.
+
+    :return: An ``EndpointResponse`` with a ``list``, or a generator if
+        ``stream`` is true, of the descriptions of the items on the page
+        and, if there are more items, a ``Link`` header giving the URL of the
+        next page.
+    """
+    keys, items = listing
+    start = 0
+    if after is not None:
+        start = _after_index(keys, after)
+    end = len(items)
+    if limit is not None:
+        end = min(start + int(limit), end)
+    page = (describe(*arguments) for arguments in items[start:end])
+    if fields is not None:
+        selected = fields.split(u",")
+        page = (dict((field, item[field])
+                     for field in selected if field in item)
+                for item in page)
+    if not stream:
+        page = list(page)
+    headers = {}
+    if end < len(items):
+        query = dict(filters, after=_cursor(keys, end),
+                     limit=limit, fields=fields)
+        headers[b"link"] = [b'<?%s>; rel="next"' % (urlencode(sorted(
+            (name, value.encode("utf-8"))
+            for (name, value) in query.items() if value is not None)),)]
+    return EndpointResponse(OK, page, headers)
+
+
+# Separates the parts of a key in the ``after`` cursor of a list endpoint;
+# it can't appear in a node address, a dataset identifier or a container
+# name:
+_CURSOR_SEPARATOR = u"@"
+
+
+def _cursor(keys, end):
+    """
+    Make the ``after`` cursor for the page of a list ending before an item.
+
+    :param list keys: The unique keys of the items, sorted.
+    :param int end: The index of the first item of the next page.
+
+    :return unicode: Just the first part of the key of the last item of the
+        page if the next item's key differs in it, otherwise all the parts
+        joined by ``_CURSOR_SEPARATOR``.
+    """
+    last = keys[end - 1]
+    if keys[end][0] != last[0]:
+        return last[0]
+    return _CURSOR_SEPARATOR.join(last)
+
+
+def _after_index(keys, after):
+    """
+    Find where the items after a cursor start in a page of a list.
+
+    :param list keys: The unique keys of the items, sorted.
+    :param unicode after: The parts of the key of the last item of the
+        previous page, joined by ``_CURSOR_SEPARATOR``.  Just the first part,
+        e.g. the dataset identifier or container name, stands for all the
+        items with that first part.
+
+    :return int: The index of the first item after the cursor.
+    """
+    if not keys:
+        return 0
+    cursor = tuple(after.split(_CURSOR_SEPARATOR, len(keys[0]) - 1))
+    if len(cursor) < len(keys[0]):
+        # The smallest string greater than the cursor is the cursor with
+        # a NUL appended, so this skips every key starting with it:
+        return bisect_left(keys, cursor[:-1] + (cursor[-1] + u"\0",))
+    return bisect_right(keys, cursor)
+
+
+def _state_datasets(deployment_state):
+    """
+    Describe the primary datasets in the cluster state.
+
+    :param DeploymentState deployment_state: The state of the cluster.
+
+    :return: A ``list`` of ``dict`` matching
+        ``/v1/endpoints.json#/definitions/state_datasets_array``.
+    """
+    _, items = _primary_manifestations(deployment_state)
+    return [_state_dataset(*arguments) for arguments in items]
+
+
+def _state_containers(deployment_state):
+    """
+    Describe the containers in the cluster state.
+
+    :param DeploymentState deployment_state: The state of the cluster.
+
+    :return: A ``list`` of ``dict`` matching
+        ``/v1/endpoints.json#/definitions/state_containers_array``.
+    """
+    _, items = _node_applications(deployment_state)
+    return [_state_container(*arguments) for arguments in items]
+
+
+def _generation_argument(since):
+    """
+    :param since: The ``since`` query argument of a request for changes, or
+        ``None`` if it was not given.
+
+    :return: The ``int`` generation, or ``None``.
+    """
+    if since is None:
+        return None
+    return int(since)
+
+
+def _changed_items(previous, current, key):
+    """
+    Compare two descriptions of a set of items.
+
+    :param list previous: ``dict`` describing each item before.
+    :param list current: ``dict`` describing each item now.
+    :param unicode key: The key of the identifier of the items.
+
+    :return: A tuple of a ``list`` of the descriptions of the items which
+        were added or changed and a ``list`` of the identifiers of items
+        which were removed.
+    """
+    previous = dict((item[key], item) for item in previous)
+    changed = [item for item in current if previous.get(item[key]) != item]
+    current_keys = set(item[key] for item in current)
+    removed = [item_key for item_key in previous
+               if item_key not in current_keys]
+    return changed, removed
+
+
+def _describe_changes(result, describe_datasets, describe_containers):
+    """
+    Describe the changes to the configuration or state since a generation.
+
+    :param tuple result: The result of ``ChangeHistory.wait``.
+    :param describe_datasets: Callable returning a ``list`` of ``dict``
+        describing the datasets in a configuration or state.
+    :param describe_containers: Callable returning a ``list`` of ``dict``
+        describing the containers in a configuration or state.
+
+    :return: A ``dict`` describing the changes.
+    """
+    previous, generation, current = result
+    if previous is current:
+        datasets = removed_datasets = containers = removed_containers = []
+    elif previous is None:
+        datasets = describe_datasets(current)
+        containers = describe_containers(current)
+        removed_datasets = removed_containers = []
+    else:
+        datasets, removed_datasets = _changed_items(
+            describe_datasets(previous), describe_datasets(current),
+            u"dataset_id")
+        containers, removed_containers = _changed_items(
+            describe_containers(previous), describe_containers(current),
+            u"name")
+    return {
+        u"generation": generation,
+        u"complete": previous is None,
+        u"datasets": datasets,
+        u"removed_datasets": removed_datasets,
+        u"containers": containers,
+        u"removed_containers": removed_containers,
+    }
+
+
 def container_configuration_response(application, node):
     """
     Return a container dict  which confirms to
@@ -996,7 +1823,8 @@ def api_dataset_from_dataset_and_node(dataset, node_hostname):
     return result
 
 
-def create_api_service(persistence_service, cluster_state_service, endpoint):
+def create_api_service(persistence_service, cluster_state_service, endpoint,
+                       output_validation_interval=1, reactor=None):
     """
     Create a Twisted Service that serves the API on the given endpoint.
 
@@ -1008,10 +1836,29 @@ def create_api_service(persistence_service, cluster_state_service, endpoint):
 
     :param endpoint: Twisted endpoint to listen on.
 
+    :param int output_validation_interval: Validate one in this many
+        responses of each endpoint against its output schema.
+
+    :param IReactorTime reactor: Reactor used to time out requests waiting
+        for changes and to log the statistics of the API's response cache
+        every ``_RESPONSE_CACHE_LOG_INTERVAL`` seconds, or ``None`` for the
+        global reactor.
+
     :return: Service that will listen on the endpoint using HTTP API server.
     """
     api_root = Resource()
-    user = ConfigurationAPIUserV1(persistence_service, cluster_state_service)
+    if reactor is None:
+        from twisted.internet import reactor
+    user = ConfigurationAPIUserV1(
+        persistence_service, cluster_state_service, reactor=reactor,
+        output_validation_interval=output_validation_interval)
     api_root.putChild('v1', user.app.resource())
     api_root._v1_user = user  # For unit testing purposes, alas
-    return StreamServerEndpointService(endpoint, Site(api_root))
+    service = MultiService()
+    StreamServerEndpointService(
+        endpoint, Site(api_root)).setServiceParent(service)
+    statistics = TimerService(
+        _RESPONSE_CACHE_LOG_INTERVAL, user.response_cache.log_statistics)
+    statistics.clock = reactor
+    statistics.setServiceParent(service)
+    return service
@@ -30,6 +30,12 @@ class ControlOptions(Options):
          "The external API port to listen on."],
         ["agent-port", "a", 'tcp:4524',
          "The port convergence agents will connect to."],
+        ["output-validation-interval", None, 100,
+         "Validate one in this many responses of each API endpoint against "
+         "its schema.", int],
+        ["state-expiry", None, 120.0,
+         "Forget the state of a node which hasn't reported it for this many "
+         "seconds.", float],
     ]
 
 
@@ -43,12 +49,17 @@ class ControlScript(object):
         persistence = ConfigurationPersistenceService(
             reactor, options["data-path"])
         persistence.setServiceParent(top_service)
-        cluster_state = ClusterStateService()
+        cluster_state = ClusterStateService(
+            reactor, expiry=options["state-expiry"])
         cluster_state.setServiceParent(top_service)
-        create_api_service(persistence, cluster_state, serverFromString(
-            reactor, options["port"])).setServiceParent(top_service)
+        create_api_service(
+            persistence, cluster_state,
+            serverFromString(reactor, options["port"]),
+            output_validation_interval=options["output-validation-interval"],
+            reactor=reactor,
+        ).setServiceParent(top_service)
         amp_service = ControlAMPService(
-            cluster_state, persistence, serverFromString(
+            reactor, cluster_state, persistence, serverFromString(
                 reactor, options["agent-port"]))
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
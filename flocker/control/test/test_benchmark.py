@@ -0,0 +1,52 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control.benchmark``.
+"""
+
+from io import BytesIO
+
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import SynchronousTestCase
+
+from ..benchmark import BENCHMARKS, main, make_deployment_state
+
+
+class MakeDeploymentStateTests(SynchronousTestCase):
+    """
+    Tests for ``make_deployment_state``.
+    """
+    def test_datasets(self):
+        """
+        The resulting state has the requested number of datasets spread
+        over nodes with at most the requested number of datasets each.
+        """
+        state = make_deployment_state(250, datasets_per_node=100)
+        nodes = state.nodes.values()
+        self.assertEqual(
+            (250, [100, 100, 50]),
+            (sum(len(node.manifestations) for node in nodes),
+             sorted((len(node.manifestations) for node in nodes),
+                    reverse=True)))
+
+
+class MainTests(SynchronousTestCase):
+    """
+    Tests for ``main``.
+    """
+    def test_all(self):
+        """
+        With no benchmarks given, all benchmarks are run and their results
+        written.
+        """
+        stdout = BytesIO()
+        main([b"--size=10"], stdout)
+        names = set(line.split(b":")[0]
+                    for line in stdout.getvalue().splitlines())
+        self.assertEqual(set(BENCHMARKS), names)
+
+    def test_unknown(self):
+        """
+        An unknown benchmark name is rejected.
+        """
+        self.assertRaises(UsageError, main, [b"nonexistent"], BytesIO())
@@ -6,6 +6,9 @@ Tests for ``flocker.control._clusterstate``.
 
 from uuid import uuid4
 
+from eliot.testing import validate_logging
+
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
@@ -135,3 +138,268 @@ class ClusterStateServiceTests(SynchronousTestCase):
         self.assertEqual(
             service.manifestation_path(u"host1", MANIFESTATION.dataset_id),
             FilePath(b"/xxx/yyy"))
+
+    def test_generation(self):
+        """
+        ``ClusterStateService.generation`` is incremented every time changes
+        are applied.
+        """
+        service = self.service()
+        initial = service.generation()
+        service.apply_changes([self.WITH_APPS])
+        first = service.generation()
+        service.apply_changes([self.WITH_MANIFESTATION])
+        self.assertEqual((initial, first, service.generation()), (0, 1, 2))
+
+    def test_generation_no_changes(self):
+        """
+        ``ClusterStateService.generation`` is not incremented if no changes
+        are applied.
+        """
+        service = self.service()
+        service.apply_changes([])
+        self.assertEqual(service.generation(), 0)
+
+    def test_generation_unchanged_report(self):
+        """
+        ``ClusterStateService.generation`` is not incremented if a node
+        reports the state already known for it.
+        """
+        service = self.service()
+        service.apply_changes([self.WITH_APPS])
+        service.apply_changes([self.WITH_APPS.set(applications=[APP2, APP1])])
+        self.assertEqual(service.generation(), 1)
+
+    def test_register_for_callback(self):
+        """
+        Callbacks can be registered that are called every time the cluster
+        state changes.
+        """
+        service = self.service()
+        callbacks = []
+        service.register(lambda: callbacks.append(service.generation()))
+        service.apply_changes([self.WITH_APPS])
+        service.apply_changes([])
+        service.apply_changes([self.WITH_MANIFESTATION])
+        self.assertEqual([1, 2], callbacks)
+
+    def test_unregister(self):
+        """
+        Callbacks which are unregistered are no longer called.
+        """
+        service = self.service()
+        callbacks = []
+        callback = lambda: callbacks.append(service.generation())
+        service.register(callback)
+        service.apply_changes([self.WITH_APPS])
+        service.unregister(callback)
+        service.apply_changes([self.WITH_MANIFESTATION])
+        self.assertEqual([1], callbacks)
+
+    @validate_logging(
+        lambda test, logger:
+        test.assertEqual(len(logger.flush_tracebacks(ZeroDivisionError)), 1))
+    def test_register_for_callback_failure(self, logger):
+        """
+        Failed callbacks don't prevent later callbacks from being called.
+        """
+        service = self.service()
+        service.logger = logger
+        callbacks = []
+        service.register(lambda: 1/0)
+        service.register(lambda: callbacks.append(1))
+        service.apply_changes([self.WITH_APPS])
+        self.assertEqual([1], callbacks)
+
+
+class ClusterStateExpiryTests(SynchronousTestCase):
+    """
+    Tests for expiry of node state by ``ClusterStateService``.
+    """
+    WITH_APPS = ClusterStateServiceTests.WITH_APPS
+    IGNORANT = NodeState(hostname=u"host1", applications=None,
+                         used_ports=None, manifestations=None, paths=None)
+
+    def setUp(self):
+        self.clock = Clock()
+        self.service = ClusterStateService(self.clock, expiry=10)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    def test_last_update(self):
+        """
+        ``ClusterStateService.last_update`` returns the time a node's state
+        was last reported.
+        """
+        self.clock.advance(3)
+        self.service.apply_changes([self.WITH_APPS])
+        self.assertEqual(
+            (3, None),
+            (self.service.last_update(u"host1"),
+             self.service.last_update(u"host2")))
+
+    def test_no_expiry(self):
+        """
+        Without an expiry node state is timestamped but never expires and no
+        calls are scheduled.
+        """
+        service = ClusterStateService(self.clock)
+        service.apply_changes([self.WITH_APPS])
+        self.assertEqual(
+            (0, DeploymentState(nodes=[self.WITH_APPS]), []),
+            (service.last_update(u"host1"), service.as_deployment(),
+             self.clock.getDelayedCalls()))
+
+    def test_expires(self):
+        """
+        A node whose state isn't reported again within the expiry is
+        dropped.
+        """
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(9.5)
+        before = self.service.as_deployment()
+        self.clock.advance(0.5)
+        self.assertEqual(
+            (DeploymentState(nodes=[self.WITH_APPS]), DeploymentState()),
+            (before, self.service.as_deployment()))
+
+    def test_partial_reporters_expire_independently(self):
+        """
+        When several reporters each provide some of a node's state, only
+        the fields of the one which stops reporting are replaced by
+        ignorance.
+        """
+        containers = self.IGNORANT.set(applications=[APP1], used_ports=[80])
+        datasets = self.IGNORANT.set(
+            manifestations={MANIFESTATION.dataset_id: MANIFESTATION},
+            paths={MANIFESTATION.dataset_id: FilePath(b"/xxx")})
+        self.service.apply_changes([containers, datasets])
+        self.clock.advance(5)
+        self.service.apply_changes([containers])
+        self.clock.advance(5)
+        self.assertEqual(
+            (DeploymentState(nodes=[containers]), 5),
+            (self.service.as_deployment(),
+             self.service.last_update(u"host1")))
+
+    def test_fields_kept_by_live_reporter(self):
+        """
+        Fields which a reporter still reporting provides are kept when
+        another reporter which also provided them expires.
+        """
+        containers = self.IGNORANT.set(applications=[APP1], used_ports=[80])
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(5)
+        self.service.apply_changes([containers])
+        self.clock.advance(5)
+        self.assertEqual(DeploymentState(nodes=[containers]),
+                         self.service.as_deployment())
+
+    def test_partial_reporters_all_expire(self):
+        """
+        Once every reporter for a node has expired the node is dropped.
+        """
+        self.service.apply_changes([
+            self.IGNORANT.set(applications=[APP1], used_ports=[80]),
+            self.IGNORANT.set(manifestations={}, paths={})])
+        self.clock.advance(10)
+        self.assertEqual(
+            (DeploymentState(), None),
+            (self.service.as_deployment(),
+             self.service.last_update(u"host1")))
+
+    def test_expiry_changes_generation(self):
+        """
+        Expiry increments the generation and calls the registered callbacks.
+        """
+        callbacks = []
+        self.service.register(
+            lambda: callbacks.append(self.service.generation()))
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(10)
+        self.assertEqual([1, 2], callbacks)
+
+    def test_update_postpones_expiry(self):
+        """
+        Reporting a node's state again postpones its expiry.
+        """
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(6)
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(6)
+        before = self.service.as_deployment()
+        self.clock.advance(4)
+        self.assertEqual(
+            (DeploymentState(nodes=[self.WITH_APPS]), DeploymentState()),
+            (before, self.service.as_deployment()))
+
+    def test_nodes_expire_independently(self):
+        """
+        Each node's state expires based on when it was last reported.
+        """
+        other = NodeState(hostname=u"host2", applications=[APP2])
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(5)
+        self.service.apply_changes([other])
+        self.clock.advance(5)
+        self.assertEqual(
+            DeploymentState(nodes=[other]),
+            self.service.as_deployment())
+
+    def test_expired_partial_update(self):
+        """
+        After expiry, a partial update only provides the information it knows
+        about; the rest remains unknown.
+        """
+        self.service.apply_changes([NodeState(
+            hostname=u"host1", applications=[APP1], used_ports=[80],
+            manifestations={MANIFESTATION.dataset_id: MANIFESTATION},
+            paths={MANIFESTATION.dataset_id: FilePath(b"/xxx")})])
+        self.clock.advance(10)
+        self.service.apply_changes([
+            self.IGNORANT.set(applications=[APP2])])
+        self.assertEqual(
+            DeploymentState(nodes=[self.IGNORANT.set(applications=[APP2])]),
+            self.service.as_deployment())
+
+    def test_late_tick(self):
+        """
+        If the reactor runs late, state which expired in the meantime is
+        still expired.
+        """
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.pump([0.5, 25])
+        self.assertEqual(DeploymentState(), self.service.as_deployment())
+
+    def test_idle_when_nothing_expires(self):
+        """
+        Once all node state has expired no more calls are scheduled.
+        """
+        self.service.apply_changes([self.WITH_APPS])
+        self.clock.advance(10)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_ticks_only_touch_due_nodes(self):
+        """
+        Each tick only examines the reporters due to expire at it, rather
+        than all of them.
+        """
+        fields = frozenset(
+            [u"applications", u"used_ports", u"manifestations", u"paths"])
+        self.service.apply_changes([
+            NodeState(hostname=u"host%d" % (i,), applications=[APP1])
+            for i in range(5)])
+        self.clock.advance(1)
+        self.service.apply_changes([self.WITH_APPS])
+        self.assertEqual(
+            [{(u"host%d" % (i,), fields) for i in (0, 2, 3, 4)},
+             {(u"host1", fields)}],
+            [slot for slot in self.service._wheel if slot])
+
+    def test_stop_cancels(self):
+        """
+        Stopping the service cancels the scheduled expiry.
+        """
+        self.service.apply_changes([self.WITH_APPS])
+        self.service.stopService()
+        self.assertEqual([], self.clock.getDelayedCalls())
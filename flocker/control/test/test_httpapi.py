@@ -11,14 +11,17 @@ from pyrsistent import pmap, thaw
 
 from zope.interface.verify import verifyObject
 
+from eliot.testing import validate_logging
+
 from twisted.internet import reactor
 from twisted.internet.defer import gatherResults
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
-from twisted.test.proto_helpers import MemoryReactor
+from twisted.test.proto_helpers import MemoryReactor, MemoryReactorClock
 from twisted.web.http import (
     CREATED, OK, CONFLICT, BAD_REQUEST, NOT_FOUND, INTERNAL_SERVER_ERROR,
-    NOT_ALLOWED as METHOD_NOT_ALLOWED
+    NOT_ALLOWED as METHOD_NOT_ALLOWED, NOT_MODIFIED
 )
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
@@ -31,12 +34,15 @@ from ...restapi.testtools import (
 
 from .. import (
     Application, Dataset, Manifestation, Node, NodeState,
-    Deployment, AttachedVolume, DockerImage, Port, RestartOnFailure,
-    RestartAlways, RestartNever, Link
+    Deployment, DeploymentState, AttachedVolume, DockerImage, Port,
+    RestartOnFailure, RestartAlways, RestartNever, Link
 )
 from ..httpapi import (
     ConfigurationAPIUserV1, create_api_service, datasets_from_deployment,
-    api_dataset_from_dataset_and_node, container_configuration_response
+    api_dataset_from_dataset_and_node, container_configuration_response,
+    deployment_index, DeploymentIndex, _DEPLOYMENT_INDEX_CACHE_SIZE,
+    _primary_manifestations, _node_applications,
+    _RESPONSE_CACHE_LOG_INTERVAL, _WATCH_TIMEOUT,
 )
 from ...node.agents.test.test_blockdevice import REALISTIC_BLOCKDEVICE_SIZE
 from .._persistence import ConfigurationPersistenceService
@@ -1399,7 +1405,7 @@ class UpdateContainerConfigurationTestsMixin(APITestsMixin):
                     image=DockerImage.from_string(u"busybox"),
                 )
                 real_expected = expected
-                for node in expected.nodes:
+                for node in expected.nodes.values():
                     if node.hostname == self.NODE_B:
                         node = node.transform(
                             ["applications"], lambda s: s.add(application)
@@ -1495,7 +1501,7 @@ class UpdateContainerConfigurationTestsMixin(APITestsMixin):
                 )
                 node = Node(hostname=u"192.0.2.3", applications=[application])
                 real_expected = expected.update_node(node)
-                for node in expected.nodes:
+                for node in expected.nodes.values():
                     if node.hostname == self.NODE_A:
                         node = node.transform(
                             ["applications"], lambda s: s.remove(application)
@@ -1602,7 +1608,7 @@ class DeleteContainerTestsMixin(APITestsMixin):
 
         def deleted(_):
             deployment = self.persistence_service.get()
-            origin = next(iter(deployment.nodes))
+            origin = next(iter(deployment.nodes.values()))
             self.assertEqual(list(origin.applications), [])
         d.addCallback(deleted)
         return d
@@ -1622,7 +1628,7 @@ class DeleteContainerTestsMixin(APITestsMixin):
 
         def deleted(_):
             deployment = self.persistence_service.get()
-            origin = next(iter(deployment.nodes))
+            origin = next(iter(deployment.nodes.values()))
             self.assertEqual(
                 list(origin.applications),
                 [Application(name=u"somecontainer",
@@ -1718,7 +1724,7 @@ class CreateDatasetTestsMixin(APITestsMixin):
 
         def failed(reason):
             deployment = self.persistence_service.get()
-            (node_a, node_b) = deployment.nodes
+            (node_a, node_b) = deployment.nodes.values()
             if node_a.hostname != self.NODE_A:
                 # They came out of the set backwards.
                 node_a, node_b = node_b, node_a
@@ -1827,7 +1833,7 @@ class CreateDatasetTestsMixin(APITestsMixin):
             (node_a,) = (
                 node
                 for node
-                in deployment.nodes
+                in deployment.nodes.values()
                 if node.hostname == self.NODE_A
             )
             self.assertEqual(
@@ -2058,7 +2064,7 @@ class UpdatePrimaryDatasetTestsMixin(APITestsMixin):
 
             def got_result(result):
                 deployment = self.persistence_service.get()
-                for node in deployment.nodes:
+                for node in deployment.nodes.values():
                     if node.hostname == target:
                         dataset_ids = [
                             (m.primary, m.dataset.dataset_id)
@@ -2404,7 +2410,7 @@ class DeleteDatasetTestsMixin(APITestsMixin):
         deployment = self.persistence_service.get()
         expected_dataset_id = dataset.dataset_id
         # There's only one node:
-        origin = next(iter(deployment.nodes))
+        origin = next(iter(deployment.nodes.values()))
 
         expected_dataset = {
             u"dataset_id": expected_dataset_id,
@@ -2422,7 +2428,7 @@ class DeleteDatasetTestsMixin(APITestsMixin):
 
         def got_result(result):
             deployment = self.persistence_service.get()
-            for node in deployment.nodes:
+            for node in deployment.nodes.values():
                 if node.hostname == origin.hostname:
                     dataset_ids = [
                         (m.dataset.deleted, m.dataset.dataset_id)
@@ -2529,7 +2535,7 @@ def get_dataset_ids(deployment):
     :return: An iterator of ``unicode`` giving the unique identifiers of all of
         the datasets.
     """
-    for node in deployment.nodes:
+    for node in deployment.nodes.values():
         for manifestation in node.manifestations.values():
             yield manifestation.dataset.dataset_id
 
@@ -2714,13 +2720,22 @@ class CreateAPIServiceTests(SynchronousTestCase):
     """
     Tests for ``create_api_service``.
     """
+    def services(self):
+        """
+        :return: A tuple of a ``ConfigurationPersistenceService`` and a
+            ``ClusterStateService`` for the API.
+        """
+        return (ConfigurationPersistenceService(
+            reactor, FilePath(self.mktemp())), ClusterStateService())
+
     def test_returns_service(self):
         """
         ``create_api_service`` returns an object providing ``IService``.
         """
         reactor = MemoryReactor()
         endpoint = TCP4ServerEndpoint(reactor, 6789)
-        verifyObject(IService, create_api_service(None, None, endpoint))
+        verifyObject(IService,
+                     create_api_service(*self.services() + (endpoint,)))
 
     def test_listens_endpoint(self):
         """
@@ -2729,7 +2744,7 @@ class CreateAPIServiceTests(SynchronousTestCase):
         """
         reactor = MemoryReactor()
         endpoint = TCP4ServerEndpoint(reactor, 6789)
-        service = create_api_service(None, None, endpoint)
+        service = create_api_service(*self.services() + (endpoint,))
         self.addCleanup(service.stopService)
         service.startService()
         server = reactor.tcpServers[0]
@@ -2737,6 +2752,45 @@ class CreateAPIServiceTests(SynchronousTestCase):
         factory = server[1].__class__
         self.assertEqual((port, factory), (6789, Site))
 
+    @validate_logging(None)
+    def test_logs_cache_statistics(self, logger):
+        """
+        ``create_api_service`` returns a service that logs the statistics of
+        the API's response cache when started and periodically after that.
+        """
+        reactor = MemoryReactorClock()
+        endpoint = TCP4ServerEndpoint(reactor, 6789)
+        service = create_api_service(
+            *self.services() + (endpoint,), reactor=reactor)
+        [server, _] = service
+        server.factory.resource._v1_user.response_cache.logger = logger
+        self.addCleanup(service.stopService)
+        service.startService()
+        reactor.advance(_RESPONSE_CACHE_LOG_INTERVAL)
+        self.assertEqual(
+            [u"api:response_cache:statistics"] * 2,
+            [message[u"message_type"] for message in logger.messages])
+
+    def test_watch_timeout_reactor(self):
+        """
+        ``create_api_service`` returns a service whose requests waiting for
+        changes time out using the given reactor.
+        """
+        reactor = Clock()
+        persistence_service, cluster_state_service = self.services()
+        persistence_service.startService()
+        self.addCleanup(persistence_service.stopService)
+        service = create_api_service(
+            persistence_service, cluster_state_service,
+            TCP4ServerEndpoint(MemoryReactor(), 6789), reactor=reactor)
+        [server, _] = service
+        user = server.factory.resource._v1_user
+        waiting = user._configuration_history.wait(
+            persistence_service.generation(), _WATCH_TIMEOUT)
+        before = waiting.called
+        reactor.advance(_WATCH_TIMEOUT)
+        self.assertEqual((False, True), (before, waiting.called))
+
 
 class DatasetsStateTestsMixin(APITestsMixin):
     """
@@ -3010,6 +3064,814 @@ class DatasetsFromDeploymentTests(SynchronousTestCase):
         )
 
 
+class BatchTestsMixin(APITestsMixin):
+    """
+    Tests for the batch configuration endpoint at ``/configuration/batch``.
+    """
+    def test_operations(self):
+        """
+        The operations of a batch are applied in order, each seeing the
+        changes made by those before it, and their results are returned.
+        """
+        dataset_id = unicode(uuid4())
+        saving = self.persistence_service.save(Deployment(
+            nodes={Node(hostname=self.NODE_A,
+                        applications=[Application(
+                            name=u"old",
+                            image=DockerImage.from_string(u"nginx"))])}))
+        saving.addCallback(lambda _: self.assertResult(
+            b"POST", b"/configuration/batch",
+            {u"operations": [
+                {u"operation": u"create_dataset",
+                 u"arguments": {u"primary": self.NODE_A,
+                                u"dataset_id": dataset_id}},
+                {u"operation": u"update_dataset",
+                 u"arguments": {u"dataset_id": dataset_id,
+                                u"maximum_size": 1024 * 1024 * 64}},
+                {u"operation": u"create_container",
+                 u"arguments": {u"host": self.NODE_A, u"name": u"db",
+                                u"image": u"postgres",
+                                u"volumes": [{u"dataset_id": dataset_id,
+                                              u"mountpoint": u"/data"}]}},
+                {u"operation": u"update_container",
+                 u"arguments": {u"name": u"db", u"host": self.NODE_B}},
+                {u"operation": u"delete_container",
+                 u"arguments": {u"name": u"old"}},
+            ]},
+            OK,
+            {u"results": [
+                {u"dataset_id": dataset_id, u"primary": self.NODE_A,
+                 u"metadata": {}, u"deleted": False},
+                {u"dataset_id": dataset_id, u"primary": self.NODE_A,
+                 u"metadata": {}, u"deleted": False,
+                 u"maximum_size": 1024 * 1024 * 64},
+                {u"host": self.NODE_A, u"name": u"db",
+                 u"image": u"postgres:latest",
+                 u"volumes": [{u"dataset_id": dataset_id,
+                               u"mountpoint": u"/data"}],
+                 u"restart_policy": {u"name": u"never"}},
+                {u"host": self.NODE_B, u"name": u"db",
+                 u"image": u"postgres:latest",
+                 u"volumes": [{u"dataset_id": dataset_id,
+                               u"mountpoint": u"/data"}],
+                 u"restart_policy": {u"name": u"never"}},
+                None]}))
+
+        def saved(_):
+            deployment = self.persistence_service.get()
+            self.assertEqual(
+                ([], [u"db"], [dataset_id]),
+                (list(deployment.get_node(self.NODE_A).applications),
+                 [application.name for application
+                  in deployment.get_node(self.NODE_B).applications],
+                 list(deployment.get_node(self.NODE_B).manifestations)))
+        saving.addCallback(saved)
+        return saving
+
+    def test_saved_once(self):
+        """
+        All the changes made by a batch are saved together.
+        """
+        generation = self.persistence_service.generation()
+        saves = []
+        self.persistence_service.register(lambda: saves.append(
+            self.persistence_service.get()))
+        d = self.assertResponseCode(
+            b"POST", b"/configuration/batch",
+            {u"operations": [
+                {u"operation": u"create_dataset",
+                 u"arguments": {u"primary": self.NODE_A}},
+                {u"operation": u"create_dataset",
+                 u"arguments": {u"primary": self.NODE_A}},
+            ]}, OK)
+
+        def saved(_):
+            [deployment] = saves
+            self.assertEqual(
+                (2, generation + 1),
+                (len(deployment.get_node(self.NODE_A).manifestations),
+                 self.persistence_service.generation()))
+        d.addCallback(saved)
+        return d
+
+    def test_empty_not_saved(self):
+        """
+        A batch with no operations doesn't save the configuration.
+        """
+        generation = self.persistence_service.generation()
+        d = self.assertResult(
+            b"POST", b"/configuration/batch", {u"operations": []},
+            OK, {u"results": []})
+        d.addCallback(lambda _: self.assertEqual(
+            generation, self.persistence_service.generation()))
+        return d
+
+    def test_failure_changes_nothing(self):
+        """
+        If an operation fails its error response is returned with the index
+        of the operation, and none of the operations are applied.
+        """
+        d = self.assertResult(
+            b"POST", b"/configuration/batch",
+            {u"operations": [
+                {u"operation": u"create_dataset",
+                 u"arguments": {u"primary": self.NODE_A}},
+                {u"operation": u"delete_container",
+                 u"arguments": {u"name": u"unknown"}},
+            ]},
+            NOT_FOUND,
+            {u"description": u"Container not found.", u"operation": 1})
+        d.addCallback(lambda _: self.assertEqual(
+            Deployment(), self.persistence_service.get()))
+        return d
+
+    def test_conflict_within_batch(self):
+        """
+        Operations of a batch are validated against the changes made by
+        earlier operations of the same batch.
+        """
+        dataset_id = unicode(uuid4())
+        operation = {u"operation": u"create_dataset",
+                     u"arguments": {u"primary": self.NODE_A,
+                                    u"dataset_id": dataset_id}}
+        return self.assertResult(
+            b"POST", b"/configuration/batch",
+            {u"operations": [operation, operation]},
+            CONFLICT,
+            {u"description": u"The provided dataset_id is already in use.",
+             u"operation": 1})
+
+    def test_unknown_operation(self):
+        """
+        An operation which is not supported is rejected.
+        """
+        return self.assertResponseCode(
+            b"POST", b"/configuration/batch",
+            {u"operations": [{u"operation": u"explode",
+                              u"arguments": {}}]},
+            BAD_REQUEST)
+
+
+RealTestsBatch, MemoryTestsBatch = buildIntegrationTests(
+    BatchTestsMixin, "Batch", _build_app)
+
+
+class ConditionalGetTestsMixin(APITestsMixin):
+    """
+    Tests for conditional requests of the configuration and state endpoints.
+    """
+    def get(self, path, etag=None):
+        """
+        Request a resource.
+
+        :param bytes path: The path of the resource.
+        :param bytes etag: An entity tag to send in ``If-None-Match``, or
+            ``None`` for none.
+
+        :return: A ``Deferred`` firing with the ``IResponse``.
+        """
+        headers = Headers()
+        if etag is not None:
+            headers.setRawHeaders(b"if-none-match", [etag])
+        return self.agent.request(b"GET", path, headers, None)
+
+    def assert_not_modified_until_change(self, path, change):
+        """
+        A request for a resource with the entity tag of the previous response
+        gets a *304 Not Modified* response, until the data it is built from is
+        changed.
+
+        :param bytes path: The path of the resource.
+        :param change: A no-argument callable which changes the data.
+
+        :return: A ``Deferred`` that fires when the test is done.
+        """
+        results = []
+        d = self.get(path)
+
+        def got_first(response):
+            [etag] = response.headers.getRawHeaders(b"etag")
+            results.append(response.code)
+            requesting = self.get(path, etag)
+            requesting.addCallback(lambda response: results.append(
+                response.code))
+            requesting.addCallback(lambda _: change())
+            requesting.addCallback(lambda _: self.get(path, etag))
+            return requesting
+        d.addCallback(got_first)
+        d.addCallback(lambda response: results.append(response.code))
+        d.addCallback(lambda _: self.assertEqual(
+            [OK, NOT_MODIFIED, OK], results))
+        return d
+
+    def test_configuration_generation(self):
+        """
+        Responses for the configuration include its generation.
+        """
+        d = self.persistence_service.save(Deployment(
+            nodes={Node(hostname=self.NODE_A)}))
+        d.addCallback(lambda _: self.get(b"/configuration/datasets"))
+        d.addCallback(lambda response: self.assertEqual(
+            [b"%d" % (self.persistence_service.generation(),)],
+            response.headers.getRawHeaders(b"x-flocker-generation")))
+        return d
+
+    def test_configuration_datasets(self):
+        """
+        The dataset configuration supports conditional requests.
+        """
+        return self.assert_not_modified_until_change(
+            b"/configuration/datasets",
+            lambda: self.persistence_service.save(Deployment(
+                nodes={Node(hostname=self.NODE_A)})))
+
+    def test_configuration_containers(self):
+        """
+        The container configuration supports conditional requests.
+        """
+        return self.assert_not_modified_until_change(
+            b"/configuration/containers",
+            lambda: self.persistence_service.save(Deployment(
+                nodes={Node(hostname=self.NODE_A)})))
+
+    def test_state_datasets(self):
+        """
+        The dataset state supports conditional requests.
+        """
+        return self.assert_not_modified_until_change(
+            b"/state/datasets",
+            lambda: self.cluster_state_service.apply_changes([
+                NodeState(hostname=self.NODE_A, used_ports=[80])]))
+
+    def test_state_containers(self):
+        """
+        The container state supports conditional requests.
+        """
+        return self.assert_not_modified_until_change(
+            b"/state/containers",
+            lambda: self.cluster_state_service.apply_changes([
+                NodeState(hostname=self.NODE_A, used_ports=[80])]))
+
+    def test_response_cache(self):
+        """
+        Repeated requests for a resource are answered from the API's response
+        cache until the data changes.
+        """
+        cache = self.api.response_cache
+        d = self.get(b"/configuration/datasets")
+        d.addCallback(lambda _: self.get(b"/configuration/datasets"))
+        d.addCallback(lambda _: self.persistence_service.save(Deployment(
+            nodes={Node(hostname=self.NODE_A)})))
+        d.addCallback(lambda _: self.get(b"/configuration/datasets"))
+        d.addCallback(lambda _: self.assertEqual(
+            (1, 2), (cache.hits, cache.misses)))
+        return d
+
+
+def _build_conditional_app(test):
+    test.initialize()
+    test.api = ConfigurationAPIUserV1(test.persistence_service,
+                                      test.cluster_state_service)
+    return test.api.app
+RealTestsConditionalGet, MemoryTestsConditionalGet = buildIntegrationTests(
+    ConditionalGetTestsMixin, "ConditionalGet", _build_conditional_app)
+
+
+class ListPageTestsMixin(APITestsMixin):
+    """
+    Tests for pagination, filtering and field selection of the list
+    endpoints.
+    """
+    DATASET_IDS = [u"%d0000000-0000-0000-0000-000000000000" % (i,)
+                   for i in range(1, 4)]
+
+    def get_page(self, path):
+        """
+        Request a page of a list.
+
+        :param bytes path: The path of the list.
+
+        :return: A ``Deferred`` firing with a tuple of the ``Link`` header
+            values and the decoded response body.
+        """
+        requesting = self.assertResponseCode(b"GET", path, None, OK)
+
+        def got_response(response):
+            reading = readBody(response)
+            reading.addCallback(lambda body: (
+                response.headers.getRawHeaders(b"link"), loads(body)))
+            return reading
+        requesting.addCallback(got_response)
+        return requesting
+
+    def add_state_datasets(self):
+        """
+        Add primary manifestations of ``DATASET_IDS`` to the cluster state,
+        the last one on ``NODE_B`` and the rest on ``NODE_A``.
+        """
+        def node_state(hostname, dataset_ids):
+            return NodeState(
+                hostname=hostname,
+                manifestations={
+                    dataset_id: Manifestation(
+                        dataset=Dataset(dataset_id=dataset_id), primary=True)
+                    for dataset_id in dataset_ids},
+                paths={dataset_id: FilePath(b"/" + dataset_id.encode("ascii"))
+                       for dataset_id in dataset_ids})
+        self.cluster_state_service.apply_changes([
+            node_state(self.NODE_B, self.DATASET_IDS[2:]),
+            node_state(self.NODE_A, self.DATASET_IDS[:2]),
+        ])
+
+    def test_first_page(self):
+        """
+        With a ``limit`` only that many items are listed, in order of their
+        keys, along with a ``Link`` header giving the next page.
+        """
+        self.add_state_datasets()
+        d = self.get_page(b"/state/datasets?limit=2&fields=dataset_id")
+        d.addCallback(self.assertEqual, (
+            [b'<?after=' + self.DATASET_IDS[1].encode("ascii") +
+             b'&fields=dataset_id&limit=2>; rel="next"'],
+            [{u"dataset_id": dataset_id}
+             for dataset_id in self.DATASET_IDS[:2]]))
+        return d
+
+    def test_last_page(self):
+        """
+        The page after the given ``after`` key which includes the last item
+        has no ``Link`` header.
+        """
+        self.add_state_datasets()
+        d = self.get_page(b"/state/datasets?limit=2&fields=dataset_id&after="
+                          + self.DATASET_IDS[1].encode("ascii"))
+        d.addCallback(self.assertEqual, (
+            None, [{u"dataset_id": self.DATASET_IDS[2]}]))
+        return d
+
+    def test_fields(self):
+        """
+        With ``fields`` only the given properties of each item are listed.
+        """
+        self.add_state_datasets()
+        d = self.get_page(b"/state/datasets?fields=dataset_id,primary")
+        d.addCallback(self.assertEqual, (
+            None,
+            [{u"dataset_id": self.DATASET_IDS[0], u"primary": self.NODE_A},
+             {u"dataset_id": self.DATASET_IDS[1], u"primary": self.NODE_A},
+             {u"dataset_id": self.DATASET_IDS[2], u"primary": self.NODE_B}]))
+        return d
+
+    def test_unknown_field(self):
+        """
+        A ``fields`` argument with an unknown property is rejected.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?fields=dataset_id,secret", None,
+            BAD_REQUEST)
+
+    def test_invalid_limit(self):
+        """
+        A ``limit`` argument which isn't a positive number is rejected.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?limit=0", None, BAD_REQUEST)
+
+    def test_duplicate_keys(self):
+        """
+        A dataset which several nodes report being primary for is listed
+        once for each node, even if a page ends between them.
+        """
+        self.add_state_datasets()
+        self.cluster_state_service.apply_changes([NodeState(
+            hostname=self.NODE_B,
+            manifestations={self.DATASET_IDS[0]: Manifestation(
+                dataset=Dataset(dataset_id=self.DATASET_IDS[0]),
+                primary=True)},
+            paths={self.DATASET_IDS[0]: FilePath(b"/other")})])
+        after = self.DATASET_IDS[0].encode("ascii") + b"%40192.0.2.1"
+        d = self.get_page(b"/state/datasets?limit=1&fields=primary")
+        d.addCallback(self.assertEqual, (
+            [b'<?after=' + after + b'&fields=primary&limit=1>; rel="next"'],
+            [{u"primary": self.NODE_A}]))
+        d.addCallback(lambda _: self.get_page(
+            b"/state/datasets?limit=1&fields=primary&after=" + after))
+        d.addCallback(self.assertEqual, (
+            [b'<?after=' + self.DATASET_IDS[0].encode("ascii") +
+             b'&fields=primary&limit=1>; rel="next"'],
+            [{u"primary": self.NODE_B}]))
+        return d
+
+    def test_state_datasets_primary(self):
+        """
+        With ``primary`` only the datasets on that node are listed, and the
+        ``Link`` header keeps the filter.
+        """
+        self.add_state_datasets()
+        d = self.get_page(b"/state/datasets?limit=1&primary=" +
+                          self.NODE_A.encode("ascii"))
+        d.addCallback(self.assertEqual, (
+            [b'<?after=' + self.DATASET_IDS[0].encode("ascii") +
+             b'&limit=1&primary=192.0.2.1>; rel="next"'],
+            [{u"dataset_id": self.DATASET_IDS[0], u"primary": self.NODE_A,
+              u"path": u"/" + self.DATASET_IDS[0]}]))
+        return d
+
+    def test_configuration_datasets_primary(self):
+        """
+        With ``primary`` only the configured datasets on that node are
+        listed.
+        """
+        d = self.persistence_service.save(Deployment(nodes={
+            Node(hostname=hostname, manifestations={
+                dataset_id: Manifestation(
+                    dataset=Dataset(dataset_id=dataset_id), primary=True)})
+            for hostname, dataset_id in zip(
+                [self.NODE_A, self.NODE_B], self.DATASET_IDS)}))
+        d.addCallback(lambda _: self.get_page(
+            b"/configuration/datasets?fields=dataset_id&primary=" +
+            self.NODE_B.encode("ascii")))
+        d.addCallback(self.assertEqual, (
+            None, [{u"dataset_id": self.DATASET_IDS[1]}]))
+        return d
+
+    def test_state_containers_node(self):
+        """
+        With ``node`` only the containers on that node are listed, in order
+        of their names.
+        """
+        def node_state(hostname, names):
+            return NodeState(hostname=hostname, applications={
+                Application(name=name,
+                            image=DockerImage.from_string(u"busybox"))
+                for name in names})
+        self.cluster_state_service.apply_changes([
+            node_state(self.NODE_A, [u"b", u"c", u"a"]),
+            node_state(self.NODE_B, [u"d"]),
+        ])
+        d = self.get_page(b"/state/containers?after=a&node=" +
+                          self.NODE_A.encode("ascii"))
+        d.addCallback(lambda (link, containers): self.assertEqual(
+            (None, [u"b", u"c"]),
+            (link, [container[u"name"] for container in containers])))
+        return d
+
+    def test_nodes(self):
+        """
+        The nodes can be listed a page at a time.
+        """
+        self.cluster_state_service.apply_changes([
+            NodeState(hostname=self.NODE_B), NodeState(hostname=self.NODE_A)])
+        d = self.get_page(b"/state/nodes?limit=1")
+        d.addCallback(self.assertEqual, (
+            [b'<?after=192.0.2.1&limit=1>; rel="next"'],
+            [{u"hostname": self.NODE_A}]))
+        return d
+
+    def test_pages_of_cached_generation(self):
+        """
+        Different pages of the same generation are not answered from the
+        cached response of the other.
+        """
+        self.add_state_datasets()
+        d = self.get_page(b"/state/datasets?limit=1&fields=dataset_id")
+        d.addCallback(lambda _: self.get_page(
+            b"/state/datasets?limit=1&fields=dataset_id&after=" +
+            self.DATASET_IDS[0].encode("ascii")))
+        d.addCallback(lambda (link, datasets): self.assertEqual(
+            [{u"dataset_id": self.DATASET_IDS[1]}], datasets))
+        return d
+
+
+RealTestsListPage, MemoryTestsListPage = buildIntegrationTests(
+    ListPageTestsMixin, "ListPage", _build_app)
+
+
+def _build_watch_app(test):
+    test.initialize()
+    test.clock = Clock()
+    return ConfigurationAPIUserV1(test.persistence_service,
+                                  test.cluster_state_service,
+                                  reactor=test.clock).app
+
+
+class WatchTestsMixin(APITestsMixin):
+    """
+    Tests for the change notification endpoints at ``/configuration/changes``
+    and ``/state/changes``.
+    """
+    def watch(self, path, since=None):
+        """
+        Request the changes since a generation.
+
+        :param bytes path: The path of the endpoint.
+        :param int since: The generation, or ``None`` to not give one.
+
+        :return: A ``Deferred`` firing with the decoded response.
+        """
+        if since is not None:
+            path += b"?since=%d" % (since,)
+        d = self.assertResponseCode(b"GET", path, None, OK)
+        d.addCallback(readBody)
+        d.addCallback(loads)
+        return d
+
+    def test_configuration_complete(self):
+        """
+        Without ``since`` the whole configuration is returned.
+        """
+        dataset_id = unicode(uuid4())
+        d = self.assertResponseCode(
+            b"POST", b"/configuration/datasets",
+            {u"primary": self.NODE_A, u"dataset_id": dataset_id}, CREATED)
+        d.addCallback(lambda _: self.watch(b"/configuration/changes"))
+        d.addCallback(self.assertEqual, {
+            u"generation": 1,
+            u"complete": True,
+            u"datasets": [{u"dataset_id": dataset_id,
+                           u"primary": self.NODE_A,
+                           u"metadata": {}, u"deleted": False}],
+            u"removed_datasets": [],
+            u"containers": [],
+            u"removed_containers": [],
+        })
+        return d
+
+    def test_configuration_changes(self):
+        """
+        With ``since`` only the datasets and containers which changed since
+        that generation are returned, once there are changes.
+        """
+        unchanged = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        removed = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        application = Application(
+            name=u"db", image=DockerImage.from_string(u"postgres"))
+        node = Node(hostname=self.NODE_A,
+                    applications=[application],
+                    manifestations={unchanged.dataset_id: unchanged,
+                                    removed.dataset_id: removed})
+        d = self.persistence_service.save(Deployment(nodes={node}))
+        d.addCallback(lambda _: self.watch(b"/configuration/changes"))
+
+        def got_generation(result):
+            waiting = self.watch(b"/configuration/changes",
+                                 result[u"generation"])
+            self.persistence_service.save(Deployment(nodes={node.set(
+                applications=[application.set(name=u"web")],
+                manifestations={unchanged.dataset_id: unchanged})}))
+            return waiting
+        d.addCallback(got_generation)
+        d.addCallback(self.assertEqual, {
+            u"generation": 2,
+            u"complete": False,
+            u"datasets": [],
+            u"removed_datasets": [removed.dataset_id],
+            u"containers": [{u"name": u"web", u"host": self.NODE_A,
+                             u"image": u"postgres:latest",
+                             u"restart_policy": {u"name": u"never"}}],
+            u"removed_containers": [u"db"],
+        })
+        return d
+
+    def test_state_changes(self):
+        """
+        With ``since`` only the datasets and containers of the cluster state
+        which changed since that generation are returned, once there are
+        changes.
+        """
+        manifestation = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        d = self.watch(b"/state/changes")
+
+        def got_generation(result):
+            waiting = self.watch(b"/state/changes", result[u"generation"])
+            self.cluster_state_service.apply_changes([NodeState(
+                hostname=self.NODE_A,
+                manifestations={manifestation.dataset_id: manifestation},
+                paths={manifestation.dataset_id: FilePath(b"/path")})])
+            return waiting
+        d.addCallback(got_generation)
+        d.addCallback(self.assertEqual, {
+            u"generation": 1,
+            u"complete": False,
+            u"datasets": [{u"dataset_id": manifestation.dataset_id,
+                           u"primary": self.NODE_A, u"path": u"/path"}],
+            u"removed_datasets": [],
+            u"containers": [],
+            u"removed_containers": [],
+        })
+        return d
+
+    def test_invalid_since(self):
+        """
+        A ``since`` which isn't a generation is rejected.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/changes?since=yesterday", None, BAD_REQUEST)
+
+
+RealTestsWatch, MemoryTestsWatch = buildIntegrationTests(
+    WatchTestsMixin, "Watch", _build_watch_app)
+
+
+class DeploymentIndexTests(SynchronousTestCase):
+    """
+    Tests for ``deployment_index``.
+    """
+    def setUp(self):
+        self.manifestation = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        self.application = Application(
+            name=u"site-clusterhq.com",
+            image=DockerImage.from_string(u"xxx"),
+            ports=[Port(internal_port=80, external_port=8080)],
+            volume=AttachedVolume(manifestation=self.manifestation,
+                                  mountpoint=FilePath(b"/blah")))
+        self.node = Node(
+            hostname=u"node1.example.com",
+            applications=[self.application],
+            manifestations={self.manifestation.dataset_id:
+                            self.manifestation})
+        self.other_node = Node(
+            hostname=u"node2.example.com",
+            manifestations={self.manifestation.dataset_id:
+                            self.manifestation.set(primary=False)})
+        self.deployment = Deployment(nodes=[self.node, self.other_node])
+
+    def test_manifestations(self):
+        """
+        The index maps each dataset ID to the manifestations of the dataset
+        and the nodes they are on.
+        """
+        index = deployment_index(self.deployment)
+        self.assertItemsEqual(
+            [(self.manifestation, self.node),
+             (self.manifestation.set(primary=False), self.other_node)],
+            index.manifestations[self.manifestation.dataset_id])
+
+    def test_applications(self):
+        """
+        The index maps each application name to the application and the node
+        it is on.
+        """
+        index = deployment_index(self.deployment)
+        self.assertEqual({self.application.name: (self.application,
+                                                  self.node)},
+                         index.applications)
+
+    def test_volumes(self):
+        """
+        The index maps the dataset ID of each attached volume to the
+        application it is attached to.
+        """
+        index = deployment_index(self.deployment)
+        self.assertEqual({self.manifestation.dataset_id: self.application},
+                         index.volumes)
+
+    def test_external_ports(self):
+        """
+        The index maps the external ports of all applications to the number
+        of applications using them.
+        """
+        index = deployment_index(self.deployment)
+        self.assertEqual({8080: 1}, index.external_ports)
+
+    def test_memoized(self):
+        """
+        The index of a deployment is only built once.
+        """
+        self.assertIs(deployment_index(self.deployment),
+                      deployment_index(self.deployment))
+
+    def test_changed_deployment(self):
+        """
+        A changed deployment gets its own index.
+        """
+        index = deployment_index(self.deployment)
+        changed = self.deployment.update_node(
+            self.other_node.set(manifestations={}))
+        self.assertEqual(
+            (1, 2),
+            (len(deployment_index(changed).manifestations[
+                self.manifestation.dataset_id]),
+             len(index.manifestations[self.manifestation.dataset_id])))
+
+    def test_least_recently_used_evicted(self):
+        """
+        Only the indexes of the most recently used deployments are kept.
+        """
+        index = deployment_index(self.deployment)
+        for _ in range(_DEPLOYMENT_INDEX_CACHE_SIZE):
+            deployment_index(Deployment())
+        self.assertIsNot(index, deployment_index(self.deployment))
+
+    def test_updated(self):
+        """
+        ``DeploymentIndex.updated`` returns the same index as indexing the
+        changed deployment from scratch, leaving the original index alone.
+        """
+        index = deployment_index(self.deployment)
+        original = vars(index).copy()
+        other_application = self.application.set(
+            name=u"other", volume=None)
+        changed = self.deployment.update_node(
+            self.other_node.set(applications=[other_application])
+        ).update_node(
+            self.node.set(applications=[], manifestations={})
+        ).update_node(Node(hostname=u"node3.example.com"))
+        self.assertEqual(
+            (vars(DeploymentIndex.from_deployment(changed)), original),
+            (vars(index.updated(self.deployment, changed)), vars(index)))
+
+    def test_updated_shares_unchanged(self):
+        """
+        ``DeploymentIndex.updated`` reuses the maps of the original index
+        which the change doesn't touch, rather than copying them.
+        """
+        index = deployment_index(self.deployment)
+        changed = self.deployment.update_node(
+            self.other_node.set(manifestations={}))
+        updated = index.updated(self.deployment, changed)
+        self.assertEqual(
+            (True, True, True),
+            (updated.applications is index.applications,
+             updated.volumes is index.volumes,
+             updated.external_ports is index.external_ports))
+
+    def test_updated_removed_node(self):
+        """
+        ``DeploymentIndex.updated`` removes the datasets and applications of
+        nodes that were removed.
+        """
+        index = deployment_index(self.deployment)
+        changed = Deployment(nodes=[self.other_node])
+        self.assertEqual(
+            vars(DeploymentIndex.from_deployment(changed)),
+            vars(index.updated(self.deployment, changed)))
+
+    def test_state(self):
+        """
+        A ``DeploymentState`` can be indexed, skipping nodes whose datasets
+        or applications are unknown.
+        """
+        state = DeploymentState(nodes=[
+            NodeState(hostname=self.node.hostname,
+                      applications=self.node.applications,
+                      manifestations=self.node.manifestations),
+            NodeState(hostname=self.other_node.hostname,
+                      applications=None, manifestations=None)])
+        index = deployment_index(state)
+        self.assertEqual(
+            ([self.node.hostname], [self.application.name]),
+            ([node.hostname for _, node in
+              index.manifestations[self.manifestation.dataset_id]],
+             list(index.applications)))
+
+    def test_listing(self):
+        """
+        ``DeploymentIndex.listing`` returns the keys and items given by
+        ``entries`` sorted by key, and only calls ``entries`` the first time
+        a listing is asked for.
+        """
+        index = deployment_index(self.deployment)
+        calls = []
+
+        def entries():
+            calls.append(None)
+            return [((u"b",), 2), ((u"a",), 1)]
+        first = index.listing(u"example", entries)
+        self.assertEqual(
+            (([(u"a",), (u"b",)], [1, 2]), True, 1),
+            (first, index.listing(u"example", entries) is first,
+             len(calls)))
+
+    def test_list_endpoint_listings_memoized(self):
+        """
+        The sorted listings the list endpoints page through are only built
+        once for each deployment.
+        """
+        self.assertEqual(
+            (True, True),
+            (_primary_manifestations(self.deployment) is
+             _primary_manifestations(self.deployment),
+             _node_applications(self.deployment) is
+             _node_applications(self.deployment)))
+
+    def test_listing_per_deployment(self):
+        """
+        A changed deployment's index has its own listings.
+        """
+        changed = self.deployment.update_node(
+            self.other_node.set(manifestations={}))
+        deployment_index(self.deployment).listing(u"example", lambda: [])
+        self.assertEqual(
+            ([(u"a",)], [1]),
+            deployment_index(changed).listing(
+                u"example", lambda: [((u"a",), 1)]))
+
+
 class APIDatasetFromDatasetAndNodeTests(SynchronousTestCase):
     """
     Tests for ``api_dataset_from_dataset_and_node``.
@@ -16,7 +16,10 @@ from twisted.python.filepath import FilePath
 from zope.interface.verify import verifyObject
 
 from ...testtools import make_with_init_tests
-from .._model import pset_field, pmap_field
+from .._model import (
+    pset_field, pmap_field, node_map_field, NodeMap, create_diff,
+    DeploymentDiff, DeploymentStateDiff,
+)
 from .. import (
     IClusterStateChange,
     Application, DockerImage, Node, Deployment, AttachedVolume, Dataset,
@@ -340,10 +343,12 @@ class NonManifestDatasetsTests(SynchronousTestCase):
 
 class DeploymentInitTests(make_with_init_tests(
         record_type=Deployment,
-        kwargs=dict(nodes=pset([
-            Node(hostname=u'node1.example.com', applications=frozenset()),
-            Node(hostname=u'node2.example.com', applications=frozenset())
-        ]))
+        kwargs=dict(nodes={
+            u'node1.example.com': Node(hostname=u'node1.example.com',
+                                       applications=frozenset()),
+            u'node2.example.com': Node(hostname=u'node2.example.com',
+                                       applications=frozenset()),
+        })
 )):
     """
     Tests for ``Deployment.__init__``.
@@ -881,6 +886,67 @@ class PMapFieldTests(SynchronousTestCase):
         assert Record(value={1: 2}).value == {1: 2}
 
 
+class NodeMapFieldTests(SynchronousTestCase):
+    """
+    Tests for ``node_map_field``.
+    """
+    class Record(PRecord):
+        nodes = node_map_field(Node)
+
+    NODE1 = Node(hostname=u"node1.example.com")
+    NODE2 = Node(hostname=u"node2.example.com")
+
+    def test_initial_value(self):
+        """
+        ``node_map_field`` results in an initial value that is empty.
+        """
+        self.assertEqual(self.Record().nodes, {})
+
+    def test_iterable(self):
+        """
+        ``node_map_field`` can be set from an iterable of nodes, resulting in
+        a ``NodeMap`` keyed by their hostnames.
+        """
+        record = self.Record(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            (True, {u"node1.example.com": self.NODE1,
+                    u"node2.example.com": self.NODE2}),
+            (isinstance(record.nodes, NodeMap), record.nodes))
+
+    def test_mapping(self):
+        """
+        ``node_map_field`` can be set from a mapping of hostnames to nodes.
+        """
+        self.assertEqual(
+            self.Record(nodes=[self.NODE1]),
+            self.Record(nodes={u"node1.example.com": self.NODE1}))
+
+    def test_same_map(self):
+        """
+        Setting a ``node_map_field`` to a map of its own type doesn't create
+        a new map.
+        """
+        record = self.Record(nodes=[self.NODE1])
+        nodes = record.nodes.set(self.NODE2.hostname, self.NODE2)
+        self.assertIs(nodes, record.set(nodes=nodes).nodes)
+
+    def test_checked_value(self):
+        """
+        ``node_map_field`` results in a map that enforces its value type.
+        """
+        record = self.Record()
+        self.assertRaises(
+            TypeError, record.nodes.set, u"node1.example.com",
+            NodeState(hostname=u"node1.example.com"))
+
+    def test_name(self):
+        """
+        The created map class name is based on the type of the nodes.
+        """
+        self.assertEqual(self.Record().nodes.__class__.__name__,
+                         "UnicodeNodePMap")
+
+
 class DeploymentStateTests(SynchronousTestCase):
     """
     Tests for ``DeploymentState``.
@@ -945,6 +1011,37 @@ class DeploymentStateTests(SynchronousTestCase):
             update_manifestations)
         self.assertEqual(updated, DeploymentState(nodes=[end_node]))
 
+    def test_update_node_unchanged(self):
+        """
+        ``update_node()`` returns the same ``DeploymentState`` if the given
+        ``NodeState`` doesn't change anything.
+        """
+        original = DeploymentState(nodes=[NodeState(
+            hostname=u"node1.example.com", used_ports=[1, 2])])
+        self.assertIs(
+            original,
+            original.update_node(NodeState(
+                hostname=u"node1.example.com", used_ports=[2, 1],
+                applications=None)))
+
+    def test_update_node_shares_unchanged(self):
+        """
+        ``update_node()`` keeps the existing values of attributes which are
+        unchanged by the given ``NodeState``.
+        """
+        original_node = NodeState(
+            hostname=u"node1.example.com", used_ports=[1, 2],
+            applications={APP1})
+        original = DeploymentState(nodes=[original_node])
+        updated = original.update_node(NodeState(
+            hostname=u"node1.example.com", used_ports=[1, 2],
+            applications={APP2}))
+        node = updated.get_node(u"node1.example.com")
+        self.assertEqual(
+            (node.used_ports, node.applications),
+            (original_node.used_ports, frozenset({APP2})))
+        self.assertIs(node.used_ports, original_node.used_ports)
+
     def test_nonmanifest_datasets_keys_are_their_ids(self):
         """
         The keys of the ``nonmanifest_datasets`` attribute must match the
@@ -953,3 +1050,115 @@ class DeploymentStateTests(SynchronousTestCase):
         self.assertRaises(InvariantException,
                           DeploymentState,
                           nonmanifest_datasets={u"123": MANIFESTATION.dataset})
+
+
+class CreateDiffTests(SynchronousTestCase):
+    """
+    Tests for ``create_diff``, ``DeploymentDiff`` and
+    ``DeploymentStateDiff``.
+    """
+    NODE1 = Node(hostname=u"node1.example.com", applications=[APP1])
+    NODE2 = Node(hostname=u"node2.example.com", applications=[APP2])
+    NODE_STATE1 = NodeState(hostname=u"node1.example.com",
+                            applications=[APP1])
+    NODE_STATE2 = NodeState(
+        hostname=u"node2.example.com",
+        manifestations={MANIFESTATION.dataset_id: MANIFESTATION})
+
+    def assertRoundTrip(self, original, updated):
+        """
+        Assert that the differences between two objects convert the
+        original into the updated object.
+        """
+        self.assertEqual(create_diff(original, updated).apply(original),
+                         updated)
+
+    def test_deployment_diff_type(self):
+        """
+        ``create_diff`` returns a ``DeploymentDiff`` for ``Deployment``
+        instances.
+        """
+        self.assertIsInstance(create_diff(Deployment(), Deployment()),
+                              DeploymentDiff)
+
+    def test_deployment_state_diff_type(self):
+        """
+        ``create_diff`` returns a ``DeploymentStateDiff`` for
+        ``DeploymentState`` instances.
+        """
+        self.assertIsInstance(
+            create_diff(DeploymentState(), DeploymentState()),
+            DeploymentStateDiff)
+
+    def test_unchanged_deployment(self):
+        """
+        The differences between equal ``Deployment`` instances are empty.
+        """
+        deployment = Deployment(nodes=[self.NODE1, self.NODE2])
+        self.assertEqual(create_diff(deployment, deployment),
+                         DeploymentDiff())
+
+    def test_only_changed_nodes(self):
+        """
+        Only nodes that have changed are included in the differences.
+        """
+        original = Deployment(nodes=[self.NODE1, self.NODE2])
+        changed = self.NODE2.transform(["applications"], lambda s: s.add(APP1))
+        updated = original.update_node(changed)
+        self.assertEqual(create_diff(original, updated),
+                         DeploymentDiff(changed_nodes=[changed]))
+
+    def test_deployment_added_node(self):
+        """
+        A ``DeploymentDiff`` can add a node.
+        """
+        self.assertRoundTrip(Deployment(nodes=[self.NODE1]),
+                             Deployment(nodes=[self.NODE1, self.NODE2]))
+
+    def test_deployment_removed_node(self):
+        """
+        A ``DeploymentDiff`` can remove a node.
+        """
+        self.assertRoundTrip(Deployment(nodes=[self.NODE1, self.NODE2]),
+                             Deployment(nodes=[self.NODE2]))
+
+    def test_deployment_changed_node(self):
+        """
+        A ``DeploymentDiff`` can change a node.
+        """
+        original = Deployment(nodes=[self.NODE1, self.NODE2])
+        self.assertRoundTrip(
+            original, original.update_node(self.NODE1.set(applications=[])))
+
+    def test_deployment_state_nodes(self):
+        """
+        A ``DeploymentStateDiff`` can add, remove and change nodes.
+        """
+        self.assertRoundTrip(
+            DeploymentState(nodes=[self.NODE_STATE1]),
+            DeploymentState(nodes=[self.NODE_STATE2]))
+        self.assertRoundTrip(
+            DeploymentState(nodes=[self.NODE_STATE1]),
+            DeploymentState(nodes=[self.NODE_STATE1.set(applications=None),
+                                   self.NODE_STATE2]))
+
+    def test_unchanged_nonmanifest_datasets(self):
+        """
+        ``DeploymentStateDiff.nonmanifest_datasets`` is ``None`` if the
+        non-manifest datasets have not changed.
+        """
+        state = DeploymentState(nonmanifest_datasets={
+            MANIFESTATION.dataset_id: MANIFESTATION.dataset})
+        self.assertEqual(
+            create_diff(state, state.update_node(self.NODE_STATE1)),
+            DeploymentStateDiff(changed_nodes=[self.NODE_STATE1],
+                                nonmanifest_datasets=None))
+
+    def test_changed_nonmanifest_datasets(self):
+        """
+        A ``DeploymentStateDiff`` can change the non-manifest datasets.
+        """
+        original = DeploymentState(nonmanifest_datasets={
+            MANIFESTATION.dataset_id: MANIFESTATION.dataset})
+        self.assertRoundTrip(original,
+                             original.set(nonmanifest_datasets={}))
@@ -4,6 +4,7 @@
 Tests for ``flocker.control._persistence``.
 """
 
+from json import loads
 from uuid import uuid4
 
 from eliot.testing import validate_logging, assertHasMessage, assertHasAction
@@ -12,15 +13,17 @@ from twisted.internet import reactor
 from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
 
-from pyrsistent import PRecord
+from pyrsistent import PRecord, InvariantException
 
 from .._persistence import (
     ConfigurationPersistenceService, wire_decode, wire_encode,
-    _LOG_SAVE, _LOG_STARTUP,
+    WireEncodeCache, cached_wire_encode, _LOG_SAVE, _LOG_STARTUP,
     )
+from ...testtools import FakeThreadsReactor
 from .._model import (
     Deployment, Application, DockerImage, Node, Dataset, Manifestation,
-    AttachedVolume, SERIALIZABLE_CLASSES)
+    AttachedVolume, SERIALIZABLE_CLASSES, NodeState, DeploymentState,
+    NonManifestDatasets, create_diff)
 
 
 DATASET = Dataset(dataset_id=unicode(uuid4()),
@@ -81,7 +84,19 @@ class ConfigurationPersistenceServiceTests(TestCase):
         """
         path = FilePath(self.mktemp())
         self.service(path)
-        self.assertTrue(path.child(b"current_configuration.v1.json").exists())
+        self.assertTrue(path.child(b"current_configuration.v2.log").exists())
+
+    def test_load_v1(self):
+        """
+        If there is only a configuration file in the format used before the
+        change log, the configuration is loaded from it.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"current_configuration.v1.json").setContent(
+            wire_encode(TEST_DEPLOYMENT))
+        service = self.service(path)
+        self.assertEqual(service.get(), TEST_DEPLOYMENT)
 
     @validate_logging(assertHasAction, _LOG_SAVE, succeeded=True,
                       startFields=dict(configuration=TEST_DEPLOYMENT))
@@ -134,6 +149,26 @@ class ConfigurationPersistenceServiceTests(TestCase):
         d.addCallback(saved_again)
         return d
 
+    def test_generation(self):
+        """
+        ``ConfigurationPersistenceService.generation`` is incremented every
+        time the configuration is saved.
+        """
+        service = self.service(FilePath(self.mktemp()))
+        generations = [service.generation()]
+        d = service.save(TEST_DEPLOYMENT)
+
+        def saved(_):
+            generations.append(service.generation())
+            return service.save(TEST_DEPLOYMENT)
+        d.addCallback(saved)
+
+        def saved_again(_):
+            generations.append(service.generation())
+            self.assertEqual(generations, [0, 1, 2])
+        d.addCallback(saved_again)
+        return d
+
     @validate_logging(
         lambda test, logger:
         test.assertEqual(len(logger.flush_tracebacks(ZeroDivisionError)), 1))
@@ -153,6 +188,214 @@ class ConfigurationPersistenceServiceTests(TestCase):
         return d
 
 
+class ConfigurationPersistenceServiceWriteTests(SynchronousTestCase):
+    """
+    Tests for how ``ConfigurationPersistenceService`` writes changes.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.reactor = FakeThreadsReactor()
+        self.service = self.start_service()
+
+    def start_service(self):
+        """
+        Start a service using ``self.path``.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(self.reactor, self.path)
+        service.startService()
+        return service
+
+    def records(self):
+        """
+        :return: The number of records in the change log.
+        """
+        return len(self.path.child(
+            b"current_configuration.v2.log").getContent().splitlines())
+
+    def deployment(self, datasets):
+        """
+        :param int datasets: The number of datasets on the last node.
+
+        :return: A ``Deployment`` with ten nodes with ten datasets each and
+            a last node with the given number of datasets.
+        """
+        nodes = []
+        for node_index, node_datasets in enumerate([10] * 10 + [datasets]):
+            manifestations = [
+                Manifestation(dataset=Dataset(
+                    dataset_id=u"%d-%d" % (node_index, i)), primary=True)
+                for i in range(node_datasets)]
+            nodes.append(Node(
+                hostname=u"node%d.example.com" % (node_index,),
+                manifestations={manifestation.dataset_id: manifestation
+                                for manifestation in manifestations}))
+        return Deployment(nodes=nodes)
+
+    def test_save_before_write(self):
+        """
+        A saved configuration is returned by ``get`` before it is written,
+        and the ``Deferred`` returned by ``save`` fires once it is written.
+        """
+        saving = self.service.save(TEST_DEPLOYMENT)
+        result = (self.service.get(), self.service.generation(),
+                  saving.called)
+        self.reactor.threadpool.run_pending()
+        self.assertEqual((TEST_DEPLOYMENT, 1, False, None),
+                         result + (self.successResultOf(saving),))
+
+    def test_write_in_thread(self):
+        """
+        Saved configurations are written in the reactor's thread pool.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        before = self.path.child(b"current_configuration.v2.log").getContent()
+        self.reactor.threadpool.run_pending()
+        self.assertEqual(
+            (before, 2),
+            (self.path.child(b"current_configuration.v2.log").getContent()[
+                :len(before)], self.records()))
+
+    def test_group_commit(self):
+        """
+        Configurations saved while a write is in progress are written
+        together by a single later write.
+        """
+        self.service.save(self.deployment(1))
+        self.service.save(self.deployment(2))
+        self.service.save(self.deployment(3))
+        pending = [len(self.reactor.threadpool.pending)]
+        onResult, f, args, kwargs = self.reactor.threadpool.pending.pop(0)
+        onResult(True, f(*args, **kwargs))
+        pending.append(len(self.reactor.threadpool.pending))
+        self.reactor.threadpool.run_pending()
+        self.assertEqual(([1, 1], self.deployment(3)),
+                         (pending, self.start_service().get()))
+
+    def test_record_per_save(self):
+        """
+        Each saved configuration is appended to the change log as a separate
+        record.
+        """
+        self.service.save(self.deployment(0))
+        self.reactor.threadpool.run_pending()
+        # The log has grown larger than its first record, so is compacted:
+        self.service.save(self.deployment(1))
+        self.reactor.threadpool.run_pending()
+        compacted = self.records()
+        self.service.save(self.deployment(2))
+        self.service.save(self.deployment(3))
+        self.reactor.threadpool.run_pending()
+        self.assertEqual(
+            (1, 3, self.deployment(3)),
+            (compacted, self.records(), self.start_service().get()))
+
+    def test_compacted_on_start(self):
+        """
+        The change log is compacted when the service starts.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        self.reactor.threadpool.run_pending()
+        self.start_service()
+        self.assertEqual(1, self.records())
+
+    def test_partial_record_ignored(self):
+        """
+        A partial last record in the change log, left by an interrupted
+        write, is ignored.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        self.reactor.threadpool.run_pending()
+        log = self.path.child(b"current_configuration.v2.log")
+        log.setContent(log.getContent() + wire_encode(
+            create_diff(TEST_DEPLOYMENT, Deployment()))[:-5])
+        self.assertEqual(TEST_DEPLOYMENT, self.start_service().get())
+
+    def test_default_format(self):
+        """
+        Records are written in the default wire format, which doesn't depend
+        on the exact definition of the model classes.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        self.reactor.threadpool.run_pending()
+        lines = self.path.child(
+            b"current_configuration.v2.log").getContent().splitlines()
+        self.assertEqual(
+            [wire_encode(Deployment()),
+             wire_encode(create_diff(Deployment(), TEST_DEPLOYMENT))],
+            lines)
+
+    def test_invalid_record(self):
+        """
+        Records are validated when the change log is loaded.
+        """
+        log = self.path.child(b"current_configuration.v2.log")
+        log.setContent(wire_encode(TEST_DEPLOYMENT).replace(
+            DATASET.dataset_id.encode("ascii"), bytes(uuid4()), 1) + b"\n")
+        service = ConfigurationPersistenceService(self.reactor, self.path)
+        self.assertRaises(InvariantException, service.startService)
+
+    @validate_logging(
+        lambda test, logger:
+        test.assertEqual(len(logger.flush_tracebacks(IOError)), 1))
+    def test_write_failure(self, logger):
+        """
+        If a write fails the ``Deferred`` returned by ``save`` fails, and the
+        next write replaces the change log with the latest configuration.
+        """
+        self.patch(self.service, "logger", logger)
+        log = self.service._log
+        path = log._path
+        log._path = self.path.child(b"missing").child(b"log")
+        saving = self.service.save(TEST_DEPLOYMENT)
+        self.reactor.threadpool.run_pending()
+        self.failureResultOf(saving, IOError)
+        log._path = path
+        self.service.save(self.deployment(1))
+        self.reactor.threadpool.run_pending()
+        self.assertEqual((1, self.deployment(1)),
+                         (self.records(), self.start_service().get()))
+
+    @validate_logging(
+        lambda test, logger:
+        test.assertEqual(len(logger.flush_tracebacks(EnvironmentError)), 1))
+    def test_write_failure_reverts(self, logger):
+        """
+        If a write fails, the configuration reverts to the last one written
+        with a new generation, the registered callbacks are called, and the
+        changes saved during the failed write fail too.
+        """
+        self.patch(self.service, "logger", logger)
+        self.service.save(self.deployment(1))
+        self.reactor.threadpool.run_pending()
+        generations = []
+        self.service.register(
+            lambda: generations.append(self.service.generation()))
+        log = self.service._log
+        log._path = self.path.child(b"missing").child(b"log")
+        saving = self.service.save(self.deployment(2))
+        later = self.service.save(self.deployment(3))
+        self.reactor.threadpool.run_pending()
+        self.failureResultOf(saving, EnvironmentError)
+        self.failureResultOf(later, EnvironmentError)
+        self.assertEqual(
+            (self.deployment(1), [2, 3, 4]),
+            (self.service.get(), generations))
+
+    def test_stop_after_write(self):
+        """
+        ``stopService`` returns a ``Deferred`` which fires once saved
+        configurations are written.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        stopping = self.service.stopService()
+        called = stopping.called
+        self.reactor.threadpool.run_pending()
+        self.assertEqual((False, None),
+                         (called, self.successResultOf(stopping)))
+
+
 class WireEncodeDecodeTests(SynchronousTestCase):
     """
     Tests for ``wire_encode`` and ``wire_decode``.
@@ -170,6 +413,14 @@ class WireEncodeDecodeTests(SynchronousTestCase):
         self.assertEqual(TEST_DEPLOYMENT,
                          wire_decode(wire_encode(TEST_DEPLOYMENT)))
 
+    def test_nodes_list(self):
+        """
+        ``wire_encode`` encodes the nodes of a ``Deployment`` as a list, as
+        they were when they were stored in a set.
+        """
+        self.assertIsInstance(
+            loads(wire_encode(TEST_DEPLOYMENT))[u"nodes"], list)
+
     def test_no_arbitrary_decoding(self):
         """
         ``wire_decode`` will not decode classes that are not in
@@ -189,3 +440,176 @@ class WireEncodeDecodeTests(SynchronousTestCase):
         # Possibly future versions might throw exception, the key point is
         # that the returned object is not a Temp instance.
         self.assertFalse(isinstance(wire_decode(data), Temp))
+
+
+TEST_STATE = DeploymentState(
+    nodes=[NodeState(hostname=u"node1.example.com",
+                     used_ports=[1, 2],
+                     applications=TEST_DEPLOYMENT.get_node(
+                         u"node1.example.com").applications,
+                     manifestations={DATASET.dataset_id: MANIFESTATION},
+                     paths={DATASET.dataset_id: FilePath(b"/xxx/yyy")}),
+           NodeState(hostname=u"node2.example.com",
+                     used_ports=None, applications=None,
+                     manifestations=None, paths=None)],
+    nonmanifest_datasets={DATASET.dataset_id: DATASET})
+
+
+class CompactWireEncodeDecodeTests(SynchronousTestCase):
+    """
+    Tests for ``wire_encode`` and ``wire_decode`` using the compact format.
+    """
+    def assert_roundtrip(self, obj):
+        """
+        Assert that the object round-trips through the compact format.
+
+        :param obj: The object to encode.
+        """
+        data = wire_encode(obj, compact=True)
+        self.assertEqual([bytes, obj], [type(data), wire_decode(data)])
+
+    def test_deployment(self):
+        """
+        A ``Deployment`` round-trips.
+        """
+        self.assert_roundtrip(TEST_DEPLOYMENT)
+
+    def test_deployment_state(self):
+        """
+        A ``DeploymentState`` including nodes with optional fields both
+        set and unset round-trips.
+        """
+        self.assert_roundtrip(TEST_STATE)
+
+    def test_diffs(self):
+        """
+        ``DeploymentDiff`` and ``DeploymentStateDiff`` instances round-trip.
+        """
+        self.assert_roundtrip(create_diff(Deployment(), TEST_DEPLOYMENT))
+        self.assert_roundtrip(create_diff(DeploymentState(), TEST_STATE))
+
+    def test_list(self):
+        """
+        A list of model objects round-trips.
+        """
+        self.assert_roundtrip([TEST_STATE, TEST_DEPLOYMENT])
+
+    def test_smaller(self):
+        """
+        The compact format is smaller than the default format.
+        """
+        self.assertLess(len(wire_encode(TEST_STATE, compact=True)),
+                        len(wire_encode(TEST_STATE)))
+
+    def test_types(self):
+        """
+        Decoded objects have the same field types as the originals.
+        """
+        decoded = wire_decode(wire_encode(TEST_STATE, compact=True))
+
+        def types(state):
+            return {(node.hostname, key): type(value)
+                    for node in state.nodes.values()
+                    for key, value in node.items()}
+        self.assertEqual(types(TEST_STATE), types(decoded))
+
+    def test_invariants(self):
+        """
+        Invariants are checked when decoding.
+        """
+        data = wire_encode(
+            NonManifestDatasets(datasets={DATASET.dataset_id: DATASET}),
+            compact=True)
+        data = data.replace(DATASET.dataset_id, unicode(uuid4()), 1)
+        self.assertRaises(InvariantException, wire_decode, data)
+
+    def test_no_arbitrary_decoding(self):
+        """
+        ``wire_decode`` will not decode classes that are not in
+        ``SERIALIZABLE_CLASSES``.
+        """
+        class Temp(PRecord):
+            """A class."""
+        SERIALIZABLE_CLASSES.append(Temp)
+
+        def cleanup():
+            if Temp in SERIALIZABLE_CLASSES:
+                SERIALIZABLE_CLASSES.remove(Temp)
+        self.addCleanup(cleanup)
+
+        data = wire_encode(Temp(), compact=True)
+        SERIALIZABLE_CLASSES.remove(Temp)
+        self.assertFalse(isinstance(wire_decode(data), Temp))
+
+
+class WireEncodeCacheTests(SynchronousTestCase):
+    """
+    Tests for ``WireEncodeCache`` and ``cached_wire_encode``.
+    """
+    def setUp(self):
+        self.encoded = []
+
+        def encode(obj):
+            self.encoded.append(obj)
+            return wire_encode(obj)
+        self.cache = WireEncodeCache(2, encode=encode)
+
+    def test_encode(self):
+        """
+        ``WireEncodeCache.encode`` returns the same bytes as ``wire_encode``.
+        """
+        self.assertEqual(wire_encode(TEST_DEPLOYMENT),
+                         self.cache.encode(TEST_DEPLOYMENT))
+
+    def test_encoded_once(self):
+        """
+        Encoding the same object repeatedly only encodes it once.
+        """
+        for _ in range(3):
+            self.cache.encode(TEST_DEPLOYMENT)
+        self.assertEqual(self.encoded, [TEST_DEPLOYMENT])
+
+    def test_identity(self):
+        """
+        Objects are cached by identity, so an equal but distinct object is
+        encoded again.
+        """
+        copy = TEST_DEPLOYMENT.set(nodes=dict(TEST_DEPLOYMENT.nodes))
+        self.cache.encode(TEST_DEPLOYMENT)
+        self.cache.encode(copy)
+        self.assertEqual(
+            [id(obj) for obj in self.encoded],
+            [id(TEST_DEPLOYMENT), id(copy)])
+
+    def test_least_recently_used_evicted(self):
+        """
+        When the cache is full the least recently used object is evicted.
+        """
+        first = Deployment()
+        second = Deployment()
+        third = Deployment()
+        for obj in [first, second, first, third, first, second]:
+            self.cache.encode(obj)
+        self.assertEqual(
+            [id(obj) for obj in self.encoded],
+            [id(first), id(second), id(third), id(second)])
+
+    def test_mutable_not_cached(self):
+        """
+        Objects that aren't ``PRecord`` instances are encoded every time,
+        since they may have been mutated.
+        """
+        obj = [u"abc"]
+        first = self.cache.encode(obj)
+        obj.append(u"def")
+        second = self.cache.encode(obj)
+        self.assertEqual((wire_decode(first), wire_decode(second)),
+                         ([u"abc"], [u"abc", u"def"]))
+
+    def test_cached_wire_encode(self):
+        """
+        ``cached_wire_encode`` returns the same bytes as ``wire_encode``
+        using the compact format.
+        """
+        self.assertEqual(wire_encode(TEST_DEPLOYMENT, compact=True),
+                         cached_wire_encode(TEST_DEPLOYMENT))
@@ -11,31 +11,40 @@ from zope.interface.verify import verifyObject
 
 from characteristic import attributes, Attribute
 
+from pyrsistent import InvariantException
+
 from eliot import ActionType, start_action, MemoryLogger, Logger
 from eliot.testing import validate_logging, assertHasAction, LoggedAction
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, AMP, MAX_VALUE_LENGTH, AmpBox, Unicode,
+    parseString, TooLong,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
 
 from .._protocol import (
-    SerializableArgument,
+    SerializableArgument, SerializableListArgument, Big,
     VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
     AgentAMP, ControlAMPService, ControlAMP, _AgentLocator,
     ControlServiceLocator, LOG_SEND_CLUSTER_STATE, LOG_SEND_TO_AGENT,
+    ClusterStatusDiffCommand, GenerationMismatch, DEFAULT_BROADCAST_WINDOW,
 )
 from .._clusterstate import ClusterStateService
 from .. import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
     Dataset, DeploymentState, NonManifestDatasets,
 )
+from .._model import create_diff
 from .._persistence import ConfigurationPersistenceService
+from ...testtools import FakeThreadsReactor
 
 
 class LoopbackAMPClient(object):
@@ -181,24 +190,218 @@ class SerializationTests(SynchronousTestCase):
         self.assertRaises(
             TypeError, SerializableArgument(NodeState).fromString, as_bytes)
 
+    def test_invariants_checked(self):
+        """
+        ``SerializableArgument`` checks the invariants of the objects it
+        deserializes, since they may come from an agent.
+        """
+        argument = SerializableArgument(NonManifestDatasets)
+        as_bytes = argument.toString(NONMANIFEST).replace(
+            NONMANIFEST.datasets.keys()[0], unicode(uuid4()), 1)
+        self.assertRaises(InvariantException, argument.fromString, as_bytes)
+
+
+class SerializableListArgumentTests(SynchronousTestCase):
+    """
+    Tests for ``SerializableListArgument``.
+    """
+    def test_roundtrip(self):
+        """
+        ``SerializableListArgument`` can round-trip a list of instances of
+        any of the given types.
+        """
+        argument = SerializableListArgument(NodeState, NonManifestDatasets)
+        as_bytes = argument.toString([NODE_STATE, NONMANIFEST])
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, [NODE_STATE, NONMANIFEST]],
+                         [type(as_bytes), deserialized])
+
+    def test_wrong_type_serialization(self):
+        """
+        ``SerializableListArgument`` throws a ``TypeError`` if one attempts
+        to serialize a list containing an object of the wrong type.
+        """
+        argument = SerializableListArgument(NodeState)
+        self.assertRaises(
+            TypeError, argument.toString, [NODE_STATE, TEST_DEPLOYMENT])
+
+    def test_wrong_type_deserialization(self):
+        """
+        ``SerializableListArgument`` throws a ``TypeError`` if one attempts
+        to deserialize a list containing an object of the wrong type.
+        """
+        as_bytes = SerializableListArgument(NodeState, Deployment).toString(
+            [NODE_STATE, TEST_DEPLOYMENT])
+        self.assertRaises(
+            TypeError, SerializableListArgument(NodeState).fromString,
+            as_bytes)
+
+    def test_not_a_list_deserialization(self):
+        """
+        ``SerializableListArgument`` throws a ``TypeError`` if one attempts
+        to deserialize something other than a list.
+        """
+        as_bytes = SerializableArgument(NodeState).toString(NODE_STATE)
+        self.assertRaises(
+            TypeError, SerializableListArgument(NodeState).fromString,
+            as_bytes)
 
-def build_control_amp_service(test):
+
+def large_deployment_state(datasets):
+    """
+    Create a ``DeploymentState`` with a single node that has the given
+    number of datasets.
+
+    :param int datasets: The number of datasets.
+
+    :return DeploymentState: The state.
+    """
+    manifestations = {}
+    for i in range(datasets):
+        manifestation = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4()),
+                            metadata={u"name": u"dataset-%d" % (i,)}),
+            primary=True)
+        manifestations[manifestation.dataset_id] = manifestation
+    return DeploymentState(nodes=[
+        NodeState(hostname=u"node1.example.com",
+                  manifestations=manifestations)])
+
+
+class BigTests(SynchronousTestCase):
+    """
+    Tests for ``Big``.
+    """
+    def roundtrip(self, argument, value):
+        """
+        Encode a value into an ``AmpBox`` with the given argument, serialize
+        the box to bytes and parse it and decode the value back again.
+
+        :param Argument argument: The argument to use.
+        :param value: The value to encode.
+
+        :return: A tuple of the decoded value and the serialized box.
+        """
+        box = AmpBox()
+        argument.toBox(b"value", box, {b"value": value}, None)
+        serialized = box.serialize()
+        [parsed] = parseString(serialized)
+        objects = {}
+        argument.fromBox(b"value", parsed, objects, None)
+        return objects[b"value"], box
+
+    def test_small(self):
+        """
+        A value smaller than the maximum AMP value size round-trips.
+        """
+        argument = Big(SerializableArgument(NodeState))
+        result, box = self.roundtrip(argument, NODE_STATE)
+        self.assertEqual((NODE_STATE, [b"value.1"]),
+                         (result, box.keys()))
+
+    def test_empty(self):
+        """
+        An empty value round-trips.
+        """
+        argument = Big(Unicode())
+        result, _ = self.roundtrip(argument, u"")
+        self.assertEqual(u"", result)
+
+    def test_large(self):
+        """
+        A value larger than the maximum AMP value size is split into
+        multiple chunks and round-trips.
+        """
+        state = large_deployment_state(1000)
+        argument = Big(SerializableArgument(DeploymentState))
+        result, box = self.roundtrip(argument, state)
+        self.assertEqual(
+            (state, True),
+            (result, len(box) > 1 and all(
+                len(value) <= MAX_VALUE_LENGTH for value in box.values())))
+
+    def test_compression(self):
+        """
+        If compression is enabled the value is compressed before being split
+        into chunks and round-trips.
+        """
+        state = large_deployment_state(1000)
+        uncompressed = Big(SerializableArgument(DeploymentState))
+        compressed = Big(SerializableArgument(DeploymentState),
+                         compression=True)
+        result, compressed_box = self.roundtrip(compressed, state)
+        _, uncompressed_box = self.roundtrip(uncompressed, state)
+        self.assertEqual(
+            (state, True),
+            (result,
+             len(compressed_box.serialize()) <
+             len(uncompressed_box.serialize())))
+
+    def test_decompressed_limit(self):
+        """
+        A compressed value which decompresses to more than the given maximum
+        length is rejected, without being decompressed any further.
+        """
+        value = u"x" * 10000
+        sender = Big(Unicode(), compression=True)
+        receiver = Big(Unicode(), compression=True, max_length=1000)
+        box = AmpBox()
+        sender.toBox(b"value", box, {b"value": value}, None)
+        error = self.assertRaises(
+            TooLong, receiver.fromBox, b"value", box, {}, None)
+        self.assertEqual(
+            (False, False, b"value", 1000, value),
+            (error.isKey, error.isLocal, error.keyName, len(error.value),
+             self.roundtrip(Big(Unicode(), compression=True,
+                                max_length=10000), value)[0]))
+
+    def test_large_command(self):
+        """
+        A ``ClusterStatusCommand`` with a cluster state that encodes to more
+        than the maximum AMP value size round-trips.
+        """
+        state = large_deployment_state(2000)
+        arguments = dict(configuration=TEST_DEPLOYMENT,
+                         configuration_generation=1,
+                         state=state,
+                         state_generation=2)
+        action = start_action(MemoryLogger(), "test")
+        box = ClusterStatusCommand.makeArguments(
+            dict(eliot_context=action, **arguments), None)
+        [parsed] = parseString(box.serialize())
+        locator = _AgentLocator(FakeAgent())
+        parsed = ClusterStatusCommand.parseArguments(parsed, locator)
+        del parsed["eliot_context"]
+        self.assertEqual(arguments, parsed)
+
+
+def build_control_amp_service(test, reactor=None,
+                              broadcast_window=DEFAULT_BROADCAST_WINDOW,
+                              expiry=None):
     """
     Create a new ``ControlAMPService``.
 
     :param TestCase test: The test this service is for.
+    :param reactor: The ``IReactorTime`` provider the service uses to
+        schedule broadcasts, or ``None`` to use a new ``Clock``.
+    :param float broadcast_window: The service's broadcast window.
+    :param expiry: The number of seconds after which the cluster state
+        service expires node state, or ``None`` to never expire it.
 
     :return ControlAMPService: Not started.
     """
-    cluster_state = ClusterStateService()
+    if reactor is None:
+        reactor = Clock()
+    cluster_state = ClusterStateService(reactor, expiry=expiry)
     cluster_state.startService()
     test.addCleanup(cluster_state.stopService)
     persistence_service = ConfigurationPersistenceService(
-        None, FilePath(test.mktemp()))
+        FakeThreadsReactor(), FilePath(test.mktemp()))
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
-    return ControlAMPService(cluster_state, persistence_service,
-                             TCP4ServerEndpoint(MemoryReactor(), 1234))
+    return ControlAMPService(reactor, cluster_state, persistence_service,
+                             TCP4ServerEndpoint(MemoryReactor(), 1234),
+                             broadcast_window=broadcast_window)
 
 
 class ControlTestCase(SynchronousTestCase):
@@ -240,7 +443,9 @@ class ControlAMPTests(ControlTestCase):
     Tests for ``ControlAMP`` and ``ControlServiceLocator``.
     """
     def setUp(self):
-        self.control_amp_service = build_control_amp_service(self)
+        self.reactor = Clock()
+        self.control_amp_service = build_control_amp_service(
+            self, self.reactor)
         self.protocol = ControlAMP(self.control_amp_service)
         self.client = LoopbackAMPClient(self.protocol.locator)
 
@@ -271,7 +476,9 @@ class ControlAMPTests(ControlTestCase):
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   configuration_generation=1,
+                   state=cluster_state,
+                   state_generation=1))))
 
     def test_connection_lost(self):
         """
@@ -317,8 +524,8 @@ class ControlAMPTests(ControlTestCase):
     def test_nodestate_notifies_all_connected(self):
         """
         ``NodeStateCommand`` results in all connected ``ControlAMP``
-        connections getting the updated cluster state along with the
-        desired configuration.
+        connections getting the changes to the cluster state and desired
+        configuration since they were last sent them.
         """
         self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
         self.protocol.makeConnection(StringTransport())
@@ -334,12 +541,79 @@ class ControlAMPTests(ControlTestCase):
             self.client.callRemote(NodeStateCommand,
                                    state_changes=(NODE_STATE,),
                                    eliot_context=TEST_ACTION))
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
         cluster_state = self.control_amp_service.cluster_state.as_deployment()
+        expected = dict(
+            configuration_diff=create_diff(TEST_DEPLOYMENT, TEST_DEPLOYMENT),
+            start_configuration_generation=1,
+            end_configuration_generation=1,
+            state_diff=create_diff(DeploymentState(), cluster_state),
+            start_state_generation=0,
+            end_state_generation=1)
         self.assertListEqual(
             [sent1[-1], sent2[-1]],
-            [(((ClusterStatusCommand,),
-              dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+            [((ClusterStatusDiffCommand,), expected)] * 2)
+
+    def test_generation_mismatch_sends_full_status(self):
+        """
+        If a connection refuses differences because it doesn't have the
+        generations they are based on, the full cluster status is sent to
+        it.
+        """
+        self.protocol.makeConnection(StringTransport())
+        sent = []
+        results = [fail(GenerationMismatch()), succeed({})]
+
+        def call_remote(command, **kwargs):
+            kwargs.pop("eliot_context")
+            sent.append((command, kwargs))
+            return results.pop(0)
+        # Patching is bad.
+        # https://clusterhq.atlassian.net/browse/FLOC-1603
+        self.patch(self.protocol, "callRemote", call_remote)
+
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(
+            [command for (command, _) in sent],
+            [ClusterStatusDiffCommand, ClusterStatusCommand])
+
+    def test_error_sends_full_status_next_time(self):
+        """
+        If sending to a connection fails, the full cluster status is sent to
+        it the next time the cluster status changes.
+        """
+        self.protocol.makeConnection(StringTransport())
+        sent = []
+        results = [fail(ConnectionLost()), succeed({})]
+
+        def call_remote(command, **kwargs):
+            kwargs.pop("eliot_context")
+            sent.append((command, kwargs))
+            return results.pop(0)
+        # Patching is bad.
+        # https://clusterhq.atlassian.net/browse/FLOC-1603
+        self.patch(self.protocol, "callRemote", call_remote)
+
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.control_amp_service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(
+            [command for (command, _) in sent],
+            [ClusterStatusDiffCommand, ClusterStatusCommand])
+
+    def test_reconnect_sends_full_status(self):
+        """
+        A connection which disconnects and then reconnects is sent the full
+        cluster status.
+        """
+        self.protocol.makeConnection(StringTransport())
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        self.assertEqual(sent[0][0], (ClusterStatusCommand,))
 
 
 class ControlAMPServiceTests(ControlTestCase):
@@ -408,7 +682,8 @@ class ControlAMPServiceTests(ControlTestCase):
         A configuration change results in connected protocols being notified
         of new cluster status.
         """
-        service = build_control_amp_service(self)
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
         service.startService()
         protocol = ControlAMP(service)
         protocol.makeConnection(StringTransport())
@@ -416,20 +691,202 @@ class ControlAMPServiceTests(ControlTestCase):
         self.patch_call_remote(sent, protocol=protocol)
 
         service.configuration_service.save(TEST_DEPLOYMENT)
+        reactor.advance(DEFAULT_BROADCAST_WINDOW)
         # Should only be one callRemote call.
         (sent,) = sent
         self.assertArgsEqual(
             sent,
             (
-                (ClusterStatusCommand,),
+                (ClusterStatusDiffCommand,),
                 dict(
-                    configuration=TEST_DEPLOYMENT,
-                    state=DeploymentState(),
+                    configuration_diff=create_diff(
+                        Deployment(), TEST_DEPLOYMENT),
+                    start_configuration_generation=0,
+                    end_configuration_generation=1,
+                    state_diff=create_diff(
+                        DeploymentState(), DeploymentState()),
+                    start_state_generation=0,
+                    end_state_generation=0,
                 )
             )
         )
 
 
+class BroadcastTests(ControlTestCase):
+    """
+    Tests for how ``ControlAMPService`` schedules sending changes to
+    connected agents.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.service = build_control_amp_service(self, self.reactor)
+        self.protocol = ControlAMP(self.service)
+        self.protocol.makeConnection(StringTransport())
+        self.sent = []
+        self.patch_call_remote(self.sent, self.protocol)
+
+    def test_delayed(self):
+        """
+        Changes are only sent once the broadcast window has passed.
+        """
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW - 0.1)
+        before = len(self.sent)
+        self.reactor.advance(0.1)
+        self.assertEqual((before, len(self.sent)), (0, 1))
+
+    def test_custom_window(self):
+        """
+        The broadcast window can be configured.
+        """
+        service = build_control_amp_service(
+            self, self.reactor, broadcast_window=5)
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, protocol)
+        service.node_changed([NODE_STATE])
+        self.reactor.advance(4.9)
+        before = len(sent)
+        self.reactor.advance(0.1)
+        self.assertEqual((before, len(sent)), (0, 1))
+
+    def test_coalesced(self):
+        """
+        All changes that happen within a broadcast window are sent together
+        as a single command.
+        """
+        another_node = NodeState(hostname=u"node2.example.com")
+        self.service.node_changed([NODE_STATE])
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        self.service.node_changed([another_node])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(
+            self.sent,
+            [((ClusterStatusDiffCommand,), dict(
+                configuration_diff=create_diff(Deployment(), TEST_DEPLOYMENT),
+                start_configuration_generation=0,
+                end_configuration_generation=1,
+                state_diff=create_diff(
+                    DeploymentState(),
+                    DeploymentState(nodes={NODE_STATE, another_node})),
+                start_state_generation=0,
+                end_state_generation=2))])
+
+    def test_new_window(self):
+        """
+        Changes after a broadcast are sent at the end of a new broadcast
+        window.
+        """
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_unchanged_not_sent(self):
+        """
+        Nothing is sent to a connection if the configuration and state are
+        the same as what it was last sent.
+        """
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        # A change which is undone within the same window:
+        self.service.node_changed([NODE_STATE.set(used_ports=[1, 2, 3])])
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_unchanged_base(self):
+        """
+        If nothing was sent to a connection because nothing changed, later
+        changes are sent relative to what it was last sent.
+        """
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.service.node_changed([NODE_STATE.set(used_ports=[1, 2, 3])])
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        _, kwargs = self.sent[-1]
+        self.assertEqual(
+            (kwargs["start_state_generation"],
+             kwargs["end_state_generation"]),
+            (1, 3))
+
+    def test_connected_during_window(self):
+        """
+        A connection made during a broadcast window is sent the full
+        configuration and state immediately and is not sent anything
+        further at the end of the window if nothing else changed.
+        """
+        self.service.node_changed([NODE_STATE])
+        protocol = ControlAMP(self.service)
+        sent = []
+        self.patch_call_remote(sent, protocol)
+        protocol.makeConnection(StringTransport())
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual([command for ((command,), _) in sent],
+                         [ClusterStatusCommand])
+
+    def test_stop_service(self):
+        """
+        Stopping the service cancels any scheduled broadcast.
+        """
+        self.service.startService()
+        self.service.node_changed([NODE_STATE])
+        self.service.stopService()
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def expiring_service(self):
+        """
+        :return: A ``ControlAMPService`` whose cluster state expires node
+            state after ten seconds, with a connected agent, and a ``list``
+            of the commands sent to the agent.
+        """
+        service = build_control_amp_service(self, self.reactor, expiry=10)
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, protocol)
+        return service, sent
+
+    def test_expiry_sent(self):
+        """
+        When the state of a node expires the change is sent to connected
+        agents without waiting for some other change.
+        """
+        service, sent = self.expiring_service()
+        service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        reported = service.cluster_state.as_deployment()
+        # Expiry happens at the first tick after ten seconds:
+        self.reactor.advance(11)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        expired = service.cluster_state.as_deployment()
+        _, kwargs = sent[-1]
+        self.assertEqual(
+            (2, NODE_STATE.hostname in expired.nodes,
+             create_diff(reported, expired)),
+            (len(sent), False, kwargs["state_diff"]))
+
+    def test_no_expiry_sent_after_stop(self):
+        """
+        Once the service has stopped, expiry of node state doesn't schedule
+        a broadcast.
+        """
+        service, sent = self.expiring_service()
+        service.startService()
+        service.node_changed([NODE_STATE])
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        service.stopService()
+        # Expiry happens at the first tick after ten seconds:
+        self.reactor.advance(11)
+        self.reactor.advance(DEFAULT_BROADCAST_WINDOW)
+        self.assertEqual(1, len(sent))
+
+
 @implementer(IConvergenceAgent)
 @attributes([Attribute("is_connected", default_value=False),
              Attribute("is_disconnected", default_value=False),
@@ -505,15 +962,93 @@ class AgentClientTests(SynchronousTestCase):
         d = self.server.callRemote(
             ClusterStatusCommand,
             configuration=TEST_DEPLOYMENT,
+            configuration_generation=1,
             state=actual,
+            state_generation=2,
             eliot_context=TEST_ACTION
         )
 
-        self.successResultOf(d)
-        self.assertEqual(self.agent, FakeAgent(is_connected=True,
-                                               client=self.client,
-                                               desired=TEST_DEPLOYMENT,
-                                               actual=actual))
+        self.assertEqual(
+            (self.successResultOf(d), self.agent),
+            ({"configuration_generation": 1, "state_generation": 2},
+             FakeAgent(is_connected=True, client=self.client,
+                       desired=TEST_DEPLOYMENT, actual=actual)))
+
+    def send_diff(self, start_generations, end_generations):
+        """
+        Send a ``ClusterStatusDiffCommand`` to the client which adds
+        ``NODE_STATE`` to the state and ``TEST_DEPLOYMENT``'s nodes to
+        an empty configuration.
+
+        :param tuple start_generations: The configuration and state
+            generations the differences are from.
+        :param tuple end_generations: The configuration and state
+            generations the differences are to.
+
+        :return: The ``Deferred`` result of the command.
+        """
+        return self.server.callRemote(
+            ClusterStatusDiffCommand,
+            configuration_diff=create_diff(Deployment(), TEST_DEPLOYMENT),
+            start_configuration_generation=start_generations[0],
+            end_configuration_generation=end_generations[0],
+            state_diff=create_diff(
+                DeploymentState(), DeploymentState(nodes=[NODE_STATE])),
+            start_state_generation=start_generations[1],
+            end_state_generation=end_generations[1],
+            eliot_context=TEST_ACTION
+        )
+
+    def test_cluster_diff(self):
+        """
+        ``ClusterStatusDiffCommand`` sent to the ``AgentClient`` results in
+        the agent being told about the previously received cluster status
+        updated with the differences.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=Deployment(),
+            configuration_generation=1,
+            state=DeploymentState(),
+            state_generation=2,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.send_diff((1, 2), (3, 4))
+        self.assertEqual(
+            (self.successResultOf(d), self.agent),
+            ({"configuration_generation": 3, "state_generation": 4},
+             FakeAgent(is_connected=True, client=self.client,
+                       desired=TEST_DEPLOYMENT,
+                       actual=DeploymentState(nodes=[NODE_STATE]))))
+
+    def test_cluster_diff_mismatch(self):
+        """
+        ``ClusterStatusDiffCommand`` fails with ``GenerationMismatch`` if the
+        differences are not based on the generations the ``AgentClient``
+        last received, and the agent is not notified.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=Deployment(),
+            configuration_generation=1,
+            state=DeploymentState(),
+            state_generation=2,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.send_diff((1, 1), (3, 4))
+        self.failureResultOf(d, GenerationMismatch)
+        self.assertEqual(self.agent.desired, Deployment())
+
+    def test_cluster_diff_before_status(self):
+        """
+        ``ClusterStatusDiffCommand`` fails with ``GenerationMismatch`` if no
+        ``ClusterStatusCommand`` has been received.
+        """
+        self.client.makeConnection(StringTransport())
+        self.failureResultOf(self.send_diff((0, 0), (1, 1)),
+                             GenerationMismatch)
 
 
 def iconvergence_agent_tests_factory(fixture):
@@ -605,7 +1140,8 @@ class ClusterStatusCommandTests(SynchronousTestCase):
         ClusterStatusCommand requires the following arguments.
         """
         self.assertItemsEqual(
-            ['configuration', 'state', 'eliot_context'],
+            ['configuration', 'configuration_generation', 'state',
+             'state_generation', 'eliot_context'],
             (v[0] for v in ClusterStatusCommand.arguments))
 
 
@@ -695,7 +1231,8 @@ class SendStateToConnectionsTests(SynchronousTestCase):
         An error sending to one agent does not prevent others from being
         notified.
         """
-        control_amp_service = build_control_amp_service(self)
+        reactor = Clock()
+        control_amp_service = build_control_amp_service(self, reactor)
         self.patch(control_amp_service, 'logger', logger)
 
         connected_protocol = ControlAMP(control_amp_service)
@@ -714,6 +1251,7 @@ class SendStateToConnectionsTests(SynchronousTestCase):
         control_amp_service.connected(disconnected_protocol)
         control_amp_service.connected(connected_protocol)
         control_amp_service.node_changed((NodeState(hostname=u"1.2.3.4"),))
+        reactor.advance(DEFAULT_BROADCAST_WINDOW)
 
         actions = LoggedAction.ofType(logger.messages, LOG_SEND_TO_AGENT)
         self.assertEqual(
@@ -70,6 +70,40 @@ class ControlOptionsTests(StandardOptionsTestsMixin,
         options.parseOptions([b"--agent-port", b"tcp:1234"])
         self.assertEqual(options["agent-port"], b"tcp:1234")
 
+    def test_default_output_validation_interval(self):
+        """
+        By default one in 100 API responses are validated.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["output-validation-interval"], 100)
+
+    def test_custom_output_validation_interval(self):
+        """
+        The ``--output-validation-interval`` command-line option allows
+        configuring how often API responses are validated.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--output-validation-interval", b"1"])
+        self.assertEqual(options["output-validation-interval"], 1)
+
+    def test_default_state_expiry(self):
+        """
+        By default node state expires after two minutes.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["state-expiry"], 120.0)
+
+    def test_custom_state_expiry(self):
+        """
+        The ``--state-expiry`` command-line option allows configuring how
+        long node state is kept without being reported again.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--state-expiry", b"7.5"])
+        self.assertEqual(options["state-expiry"], 7.5)
+
 
 class ControlScriptEffectsTests(SynchronousTestCase):
     """
@@ -123,6 +157,35 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         self.assertEqual((service.__class__, service.running),
                          (ClusterStateService, True))
 
+    def test_state_expiry(self):
+        """
+        ``ControlScript.main`` configures the cluster state service with the
+        given state expiry.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--state-expiry", b"7", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        server = reactor.tcpServers[0]
+        service = server[1].resource._v1_user.cluster_state_service
+        self.assertEqual(7.0, service._expiry)
+
+    def test_output_validation_interval(self):
+        """
+        ``ControlScript.main`` configures the HTTP API with the given output
+        validation interval.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--output-validation-interval", b"7",
+             b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        server = reactor.tcpServers[0]
+        self.assertEqual(
+            7, server[1].resource._v1_user.output_validation_interval)
+
     def test_starts_control_amp_service(self):
         """
         ``ControlScript.main`` starts a AMP service on the given port.
@@ -0,0 +1,104 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._watch``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._watch import ChangeHistory
+
+
+class ChangeHistoryTests(SynchronousTestCase):
+    """
+    Tests for ``ChangeHistory``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.generation = 0
+        self.data = u"initial"
+        self.history = ChangeHistory(
+            self.clock, lambda: self.generation, lambda: self.data, size=3)
+
+    def change(self, data):
+        """
+        Change the data and tell the history about it.
+
+        :param data: The new data.
+        """
+        self.generation += 1
+        self.data = data
+        self.history.changed()
+
+    def test_since_older(self):
+        """
+        Waiting with an older remembered generation fires immediately with
+        the data at that generation and the current data.
+        """
+        self.history.changed()
+        self.change(u"first")
+        self.change(u"second")
+        self.assertEqual(
+            (u"initial", 2, u"second"),
+            self.successResultOf(self.history.wait(0, 30)))
+
+    def test_since_unknown(self):
+        """
+        Waiting with a generation which isn't remembered fires immediately
+        with ``None`` for the data at that generation.
+        """
+        self.assertEqual(
+            (None, 0, u"initial"),
+            self.successResultOf(self.history.wait(7, 30)))
+
+    def test_since_forgotten(self):
+        """
+        Only the given number of versions are remembered.
+        """
+        self.history.changed()
+        for data in [u"first", u"second", u"third"]:
+            self.change(data)
+        self.assertEqual(
+            [(None, 3, u"third"), (u"first", 3, u"third")],
+            [self.successResultOf(self.history.wait(0, 30)),
+             self.successResultOf(self.history.wait(1, 30))])
+
+    def test_wait_for_change(self):
+        """
+        Waiting with the current generation fires once the data changes.
+        """
+        waiting = self.history.wait(0, 30)
+        self.assertNoResult(waiting)
+        self.change(u"first")
+        self.assertEqual((u"initial", 1, u"first"),
+                         self.successResultOf(waiting))
+
+    def test_timeout(self):
+        """
+        Waiting with the current generation fires with the unchanged data
+        once the timeout passes.
+        """
+        waiting = self.history.wait(0, 30)
+        self.clock.advance(29)
+        self.assertNoResult(waiting)
+        self.clock.advance(1)
+        self.assertEqual((u"initial", 0, u"initial"),
+                         self.successResultOf(waiting))
+
+    def test_change_cancels_timeout(self):
+        """
+        The timeout is cancelled once the data changes.
+        """
+        self.history.wait(0, 30)
+        self.change(u"first")
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_changed_without_change(self):
+        """
+        Calling ``changed`` when the generation is unchanged does not wake up
+        anyone waiting.
+        """
+        waiting = self.history.wait(0, 30)
+        self.history.changed()
+        self.assertNoResult(waiting)
@@ -6,12 +6,12 @@ Local node manager for Flocker.
 
 from ._deploy import (
     P2PNodeDeployer, change_node_state, IDeployer, IStateChange,
-    InParallel, Sequentially, P2PManifestationDeployer,
+    InParallel, Sequentially, InDependencyOrder, P2PManifestationDeployer,
     ApplicationNodeDeployer
 )
 
 __all__ = [
     'P2PNodeDeployer', 'change_node_state', 'IDeployer', 'IStateChange',
-    'InParallel', 'Sequentially', 'P2PManifestationDeployer',
-    'ApplicationNodeDeployer'
+    'InParallel', 'Sequentially', 'InDependencyOrder',
+    'P2PManifestationDeployer', 'ApplicationNodeDeployer'
 ]
@@ -5,17 +5,20 @@
 Deploy applications on nodes.
 """
 
+from collections import defaultdict, deque
 from itertools import chain
 
 from zope.interface import Interface, implementer, Attribute
 
 from characteristic import attributes
 
-from pyrsistent import PRecord, field
+from pyrsistent import PRecord, CheckedPVector, field, pmap
 
 from eliot import write_failure, Logger
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from twisted.internet.defer import (
+    Deferred, gatherResults, fail, succeed, maybeDeferred)
+from twisted.python.failure import Failure
 
 from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
 from ..control._model import (
@@ -47,6 +50,27 @@ def _to_volume_name(dataset_id):
     return VolumeName(namespace=u"default", dataset_id=dataset_id)
 
 
+def _dataset_id(application):
+    """
+    :param Application application: An application.
+
+    :return: The ID of the dataset the application uses, or ``None`` if it
+        has no volume.
+    """
+    if application.volume is None:
+        return None
+    return application.volume.manifestation.dataset_id
+
+
+def _external_ports(application):
+    """
+    :param Application application: An application.
+
+    :return: A ``set`` of the ports the application exposes on the node.
+    """
+    return {port.external_port for port in application.ports}
+
+
 class IStateChange(Interface):
     """
     An operation that changes local state.
@@ -184,6 +208,177 @@ class InParallel(object):
             [change.run(deployer) for change in self.changes])
 
 
+def _to_dependencies(dependencies):
+    """
+    :param dependencies: A mapping from indexes of changes to collections of
+        indexes of the changes they depend on.
+
+    :return: The same dependencies as a ``PMap`` of ``frozenset``\ s,
+        leaving out changes which depend on nothing.
+    """
+    return pmap({index: frozenset(after)
+                 for index, after in dependencies.items() if after})
+
+
+class _StateChangeVector(CheckedPVector):
+    """
+    A ``CheckedPVector`` of ``IStateChange`` providers.
+    """
+    __invariant__ = lambda change: (
+        IStateChange.providedBy(change),
+        "{!r} does not provide IStateChange".format(change))
+
+
+@implementer(IStateChange)
+class InDependencyOrder(PRecord):
+    """
+    Run a series of changes, each as soon as the changes it depends on have
+    succeeded.
+
+    Failures in one change stop the changes which depend on it, but not
+    other changes.  ``Sequentially`` is the case where each change depends
+    on the one before it, and ``InParallel`` the case where no change
+    depends on another.
+
+    :ivar PVector changes: The ``IStateChange`` providers to run.
+    :ivar dependencies: A ``PMap`` mapping the index in ``changes`` of a
+        change to a ``frozenset`` of the indexes of the changes which must
+        succeed before it starts.  Changes which aren't included depend on
+        nothing.
+    :ivar limit: The largest number of changes to run at the same time, at
+        least 1, or ``None`` for no limit.
+    """
+    changes = field(type=_StateChangeVector, factory=_StateChangeVector,
+                    mandatory=True)
+    dependencies = field(initial=pmap(), factory=_to_dependencies)
+    limit = field(
+        type=(int, long, type(None)), initial=None,
+        invariant=lambda limit: (limit is None or limit >= 1,
+                                 "limit must be None or at least 1"))
+
+    def run(self, deployer):
+        return _DependencyOrderRun(self, deployer).start()
+
+
+class _DependencyOrderRun(object):
+    """
+    The progress of running an ``InDependencyOrder``.
+
+    :ivar dict _waiting: Map the index of each change which hasn't started
+        to the ``set`` of indexes of the changes it is still waiting for.
+    :ivar dict _dependents: Map the index of each change to a ``list`` of
+        the indexes of the changes which depend on it.
+    :ivar deque _ready: The indexes of the changes which can start once
+        fewer than the limit are running.
+    :ivar int _running: The number of changes running.
+    :ivar list _results: The ``Deferred``\ s of the changes started.
+    :ivar bool _starting: Whether changes are being started, so changes
+        which finish immediately don't start more recursively.
+    :ivar Deferred _done: Fires once nothing is running and nothing more
+        can start.
+    """
+    def __init__(self, change, deployer):
+        """
+        :param InDependencyOrder change: The changes to run.
+        :param IDeployer deployer: The ``IDeployer`` to run them with.
+        """
+        self._changes = change.changes
+        self._limit = change.limit
+        self._deployer = deployer
+        self._waiting = {index: set(change.dependencies.get(index, ()))
+                         for index in range(len(self._changes))}
+        self._dependents = defaultdict(list)
+        for index, after in sorted(self._waiting.items()):
+            for dependency in after:
+                self._dependents[dependency].append(index)
+        self._ready = deque(index for index, after
+                            in sorted(self._waiting.items()) if not after)
+        self._running = 0
+        self._results = []
+        self._starting = False
+        self._done = Deferred()
+
+    def _check(self):
+        """
+        Make sure every change can eventually start.
+
+        :raise ValueError: If a change depends on a change which isn't part
+            of the series, or changes depend on each other.
+        """
+        if not set(self._dependents).issubset(self._waiting):
+            raise ValueError(
+                "Changes can only depend on other changes in the series.")
+        unfinished = {index: len(after)
+                      for index, after in self._waiting.items()}
+        startable = list(self._ready)
+        while startable:
+            for dependent in self._dependents[startable.pop()]:
+                unfinished[dependent] -= 1
+                if not unfinished[dependent]:
+                    startable.append(dependent)
+        if any(unfinished.values()):
+            raise ValueError("Changes can't depend on each other.")
+
+    def start(self):
+        """
+        Start running the changes.
+
+        :return: ``Deferred`` firing once every change which could run is
+            done, failing if any of them failed.
+        """
+        try:
+            self._check()
+        except ValueError:
+            return fail()
+        self._start_ready()
+        return self._done
+
+    def _start_ready(self):
+        """
+        Start as many of the ready changes as the limit allows, and fire
+        ``_done`` if nothing is left running.
+        """
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            while self._ready and (
+                    self._limit is None or self._running < self._limit):
+                index = self._ready.popleft()
+                del self._waiting[index]
+                self._running += 1
+                result = maybeDeferred(
+                    self._changes[index].run, self._deployer)
+                self._results.append(result)
+                result.addBoth(self._finished, index)
+        finally:
+            self._starting = False
+        if self._running == 0 and not self._done.called:
+            gathering = gather_deferreds(self._results)
+            gathering.addCallback(lambda _: None)
+            gathering.chainDeferred(self._done)
+
+    def _finished(self, result, index):
+        """
+        Note that a change is done, making the changes which depend on it
+        ready if it succeeded.
+
+        :param result: The result of the change.
+        :param int index: The index of the change.
+
+        :return: ``result``, so failures are reported.
+        """
+        self._running -= 1
+        if not isinstance(result, Failure):
+            for dependent in self._dependents[index]:
+                waiting = self._waiting[dependent]
+                waiting.discard(index)
+                if not waiting:
+                    self._ready.append(dependent)
+        self._start_ready()
+        return result
+
+
 @implementer(IStateChange)
 @attributes(["application", "hostname"])
 class StartApplication(object):
@@ -271,6 +466,25 @@ def _link_environment(protocol, alias, local_port, hostname, remote_port):
     }
 
 
+@implementer(IStateChange)
+class PullImages(PRecord):
+    """
+    Make sure the Docker images needed to start applications are available
+    locally, downloading any which aren't at the same time.
+
+    Pulling images before anything is stopped means the time spent
+    downloading them isn't part of an application's downtime.
+
+    :ivar images: The ``DockerImage``\ s needed.
+    """
+    images = pset_field(DockerImage)
+
+    def run(self, deployer):
+        return gather_deferreds([
+            deployer.docker_client.pull(image.full_name)
+            for image in self.images])
+
+
 @implementer(IStateChange)
 @attributes(["application"])
 class StopApplication(object):
@@ -525,8 +739,13 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
         deployment operations. Default ``DockerClient``.
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
+    :ivar limit: The largest number of changes calculated by
+        ``calculate_necessary_state_changes`` to run at the same time, or
+        ``None`` for no limit.  ``DockerClient`` separately limits how many
+        requests of each kind it makes to Docker at once.
     """
-    def __init__(self, hostname, docker_client=None, network=None):
+    def __init__(self, hostname, docker_client=None, network=None,
+                 limit=None):
         self.hostname = hostname
         if docker_client is None:
             docker_client = DockerClient()
@@ -534,6 +753,7 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
         if network is None:
             network = make_host_network()
         self.network = network
+        self.limit = limit
 
     def discover_local_state(self, local_state):
         """
@@ -659,15 +879,22 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
         Work out which changes need to happen to the local state to match
         the given desired state.
 
-        Currently this involves the following phases:
-
-        1. Change proxies to point to new addresses (should really be
-           last, see https://clusterhq.atlassian.net/browse/FLOC-380)
-        2. Stop all relevant containers.
-        3. Handoff volumes.
-        4. Wait for volumes.
-        5. Create volumes.
-        6. Start and restart any relevant containers.
+        Each change only waits for the changes it depends on, so e.g. a slow
+        dataset handoff doesn't delay starting unrelated applications:
+
+        * Proxies, open ports, image pulls and resizes of datasets here
+          depend on nothing.  (Proxies should really change last, see
+          https://clusterhq.atlassian.net/browse/FLOC-380)
+        * Datasets moving away are pushed once they are resized.
+        * Containers are stopped after datasets moving away have had an
+          initial push, and containers using ports needed by a container
+          being started are stopped after its image is pulled, so
+          application downtime excludes copying data or downloading images.
+        * Datasets are handed off or deleted after containers are stopped.
+        * Datasets coming here are resized once they have arrived.
+        * Containers are started or restarted once their image is pulled,
+          their dataset is ready and any container using the same ports or
+          the same dataset is stopped.
 
         :param NodeState local_state: The local state of the node.
         :param Deployment desired_configuration: The intended
@@ -681,12 +908,26 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
 
         :return: A ``IStateChange`` provider.
         """
-        phases = []
+        changes = []
+        dependencies = {}
+
+        def add(change, after=()):
+            """
+            Add a change to those which will be run.
+
+            :param IStateChange change: The change.
+            :param after: The indexes of the changes it depends on.
+
+            :return: The index of the change.
+            """
+            dependencies[len(changes)] = after
+            changes.append(change)
+            return len(changes) - 1
 
         desired_proxies = set()
         desired_open_ports = set()
         desired_node_applications = []
-        for node in desired_configuration.nodes:
+        for node in desired_configuration.nodes.values():
             if node.hostname == self.hostname:
                 desired_node_applications = node.applications
                 for application in node.applications:
@@ -702,10 +943,10 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
                                                   port=port.external_port))
 
         if desired_proxies != set(self.network.enumerate_proxies()):
-            phases.append(SetProxies(ports=desired_proxies))
+            add(SetProxies(ports=desired_proxies))
 
         if desired_open_ports != set(self.network.enumerate_open_ports()):
-            phases.append(OpenPorts(ports=desired_open_ports))
+            add(OpenPorts(ports=desired_open_ports))
 
         # We are a node-specific IDeployer:
         current_node_state = local_state
@@ -729,8 +970,10 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
         stop_names = {app.name for app in all_applications}.difference(
             desired_local_state)
 
-        start_containers = [
-            StartApplication(application=app, hostname=self.hostname)
+        # The applications to start or restart, each with the change doing
+        # so:
+        starting = [
+            (StartApplication(application=app, hostname=self.hostname), app)
             for app in desired_node_applications
             if app.name in start_names
         ]
@@ -738,13 +981,18 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
             StopApplication(application=app) for app in all_applications
             if app.name in stop_names
         ]
-        restart_containers = [
-            Sequentially(changes=[StopApplication(application=app),
-                                  StartApplication(application=app,
-                                                   hostname=self.hostname)])
+        # Containers restarted because they stopped already have their
+        # image, so only new containers and changed images need pulling:
+        images = {app.image for app in desired_node_applications
+                  if app.name in start_names}
+        starting.extend(
+            (Sequentially(changes=[StopApplication(application=app),
+                                   StartApplication(application=app,
+                                                    hostname=self.hostname)]),
+             app)
             for app in desired_node_applications
             if app.name in not_running
-        ]
+        )
 
         applications_to_inspect = current_state & desired_local_state
         current_applications_dict = dict(zip(
@@ -763,65 +1011,95 @@ class ApplicationNodeDeployer(_OldToNewDeployer):
                 inspect_desired = inspect_desired.transform(
                     ["volume", "manifestation", "dataset", "metadata"], {})
             if inspect_desired != inspect_current:
-                changes = [
+                sequence = Sequentially(changes=[
                     StopApplication(application=inspect_current),
                     StartApplication(application=inspect_desired,
                                      hostname=self.hostname)
-                ]
-                sequence = Sequentially(changes=changes)
-                if sequence not in restart_containers:
-                    restart_containers.append(sequence)
+                ])
+                if (sequence, inspect_desired) not in starting:
+                    starting.append((sequence, inspect_desired))
+                if inspect_desired.image != inspect_current.image:
+                    images.add(inspect_desired.image)
+
+        pulling = [add(PullImages(images=images))] if images else []
 
         # Find any dataset that are moving to or from this node - or
         # that are being newly created by this new configuration.
         dataset_changes = find_dataset_changes(
             self.hostname, current_cluster_state, desired_configuration)
 
-        if dataset_changes.resizing:
-            phases.append(InParallel(changes=[
-                ResizeDataset(dataset=dataset)
-                for dataset in dataset_changes.resizing]))
+        # The changes which must succeed before an application can use a
+        # dataset, by dataset ID:
+        dataset_ready = defaultdict(list)
+        for dataset in dataset_changes.resizing:
+            dataset_ready[dataset.dataset_id].append(
+                add(ResizeDataset(dataset=dataset)))
 
         # Do an initial push of all volumes that are going to move, so
         # that the final push which happens during handoff is a quick
         # incremental push. This should significantly reduces the
         # application downtime caused by the time it takes to copy
         # data.
-        if dataset_changes.going:
-            phases.append(InParallel(changes=[
+        pushes = {}
+        for handoff in dataset_changes.going:
+            dataset_id = handoff.dataset.dataset_id
+            pushes[dataset_id] = add(
                 PushDataset(dataset=handoff.dataset,
-                            hostname=handoff.hostname)
-                for handoff in dataset_changes.going]))
-
-        if stop_containers:
-            phases.append(InParallel(changes=stop_containers))
-        if dataset_changes.going:
-            phases.append(InParallel(changes=[
-                HandoffDataset(dataset=handoff.dataset,
-                               hostname=handoff.hostname)
-                for handoff in dataset_changes.going]))
+                            hostname=handoff.hostname),
+                dataset_ready[dataset_id])
+
+        # Discovered applications don't necessarily say which dataset they
+        # use, so every stop waits for every initial push and every handoff
+        # or deletion waits for every stop:
+        pulled_ports = {
+            port for _, application in starting
+            if application.image in images
+            for port in _external_ports(application)}
+        stops = []
+        stops_using_port = defaultdict(list)
+        stops_using_dataset = defaultdict(list)
+        for stop in stop_containers:
+            ports = _external_ports(stop.application)
+            after = list(pushes.values())
+            if ports & pulled_ports:
+                after.extend(pulling)
+            index = add(stop, after)
+            stops.append(index)
+            for port in ports:
+                stops_using_port[port].append(index)
+            dataset_id = _dataset_id(stop.application)
+            if dataset_id is not None:
+                stops_using_dataset[dataset_id].append(index)
+
+        for handoff in dataset_changes.going:
+            add(HandoffDataset(dataset=handoff.dataset,
+                               hostname=handoff.hostname),
+                [pushes[handoff.dataset.dataset_id]] + stops)
         # any datasets coming to this node should also be
         # resized to the appropriate quota max size once they
         # have been received
-        if dataset_changes.coming:
-            phases.append(InParallel(changes=[
-                WaitForDataset(dataset=dataset)
-                for dataset in dataset_changes.coming]))
-            phases.append(InParallel(changes=[
-                ResizeDataset(dataset=dataset)
-                for dataset in dataset_changes.coming]))
-        if dataset_changes.creating:
-            phases.append(InParallel(changes=[
-                CreateDataset(dataset=dataset)
-                for dataset in dataset_changes.creating]))
-        if dataset_changes.deleting:
-            phases.append(InParallel(changes=[
-                DeleteDataset(dataset=dataset)
-                for dataset in dataset_changes.deleting]))
-        start_restart = start_containers + restart_containers
-        if start_restart:
-            phases.append(InParallel(changes=start_restart))
-        return Sequentially(changes=phases)
+        for dataset in dataset_changes.coming:
+            waiting = add(WaitForDataset(dataset=dataset))
+            dataset_ready[dataset.dataset_id].append(
+                add(ResizeDataset(dataset=dataset), [waiting]))
+        for dataset in dataset_changes.creating:
+            dataset_ready[dataset.dataset_id].append(
+                add(CreateDataset(dataset=dataset)))
+        for dataset in dataset_changes.deleting:
+            add(DeleteDataset(dataset=dataset), stops)
+
+        for change, application in starting:
+            dataset_id = _dataset_id(application)
+            after = list(dataset_ready[dataset_id])
+            # Two containers must never use a dataset at the same time:
+            after.extend(stops_using_dataset[dataset_id])
+            if application.image in images:
+                after.extend(pulling)
+            for port in _external_ports(application):
+                after.extend(stops_using_port[port])
+            add(change, after)
+        return InDependencyOrder(changes=changes, dependencies=dependencies,
+                                 limit=self.limit)
 
 
 def change_node_state(deployer, desired_configuration,  current_cluster_state):
@@ -874,11 +1152,12 @@ def find_dataset_changes(hostname, current_state, desired_state):
     desired_datasets = {node.hostname:
                         set(manifestation.dataset for manifestation
                             in node.manifestations.values())
-                        for node in desired_state.nodes}
+                        for node in desired_state.nodes.values()}
     current_datasets = {node.hostname:
                         set(manifestation.dataset for manifestation
                             in node.manifestations.values())
-                        for node in current_state.nodes}
+                        for node in current_state.nodes.values()
+                        if node.manifestations is not None}
     local_desired_datasets = desired_datasets.get(hostname, set())
     local_desired_dataset_ids = set(dataset.dataset_id for dataset in
                                     local_desired_datasets)
@@ -7,20 +7,32 @@ Docker API client.
 
 from __future__ import absolute_import
 
+from collections import OrderedDict
+from httplib import HTTPConnection
+from json import loads
+from threading import Event, Thread, local
 from time import sleep
 
 from zope.interface import Interface, implementer
 
+from eliot import Logger, write_traceback
+
 from docker import Client
 from docker.errors import APIError
+from docker.unixconn.unixconn import (
+    UnixAdapter, UnixHTTPConnection, UnixHTTPConnectionPool)
 from docker.utils import create_host_config
 
 from pyrsistent import field, PRecord
 
+from twisted.application.service import Service
 from twisted.python.components import proxyForInterface
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, fail
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import (
+    DeferredSemaphore, FirstError, gatherResults, maybeDeferred, succeed,
+    fail)
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
 
 from ..control._model import (
@@ -187,6 +199,15 @@ class IDockerClient(Interface):
 
         """
 
+    def pull(image_name):
+        """
+        Make sure an image is available locally, downloading it if it isn't.
+
+        :param unicode image_name: The Docker image to make available.
+
+        :return: ``Deferred`` that fires once the image is available.
+        """
+
     def exists(unit_name):
         """
         Check whether the unit exists.
@@ -225,6 +246,7 @@ class FakeDockerClient(object):
     The state the the simulated units is stored in memory.
 
     :ivar dict _units: See ``units`` of ``__init__``\ .
+    :ivar set pulled_images: The names of the images which were pulled.
     """
 
     def __init__(self, units=None):
@@ -237,6 +259,11 @@ class FakeDockerClient(object):
         if units is None:
             units = {}
         self._units = units
+        self.pulled_images = set()
+
+    def pull(self, image_name):
+        self.pulled_images.add(image_name)
+        return succeed(None)
 
     def add(self, unit_name, image_name, ports=frozenset(), environment=None,
             volumes=frozenset(), mem_limit=None, cpu_shares=None,
@@ -274,23 +301,306 @@ class FakeDockerClient(object):
 BASE_NAMESPACE = u"flocker--"
 BASE_DOCKER_API_URL = u'unix://var/run/docker.sock'
 
+# The number of threads used to talk to Docker:
+_DOCKER_THREADS = 10
+
+# The number of each kind of Docker operation which may run at the same
+# time, unless configured otherwise.  Inspections are of the containers or
+# images needed while listing units, and only one listing runs at a time
+# since listings update what is remembered about containers.  Pulls are
+# bounded by the registry's bandwidth rather than Docker's:
+_DOCKER_LIMITS = {
+    u"pull": 2,
+    u"add": 4,
+    u"remove": 4,
+    u"exists": 4,
+    u"list": 1,
+    u"inspect": 8,
+}
+
+# The number of images whose environment is remembered between listings:
+_IMAGE_CACHE_SIZE = 64
+
+# The Docker events which may change what is known about a container:
+_CONTAINER_EVENTS = frozenset([
+    u"create", u"destroy", u"die", u"kill", u"oom", u"pause", u"rename",
+    u"restart", u"start", u"stop", u"unpause"])
+
+
+class _UnixConnection(UnixHTTPConnection):
+    """
+    A connection to Docker's unix socket which can be reused.
+
+    docker-py's connection sends every request to the path it was first
+    created for, so it makes a new connection pool for every path.
+    """
+    def request(self, method, url, **kwargs):
+        HTTPConnection.request(self, method, url, **kwargs)
+
+
+class _UnixConnectionPool(UnixHTTPConnectionPool):
+    """
+    A pool of reusable connections to Docker's unix socket.
+    """
+    def _new_conn(self):
+        return _UnixConnection(self.base_url, self.socket_path, self.timeout)
+
+
+class _PersistentUnixAdapter(UnixAdapter):
+    """
+    A ``requests`` adapter which sends all requests to Docker's unix socket
+    through one pool, so connections are kept alive between requests.
+    """
+    def request_url(self, request, proxies):
+        # The URL's "host" and the start of its path are the socket's path:
+        return request.url[len(self.base_url):]
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(self.base_url)
+            if pool is None:
+                pool = _UnixConnectionPool(self.base_url, url, self.timeout)
+                self.pools[self.base_url] = pool
+        return pool
+
+
+class _PerThreadClient(local):
+    """
+    A docker-py ``Client`` for each thread using this object, so each of
+    the threads talking to Docker has a session and connection of its own.
+    """
+    def __init__(self, base_url):
+        """
+        :param unicode base_url: The URL of the Docker API.
+        """
+        self.client = Client(version="1.15", base_url=base_url)
+        if self.client.base_url.startswith(u"http+unix://"):
+            self.client.mount(
+                u"http+unix://",
+                _PersistentUnixAdapter(self.client.base_url,
+                                       self.client._timeout))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class _Operation(object):
+    """
+    Limit how many of one kind of Docker operation run at the same time,
+    and measure them.
+
+    :ivar DeferredSemaphore _semaphore: Limits the number of operations
+        running.
+    :ivar int calls: The number of operations which finished.
+    :ivar float total_latency: The total number of seconds taken by those
+        operations, from being requested to finishing.
+    :ivar float max_latency: The longest such time taken.
+    """
+    def __init__(self, reactor, limit):
+        """
+        :param IReactorTime reactor: Used to measure latency.
+        :param int limit: How many operations may run at the same time.
+        """
+        self._reactor = reactor
+        self._semaphore = DeferredSemaphore(limit)
+        self.calls = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def run(self, f, *args, **kwargs):
+        """
+        Run an operation once fewer than the limit are running.
+
+        :param f: Callable returning a ``Deferred``.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        requested = self._reactor.seconds()
+
+        def finished(result):
+            latency = self._reactor.seconds() - requested
+            self.calls += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            return result
+        running = self._semaphore.run(f, *args, **kwargs)
+        running.addBoth(finished)
+        return running
+
+    def statistics(self):
+        """
+        :return: A ``dict`` describing the operations: the number
+            ``queued`` waiting to run, the number ``running``, the number
+            of ``calls`` finished and their ``mean_latency`` and
+            ``max_latency`` in seconds.
+        """
+        return {
+            u"queued": len(self._semaphore.waiting),
+            u"running": self._semaphore.limit - self._semaphore.tokens,
+            u"calls": self.calls,
+            u"mean_latency": self.total_latency / max(self.calls, 1),
+            u"max_latency": self.max_latency,
+        }
+
+
+def _gather(deferreds):
+    """
+    Gather the results of some ``Deferred``\ s, failing with the first
+    failure itself rather than a ``FirstError`` wrapping it.
+
+    :param list deferreds: ``Deferred``\ s to gather.
+
+    :return: ``Deferred`` firing with a ``list`` of their results.
+    """
+    gathering = gatherResults(deferreds, consumeErrors=True)
+
+    def unwrap(failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+    gathering.addErrback(unwrap)
+    return gathering
+
 
 @implementer(IDockerClient)
 class DockerClient(object):
     """
     Talk to the real Docker server directly.
 
-    Some operations can take a while (e.g. stopping a container), so we
-    use a thread pool. See https://clusterhq.atlassian.net/browse/FLOC-718
-    for using a custom thread pool.
+    Some operations can take a while (e.g. stopping a container), so they
+    run in a thread pool of their own, rather than competing with other
+    users of the reactor's thread pool.  Each thread has its own persistent
+    connection to Docker.  The number of each kind of operation running at
+    once is limited, and their queue depths and latencies are available
+    from ``statistics``.
+
+    Listing inspects several containers at a time, and remembers enough
+    between listings that unchanged containers are not parsed again and
+    each image is only inspected once.  While a ``DockerEventsService``
+    follows Docker's events for this client, only the containers which
+    events say changed are inspected, and the functions given to
+    ``register`` are told about changes.  Otherwise every listing inspects
+    every container, so listings are never out of date.
 
     :ivar unicode namespace: A namespace prefix to add to container names
         so we don't clobber other applications interacting with Docker.
+    :ivar dict _operations: Map the kinds of operation to the
+        ``_Operation`` limiting and measuring them.
+    :ivar int _pending: The number of calls given to the thread pool which
+        haven't finished.
+    :ivar dict _units: Map the IDs of the containers listed last time to a
+        tuple of their state when listed and the ``Unit`` parsed from them.
+    :ivar OrderedDict _image_environments: Map image IDs to the environment
+        variables of the image, least recently used first.
+    :ivar bool _following: Whether Docker's events are being followed.
+    :ivar bool _synchronized: Whether ``_units`` is known to be up to date
+        apart from the containers in ``_dirty``.
+    :ivar int _events_epoch: Incremented every time Docker's events start or
+        stop being followed.
+    :ivar set _dirty: The IDs of containers which events say changed since
+        they were last inspected.
+    :ivar list _destroyed: For each listing in progress, a ``set`` of the
+        IDs of containers which events say were destroyed since it started,
+        whose inspections are out of date.
+    :ivar list _change_callbacks: The functions given to ``register``.
     """
+    logger = Logger()
+
     def __init__(self, namespace=BASE_NAMESPACE,
-                 base_url=BASE_DOCKER_API_URL):
+                 base_url=BASE_DOCKER_API_URL, reactor=None, threadpool=None,
+                 limits=None):
+        """
+        :param unicode namespace: See ``namespace``.
+        :param unicode base_url: The URL of the Docker API.
+        :param reactor: The reactor to use, or ``None`` for the global one.
+        :param threadpool: The ``ThreadPool`` to talk to Docker in, or
+            ``None`` to start a pool of ``_DOCKER_THREADS`` threads when
+            first needed and stop it when the reactor shuts down.
+        :param dict limits: Map the kinds of operation (``u"add"``,
+            ``u"remove"``, ``u"exists"``, ``u"list"``, ``u"inspect"``) to
+            how many may run at the same time, overriding
+            ``_DOCKER_LIMITS``.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
         self.namespace = namespace
-        self._client = Client(version="1.15", base_url=base_url)
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self._own_threadpool = threadpool is None
+        self._pending = 0
+        self._operations = {
+            operation: _Operation(reactor, limit)
+            for operation, limit
+            in dict(_DOCKER_LIMITS, **(limits or {})).items()}
+        self._client = _PerThreadClient(base_url)
+        self._events_client = Client(
+            version="1.15", base_url=base_url, timeout=None)
+        self._units = {}
+        self._image_environments = OrderedDict()
+        self._following = False
+        self._synchronized = False
+        self._events_epoch = 0
+        self._dirty = set()
+        self._destroyed = []
+        self._change_callbacks = []
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever Docker's events say a
+        container changed, e.g. it stopped.  It is only called while a
+        ``DockerEventsService`` follows the events for this client.
+
+        :param change_callback: Callable that takes no arguments.
+        """
+        self._change_callbacks.append(change_callback)
+
+    def _in_thread(self, f, *args, **kwargs):
+        """
+        Call a blocking function in the thread pool.
+
+        :param f: The function to call.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(
+                minthreads=0, maxthreads=_DOCKER_THREADS, name="docker")
+            self._threadpool.start()
+            self._reactor.addSystemEventTrigger(
+                "during", "shutdown", self._threadpool.stop)
+        self._pending += 1
+
+        def finished(result):
+            self._pending -= 1
+            return result
+        calling = deferToThreadPool(
+            self._reactor, self._threadpool, f, *args, **kwargs)
+        calling.addBoth(finished)
+        return calling
+
+    def _run(self, operation, f, *args, **kwargs):
+        """
+        Call a blocking function in the thread pool as part of an operation.
+
+        :param unicode operation: The kind of operation.
+        :param f: The function to call.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        return self._operations[operation].run(
+            self._in_thread, f, *args, **kwargs)
+
+    def statistics(self):
+        """
+        Describe the Docker operations this client has done and is doing.
+
+        :return: A ``dict`` with the number of calls ``pending`` in the
+            thread pool and, for each kind of operation, a ``dict`` of its
+            statistics as described by ``_Operation.statistics``.
+        """
+        result = {u"pending": self._pending}
+        for operation, measured in self._operations.items():
+            result[operation] = measured.statistics()
+        return result
 
     def _to_container_name(self, unit_name):
         """
@@ -391,6 +701,17 @@ class DockerClient(object):
         except KeyError:
             raise ValueError("Unknown restart policy: %r" % (restart_policy,))
 
+    def pull(self, image_name):
+        def _pull():
+            try:
+                self._client.inspect_image(image_name)
+            except APIError as e:
+                if e.response.status_code == NOT_FOUND:
+                    self._client.pull(image_name)
+                else:
+                    raise
+        return self._run(u"pull", _pull)
+
     def add(self, unit_name, image_name, ports=None, environment=None,
             volumes=(), mem_limit=None, cpu_shares=None,
             restart_policy=RestartNever()):
@@ -450,7 +771,7 @@ class DockerClient(object):
                 sleep(0.001)
                 continue
             self._client.start(container_name)
-        d = deferToThread(_add)
+        d = self._run(u"add", _add)
 
         def _extract_error(failure):
             failure.trap(APIError)
@@ -478,7 +799,7 @@ class DockerClient(object):
 
     def exists(self, unit_name):
         container_name = self._to_container_name(unit_name)
-        return deferToThread(self._blocking_exists, container_name)
+        return self._run(u"exists", self._blocking_exists, container_name)
 
     def remove(self, unit_name):
         container_name = self._to_container_name(unit_name)
@@ -517,86 +838,465 @@ class DockerClient(object):
                 # Can't figure out how to get test coverage for this, but
                 # it's definitely necessary:
                 raise
-        d = deferToThread(_remove)
+        d = self._run(u"remove", _remove)
         return d
 
-    def list(self):
-        def _list():
-            result = set()
-            ids = [d[u"Id"] for d in
-                   self._client.containers(quiet=True, all=True)]
-            for i in ids:
+    def _is_own_container(self, names):
+        """
+        :param list names: The names of a container as given by
+            ``self._client.containers``, including the names it is linked
+            as, e.g. ``[u"/flocker--web", u"/flocker--proxy/web"]``.
 
-                try:
-                    data = self._client.inspect_container(i)
-                except APIError as e:
-                    # The container ID returned by the list API call above, may
-                    # have been removed in another thread.
-                    if e.response.status_code == NOT_FOUND:
-                        continue
+        :return: ``True`` if the container is in our namespace.
+        """
+        prefix = u"/" + self.namespace
+        return any(name.startswith(prefix) and u"/" not in name[1:]
+                   for name in names or ())
 
-                state = (u"active" if data[u"State"][u"Running"]
-                         else u"inactive")
-                name = data[u"Name"]
-                image = data[u"Config"][u"Image"]
-                port_bindings = data[u"HostConfig"][u"PortBindings"]
-                if port_bindings is not None:
-                    ports = self._parse_container_ports(port_bindings)
-                else:
-                    ports = list()
-                volumes = []
-                binds = data[u"HostConfig"]['Binds']
-                if binds is not None:
-                    for bind_config in binds:
-                        parts = bind_config.split(':', 2)
-                        node_path, container_path = parts[:2]
-                        volumes.append(
-                            Volume(container_path=FilePath(container_path),
-                                   node_path=FilePath(node_path))
-                        )
-                if name.startswith(u"/" + self.namespace):
-                    name = name[1 + len(self.namespace):]
-                else:
-                    continue
-                # Retrieve environment variables for this container,
-                # disregarding any environment variables that are part
-                # of the image, rather than supplied in the configuration.
-                image_data = self._client.inspect_image(image)
-                unit_environment = []
-                container_environment = data[u"Config"][u"Env"]
-                image_environment = image_data[u"Config"]["Env"]
-                for environment in container_environment:
-                    if environment not in image_environment:
-                        env_key, env_value = environment.split('=', 1)
-                        unit_environment.append((env_key, env_value))
-                unit_environment = (
-                    Environment(variables=frozenset(unit_environment))
-                    if unit_environment else None
-                )
-                # Our Unit model counts None as the value for cpu_shares and
-                # mem_limit in containers without specified limits, however
-                # Docker returns the values in these cases as zero, so we
-                # manually convert.
-                cpu_shares = data[u"Config"][u"CpuShares"]
-                cpu_shares = None if cpu_shares == 0 else cpu_shares
-                mem_limit = data[u"Config"][u"Memory"]
-                mem_limit = None if mem_limit == 0 else mem_limit
-                restart_policy = self._parse_restart_policy(
-                    data[U"HostConfig"][u"RestartPolicy"])
-                result.add(Unit(
-                    name=name,
-                    container_name=self._to_container_name(name),
-                    activation_state=state,
-                    container_image=image,
-                    ports=frozenset(ports),
-                    volumes=frozenset(volumes),
-                    environment=unit_environment,
-                    mem_limit=mem_limit,
-                    cpu_shares=cpu_shares,
-                    restart_policy=restart_policy)
+    def _blocking_inspect_container(self, container_id):
+        """
+        Blocking API to inspect a container.
+
+        :param unicode container_id: The ID of the container.
+
+        :return: The ``dict`` describing the container, or ``None`` if it
+            no longer exists.
+        """
+        try:
+            return self._client.inspect_container(container_id)
+        except APIError as e:
+            # The container ID returned by the list API call may have been
+            # removed in another thread.
+            if e.response.status_code == NOT_FOUND:
+                return None
+            raise
+
+    def _blocking_inspect_image(self, image_id):
+        """
+        Blocking API to inspect an image.
+
+        :param unicode image_id: The ID of the image.
+
+        :return: The ``dict`` describing the image.
+        """
+        return self._client.inspect_image(image_id)
+
+    def _blocking_containers(self):
+        """
+        Blocking API to list all containers.
+
+        :return: A ``list`` of ``dict``\ s describing the containers.
+        """
+        return self._client.containers(all=True)
+
+    def _inspect(self, function, identifier):
+        """
+        Run an inspection in a thread, once few enough others are running.
+
+        :param function: One-argument blocking callable doing the
+            inspection.
+        :param unicode identifier: The ID of the container or image.
+
+        :return: ``Deferred`` firing with the result of ``function``.
+        """
+        return self._run(u"inspect", function, identifier)
+
+    def _state_key(self, data):
+        """
+        :param dict data: The result of inspecting a container.
+
+        :return: A tuple of the parts of the container's description which
+            can change after it is created: its name, which ``docker
+            rename`` changes, its image ID and its running state, which
+            changes whenever it is started or stopped.
+        """
+        state = data[u"State"]
+        return (data[u"Name"], data[u"Image"], state[u"Running"],
+                state[u"StartedAt"], state[u"FinishedAt"])
+
+    def _cached_unit(self, data):
+        """
+        :param dict data: The result of inspecting a container.
+
+        :return: The ``Unit`` parsed from the container by an earlier
+            listing if its state hasn't changed since, otherwise ``None``.
+        """
+        key, unit = self._units.get(data[u"Id"], (None, None))
+        if key != self._state_key(data):
+            return None
+        return unit
+
+    def _image_environments_for(self, image_ids):
+        """
+        Look up the environments of images, inspecting those which aren't
+        remembered.
+
+        :param set image_ids: The IDs of the images.
+
+        :return: ``Deferred`` firing with a ``dict`` mapping the image IDs
+            to the ``list`` of environment variables of each image.
+        """
+        environments = {}
+        missing = []
+        for image_id in sorted(image_ids):
+            if image_id in self._image_environments:
+                # Move to the end, as the most recently used:
+                environments[image_id] = self._image_environments.pop(
+                    image_id)
+                self._image_environments[image_id] = environments[image_id]
+            else:
+                missing.append(image_id)
+        inspecting = _gather([
+            self._inspect(self._blocking_inspect_image, image_id)
+            for image_id in missing])
+
+        def got_images(images):
+            for image_id, image_data in zip(missing, images):
+                environment = image_data[u"Config"][u"Env"] or []
+                environments[image_id] = environment
+                self._image_environments[image_id] = environment
+            while len(self._image_environments) > _IMAGE_CACHE_SIZE:
+                self._image_environments.popitem(last=False)
+            return environments
+        inspecting.addCallback(got_images)
+        return inspecting
+
+    def _parse_unit(self, data, image_environment):
+        """
+        Parse the result of inspecting a container into a ``Unit``.
+
+        :param dict data: The result of inspecting the container.
+        :param list image_environment: The environment variables of the
+            container's image.
+
+        :return: The ``Unit``, or ``None`` if the container is not in the
+            namespace.
+        """
+        name = data[u"Name"]
+        if name.startswith(u"/" + self.namespace):
+            name = name[1 + len(self.namespace):]
+        else:
+            return None
+        state = (u"active" if data[u"State"][u"Running"]
+                 else u"inactive")
+        image = data[u"Config"][u"Image"]
+        port_bindings = data[u"HostConfig"][u"PortBindings"]
+        if port_bindings is not None:
+            ports = self._parse_container_ports(port_bindings)
+        else:
+            ports = list()
+        volumes = []
+        binds = data[u"HostConfig"]['Binds']
+        if binds is not None:
+            for bind_config in binds:
+                parts = bind_config.split(':', 2)
+                node_path, container_path = parts[:2]
+                volumes.append(
+                    Volume(container_path=FilePath(container_path),
+                           node_path=FilePath(node_path))
                 )
+        # Retrieve environment variables for this container,
+        # disregarding any environment variables that are part
+        # of the image, rather than supplied in the configuration.
+        unit_environment = []
+        container_environment = data[u"Config"][u"Env"]
+        for environment in container_environment:
+            if environment not in image_environment:
+                env_key, env_value = environment.split('=', 1)
+                unit_environment.append((env_key, env_value))
+        unit_environment = (
+            Environment(variables=frozenset(unit_environment))
+            if unit_environment else None
+        )
+        # Our Unit model counts None as the value for cpu_shares and
+        # mem_limit in containers without specified limits, however
+        # Docker returns the values in these cases as zero, so we
+        # manually convert.
+        cpu_shares = data[u"Config"][u"CpuShares"]
+        cpu_shares = None if cpu_shares == 0 else cpu_shares
+        mem_limit = data[u"Config"][u"Memory"]
+        mem_limit = None if mem_limit == 0 else mem_limit
+        restart_policy = self._parse_restart_policy(
+            data[U"HostConfig"][u"RestartPolicy"])
+        return Unit(
+            name=name,
+            container_name=self._to_container_name(name),
+            activation_state=state,
+            container_image=image,
+            ports=frozenset(ports),
+            volumes=frozenset(volumes),
+            environment=unit_environment,
+            mem_limit=mem_limit,
+            cpu_shares=cpu_shares,
+            restart_policy=restart_policy)
+
+    def _events_connected(self):
+        """
+        Called when Docker's events start being followed.  Events may have
+        been missed before this, so the next listing lists everything.
+        """
+        self._following = True
+        self._synchronized = False
+        self._events_epoch += 1
+
+    def _events_lost(self):
+        """
+        Called when Docker's events stop being followed.  Listings list
+        everything until they are followed again.
+        """
+        self._following = False
+        self._synchronized = False
+        self._events_epoch += 1
+
+    def _container_event(self, event):
+        """
+        Called with each event from Docker.
+
+        :param dict event: The event, e.g. ``{u"status": u"start", u"id":
+            u"<container ID>", ...}``.
+        """
+        status = event.get(u"status")
+        if not self._following or status not in _CONTAINER_EVENTS:
+            return
+        container_id = event[u"id"]
+        if status == u"destroy":
+            self._units.pop(container_id, None)
+            self._dirty.discard(container_id)
+            for destroyed in self._destroyed:
+                destroyed.add(container_id)
+        else:
+            self._dirty.add(container_id)
+        for callback in self._change_callbacks:
+            try:
+                callback()
+            except:
+                write_traceback(self.logger, u"")
+
+    def _parse_units(self, inspected, environments):
+        """
+        Parse the results of inspecting containers, reusing units parsed
+        from unchanged containers.
+
+        :param list inspected: The results of inspecting the containers.
+        :param dict environments: Map the image IDs of changed containers
+            to the environment variables of the image.
+
+        :return: A ``dict`` mapping the IDs of containers in the namespace
+            to a tuple of their state and the parsed ``Unit``.
+        """
+        units = {}
+        for data in inspected:
+            unit = self._cached_unit(data)
+            if unit is None:
+                unit = self._parse_unit(data, environments[data[u"Image"]])
+            if unit is not None:
+                units[data[u"Id"]] = (self._state_key(data), unit)
+        return units
+
+    def _inspect_units(self, container_ids):
+        """
+        Inspect some containers and parse them.
+
+        :param container_ids: The IDs of the containers.
+
+        :return: ``Deferred`` firing with the result of ``_parse_units``
+            for the containers which still exist.
+        """
+        inspecting = _gather([
+            self._inspect(self._blocking_inspect_container, container_id)
+            for container_id in container_ids])
+
+        def inspect_images(inspected):
+            inspected = [data for data in inspected if data is not None]
+            images = self._image_environments_for(set(
+                data[u"Image"] for data in inspected
+                if self._cached_unit(data) is None))
+            images.addCallback(
+                lambda environments: self._parse_units(
+                    inspected, environments))
+            return images
+        inspecting.addCallback(inspect_images)
+        return inspecting
+
+    def _track_destroyed(self, destroyed, listing):
+        """
+        Record the containers destroyed while a listing is in progress, so
+        their out of date inspections can be dropped.
+
+        :param set destroyed: The IDs of destroyed containers are added to
+            this until the listing is done.
+        :param listing: A no-argument callable starting the listing and
+            returning a ``Deferred`` firing with a ``dict`` like the result
+            of ``_parse_units``.
+
+        :return: ``Deferred`` firing with the result of ``listing``,
+            leaving out the destroyed containers.
+        """
+        self._destroyed.append(destroyed)
+
+        def finished(result):
+            self._destroyed.remove(destroyed)
             return result
-        return deferToThread(_list)
+
+        def drop_destroyed(units):
+            return {container_id: unit
+                    for container_id, unit in units.items()
+                    if container_id not in destroyed}
+        d = maybeDeferred(listing)
+        d.addBoth(finished)
+        d.addCallback(drop_destroyed)
+        return d
+
+    def _current_units(self):
+        """
+        :return: The ``set`` of units last listed.
+        """
+        return set(unit for _, unit in self._units.values())
+
+    def _list_all(self):
+        """
+        List units by inspecting every container in the namespace.
+
+        :return: ``Deferred`` firing with ``set`` of :class:`Unit`.
+        """
+        epoch = self._events_epoch
+
+        def inspect_containers(containers):
+            return self._inspect_units(
+                container[u"Id"] for container in containers
+                if self._is_own_container(container[u"Names"]))
+
+        def list_containers():
+            listing = self._in_thread(self._blocking_containers)
+            listing.addCallback(inspect_containers)
+            return listing
+
+        def inspected(units):
+            # Replaced rather than updated, so containers which are gone are
+            # forgotten:
+            self._units = units
+            if self._following and epoch == self._events_epoch:
+                self._synchronized = True
+            return self._current_units()
+        listing = self._track_destroyed(set(), list_containers)
+        listing.addCallback(inspected)
+        return listing
+
+    def _list_changed(self):
+        """
+        List units by only inspecting the containers which events say
+        changed since the last listing.
+
+        :return: ``Deferred`` firing with ``set`` of :class:`Unit`.
+        """
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return succeed(self._current_units())
+        destroyed = set()
+        listing = self._track_destroyed(
+            destroyed, lambda: self._inspect_units(dirty))
+
+        def inspected(units):
+            for container_id in dirty:
+                self._units.pop(container_id, None)
+            self._units.update(units)
+            return self._current_units()
+
+        def failed(reason):
+            # Try again next time, apart from containers which are gone:
+            self._dirty |= dirty - destroyed
+            return reason
+        listing.addCallbacks(inspected, failed)
+        return listing
+
+    def list(self):
+        def list_units():
+            if self._synchronized:
+                return self._list_changed()
+            return self._list_all()
+        return self._operations[u"list"].run(list_units)
+
+
+class DockerEventsService(Service):
+    """
+    Follow Docker's events, telling a ``DockerClient`` which containers
+    changed so its listings only need to inspect those.
+
+    Reading the events blocks until the next event, so they are read in a
+    daemon thread of their own.  If following them fails the client goes
+    back to listing everything, and they are followed again after a delay.
+
+    :ivar Event _stopping: Set when the thread following the events should
+        stop.
+    """
+    logger = Logger()
+
+    def __init__(self, reactor, docker_client, retry_interval=1.0):
+        """
+        :param reactor: The reactor to report events to.
+        :param DockerClient docker_client: The client to report events to.
+        :param float retry_interval: The number of seconds to wait before
+            following the events again if that fails.
+        """
+        self._reactor = reactor
+        self._docker_client = docker_client
+        self._retry_interval = retry_interval
+        self._stopping = None
+
+    def startService(self):
+        Service.startService(self)
+        self._stopping = Event()
+        thread = Thread(target=self._follow, args=(self._stopping,),
+                        name="docker-events")
+        thread.daemon = True
+        thread.start()
+
+    def stopService(self):
+        self._stopping.set()
+        self._docker_client._events_lost()
+        return Service.stopService(self)
+
+    def _follow(self, stopping):
+        """
+        Follow Docker's events until told to stop.  Runs in a thread.
+
+        :param Event stopping: Set when following should stop.
+        """
+        while not stopping.is_set():
+            self._follow_once(stopping)
+            stopping.wait(self._retry_interval)
+
+    def _follow_once(self, stopping):
+        """
+        Follow Docker's events until that fails or the thread is told to
+        stop.  Runs in a thread.
+
+        :param Event stopping: Set when following should stop.
+        """
+        client = self._docker_client
+        try:
+            events = client._events_client.events()
+            self._report(stopping, client._events_connected)
+            for data in events:
+                if stopping.is_set():
+                    return
+                self._report(stopping, client._container_event, loads(data))
+        except Exception:
+            write_traceback(self.logger, u"")
+        self._report(stopping, client._events_lost)
+
+    def _report(self, stopping, f, *args):
+        """
+        Call a method of the client in the reactor thread, unless the
+        service stopped by then.  Runs in a thread.
+
+        :param Event stopping: Set when following should stop.
+        :param f: The method to call.
+        """
+        def report():
+            if not stopping.is_set():
+                f(*args)
+        self._reactor.callFromThread(report)
 
 
 class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
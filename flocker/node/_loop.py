@@ -13,6 +13,8 @@ The ClusterStatus state machine receives inputs from the connection to the
 control service, and sends inputs to the ConvergenceLoop state machine.
 """
 
+from random import random
+
 from zope.interface import implementer
 
 from eliot import ActionType, Field, writeFailure
@@ -32,6 +34,7 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from ..control._protocol import (
     NodeStateCommand, IConvergenceAgent, AgentAMP,
     )
+from ._deploy import InParallel, Sequentially, InDependencyOrder
 
 
 class ClusterStatusInputs(Names):
@@ -195,6 +198,10 @@ class ConvergenceLoopInputs(Names):
     # Finished applying necessary changes to local state, a single
     # iteration of the convergence loop:
     ITERATION_DONE = NamedConstant()
+    # Finished waiting between iterations of the convergence loop:
+    WAKEUP = NamedConstant()
+    # Something changed the local state, e.g. a container stopped:
+    LOCAL_CHANGE = NamedConstant()
 
 
 @attributes(["client", "configuration", "state"])
@@ -221,6 +228,8 @@ class ConvergenceLoopStates(Names):
     # Local state is being converged, and once that is done we will
     # immediately stop:
     CONVERGING_STOPPING = NamedConstant()
+    # Waiting before the next iteration of the convergence loop:
+    SLEEPING = NamedConstant()
 
 
 class ConvergenceLoopOutputs(Names):
@@ -232,6 +241,16 @@ class ConvergenceLoopOutputs(Names):
     STORE_INFO = NamedConstant()
     # Start an iteration of the covergence loop:
     CONVERGE = NamedConstant()
+    # Schedule the next iteration of the convergence loop:
+    SCHEDULE_WAKEUP = NamedConstant()
+    # Cancel the scheduled iteration of the convergence loop:
+    CLEAR_WAKEUP = NamedConstant()
+    # Store AMP client, desired configuration and cluster state, and start
+    # the scheduled iteration now if the configuration or state changed:
+    UPDATE_MAYBE_WAKEUP = NamedConstant()
+    # Make sure another iteration starts as soon as possible, since the
+    # local state changed:
+    NOTE_LOCAL_CHANGE = NamedConstant()
 
 
 _FIELD_CONNECTION = Field(
@@ -244,6 +263,35 @@ LOG_SEND_TO_CONTROL_SERVICE = ActionType(
     [_FIELD_CONNECTION], [],
     "Send the local state to the control service.")
 
+# The number of seconds to wait between iterations of the convergence loop
+# while things are changing:
+_MINIMUM_SLEEP = 1.0
+
+# The number of seconds the wait between iterations grows to while nothing
+# changes:
+_MAXIMUM_SLEEP = 10.0
+
+# The wait between iterations is shortened by a random fraction of up to
+# this much, so that agents started at the same time don't keep converging
+# at the same time:
+_SLEEP_JITTER = 0.2
+
+# The number of seconds after which unchanged local state is sent to the
+# control service again, to let it know the agent is still there:
+_HEARTBEAT_INTERVAL = 30.0
+
+
+def _is_no_op(change):
+    """
+    :param IStateChange change: A state change.
+
+    :return: ``True`` if the change is known to do nothing, i.e. it is a
+        combination of no changes.
+    """
+    if isinstance(change, (InParallel, Sequentially, InDependencyOrder)):
+        return all(_is_no_op(subchange) for subchange in change.changes)
+    return False
+
 
 class ConvergenceLoop(object):
     """
@@ -260,91 +308,232 @@ class ConvergenceLoop(object):
         ``None``.
 
     :ivar fsm: The finite state machine this is part of.
+
+    :ivar float sleep: The number of seconds to wait before the next
+        iteration, which doubles after every iteration in which nothing
+        changed up to ``_MAXIMUM_SLEEP``.
+
+    :ivar bool _updated: Whether a status update changed the configuration or
+        cluster state, or the local state changed, since the start of the
+        current iteration.
+
+    :ivar bool _quiet: Whether the current iteration found the same local
+        state as the previous one and didn't fail.
+
+    :ivar _last_state_changes: The local state discovered by the previous
+        iteration, or ``None``.
+
+    :ivar _wakeup: The ``IDelayedCall`` which starts the next iteration, or
+        ``None``.
+
+    :ivar int calculations_skipped: The number of iterations which didn't
+        need to calculate changes because nothing changed since a previous
+        calculation found that no changes were necessary.
+
+    :ivar _no_changes: A tuple of the configuration and cluster state for
+        which the last calculation found that no changes were necessary and
+        the resulting state change, or ``None``.
+
+    :ivar _acknowledged: A tuple of the client, the local state changes last
+        acknowledged by the control service through that client and the
+        time they were sent, or ``None``.  The same changes are only sent
+        again through the same client once ``_HEARTBEAT_INTERVAL`` has
+        passed.
     """
-    def __init__(self, reactor, deployer):
+    def __init__(self, reactor, deployer, random=random):
         """
         :param IReactorTime reactor: Used to schedule delays in the loop.
 
         :param IDeployer deployer: Used to discover local state and calculate
             necessary changes to match desired configuration.
+
+        :param random: A no-argument callable returning a random ``float``
+            between 0 and 1, used to vary the delays.
         """
         self.reactor = reactor
         self.deployer = deployer
+        self.random = random
+        self.client = None
+        self.configuration = None
         self.cluster_state = None
+        self.sleep = _MINIMUM_SLEEP
+        self._updated = False
+        self._quiet = False
+        self._last_state_changes = None
+        self._wakeup = None
+        self.calculations_skipped = 0
+        self._no_changes = None
+        self._acknowledged = None
 
     def output_STORE_INFO(self, context):
+        if (context.configuration != self.configuration or
+                context.state != self.cluster_state):
+            self._updated = True
         self.client, self.configuration, self.cluster_state = (
             context.client, context.configuration, context.state)
 
+    def output_UPDATE_MAYBE_WAKEUP(self, context):
+        self.output_STORE_INFO(context)
+        if self._updated:
+            self._wakeup.reset(0)
+
+    def output_NOTE_LOCAL_CHANGE(self, context):
+        self._updated = True
+        if self._wakeup is not None:
+            self._wakeup.reset(0)
+
+    def output_SCHEDULE_WAKEUP(self, context):
+        if self._updated:
+            # The iteration used an out of date configuration or cluster
+            # state, so start the next one right away:
+            self.sleep = _MINIMUM_SLEEP
+            delay = 0
+        else:
+            if not self._quiet:
+                self.sleep = _MINIMUM_SLEEP
+            delay = self.sleep * (1 - _SLEEP_JITTER * self.random())
+            self.sleep = min(self.sleep * 2, _MAXIMUM_SLEEP)
+        self._wakeup = self.reactor.callLater(
+            delay, self.fsm.receive, ConvergenceLoopInputs.WAKEUP)
+
+    def output_CLEAR_WAKEUP(self, context):
+        self._wakeup.cancel()
+        self._wakeup = None
+
+    def _maybe_send_state(self, state_changes):
+        """
+        Send the local state to the control service, unless the same state
+        was recently acknowledged by it.
+
+        :param state_changes: The discovered local state changes.
+        """
+        now = self.reactor.seconds()
+        if self._acknowledged is not None:
+            client, acknowledged, sent = self._acknowledged
+            if (client is self.client and acknowledged == state_changes and
+                    now - sent < _HEARTBEAT_INTERVAL):
+                return
+        client = self.client
+        with LOG_SEND_TO_CONTROL_SERVICE(
+                self.fsm.logger, connection=client) as context:
+            sending = client.callRemote(NodeStateCommand,
+                                        state_changes=state_changes,
+                                        eliot_context=context)
+
+        def acknowledged(_):
+            self._acknowledged = (client, state_changes, now)
+        sending.addCallback(acknowledged)
+
+        # A failure to send just means it'll be sent again next time:
+        def failed(reason):
+            writeFailure(reason, self.fsm.logger, u"")
+        sending.addErrback(failed)
+
+    def _calculate_changes(self):
+        """
+        Calculate the changes necessary to converge the local state.
+
+        Calculating changes is a pure function of the configuration and the
+        cluster state, so if they are the same as when no changes were last
+        found necessary, that result is reused.
+
+        :return: An ``IStateChange`` provider.
+        """
+        if self._no_changes is not None:
+            configuration, cluster_state, action = self._no_changes
+            if (configuration == self.configuration and
+                    cluster_state == self.cluster_state):
+                self.calculations_skipped += 1
+                return action
+        action = self.deployer.calculate_changes(
+            self.configuration, self.cluster_state)
+        if _is_no_op(action):
+            self._no_changes = (self.configuration, self.cluster_state, action)
+        else:
+            self._no_changes = None
+        return action
+
     def output_CONVERGE(self, context):
+        self._wakeup = None
+        self._updated = False
+        self._quiet = False
         known_local_state = self.cluster_state.get_node(self.deployer.hostname)
         d = DeferredContext(self.deployer.discover_state(known_local_state))
 
         def got_local_state(state_changes):
+            self._quiet = state_changes == self._last_state_changes
+            self._last_state_changes = state_changes
             # Current cluster state is likely out of date as regards the local
             # state, so update it accordingly.
             for state in state_changes:
                 self.cluster_state = state.update_cluster_state(
                     self.cluster_state
                 )
-            with LOG_SEND_TO_CONTROL_SERVICE(
-                    self.fsm.logger, connection=self.client) as context:
-                self.client.callRemote(NodeStateCommand,
-                                       state_changes=state_changes,
-                                       eliot_context=context)
-            action = self.deployer.calculate_changes(
-                self.configuration, self.cluster_state
-            )
+            self._maybe_send_state(state_changes)
+            action = self._calculate_changes()
             return action.run(self.deployer)
         d.addCallback(got_local_state)
-        # If an error occurred we just want to log it and then try
-        # converging again; hopefully next time we'll have more success.
-        d.addErrback(writeFailure, self.fsm.logger, u"")
 
-        # It would be better to have a "quiet time" state in the FSM and
-        # transition to that next, then have a timeout input kick the machine
-        # back around to the beginning of the loop in the FSM.  However, we're
-        # not going to keep this sleep-for-a-bit solution in the long term.
-        # Instead, we'll be more event driven.  So just going with the simple
-        # solution and inserting a side-effect-y delay directly here.
+        # If an error occurred we just want to log it and then try
+        # converging again soon; hopefully next time we'll have more success.
+        def failed(reason):
+            self._quiet = False
+            writeFailure(reason, self.fsm.logger, u"")
+        d.addErrback(failed)
 
         d.addCallback(
-            lambda _:
-                self.reactor.callLater(
-                    1.0, self.fsm.receive, ConvergenceLoopInputs.ITERATION_DONE
-                )
-        )
+            lambda _: self.fsm.receive(ConvergenceLoopInputs.ITERATION_DONE))
 
 
-def build_convergence_loop_fsm(reactor, deployer):
+def build_convergence_loop_fsm(reactor, deployer, random=random):
     """
     Create a convergence loop FSM.
 
+    Between iterations the loop sleeps for a while.  The sleep grows while
+    nothing changes, so an idle agent does little work, and is cut short
+    when a status update brings a changed configuration or cluster state,
+    or when the local state changes.
+
     :param IReactorTime reactor: Used to schedule delays in the loop.
 
     :param IDeployer deployer: Used to discover local state and calcualte
         necessary changes to match desired configuration.
+
+    :param random: A no-argument callable returning a random ``float``
+        between 0 and 1, used to vary the delays.
     """
     I = ConvergenceLoopInputs
     O = ConvergenceLoopOutputs
     S = ConvergenceLoopStates
 
     table = TransitionTable()
-    table = table.addTransition(
-        S.STOPPED, I.STATUS_UPDATE, [O.STORE_INFO, O.CONVERGE], S.CONVERGING)
+    table = table.addTransitions(
+        S.STOPPED, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CONVERGE], S.CONVERGING),
+            I.LOCAL_CHANGE: ([], S.STOPPED),
+        })
     table = table.addTransitions(
         S.CONVERGING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
             I.STOP: ([], S.CONVERGING_STOPPING),
-            I.ITERATION_DONE: ([O.CONVERGE], S.CONVERGING),
+            I.ITERATION_DONE: ([O.SCHEDULE_WAKEUP], S.SLEEPING),
+            I.LOCAL_CHANGE: ([O.NOTE_LOCAL_CHANGE], S.CONVERGING),
         })
     table = table.addTransitions(
         S.CONVERGING_STOPPING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
             I.ITERATION_DONE: ([], S.STOPPED),
+            I.LOCAL_CHANGE: ([], S.CONVERGING_STOPPING),
+        })
+    table = table.addTransitions(
+        S.SLEEPING, {
+            I.STATUS_UPDATE: ([O.UPDATE_MAYBE_WAKEUP], S.SLEEPING),
+            I.STOP: ([O.CLEAR_WAKEUP], S.STOPPED),
+            I.WAKEUP: ([O.CONVERGE], S.CONVERGING),
+            I.LOCAL_CHANGE: ([O.NOTE_LOCAL_CHANGE], S.SLEEPING),
         })
 
-    loop = ConvergenceLoop(reactor, deployer)
+    loop = ConvergenceLoop(reactor, deployer, random)
     fsm = constructFiniteStateMachine(
         inputs=I, outputs=O, states=S, initial=S.STOPPED, table=table,
         richInputs=[_ClientStatusUpdate], inputContext={},
@@ -365,6 +554,7 @@ class AgentLoopService(object, MultiService):
     :ivar host: Host to connect to.
     :ivar port: Port to connect to.
     :ivar cluster_status: A cluster status FSM.
+    :ivar convergence_loop: The convergence loop FSM.
     :ivar factory: The factory used to connect to the control service.
     """
 
@@ -373,6 +563,7 @@ class AgentLoopService(object, MultiService):
         convergence_loop = build_convergence_loop_fsm(
             self.reactor, self.deployer
         )
+        self.convergence_loop = convergence_loop
         self.logger = convergence_loop.logger
         self.cluster_status = build_cluster_status_fsm(convergence_loop)
         self.factory = ReconnectingClientFactory.forProtocol(
@@ -387,6 +578,14 @@ class AgentLoopService(object, MultiService):
         self.factory.stopTrying()
         self.cluster_status.receive(ClusterStatusInputs.SHUTDOWN)
 
+    def local_state_changed(self):
+        """
+        Tell the convergence loop the local state changed, e.g. because a
+        container stopped, so it converges again without waiting for its
+        sleep to end.
+        """
+        self.convergence_loop.receive(ConvergenceLoopInputs.LOCAL_CHANGE)
+
     # IConvergenceAgent methods:
 
     def connected(self, client):
@@ -35,6 +35,7 @@ from ..control import (
 )
 from . import P2PNodeDeployer, change_node_state
 from ._loop import AgentLoopService
+from ._docker import DockerEventsService
 from .agents.blockdevice import LoopbackBlockDeviceAPI, BlockDeviceDeployer
 
 
@@ -267,6 +268,12 @@ class ZFSAgentScript(object):
         loop = AgentLoopService(reactor=reactor, deployer=deployer,
                                 host=host, port=port)
         volume_service.setServiceParent(loop)
+        # Follow Docker's events so listing containers only inspects those
+        # which changed, and so the loop notices changes it didn't make
+        # without waiting for its next iteration:
+        deployer.docker_client.register(loop.local_state_changed)
+        DockerEventsService(reactor, deployer.docker_client).setServiceParent(
+            loop)
         return main_for_service(reactor, loop)
 
 
@@ -10,7 +10,7 @@ from zope.interface.verify import verifyObject
 
 from eliot.testing import validate_logging
 
-from pyrsistent import pmap, pset
+from pyrsistent import pmap, pset, InvariantException
 
 from twisted.internet.defer import fail, FirstError, succeed, Deferred
 from twisted.trial.unittest import SynchronousTestCase, TestCase
@@ -30,7 +30,7 @@ from .._deploy import (
     IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
     CreateDataset, WaitForDataset, HandoffDataset, SetProxies, PushDataset,
     ResizeDataset, _link_environment, _to_volume_name,
-    DeleteDataset, OpenPorts
+    DeleteDataset, OpenPorts, PullImages, InDependencyOrder
 )
 from ...testtools import CustomException
 from .. import _deploy
@@ -151,6 +151,15 @@ DeleteDatasetTests = make_istatechange_tests(
     DeleteDataset,
     dict(dataset=Dataset(dataset_id=unicode(uuid4()))),
     dict(dataset=Dataset(dataset_id=unicode(uuid4()))))
+_DELETES = [DeleteDataset(dataset=Dataset(dataset_id=unicode(uuid4())))
+            for _ in range(2)]
+InDependencyOrderIStateChangeTests = make_istatechange_tests(
+    InDependencyOrder, dict(changes=_DELETES, dependencies={1: [0]}),
+    dict(changes=_DELETES))
+PullImagesIStateChangeTests = make_istatechange_tests(
+    PullImages,
+    dict(images=[DockerImage.from_string(u"busybox")]),
+    dict(images=[DockerImage.from_string(u"nginx")]))
 
 
 class ControllableActionIStateChangeTests(
@@ -316,6 +325,146 @@ class InParallelTests(SynchronousTestCase):
         )
 
 
+class InDependencyOrderTests(SynchronousTestCase):
+    """
+    Tests for ``InDependencyOrder``.
+    """
+    def test_subchanges_get_deployer(self):
+        """
+        ``InDependencyOrder.run`` runs sub-changes with the given deployer.
+        """
+        subchanges = [ControllableAction(result=succeed(None)),
+                      ControllableAction(result=succeed(None))]
+        change = InDependencyOrder(changes=subchanges, dependencies={1: [0]})
+        deployer = object()
+        change.run(deployer)
+        self.assertEqual([c.deployer for c in subchanges],
+                         [deployer, deployer])
+
+    def test_independent_in_parallel(self):
+        """
+        Sub-changes which don't depend on each other run at the same time,
+        and the result fires once they are all done.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        subchanges = [ControllableAction(result=not_done1),
+                      ControllableAction(result=not_done2)]
+        result = InDependencyOrder(changes=subchanges).run(object())
+        called = [c.called for c in subchanges]
+        not_done1.callback(None)
+        self.assertNoResult(result)
+        not_done2.callback(None)
+        self.successResultOf(result)
+        self.assertEqual([True, True], called)
+
+    def test_dependencies_first(self):
+        """
+        A sub-change runs once all the sub-changes it depends on are done,
+        whatever the order they are given in.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        subchanges = [ControllableAction(result=succeed(None)),
+                      ControllableAction(result=not_done1),
+                      ControllableAction(result=not_done2)]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies={0: [1, 2]})
+        change.run(object())
+        called = [subchanges[0].called]
+        not_done2.callback(None)
+        called.append(subchanges[0].called)
+        not_done1.callback(None)
+        called.append(subchanges[0].called)
+        self.assertEqual([False, False, True], called)
+
+    def test_failure_stops_dependents(self):
+        """
+        A failed sub-change stops the sub-changes which depend on it, but
+        not others, and the result fails with the first failure once the
+        other sub-changes are done.
+        """
+        not_done = Deferred()
+        subchanges = [ControllableAction(result=fail(RuntimeError())),
+                      ControllableAction(result=succeed(None)),
+                      ControllableAction(result=not_done),
+                      ControllableAction(result=succeed(None))]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies={1: [0], 3: [2]})
+        result = change.run(object())
+        self.assertNoResult(result)
+        not_done.callback(None)
+        failure = self.failureResultOf(result, FirstError)
+        self.assertEqual(
+            (RuntimeError, [True, False, True, True]),
+            (failure.value.subFailure.type, [c.called for c in subchanges]))
+        self.flushLoggedErrors(RuntimeError)
+
+    def test_limit(self):
+        """
+        No more than the given number of sub-changes run at the same time.
+        """
+        not_done = [Deferred() for _ in range(3)]
+        subchanges = [ControllableAction(result=d) for d in not_done]
+        change = InDependencyOrder(changes=subchanges, limit=2)
+        result = change.run(object())
+        called = [[c.called for c in subchanges]]
+        not_done[1].callback(None)
+        called.append([c.called for c in subchanges])
+        not_done[0].callback(None)
+        not_done[2].callback(None)
+        self.successResultOf(result)
+        self.assertEqual([[True, True, False], [True, True, True]], called)
+
+    def test_changes_provide_istatechange(self):
+        """
+        Only ``IStateChange`` providers can be changes.
+        """
+        self.assertRaises(
+            InvariantException, InDependencyOrder, changes=[object()])
+
+    def test_invalid_limit(self):
+        """
+        A limit of less than one is rejected, since no sub-change would ever
+        run.
+        """
+        self.assertRaises(
+            InvariantException, InDependencyOrder, changes=[], limit=0)
+
+    def test_long_chain(self):
+        """
+        A long chain of sub-changes which finish immediately runs to
+        completion.
+        """
+        subchanges = [ControllableAction(result=succeed(None))
+                      for _ in range(5000)]
+        change = InDependencyOrder(changes=subchanges, dependencies={
+            index: [index - 1] for index in range(1, len(subchanges))})
+        self.successResultOf(change.run(object()))
+        self.assertTrue(subchanges[-1].called)
+
+    def test_cycle(self):
+        """
+        ``InDependencyOrder.run`` fails with ``ValueError`` without running
+        anything if sub-changes depend on each other.
+        """
+        subchanges = [ControllableAction(result=succeed(None))
+                      for _ in range(3)]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies={1: [2], 2: [1]})
+        self.failureResultOf(change.run(object()), ValueError)
+        self.assertEqual([False, False, False],
+                         [c.called for c in subchanges])
+
+    def test_unknown_dependency(self):
+        """
+        ``InDependencyOrder.run`` fails with ``ValueError`` if a sub-change
+        depends on an index which isn't a sub-change.
+        """
+        change = InDependencyOrder(
+            changes=[ControllableAction(result=succeed(None))],
+            dependencies={0: [1]})
+        self.failureResultOf(change.run(object()), ValueError)
+
+
 class StartApplicationTests(SynchronousTestCase):
     """
     Tests for ``StartApplication``.
@@ -663,6 +812,34 @@ class StopApplicationTests(SynchronousTestCase):
         self.assertIs(None, result)
 
 
+class PullImagesTests(SynchronousTestCase):
+    """
+    Tests for ``PullImages``.
+    """
+    def test_pull(self):
+        """
+        ``PullImages.run()`` pulls each of the images, returning a
+        ``Deferred`` which fires once they are all available.
+        """
+        fake_docker = FakeDockerClient()
+        api = P2PNodeDeployer(u'example.com', create_volume_service(self),
+                              docker_client=fake_docker)
+        result = PullImages(images=[
+            DockerImage.from_string(u"clusterhq/postgresql:9.1"),
+            DockerImage.from_string(u"busybox")]).run(api)
+        self.successResultOf(result)
+        self.assertEqual({u"clusterhq/postgresql:9.1", u"busybox:latest"},
+                         fake_docker.pulled_images)
+
+    def test_deduplicated(self):
+        """
+        An image given more than once is only pulled once.
+        """
+        image = DockerImage.from_string(u"busybox")
+        self.assertEqual(
+            PullImages(images=[image]), PullImages(images=[image, image]))
+
+
 # This models an application that has a volume.
 
 APPLICATION_WITH_VOLUME_NAME = b"psql-clusterhq"
@@ -1811,6 +1988,22 @@ class P2PManifestationDeployerDiscoveryTests(SynchronousTestCase):
             manifestation)
 
 
+def in_dependency_order(*changes):
+    """
+    Create an ``InDependencyOrder``, naming the changes each change depends
+    on rather than giving their indexes.
+
+    :param changes: Pairs of an ``IStateChange`` provider and a ``list`` of
+        the changes given before it which it depends on.
+
+    :return: The ``InDependencyOrder``.
+    """
+    ordered = [change for change, _ in changes]
+    return InDependencyOrder(changes=ordered, dependencies={
+        index: [ordered.index(dependency) for dependency in after]
+        for index, (_, after) in enumerate(changes)})
+
+
 class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
     """
     Tests for ``P2PNodeDeployer.calculate_necessary_state_changes``.
@@ -1833,9 +2026,24 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(changes=[])
         self.assertEqual(expected, result)
 
+    def test_limit(self):
+        """
+        ``ApplicationNodeDeployer.calculate_necessary_state_changes`` limits
+        the number of changes run at the same time to the deployer's limit.
+        """
+        api = ApplicationNodeDeployer(
+            u'node.example.com', docker_client=FakeDockerClient(units={}),
+            network=make_memory_network(), limit=3)
+        result = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(
+                NodeState(hostname=api.hostname, manifestations={}))),
+            desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(3, result.limit)
+
     def test_proxy_needs_creating(self):
         """
         ``P2PNodeDeployer.calculate_necessary_state_changes`` returns a
@@ -1873,7 +2081,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired, current_cluster_state=EMPTY)
         proxy = Proxy(ip=expected_destination_host,
                       port=expected_destination_port)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset([proxy]))])
+        expected = InDependencyOrder(
+            changes=[SetProxies(ports=frozenset([proxy]))])
         self.assertEqual(expected, result)
 
     def test_proxy_empty(self):
@@ -1894,7 +2103,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state(
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired, current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset())])
+        expected = InDependencyOrder(changes=[SetProxies(ports=frozenset())])
         self.assertEqual(expected, result)
 
     def test_open_port_needs_creating(self):
@@ -1943,7 +2152,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state(
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired, current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[
+        expected = InDependencyOrder(changes=[
             OpenPorts(ports=[OpenPort(port=expected_destination_port)])])
         self.assertEqual(expected, result)
 
@@ -1966,7 +2175,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 NodeState(hostname=api.hostname))),
 
             desired_configuration=desired, current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[OpenPorts(ports=[])])
+        expected = InDependencyOrder(changes=[OpenPorts(ports=[])])
         self.assertEqual(expected, result)
 
     def test_application_needs_stopping(self):
@@ -1992,7 +2201,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         to_stop = StopApplication(application=Application(
             name=unit.name, image=DockerImage.from_string(
                 unit.container_image)))
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(changes=[to_stop])
         self.assertEqual(expected, result)
 
     def test_application_needs_starting(self):
@@ -2024,11 +2233,35 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[InParallel(
-            changes=[StartApplication(application=application,
-                                      hostname="node.example.com")])])
+        pull = PullImages(images={application.image})
+        expected = in_dependency_order(
+            (pull, []),
+            (StartApplication(application=application,
+                              hostname="node.example.com"), [pull]))
         self.assertEqual(expected, result)
 
+    def test_shared_image_pulled_once(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` pulls an image
+        needed by several applications which are starting only once.
+        """
+        api = P2PNodeDeployer(u'node.example.com', create_volume_service(self),
+                              docker_client=FakeDockerClient(units={}),
+                              network=make_memory_network())
+        image = DockerImage(repository=u'clusterhq/flocker',
+                            tag=u'release-14.0')
+        applications = [Application(name=name, image=image)
+                        for name in [u'mysql-hybridcluster', u'site']]
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u'node.example.com',
+                 applications=frozenset(applications))]))
+        result = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(
+                NodeState(hostname=api.hostname))),
+            desired_configuration=desired,
+            current_cluster_state=EMPTY)
+        self.assertEqual(PullImages(images={image}), result.changes[0])
+
     def test_only_this_node(self):
         """
         ``P2PNodeDeployer.calculate_necessary_state_changes`` does not specify
@@ -2058,7 +2291,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(changes=[])
         self.assertEqual(expected, result)
 
     def test_no_change_needed(self):
@@ -2098,7 +2331,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 NodeState(hostname=api.hostname))),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(changes=[])
         self.assertEqual(expected, result)
 
     def test_node_not_described(self):
@@ -2128,7 +2361,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 image=DockerImage.from_string(unit.container_image)
             )
         )
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(changes=[to_stop])
         self.assertEqual(expected, result)
 
     def test_volume_created(self):
@@ -2176,11 +2409,13 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[CreateDataset(dataset=volume.dataset)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME,
-                hostname=hostname)])])
+        pull = PullImages(images={APPLICATION_WITH_VOLUME.image})
+        create = CreateDataset(dataset=volume.dataset)
+        expected = in_dependency_order(
+            (pull, []),
+            (create, []),
+            (StartApplication(application=APPLICATION_WITH_VOLUME,
+                              hostname=hostname), [create, pull]))
         self.assertEqual(expected, changes)
 
     def test_dataset_deleted(self):
@@ -2220,10 +2455,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[DeleteDataset(dataset=DATASET.set(
-                "deleted", True))])
-            ])
+        expected = InDependencyOrder(changes=[
+            DeleteDataset(dataset=DATASET.set("deleted", True))])
         self.assertEqual(expected, changes)
 
     def test_deletion_after_application_stop(self):
@@ -2267,11 +2500,9 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         to_stop = StopApplication(application=Application(
             name=unit.name, image=DockerImage.from_string(
                 unit.container_image)))
-        expected = Sequentially(changes=[
-            InParallel(changes=[to_stop]),
-            InParallel(changes=[DeleteDataset(dataset=DATASET.set(
-                "deleted", True))])
-            ])
+        expected = in_dependency_order(
+            (to_stop, []),
+            (DeleteDataset(dataset=DATASET.set("deleted", True)), [to_stop]))
         self.assertEqual(expected, changes)
 
     def test_volume_wait(self):
@@ -2323,12 +2554,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
-            InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME,
-                hostname="node1.example.com")])])
+        pull = PullImages(images={APPLICATION_WITH_VOLUME.image})
+        wait = WaitForDataset(dataset=volume.dataset)
+        resize = ResizeDataset(dataset=volume.dataset)
+        expected = in_dependency_order(
+            (pull, []),
+            (wait, []),
+            (resize, [wait]),
+            (StartApplication(application=APPLICATION_WITH_VOLUME,
+                              hostname="node1.example.com"), [resize, pull]))
         self.assertEqual(expected, changes)
 
     def test_volume_handoff(self):
@@ -2389,19 +2623,164 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushDataset(
-                dataset=volume.dataset, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            unit.container_image
-                                        )),)]),
-            InParallel(changes=[HandoffDataset(
-                dataset=volume.dataset, hostname=another_node.hostname)]),
-        ])
+        push = PushDataset(
+            dataset=volume.dataset, hostname=another_node.hostname)
+        stop = StopApplication(
+            application=Application(name=APPLICATION_WITH_VOLUME_NAME,
+                                    image=DockerImage.from_string(
+                                        unit.container_image
+                                    )),)
+        expected = in_dependency_order(
+            (push, []),
+            (stop, [push]),
+            (HandoffDataset(
+                dataset=volume.dataset, hostname=another_node.hostname),
+             [push, stop]),
+        )
         self.assertEqual(expected, changes)
 
+    def test_start_independent_of_handoff(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` doesn't make
+        starting an application wait for an unrelated volume handoff.
+        """
+        unit = Unit(
+            name=APPLICATION_WITH_VOLUME_NAME,
+            container_name=APPLICATION_WITH_VOLUME_NAME,
+            container_image=APPLICATION_WITH_VOLUME_IMAGE,
+            activation_state=u'active'
+        )
+        docker = FakeDockerClient(units={unit.name: unit})
+        node = Node(
+            hostname=u"node1.example.com",
+            applications=frozenset({DISCOVERED_APPLICATION_WITH_VOLUME}),
+            manifestations={MANIFESTATION.dataset_id:
+                            MANIFESTATION},
+        )
+        another_node = Node(hostname=u"node2.example.com")
+        current = Deployment(nodes=frozenset([node, another_node]))
+        volume_service = create_volume_service(self)
+        self.successResultOf(volume_service.create(
+            volume_service.get(_to_volume_name(DATASET_ID))))
+        api = P2PNodeDeployer(
+            node.hostname,
+            volume_service, docker_client=docker,
+            network=make_memory_network()
+        )
+        new_application = Application(
+            name=u"site", image=DockerImage.from_string(u"nginx"))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=node.hostname,
+                 applications=frozenset({new_application})),
+            Node(hostname=another_node.hostname,
+                 applications=frozenset({APPLICATION_WITH_VOLUME}),
+                 manifestations={MANIFESTATION.dataset_id:
+                                 MANIFESTATION}),
+        }))
+
+        changes = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(
+                NodeState(hostname=api.hostname))),
+            desired_configuration=desired,
+            current_cluster_state=current,
+        )
+
+        start = changes.changes.index(StartApplication(
+            application=new_application, hostname=node.hostname))
+        pull = changes.changes.index(
+            PullImages(images={new_application.image}))
+        self.assertEqual({pull}, changes.dependencies[start])
+
+    def test_start_after_stop_using_port(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` starts an
+        application once any application using the same port is stopped,
+        which only happens once the new application's image is pulled.
+        """
+        unit = Unit(
+            name=u"old-site",
+            container_name=u"old-site",
+            container_image=u"nginx:1.7",
+            activation_state=u'active',
+            ports=frozenset([PortMap(internal_port=80, external_port=8080)]),
+        )
+        api = P2PNodeDeployer(
+            u"node1.example.com", create_volume_service(self),
+            docker_client=FakeDockerClient(units={unit.name: unit}),
+            network=make_memory_network()
+        )
+        new_application = Application(
+            name=u"site", image=DockerImage.from_string(u"nginx:1.9"),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=api.hostname,
+                 applications=frozenset({new_application}))}))
+
+        changes = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(
+                NodeState(hostname=api.hostname))),
+            desired_configuration=desired,
+            current_cluster_state=EMPTY,
+        )
+
+        kinds = [type(change) for change in changes.changes]
+        pull, stop, start = (kinds.index(PullImages),
+                             kinds.index(StopApplication),
+                             kinds.index(StartApplication))
+        self.assertEqual(
+            ({pull}, {pull, stop}),
+            (changes.dependencies[stop], changes.dependencies[start]))
+
+    def test_start_after_stop_using_dataset(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` starts an
+        application using a dataset only once a differently named
+        application using the same dataset on the node is stopped.
+        """
+        volume_service = create_volume_service(self)
+        node_path = self.successResultOf(volume_service.create(
+            volume_service.get(
+                _to_volume_name(DATASET.dataset_id))
+            )
+        ).get_filesystem().get_path()
+        unit = Unit(
+            name=APPLICATION_WITH_VOLUME_NAME,
+            container_name=APPLICATION_WITH_VOLUME_NAME,
+            container_image=APPLICATION_WITH_VOLUME_IMAGE,
+            volumes=frozenset([DockerVolume(
+                container_path=APPLICATION_WITH_VOLUME_MOUNTPOINT,
+                node_path=node_path)]),
+            activation_state=u'active'
+        )
+        current_node = NodeState(
+            hostname=u"node1.example.com",
+            applications=frozenset({APPLICATION_WITH_VOLUME}),
+            manifestations={MANIFESTATION.dataset_id: MANIFESTATION},
+        )
+        new_application = APPLICATION_WITH_VOLUME.set(name=u"new-name")
+        desired = Deployment(nodes=frozenset([Node(
+            hostname=current_node.hostname,
+            applications=frozenset({new_application}),
+            manifestations={MANIFESTATION.dataset_id: MANIFESTATION},
+        )]))
+        api = P2PNodeDeployer(
+            current_node.hostname,
+            volume_service,
+            docker_client=FakeDockerClient(units={unit.name: unit}),
+            network=make_memory_network()
+        )
+
+        changes = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(current_node)),
+            desired_configuration=desired,
+            current_cluster_state=DeploymentState(nodes=[current_node]),
+        )
+
+        kinds = [type(change) for change in changes.changes]
+        stop, start = (kinds.index(StopApplication),
+                       kinds.index(StartApplication))
+        self.assertIn(stop, changes.dependencies[start])
+
     def test_no_volume_changes(self):
         """
         ``P2PNodeDeployer.calculate_necessary_state_changes`` specifies no
@@ -2462,7 +2841,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(changes=[])
         self.assertEqual(expected, changes)
 
     def test_volume_resize(self):
@@ -2525,21 +2904,16 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeDataset(
-                    dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset,
-                    )]
-            ),
-            InParallel(
-                changes=[Sequentially(
-                    changes=[
-                        StopApplication(application=APPLICATION_WITH_VOLUME),
-                        StartApplication(
-                            application=APPLICATION_WITH_VOLUME_SIZE,
-                            hostname=u'node1.example.com')
-                    ])]
-            )])
+        resize = ResizeDataset(
+            dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset)
+        expected = in_dependency_order(
+            (resize, []),
+            (Sequentially(changes=[
+                StopApplication(application=APPLICATION_WITH_VOLUME),
+                StartApplication(
+                    application=APPLICATION_WITH_VOLUME_SIZE,
+                    hostname=u'node1.example.com')
+            ]), [resize]))
         self.assertEqual(expected, changes)
 
     def test_volume_resized_before_move(self):
@@ -2613,25 +2987,17 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         volume = APPLICATION_WITH_VOLUME_SIZE.volume
 
         # expected is: resize volume, push, stop application, handoff
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeDataset(dataset=volume.dataset)],
-            ),
-            InParallel(
-                changes=[PushDataset(
-                    dataset=volume.dataset,
-                    hostname=u'node2.example.com')]
-            ),
-            InParallel(
-                changes=[
-                    StopApplication(application=APPLICATION_WITH_VOLUME)
-                ]
-            ),
-            InParallel(
-                changes=[HandoffDataset(
-                    dataset=volume.dataset,
-                    hostname=u'node2.example.com')]
-            )])
+        resize = ResizeDataset(dataset=volume.dataset)
+        push = PushDataset(
+            dataset=volume.dataset, hostname=u'node2.example.com')
+        stop = StopApplication(application=APPLICATION_WITH_VOLUME)
+        expected = in_dependency_order(
+            (resize, []),
+            (push, [resize]),
+            (stop, [push]),
+            (HandoffDataset(
+                dataset=volume.dataset, hostname=u'node2.example.com'),
+             [push, stop]))
         self.assertEqual(expected, changes)
 
     def test_metadata_does_not_cause_restarts(self):
@@ -2697,7 +3063,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired,
             current_cluster_state=current,
         )
-        self.assertEqual(changes, Sequentially(changes=[]))
+        self.assertEqual(changes, InDependencyOrder(changes=[]))
 
     def test_volume_max_size_preserved_after_move(self):
         """
@@ -2746,12 +3112,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME_SIZE.volume
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
-            InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME_SIZE,
-                hostname="node1.example.com")])])
+        pull = PullImages(images={APPLICATION_WITH_VOLUME_SIZE.image})
+        wait = WaitForDataset(dataset=volume.dataset)
+        resize = ResizeDataset(dataset=volume.dataset)
+        expected = in_dependency_order(
+            (pull, []),
+            (wait, []),
+            (resize, [wait]),
+            (StartApplication(application=APPLICATION_WITH_VOLUME_SIZE,
+                              hostname="node1.example.com"), [resize, pull]))
         self.assertEqual(expected, changes)
 
     def test_local_not_running_applications_restarted(self):
@@ -2787,11 +3156,11 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired,
             current_cluster_state=EMPTY)
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = InDependencyOrder(changes=[
             Sequentially(changes=[StopApplication(application=application),
                                   StartApplication(application=application,
                                                    hostname="n.example.com")]),
-        ])])
+        ])
         self.assertEqual(expected, result)
 
     def test_not_local_not_running_applications_stopped(self):
@@ -2821,8 +3190,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             image=DockerImage.from_string(unit.container_image),
             running=False,
         )
-        expected = Sequentially(changes=[InParallel(changes=[
-            StopApplication(application=to_stop)])])
+        expected = InDependencyOrder(changes=[
+            StopApplication(application=to_stop)])
         self.assertEqual(expected, result)
 
     def test_handoff_precedes_wait(self):
@@ -2906,21 +3275,27 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushDataset(
-                dataset=volume.dataset, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            u'clusterhq/postgresql:9.1'),),)]),
-            InParallel(changes=[HandoffDataset(
-                dataset=volume.dataset, hostname=another_node.hostname)]),
-            InParallel(changes=[WaitForDataset(dataset=volume2.dataset)]),
-            InParallel(changes=[ResizeDataset(dataset=volume2.dataset)]),
-            InParallel(changes=[
-                StartApplication(application=another_application,
-                                 hostname="node1.example.com")]),
-        ])
+        pull = PullImages(images={another_application.image})
+        push = PushDataset(
+            dataset=volume.dataset, hostname=another_node.hostname)
+        stop = StopApplication(
+            application=Application(name=APPLICATION_WITH_VOLUME_NAME,
+                                    image=DockerImage.from_string(
+                                        u'clusterhq/postgresql:9.1'),),)
+        wait = WaitForDataset(dataset=volume2.dataset)
+        resize = ResizeDataset(dataset=volume2.dataset)
+        expected = in_dependency_order(
+            (pull, []),
+            (push, []),
+            (stop, [push]),
+            (HandoffDataset(
+                dataset=volume.dataset, hostname=another_node.hostname),
+             [push, stop]),
+            (wait, []),
+            (resize, [wait]),
+            (StartApplication(application=another_application,
+                              hostname="node1.example.com"), [resize, pull]),
+        )
         self.assertEqual(expected, changes)
 
     def test_restart_application_once_only(self):
@@ -2978,17 +3353,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[
-                CreateDataset(dataset=new_postgres_app.volume.dataset)]),
-            InParallel(changes=[
-                Sequentially(changes=[
-                    StopApplication(application=new_postgres_app),
-                    StartApplication(application=new_postgres_app,
-                                     hostname=u'node1.example.com')
-                ])
-            ])
-        ])
+        create = CreateDataset(dataset=new_postgres_app.volume.dataset)
+        expected = in_dependency_order(
+            (create, []),
+            (Sequentially(changes=[
+                StopApplication(application=new_postgres_app),
+                StartApplication(application=new_postgres_app,
+                                 hostname=u'node1.example.com')
+            ]), [create]))
         self.assertEqual(expected, result)
 
     def test_app_with_changed_image_restarted(self):
@@ -3039,13 +3411,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
+        pull = PullImages(images={new_postgres_app.image})
+        expected = in_dependency_order(
+            (pull, []),
+            (Sequentially(changes=[
                 StopApplication(application=old_postgres_app),
                 StartApplication(application=new_postgres_app,
                                  hostname="node1.example.com")
-                ]),
-        ])])
+            ]), [pull]))
 
         self.assertEqual(expected, result)
 
@@ -3112,14 +3485,12 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[
+        expected = InDependencyOrder(changes=[
             OpenPorts(ports=[OpenPort(port=50433)]),
-            InParallel(changes=[
-                Sequentially(changes=[
-                    StopApplication(application=old_postgres_app),
-                    StartApplication(application=new_postgres_app,
-                                     hostname="node1.example.com")
-                ]),
+            Sequentially(changes=[
+                StopApplication(application=old_postgres_app),
+                StartApplication(application=new_postgres_app,
+                                 hostname="node1.example.com")
             ]),
         ])
 
@@ -3184,13 +3555,13 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = InDependencyOrder(changes=[
             Sequentially(changes=[
                 StopApplication(application=old_wordpress_app),
                 StartApplication(application=new_wordpress_app,
                                  hostname="node1.example.com")
                 ]),
-        ])])
+        ])
 
         self.assertEqual(expected, result)
 
@@ -3234,9 +3605,8 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[CreateDataset(
-                dataset=MANIFESTATION.dataset)])])
+        expected = InDependencyOrder(changes=[
+            CreateDataset(dataset=MANIFESTATION.dataset)])
         self.assertEqual(expected, changes)
 
     def test_dataset_wait(self):
@@ -3277,11 +3647,10 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[
-                WaitForDataset(dataset=MANIFESTATION.dataset)]),
-            InParallel(changes=[
-                ResizeDataset(dataset=MANIFESTATION.dataset)])])
+        wait = WaitForDataset(dataset=MANIFESTATION.dataset)
+        expected = in_dependency_order(
+            (wait, []),
+            (ResizeDataset(dataset=MANIFESTATION.dataset), [wait]))
         self.assertEqual(expected, changes)
 
     def test_dataset_handoff(self):
@@ -3326,12 +3695,12 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
 
         dataset = MANIFESTATION.dataset
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushDataset(
-                dataset=dataset, hostname=another_node.hostname)]),
-            InParallel(changes=[HandoffDataset(
-                dataset=dataset, hostname=another_node.hostname)]),
-        ])
+        push = PushDataset(dataset=dataset, hostname=another_node.hostname)
+        expected = in_dependency_order(
+            (push, []),
+            (HandoffDataset(dataset=dataset, hostname=another_node.hostname),
+             [push]),
+        )
         self.assertEqual(expected, changes)
 
     def test_no_dataset_changes(self):
@@ -3367,7 +3736,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(changes=[])
         self.assertEqual(expected, changes)
 
     def test_dataset_resize(self):
@@ -3409,12 +3778,8 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeDataset(
-                    dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset,
-                    )]
-            )
+        expected = InDependencyOrder(changes=[
+            ResizeDataset(dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset)
         ])
         self.assertEqual(expected, changes)
 
@@ -3470,20 +3835,13 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
         dataset = MANIFESTATION_WITH_SIZE.dataset
 
         # expected is: resize, push, handoff
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeDataset(dataset=dataset)],
-            ),
-            InParallel(
-                changes=[PushDataset(
-                    dataset=dataset,
-                    hostname=u'node2.example.com')]
-            ),
-            InParallel(
-                changes=[HandoffDataset(
-                    dataset=dataset,
-                    hostname=u'node2.example.com')]
-            )])
+        resize = ResizeDataset(dataset=dataset)
+        push = PushDataset(dataset=dataset, hostname=u'node2.example.com')
+        expected = in_dependency_order(
+            (resize, []),
+            (push, [resize]),
+            (HandoffDataset(dataset=dataset, hostname=u'node2.example.com'),
+             [push]))
         self.assertEqual(expected, changes)
 
     def test_dataset_max_size_preserved_after_move(self):
@@ -3536,10 +3894,11 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
 
         dataset = MANIFESTATION_WITH_SIZE.dataset
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForDataset(dataset=dataset)]),
-            InParallel(changes=[ResizeDataset(dataset=dataset)]),
-        ])
+        wait = WaitForDataset(dataset=dataset)
+        expected = in_dependency_order(
+            (wait, []),
+            (ResizeDataset(dataset=dataset), [wait]),
+        )
         self.assertEqual(expected, changes)
 
 
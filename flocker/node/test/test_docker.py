@@ -2,17 +2,34 @@
 
 """Tests for :module:`flocker.node._docker`."""
 
+from BaseHTTPServer import BaseHTTPRequestHandler
+from json import dumps
+from SocketServer import UnixStreamServer
+from tempfile import mkdtemp
+from threading import Event, Thread, current_thread, local
+
 from zope.interface.verify import verifyObject
 
+from eliot.testing import validate_logging
+
+from docker.errors import APIError
+from requests import Response
+
 from pyrsistent import pset
 
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import SynchronousTestCase, TestCase
 from twisted.python.filepath import FilePath
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import reactor
+from twisted.web.http import NOT_FOUND, OK
 
-from ...testtools import random_name, make_with_init_tests
+from ...testtools import (
+    random_name, make_with_init_tests, FakeThreadPool, FakeThreadsReactor,
+    MemoryCoreReactor)
+from .. import _docker
 from .._docker import (
     IDockerClient, FakeDockerClient, AlreadyExists, PortMap, Unit,
-    Environment, Volume)
+    Environment, Volume, DockerClient, DockerEventsService, _PerThreadClient)
 
 from ...control._model import RestartAlways, RestartNever, RestartOnFailure
 
@@ -72,6 +89,15 @@ def make_idockerclient_tests(fixture):
             d.addCallback(lambda _: client.remove(name))
             return d
 
+        def test_pull(self):
+            """
+            An image can be pulled, and pulling it again does no harm.
+            """
+            client = fixture(self)
+            d = client.pull(u"busybox:latest")
+            d.addCallback(lambda _: client.pull(u"busybox:latest"))
+            return d
+
         def test_unknown_does_not_exist(self):
             """A unit that was never added does not exist."""
             client = fixture(self)
@@ -265,6 +291,753 @@ class FakeDockerClientImplementationTests(TestCase):
         self.assertEqual(units, FakeDockerClient(units=units)._units)
 
 
+class _InventoryDockerAPI(object):
+    """
+    Just enough of ``docker.Client`` to list containers, recording the
+    inspections made.
+
+    :ivar dict containers: Map container IDs to the result of inspecting
+        them.
+    :ivar dict names: Map container IDs to their names as listed.
+    :ivar list inspected: The IDs of the containers and images inspected.
+    :ivar set missing_images: The names of images which aren't available
+        until they are pulled.
+    :ivar list pulled: The names of the images pulled.
+    """
+    def __init__(self):
+        self.containers_data = {}
+        self.names = {}
+        self.inspected = []
+        self.missing_images = set()
+        self.pulled = []
+
+    def add(self, container_id, name, image_id=u"image1", running=True,
+            environment=()):
+        """
+        Add a container.
+
+        :param unicode container_id: The ID of the container.
+        :param unicode name: Its name, without the leading ``/``.
+        :param unicode image_id: The ID of its image.
+        :param bool running: Whether it is running.
+        :param environment: Its environment variables.
+        """
+        self.names[container_id] = [u"/" + name]
+        self.containers_data[container_id] = {
+            u"Id": container_id,
+            u"Name": u"/" + name,
+            u"Image": image_id,
+            u"State": {u"Running": running,
+                       u"StartedAt": u"2015-06-01T00:00:00Z",
+                       u"FinishedAt": u"0001-01-01T00:00:00Z"},
+            u"Config": {u"Image": u"openshift/busybox-http-app",
+                        u"Env": [u"PATH=/bin"] + list(environment),
+                        u"CpuShares": 0, u"Memory": 0},
+            u"HostConfig": {u"PortBindings": None, u"Binds": None,
+                            u"RestartPolicy": {u"Name": u"",
+                                               u"MaximumRetryCount": 0}},
+        }
+
+    def containers(self, all):
+        return [{u"Id": container_id, u"Names": names}
+                for container_id, names in self.names.items()]
+
+    def inspect_container(self, container_id):
+        self.inspected.append(container_id)
+        for data in self.containers_data.values():
+            if container_id in (data[u"Id"], data[u"Name"][1:]):
+                return data
+        raise KeyError(container_id)
+
+    def inspect_image(self, image_id):
+        self.inspected.append(image_id)
+        if image_id in self.missing_images:
+            response = Response()
+            response.status_code = NOT_FOUND
+            raise APIError("missing", response)
+        return {u"Id": image_id, u"Config": {u"Env": [u"PATH=/bin"]}}
+
+    def pull(self, repository):
+        self.pulled.append(repository)
+        self.missing_images.discard(repository)
+
+
+class _DockerClientTestsMixin(object):
+    """
+    Set up a ``DockerClient`` talking to an ``_InventoryDockerAPI`` in a
+    fake thread pool.
+    """
+    def setUp(self):
+        self.api = _InventoryDockerAPI()
+        self.reactor = FakeThreadsReactor()
+        self.client = DockerClient(
+            namespace=u"ns--", reactor=self.reactor,
+            threadpool=self.reactor.threadpool)
+        self.client._client = self.api
+
+    def list(self):
+        """
+        List the units, forgetting the inspections made before.
+
+        :return: The ``set`` of units.
+        """
+        del self.api.inspected[:]
+        listing = self.client.list()
+        self.reactor.threadpool.run_pending()
+        return self.successResultOf(listing)
+
+
+class DockerClientListTests(_DockerClientTestsMixin, SynchronousTestCase):
+    """
+    Tests for how ``DockerClient.list`` inspects and caches containers and
+    images.
+    """
+    def test_only_namespace_inspected(self):
+        """
+        Containers outside the namespace, as given by their listed names, are
+        not inspected.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.api.add(u"c2", u"other")
+        units = self.list()
+        self.assertEqual(
+            ([u"web"], [u"c1", u"image1"]),
+            ([unit.name for unit in units], self.api.inspected))
+
+    def test_image_inspected_once(self):
+        """
+        An image shared by several containers is only inspected once, and
+        its environment variables are left out of each unit's environment.
+        """
+        for i in range(5):
+            self.api.add(u"c%d" % (i,), u"ns--web%d" % (i,),
+                         environment=[u"KEY=%d" % (i,)])
+        units = self.list()
+        self.assertEqual(
+            (1, set(Environment(
+                variables=frozenset({(u"KEY", u"%d" % (i,))}))
+                for i in range(5))),
+            (self.api.inspected.count(u"image1"),
+             set(unit.environment for unit in units)))
+
+    def test_unchanged_not_parsed(self):
+        """
+        A container whose state is unchanged since it was last listed is not
+        parsed again and its image is not inspected again.
+        """
+        self.api.add(u"c1", u"ns--web")
+        [first] = self.list()
+        [second] = self.list()
+        self.assertEqual([u"c1"], self.api.inspected)
+        self.assertIs(first, second)
+
+    def test_changed_state_parsed(self):
+        """
+        A container whose state changed since it was last listed is parsed
+        again.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.list()
+        state = self.api.containers_data[u"c1"][u"State"]
+        state[u"Running"] = False
+        state[u"FinishedAt"] = u"2015-06-02T00:00:00Z"
+        self.assertEqual([u"inactive"],
+                         [unit.activation_state for unit in self.list()])
+
+    def test_renamed_parsed(self):
+        """
+        A container renamed since it was last listed is parsed again.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.list()
+        self.api.names[u"c1"] = [u"/ns--db"]
+        self.api.containers_data[u"c1"][u"Name"] = u"/ns--db"
+        self.assertEqual([u"db"], [unit.name for unit in self.list()])
+
+    def test_removed_forgotten(self):
+        """
+        Containers which are no longer listed are forgotten.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.list()
+        del self.api.names[u"c1"]
+        self.assertEqual((set(), {}), (self.list(), self.client._units))
+
+    def test_removed_during_listing(self):
+        """
+        A container which is removed between being listed and being
+        inspected is left out.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.api.names[u"c2"] = [u"/ns--gone"]
+        response = Response()
+        response.status_code = NOT_FOUND
+        inspect_container = self.api.inspect_container
+
+        def inspect_removed(container_id):
+            if container_id == u"c2":
+                raise APIError("gone", response)
+            return inspect_container(container_id)
+        self.api.inspect_container = inspect_removed
+        self.assertEqual([u"web"], [unit.name for unit in self.list()])
+
+    def test_image_cache_evicted(self):
+        """
+        Only the most recently used images are remembered.
+        """
+        self.patch(_docker, "_IMAGE_CACHE_SIZE", 2)
+        for i in range(3):
+            self.api.add(u"c%d" % (i,), u"ns--web%d" % (i,),
+                         image_id=u"image%d" % (i,))
+        self.list()
+        self.assertEqual(2, len(self.client._image_environments))
+
+
+class DockerClientEventsTests(_DockerClientTestsMixin, SynchronousTestCase):
+    """
+    Tests for how ``DockerClient.list`` uses Docker's events.
+    """
+    def setUp(self):
+        super(DockerClientEventsTests, self).setUp()
+        self.api.add(u"c1", u"ns--web")
+        self.api.add(u"c2", u"ns--db")
+
+    def synchronized(self):
+        """
+        Start following events and list everything once.
+        """
+        self.client._events_connected()
+        self.list()
+
+    def assert_inspected(self, inspected, names):
+        """
+        Assert that listing only inspects the given containers or images and
+        lists units with the given names.
+        """
+        units = self.list()
+        self.assertEqual(
+            (inspected, names),
+            (sorted(self.api.inspected),
+             sorted(unit.name for unit in units)))
+
+    def event(self, status, container_id):
+        """
+        Report an event to the client.
+        """
+        self.client._container_event({u"status": status, u"id": container_id,
+                                      u"time": 1433116800})
+
+    def test_change_callbacks(self):
+        """
+        Functions given to ``register`` are called for each event which may
+        change a container, while events are followed.
+        """
+        calls = []
+        self.client.register(lambda: calls.append(None))
+        self.event(u"die", u"c1")
+        self.client._events_connected()
+        self.event(u"die", u"c1")
+        self.event(u"destroy", u"c2")
+        self.event(u"pull", u"c1")
+        self.assertEqual(2, len(calls))
+
+    def test_not_following(self):
+        """
+        If events aren't being followed, every listing inspects every
+        container.
+        """
+        self.list()
+        self.assert_inspected([u"c1", u"c2"], [u"db", u"web"])
+
+    def test_synchronized(self):
+        """
+        Once events are followed and everything was listed, listings don't
+        inspect unchanged containers.
+        """
+        self.synchronized()
+        self.assert_inspected([], [u"db", u"web"])
+
+    def test_changed(self):
+        """
+        Only containers which events say changed are inspected again.
+        """
+        self.synchronized()
+        self.api.containers_data[u"c1"][u"State"][u"Running"] = False
+        self.event(u"die", u"c1")
+        self.assert_inspected([u"c1"], [u"db", u"web"])
+        self.assertEqual(
+            [u"inactive"], [unit.activation_state
+                            for unit in self.client._current_units()
+                            if unit.name == u"web"])
+
+    def test_created(self):
+        """
+        Containers which events say were created are inspected and listed.
+        """
+        self.synchronized()
+        self.api.add(u"c3", u"ns--cache", image_id=u"image2")
+        self.event(u"create", u"c3")
+        self.assert_inspected([u"c3", u"image2"], [u"cache", u"db", u"web"])
+
+    def test_destroyed(self):
+        """
+        Containers which events say were destroyed are no longer listed.
+        """
+        self.synchronized()
+        self.event(u"destroy", u"c1")
+        self.assert_inspected([], [u"db"])
+
+    def test_other_events_ignored(self):
+        """
+        Events which don't change containers, e.g. about images, are
+        ignored.
+        """
+        self.synchronized()
+        self.event(u"untag", u"image1")
+        self.assert_inspected([], [u"db", u"web"])
+
+    def test_events_lost(self):
+        """
+        Once events stop being followed, listings inspect everything again.
+        """
+        self.synchronized()
+        self.client._events_lost()
+        self.assert_inspected([u"c1", u"c2"], [u"db", u"web"])
+
+    def test_reconnected_during_listing(self):
+        """
+        If events are followed again while everything is being listed, the
+        listing may have missed events so everything is listed again next
+        time.
+        """
+        self.client._events_connected()
+        listing = self.client.list()
+        self.client._events_connected()
+        self.reactor.threadpool.run_pending()
+        self.successResultOf(listing)
+        self.assert_inspected([u"c1", u"c2"], [u"db", u"web"])
+
+    def assert_destroyed_during_listing(self):
+        """
+        Start a listing, destroy ``c1`` while it is in progress and assert
+        that the container is forgotten rather than listed.
+        """
+        listing = self.client.list()
+        self.event(u"destroy", u"c1")
+        self.reactor.threadpool.run_pending()
+        self.assertEqual(
+            ([u"db"], [u"c2"], []),
+            (sorted(unit.name for unit in self.successResultOf(listing)),
+             sorted(self.client._units), self.client._destroyed))
+
+    def test_destroyed_during_full_listing(self):
+        """
+        A container destroyed while everything is being listed is left out,
+        even though it was inspected before it was destroyed.
+        """
+        self.client._events_connected()
+        self.assert_destroyed_during_listing()
+
+    def test_destroyed_during_changed_listing(self):
+        """
+        A changed container destroyed while it is being inspected again is
+        left out, even though it was inspected before it was destroyed.
+        """
+        self.synchronized()
+        self.event(u"die", u"c1")
+        self.assert_destroyed_during_listing()
+
+
+class _FakeThreadPool(FakeThreadPool):
+    """
+    A ``FakeThreadPool`` which can be started and stopped.
+    """
+    started = False
+
+    def __init__(self, minthreads, maxthreads, name):
+        FakeThreadPool.__init__(self)
+        self.min = minthreads
+        self.max = maxthreads
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+
+class _CoreThreadsReactor(MemoryCoreReactor):
+    """
+    A ``MemoryCoreReactor`` with just enough of ``IReactorTime`` and
+    ``IReactorThreads`` for ``DockerClient``.
+    """
+    def seconds(self):
+        return 0
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class DockerClientOperationsTests(_DockerClientTestsMixin,
+                                  SynchronousTestCase):
+    """
+    Tests for how ``DockerClient`` limits and measures Docker operations.
+    """
+    def test_limited(self):
+        """
+        Operations beyond the configured limit wait until earlier ones are
+        done, and are counted as queued until then.
+        """
+        client = DockerClient(reactor=self.reactor,
+                              threadpool=self.reactor.threadpool,
+                              limits={u"exists": 2})
+        client._client = self.api
+        self.api.add(u"c1", u"flocker--web")
+        existing = [client.exists(u"web") for _ in range(3)]
+        in_threads = len(self.reactor.threadpool.pending)
+        before = client.statistics()
+        self.reactor.threadpool.run_pending()
+        results = [self.successResultOf(d) for d in existing]
+        self.assertEqual(
+            ((2, 1, 2), [True, True, True]),
+            ((in_threads, before[u"exists"][u"queued"],
+              before[u"exists"][u"running"]),
+             results))
+
+    def test_latency(self):
+        """
+        The latency of each operation, from being requested to finishing,
+        is measured.
+        """
+        self.api.add(u"c1", u"ns--web")
+        existing = self.client.exists(u"web")
+        self.reactor.advance(2)
+        self.reactor.threadpool.run_pending()
+        self.successResultOf(existing)
+        existing = self.client.exists(u"web")
+        self.reactor.threadpool.run_pending()
+        self.successResultOf(existing)
+        statistics = self.client.statistics()[u"exists"]
+        self.assertEqual(
+            (2, 1.0, 2.0),
+            (statistics[u"calls"], statistics[u"mean_latency"],
+             statistics[u"max_latency"]))
+
+    def test_pending(self):
+        """
+        The number of calls given to the thread pool which haven't finished
+        is measured.
+        """
+        self.api.add(u"c1", u"ns--web")
+        self.client.exists(u"web")
+        before = self.client.statistics()[u"pending"]
+        self.reactor.threadpool.run_pending()
+        self.assertEqual((1, 0),
+                         (before, self.client.statistics()[u"pending"]))
+
+    def test_pull_missing(self):
+        """
+        ``DockerClient.pull`` pulls an image which isn't available, as a
+        ``pull`` operation.
+        """
+        self.api.missing_images.add(u"busybox:latest")
+        pulling = self.client.pull(u"busybox:latest")
+        self.reactor.threadpool.run_pending()
+        self.successResultOf(pulling)
+        self.assertEqual(
+            ([u"busybox:latest"], 1),
+            (self.api.pulled,
+             self.client.statistics()[u"pull"][u"calls"]))
+
+    def test_pull_available(self):
+        """
+        ``DockerClient.pull`` doesn't pull an image which is already
+        available.
+        """
+        pulling = self.client.pull(u"busybox:latest")
+        self.reactor.threadpool.run_pending()
+        self.successResultOf(pulling)
+        self.assertEqual([], self.api.pulled)
+
+    def test_own_threadpool(self):
+        """
+        By default ``DockerClient`` starts a thread pool of its own when
+        first needed, which is stopped when the reactor shuts down.
+        """
+        self.patch(_docker, "ThreadPool", _FakeThreadPool)
+        reactor = _CoreThreadsReactor()
+        client = DockerClient(reactor=reactor)
+        client._client = self.api
+        self.api.add(u"c1", u"flocker--web")
+        before = client._threadpool
+        existing = client.exists(u"web")
+        threadpool = client._threadpool
+        started = threadpool.started
+        threadpool.run_pending()
+        reactor.fireSystemEvent("shutdown")
+        self.assertEqual(
+            (None, (0, _docker._DOCKER_THREADS), True, False, True),
+            (before, (threadpool.min, threadpool.max), started,
+             threadpool.started, self.successResultOf(existing)))
+
+
+class _PerThreadInventoryAPI(local):
+    """
+    Like ``_PerThreadClient``, a separate client for each thread, delegating
+    to a shared ``_InventoryDockerAPI``.
+
+    Each call records whether it was made in the thread which looked up
+    the method's client.
+    """
+    def __init__(self, api, uses):
+        """
+        :param _InventoryDockerAPI api: The API to delegate to.
+        :param list uses: Each call appends ``True`` if it was made in the
+            thread owning the client used, otherwise ``False``.
+        """
+        self._api = api
+        self._uses = uses
+        self._owner = current_thread()
+
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+        owner = self._owner
+        uses = self._uses
+
+        def call(*args, **kwargs):
+            uses.append(owner is current_thread())
+            return method(*args, **kwargs)
+        return call
+
+
+class DockerClientThreadsTests(TestCase):
+    """
+    Tests for how ``DockerClient`` uses its per-thread Docker clients.
+    """
+    def test_list_uses_worker_clients(self):
+        """
+        Listing, inspecting containers and inspecting images all use the
+        Docker client belonging to the worker thread doing so.
+        """
+        api = _InventoryDockerAPI()
+        api.add(u"c1", u"flocker--web")
+        uses = []
+        threadpool = ThreadPool(minthreads=2, maxthreads=2)
+        threadpool.start()
+        self.addCleanup(threadpool.stop)
+        client = DockerClient(reactor=reactor, threadpool=threadpool)
+        client._client = _PerThreadInventoryAPI(api, uses)
+        listing = client.list()
+        listing.addCallback(
+            lambda units: self.assertEqual(
+                ([u"web"], [True, True, True]),
+                ([unit.name for unit in units], uses)))
+        return listing
+
+
+class _DockerAPIHandler(BaseHTTPRequestHandler):
+    """
+    Respond to every request with an empty JSON list, keeping the
+    connection alive.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.send_response(OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"[]")
+
+    def log_message(self, *args):
+        pass
+
+
+class _DockerAPIServer(UnixStreamServer):
+    """
+    An HTTP server on a unix socket recording the connections made.
+    """
+    def __init__(self, path):
+        UnixStreamServer.__init__(self, path, _DockerAPIHandler)
+        self.paths = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        thread = Thread(target=UnixStreamServer.process_request,
+                        args=(self, request, client_address))
+        thread.daemon = True
+        thread.start()
+
+
+class PerThreadClientTests(SynchronousTestCase):
+    """
+    Tests for ``_PerThreadClient``.
+    """
+    def test_per_thread(self):
+        """
+        Each thread gets a docker-py ``Client`` of its own.
+        """
+        client = _PerThreadClient(b"unix://var/run/docker.sock")
+        clients = []
+        thread = Thread(target=lambda: clients.append(client.client))
+        thread.start()
+        thread.join()
+        self.assertEqual((2, u"http+unix://var/run/docker.sock"),
+                         (len({id(client.client), id(clients[0])}),
+                          client.base_url))
+
+    def test_connection_reused(self):
+        """
+        Requests for different paths reuse the same connection to Docker's
+        unix socket.
+        """
+        # Unix socket paths are limited to ~100 bytes, too short for trial's
+        # temporary paths:
+        directory = FilePath(mkdtemp())
+        self.addCleanup(directory.remove)
+        path = directory.child(b"docker.sock")
+        server = _DockerAPIServer(path.path)
+        self.addCleanup(server.server_close)
+        serving = Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+        self.addCleanup(server.shutdown)
+        client = _PerThreadClient(b"unix:/" + path.path)
+        client.containers(all=True)
+        client.images()
+        self.assertEqual(
+            (1, [u"/v1.15/containers/json?all=1&limit=-1&trunc_cmd=1&size=0",
+                 u"/v1.15/images/json?only_ids=0&all=0"]),
+            (server.connections, server.paths))
+
+
+class _QueueingReactor(object):
+    """
+    Just enough of a reactor to queue functions called from the thread
+    following Docker's events, until the test runs them.
+
+    :ivar list calls: The queued calls.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, f, *args):
+        self.calls.append((f, args))
+
+    def run_calls(self):
+        """
+        Run the queued calls.
+        """
+        calls, self.calls = self.calls, []
+        for f, args in calls:
+            f(*args)
+
+
+class _SynchronousReactor(object):
+    """
+    Just enough of a reactor to call functions from the thread following
+    Docker's events, synchronously.
+    """
+    def callFromThread(self, f, *args):
+        f(*args)
+
+
+class _RecordingDockerClient(object):
+    """
+    Record what a ``DockerEventsService`` reports to a ``DockerClient``.
+
+    :ivar list reported: What was reported.
+    """
+    def __init__(self, events):
+        """
+        :param events: A no-argument callable returning an iterable of
+            JSON-encoded events, like ``docker.Client.events``.
+        """
+        self._events_client = self
+        self.events = events
+        self.reported = []
+
+    def _events_connected(self):
+        self.reported.append(u"connected")
+
+    def _events_lost(self):
+        self.reported.append(u"lost")
+
+    def _container_event(self, event):
+        self.reported.append(event)
+
+
+class DockerEventsServiceTests(SynchronousTestCase):
+    """
+    Tests for ``DockerEventsService``.
+    """
+    EVENT = {u"status": u"start", u"id": u"c1", u"from": u"busybox:latest",
+             u"time": 1433116800}
+
+    def follow(self, events, stopping=None):
+        """
+        Follow some events until they run out.
+
+        :return: What was reported to the client.
+        """
+        client = _RecordingDockerClient(events)
+        service = DockerEventsService(_SynchronousReactor(), client)
+        if stopping is None:
+            stopping = Event()
+        service._follow_once(stopping)
+        return client.reported
+
+    def test_events(self):
+        """
+        The client is told once events are being followed, of each event,
+        and once the events end.
+        """
+        self.assertEqual(
+            [u"connected", self.EVENT, self.EVENT, u"lost"],
+            self.follow(lambda: [dumps(self.EVENT), dumps(self.EVENT)]))
+
+    @validate_logging(
+        lambda test, logger:
+        test.assertEqual(len(logger.flush_tracebacks(ZeroDivisionError)), 1))
+    def test_failure(self, logger):
+        """
+        If following events fails the failure is logged and the client is
+        told the events were lost.
+        """
+        self.patch(DockerEventsService, "logger", logger)
+        self.assertEqual([u"lost"], self.follow(lambda: 1 / 0))
+
+    def test_stopping(self):
+        """
+        Once told to stop, no further events are reported.
+        """
+        stopping = Event()
+
+        def events():
+            yield dumps(self.EVENT)
+            stopping.set()
+            yield dumps(self.EVENT)
+        self.assertEqual([u"connected", self.EVENT],
+                         self.follow(events, stopping))
+
+    def test_reported_after_stopping(self):
+        """
+        Reports queued for the reactor thread before the service stopped
+        but run after it stopped are ignored, so the client doesn't think
+        events are still being followed.
+        """
+        client = _RecordingDockerClient(lambda: [dumps(self.EVENT)])
+        reactor = _QueueingReactor()
+        service = DockerEventsService(reactor, client)
+        stopping = Event()
+        service._follow_once(stopping)
+        stopping.set()
+        reactor.run_calls()
+        self.assertEqual([], client.reported)
+
+
 class PortMapInitTests(
         make_with_init_tests(
             record_type=PortMap,
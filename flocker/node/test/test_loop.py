@@ -14,6 +14,7 @@ from twisted.test.proto_helpers import StringTransport, MemoryReactorClock
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 from twisted.internet.defer import succeed, Deferred, fail
 from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionLost
 
 from ...testtools import FakeAMPClient
 from .._loop import (
@@ -23,6 +24,7 @@ from .._loop import (
     ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE
     )
 from ..testtools import ControllableDeployer, ControllableAction, to_node
+from .._deploy import InParallel, Sequentially, InDependencyOrder
 from ...control import (
     NodeState, Deployment, Manifestation, Dataset, DeploymentState,
 )
@@ -416,7 +418,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         iteration starts another iteration.
         """
         local_state = NodeState(hostname=u'192.0.2.123')
-        local_state2 = NodeState(hostname=u'192.0.2.123')
+        local_state2 = NodeState(hostname=u'192.0.2.123', used_ports=[80])
         configuration = Deployment(nodes=frozenset([to_node(local_state)]))
         state = DeploymentState(nodes=[local_state])
         action = ControllableAction(result=succeed(None))
@@ -439,7 +441,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         self.assertTupleEqual(
             (deployer.calculate_inputs, client.calls),
             ([(local_state, configuration, state),
-              (local_state2, configuration, state)],
+              (local_state2, configuration,
+               DeploymentState(nodes=[local_state2]))],
              [(NodeStateCommand, dict(state_changes=(local_state,))),
               (NodeStateCommand, dict(state_changes=(local_state2,)))])
         )
@@ -615,6 +618,331 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
              [(NodeStateCommand, dict(state_changes=(local_state2,)))]))
 
 
+class RunningConvergenceLoopMixin(object):
+    """
+    Helpers for tests of an FSM created by ``build_convergence_loop_fsm``
+    running several iterations.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=u'192.0.2.123')
+        self.configuration = Deployment(
+            nodes=frozenset([to_node(self.local_state)]))
+        self.state = DeploymentState(nodes=[self.local_state])
+        self.deployer = ControllableDeployer(
+            self.local_state.hostname,
+            [succeed(self.local_state) for _ in range(10)],
+            [ControllableAction(result=succeed(None)) for _ in range(10)])
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(state_changes=(self.local_state,)),
+            {"result": None})
+        self.reactor = Clock()
+        self.random = 0.0
+        self.loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, lambda: self.random)
+
+    def status_update(self, configuration=None):
+        """
+        Send a status update to the FSM.
+
+        :param configuration: The configuration to send, by default the
+            one in ``setUp``.
+        """
+        if configuration is None:
+            configuration = self.configuration
+        self.loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration,
+            state=self.state))
+
+    def delays(self, iterations):
+        """
+        Let the FSM run some iterations.
+
+        :param int iterations: The number of iterations to wait for.
+
+        :return: A ``list`` of the delays before each iteration.
+        """
+        delays = []
+        for _ in range(iterations):
+            [call] = self.reactor.getDelayedCalls()
+            delay = call.getTime() - self.reactor.seconds()
+            delays.append(delay)
+            self.reactor.advance(delay)
+        return delays
+
+
+class ConvergenceLoopSleepTests(RunningConvergenceLoopMixin,
+                                SynchronousTestCase):
+    """
+    Tests for the waits between iterations of the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def test_sleeping(self):
+        """
+        After an iteration the FSM sleeps until the next one.
+        """
+        self.status_update()
+        self.assertEqual(
+            (ConvergenceLoopStates.SLEEPING, 1),
+            (self.loop.state, len(self.reactor.getDelayedCalls())))
+
+    def test_backoff(self):
+        """
+        The delay between iterations doubles while the discovered local
+        state doesn't change, up to a maximum.
+        """
+        self.status_update()
+        self.assertEqual([1.0, 2.0, 4.0, 8.0, 10.0, 10.0], self.delays(6))
+
+    def test_backoff_reset(self):
+        """
+        The delay between iterations goes back to the minimum when the
+        discovered local state changes.
+        """
+        changed = NodeState(hostname=self.local_state.hostname,
+                            used_ports=[80])
+        self.client.register_response(
+            NodeStateCommand, dict(state_changes=(changed,)),
+            {"result": None})
+        self.deployer.local_states[2] = succeed(changed)
+        self.status_update()
+        self.assertEqual([1.0, 2.0, 1.0, 1.0, 2.0], self.delays(5))
+
+    @validate_logging(lambda test_case, logger: test_case.assertEqual(
+        len(logger.flush_tracebacks(RuntimeError)), 1))
+    def test_failure_resets_backoff(self, logger):
+        """
+        The delay between iterations goes back to the minimum when an
+        iteration fails.
+        """
+        self.patch(self.loop, "logger", logger)
+        self.deployer.calculated_actions[2] = ControllableAction(
+            result=fail(RuntimeError()))
+        self.status_update()
+        self.assertEqual([1.0, 2.0, 1.0, 2.0], self.delays(4))
+
+    def test_jitter(self):
+        """
+        The delay between iterations is shortened by a random fraction.
+        """
+        self.random = 0.5
+        self.status_update()
+        self.assertEqual(
+            [0.9, 1.8], [round(delay, 6) for delay in self.delays(2)])
+
+    def test_changed_status_update_wakes_up(self):
+        """
+        A status update with a changed configuration received while sleeping
+        starts the next iteration immediately.
+        """
+        self.status_update()
+        self.delays(3)
+        self.status_update(Deployment(nodes=frozenset()))
+        self.assertEqual(
+            ([0], 5), (self.delays(1), len(self.deployer.local_states)))
+
+    def test_unchanged_status_update(self):
+        """
+        A status update with the same configuration and cluster state
+        received while sleeping doesn't change when the next iteration
+        starts.
+        """
+        self.status_update()
+        self.status_update()
+        self.assertEqual([1.0], self.delays(1))
+
+    def test_status_update_while_converging(self):
+        """
+        If a status update with a changed configuration is received during an
+        iteration the next iteration starts immediately.
+        """
+        self.deployer.calculated_actions[0] = action = ControllableAction(
+            result=Deferred())
+        self.status_update()
+        self.status_update(Deployment(nodes=frozenset()))
+        action.result.callback(None)
+        self.assertEqual([0, 1.0], self.delays(2))
+
+    def test_local_change_wakes_up(self):
+        """
+        A local change received while sleeping starts the next iteration
+        immediately.
+        """
+        self.status_update()
+        self.delays(3)
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_CHANGE)
+        self.assertEqual(
+            ([0], 5), (self.delays(1), len(self.deployer.local_states)))
+
+    def test_local_change_while_converging(self):
+        """
+        If a local change is received during an iteration the next
+        iteration starts immediately.
+        """
+        self.deployer.calculated_actions[0] = action = ControllableAction(
+            result=Deferred())
+        self.status_update()
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_CHANGE)
+        action.result.callback(None)
+        self.assertEqual([0, 1.0], self.delays(2))
+
+    def test_local_change_while_stopped(self):
+        """
+        A local change received before the first status update is ignored.
+        """
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_CHANGE)
+        self.assertEqual((ConvergenceLoopStates.STOPPED, []),
+                         (self.loop.state, self.reactor.getDelayedCalls()))
+
+    def test_stop_while_sleeping(self):
+        """
+        A stop input received while sleeping stops the FSM and cancels the
+        next iteration.
+        """
+        self.status_update()
+        self.loop.receive(ConvergenceLoopInputs.STOP)
+        self.assertEqual((ConvergenceLoopStates.STOPPED, []),
+                         (self.loop.state, self.reactor.getDelayedCalls()))
+
+
+class ConvergenceLoopSendTests(RunningConvergenceLoopMixin,
+                               SynchronousTestCase):
+    """
+    Tests for sending the local state to the control service from the FSM
+    created by ``build_convergence_loop_fsm``.
+    """
+    def sends(self):
+        """
+        :return: The number of ``NodeStateCommand`` calls made by the client.
+        """
+        return len(self.client.calls)
+
+    def test_unchanged_not_sent(self):
+        """
+        Local state which is the same as that acknowledged by the control
+        service is not sent again.
+        """
+        self.status_update()
+        self.delays(3)
+        self.assertEqual(1, self.sends())
+
+    def test_changed_sent(self):
+        """
+        Local state which differs from that acknowledged by the control
+        service is sent.
+        """
+        changed = NodeState(hostname=self.local_state.hostname,
+                            used_ports=[80])
+        self.client.register_response(
+            NodeStateCommand, dict(state_changes=(changed,)),
+            {"result": None})
+        self.deployer.local_states[1] = succeed(changed)
+        self.status_update()
+        self.delays(2)
+        self.assertEqual(3, self.sends())
+
+    def test_heartbeat(self):
+        """
+        Unchanged local state is sent again once the heartbeat interval has
+        passed since it was last sent.
+        """
+        self.status_update()
+        # 1 + 2 + 4 + 8 + 10 + 10 seconds pass:
+        self.delays(6)
+        self.assertEqual(2, self.sends())
+
+    def test_not_acknowledged(self):
+        """
+        Local state which wasn't acknowledged by the control service is sent
+        again.
+        """
+        self.client = FakeAMPClient()
+        self.status_update()
+        self.delays(2)
+        self.assertEqual(3, self.sends())
+
+    @validate_logging(lambda test_case, logger: test_case.assertEqual(
+        len(logger.flush_tracebacks(ConnectionLost)), 1))
+    def test_send_failure_logged(self, logger):
+        """
+        A failure to send the local state is logged, and the iteration
+        carries on.
+        """
+        self.patch(self.loop, "logger", logger)
+        self.patch(self.client, "callRemote",
+                   lambda command, **kwargs: fail(ConnectionLost()))
+        self.status_update()
+        self.assertEqual(1, len(self.reactor.getDelayedCalls()))
+
+    def test_new_client(self):
+        """
+        Unchanged local state is sent again through a new client.
+        """
+        self.status_update()
+        self.delays(1)
+        client = self.client
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(state_changes=(self.local_state,)),
+            {"result": None})
+        self.status_update()
+        self.delays(1)
+        self.assertEqual((1, 1), (len(client.calls), self.sends()))
+
+
+class ConvergenceLoopCalculationTests(RunningConvergenceLoopMixin,
+                                      SynchronousTestCase):
+    """
+    Tests for skipping the calculation of changes in the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def no_changes(self):
+        """
+        Make the deployer find that no changes are necessary.
+        """
+        self.deployer.calculated_actions = [
+            InParallel(changes=[Sequentially(changes=[
+                InDependencyOrder(changes=[])])])
+            for _ in range(10)]
+
+    def calculations(self):
+        """
+        :return: A tuple of the number of calculations done by the deployer
+            and the number skipped by the loop.
+        """
+        return (len(self.deployer.calculate_inputs),
+                self.loop._fsm._world.original.calculations_skipped)
+
+    def test_unchanged_skipped(self):
+        """
+        If no changes were found necessary, changes are not calculated again
+        while the configuration and cluster state stay the same.
+        """
+        self.no_changes()
+        self.status_update()
+        self.delays(2)
+        self.assertEqual((1, 2), self.calculations())
+
+    def test_changes_necessary(self):
+        """
+        If changes were found necessary, changes are calculated again.
+        """
+        self.status_update()
+        self.delays(2)
+        self.assertEqual((3, 0), self.calculations())
+
+    def test_configuration_changed(self):
+        """
+        Changes are calculated again after the configuration changes.
+        """
+        self.no_changes()
+        self.status_update()
+        self.delays(1)
+        self.status_update(Deployment(nodes=frozenset()))
+        self.delays(1)
+        self.assertEqual((2, 1), self.calculations())
+
+
 class AgentLoopServiceTests(SynchronousTestCase):
     """
     Tests for ``AgentLoopService``.
@@ -418,10 +418,53 @@ class ReportStateScriptMainTests(SynchronousTestCase):
         self.assertEqual(safe_load(content.getvalue()), expected)
 
 
+class _FakeDockerEventsService(Service):
+    """
+    Stand-in for ``DockerEventsService`` which doesn't talk to Docker.
+    """
+    def __init__(self, reactor, docker_client):
+        self.reactor = reactor
+        self.docker_client = docker_client
+
+
 class ZFSAgentScriptTests(SynchronousTestCase):
     """
     Tests for ``ZFSAgentScript``.
     """
+    def setUp(self):
+        self.patch(script_module, "DockerEventsService",
+                   _FakeDockerEventsService)
+
+    def test_follows_docker_events(self):
+        """
+        ``ZFSAgentScript.main`` starts following Docker's events for the
+        deployer's Docker client.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        test_reactor = MemoryCoreReactor()
+        ZFSAgentScript().main(test_reactor, options, service)
+        [events] = [child for child in service.parent
+                    if isinstance(child, _FakeDockerEventsService)]
+        self.assertEqual(
+            (events.reactor, events.docker_client, events.running),
+            (test_reactor, service.parent.deployer.docker_client, True))
+
+    def test_docker_events_wake_loop(self):
+        """
+        ``ZFSAgentScript.main`` tells the convergence loop about changes
+        Docker's events report.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        loop = service.parent
+        self.assertEqual(
+            [loop.local_state_changed],
+            loop.deployer.docker_client._change_callbacks)
+
     def test_main_starts_service(self):
         """
         ``ZFSAgentScript.main`` starts the given service.
@@ -5,13 +5,14 @@ Infrastructure for publishing a REST HTTP API.
 """
 
 from ._infrastructure import (
-    structured, EndpointResponse, user_documentation,
+    structured, conditional, EndpointResponse, user_documentation,
+    ResponseCache,
     )
 
-from ._error import makeBadRequest as make_bad_request
+from ._error import makeBadRequest as make_bad_request, BadRequest
 
 
 __all__ = [
-    "structured", "EndpointResponse", "user_documentation",
-    "make_bad_request",
+    "structured", "conditional", "EndpointResponse", "user_documentation",
+    "ResponseCache", "make_bad_request", "BadRequest",
 ]
@@ -6,22 +6,33 @@ This module implements tools for exposing Python methods as API endpoints.
 from __future__ import absolute_import
 
 __all__ = [
-    "EndpointResponse", "structured", "user_documentation",
+    "EndpointResponse", "structured", "conditional", "user_documentation",
+    "ResponseCache",
     ]
 
 from functools import wraps
+from itertools import count
+from types import GeneratorType
+from uuid import uuid4
+from weakref import WeakKeyDictionary
 
 from json import loads, dumps
 
-from twisted.internet.defer import maybeDeferred
-from twisted.web.http import OK, INTERNAL_SERVER_ERROR
+from zope.interface import implementer
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.failure import Failure
+from twisted.web.http import OK, INTERNAL_SERVER_ERROR, NOT_MODIFIED
 
 from eliot import Logger, writeFailure
 from eliot.twisted import DeferredContext
 
+from ..common import LRUCache
 from ._error import (
     ILLEGAL_CONTENT_TYPE, DECODING_ERROR, BadRequest, InvalidRequestJSON)
-from ._logging import LOG_SYSTEM, REQUEST, JSON_REQUEST
+from ._logging import (
+    LOG_SYSTEM, REQUEST, JSON_REQUEST, RESPONSE_CACHE_STATISTICS)
 from ._schema import getValidator
 
 _ASCENDING = b"ascending"
@@ -29,22 +40,38 @@ _DESCENDING = b"descending"
 
 _logger = Logger()
 
+# Generations start again from zero when the process restarts, so entity tags
+# also identify the process that issued them:
+_PROCESS_TAG = uuid4().hex.encode("ascii")
+
+# The default number of responses kept by a ResponseCache:
+_RESPONSE_CACHE_SIZE = 64
+
 
 class EndpointResponse(object):
     """
     An endpoint can return an L{EndpointResponse} instance to return a custom
-    response code to the client along with a successful response body.
+    response code and headers to the client along with a successful response
+    body.
     """
-    def __init__(self, code, result):
+    def __init__(self, code, result, headers=None):
         """
         @param code: The HTTP response code to set in the response.
         @type code: L{int}
 
         @param result: The (structured) value to put into the response
-            body.  This must be JSON encodeable.
+            body.  This must be JSON encodeable, or a generator of the
+            JSON encodeable items of an array.
+
+        @param headers: Additional response headers, mapping header names to
+            L{list}s of values.
+        @type headers: L{dict} of L{bytes}
         """
         self.code = code
         self.result = result
+        if headers is None:
+            headers = {}
+        self.headers = headers
 
 
 def _get_logger(self):
@@ -109,31 +136,159 @@ def _logging(original):
     return logger
 
 
+def _get_output_validation_interval(self):
+    """
+    Find how often the results of an endpoint should be validated.
+
+    :return: The ``int`` number of results of which one is validated, from
+        the ``output_validation_interval`` attribute if there is one.
+        Otherwise every result is validated.
+    """
+    return getattr(self, "output_validation_interval", 1)
+
+
+@implementer(IPushProducer)
+class _JSONArrayProducer(object):
+    """
+    Write the JSON encoding of an array to a request one item at a time, so
+    only one item needs to be in memory at once.  Writing stops while the
+    transport of the request is paused.
+
+    Nothing is written until the first item has been encoded, so if that
+    fails an error response can still be sent.  If a later item fails the
+    response can't be changed any more, so the failure is logged and the
+    connection aborted to let the client know the response is incomplete.
+
+    @ivar _separator: The bytes to write before the next item.
+    @ivar _paused: Whether the transport asked for writing to stop.
+    @ivar _done: A L{Deferred} which fires once all items are written.
+    """
+    def __init__(self, request, items, validate, logger):
+        """
+        @param request: The request to write the response body to.
+        @param items: An iterator of the JSON encodeable items.
+        @param validate: A one-argument callable which raises an exception
+            if an item is not valid.
+        @param logger: The L{Logger} to log failures with.
+        """
+        self._request = request
+        self._items = items
+        self._validate = validate
+        self._logger = logger
+        self._separator = b"["
+        self._paused = False
+        self._done = Deferred()
+
+    def start(self):
+        """
+        Start writing.
+
+        @return: A L{Deferred} which fires with an empty body once all items
+            have been written, or fails if the first item could not be
+            encoded.
+        """
+        self._request.registerProducer(self, True)
+        self.resumeProducing()
+        return self._done
+
+    def _finish(self, result):
+        """
+        Stop writing and fire the L{Deferred} returned by C{start}.
+        """
+        if self._done.called:
+            return
+        self._request.unregisterProducer()
+        self._done.callback(result)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while not self._paused and not self._done.called:
+            try:
+                item = next(self._items)
+                self._validate(item)
+                data = dumps(item)
+            except StopIteration:
+                if self._separator == b"[":
+                    self._request.write(b"[]")
+                else:
+                    self._request.write(b"]")
+                self._finish(b"")
+                return
+            except Exception:
+                self._failed(Failure())
+                return
+            self._request.write(self._separator + data)
+            self._separator = b", "
+
+    def stopProducing(self):
+        self._finish(b"")
+
+    def _failed(self, reason):
+        """
+        Handle a failure to get or encode an item.
+        """
+        if self._separator == b"[":
+            self._request.unregisterProducer()
+            self._done.errback(reason)
+        else:
+            writeFailure(reason, self._logger, LOG_SYSTEM)
+            self._request.transport.abortConnection()
+            self._finish(b"")
+
+
 def _serialize(outputValidator):
     """
     Decorate a function so that its return value is automatically JSON encoded
     into a structure indicating a successful result.
 
+    If the return value is a generator its items are encoded as a JSON
+    array, and written to the request as they are generated rather than all
+    at once.  The response body is then written before the L{Deferred}
+    returned by the decorated function fires, with an empty body.
+
     @param outputValidator: A L{jsonschema} validator for the returned JSON.
 
     @return: A decorator that decorates a function with the signature
         of a Klein route endpoint that may return a Deferred.
     """
     def deco(original):
-        def success(result, request):
+        # Count the results, to validate the right fraction of them:
+        results = count()
+
+        def success(result, request, interval, logger):
             code = OK
             if isinstance(result, EndpointResponse):
                 code = result.code
+                for name, values in result.headers.items():
+                    request.responseHeaders.setRawHeaders(name, values)
                 result = result.result
-            outputValidator.validate(result)
+            validating = next(results) % interval == 0
             request.responseHeaders.setRawHeaders(
                 b"content-type", [b"application/json"])
             request.setResponseCode(code)
+            if isinstance(result, GeneratorType):
+                if validating:
+                    # The schema is for the whole array, so validate each
+                    # item as an array of its own:
+                    def validate(item):
+                        outputValidator.validate([item])
+                else:
+                    def validate(item):
+                        pass
+                return _JSONArrayProducer(
+                    request, result, validate, logger).start()
+            if validating:
+                outputValidator.validate(result)
             return dumps(result)
 
         def doit(self, request, **routeArguments):
             result = maybeDeferred(original, self, request, **routeArguments)
-            result.addCallback(success, request)
+            result.addCallback(
+                success, request, _get_output_validation_interval(self),
+                _get_logger(self))
             return result
 
         return doit
@@ -156,25 +311,51 @@ def structured(inputSchema, outputSchema, schema_store=None):
         original(foo="bar")
 
     The encoded form of the object returned by C{original} will define the
-    response body.
-
-    :param inputSchema: JSON Schema describing the request body.
+    response body.  If C{original} returns a generator the response body is
+    a JSON array of the items it generates, which are encoded and written as
+    they are generated so a large response needn't be kept in memory.
+
+    C{GET} requests have no body.  If C{inputSchema} is not empty, the last
+    value given for each query argument of a C{GET} request is passed as a
+    keyword argument instead, after being validated in the same way.  Since
+    they are strings the schema has to describe them as such.
+
+    If the object the decorated method is bound to has an
+    ``output_validation_interval`` attribute only one in that many responses
+    is validated against C{outputSchema}, since validating large responses
+    can cost more than building them.
+
+    :param inputSchema: JSON Schema describing the request body, or the query
+        arguments of a C{GET} request.
     :param outputSchema: JSON Schema describing the response body.
     :param schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure, allowing
         input/output schemas to just be references.
+
     """
     if schema_store is None:
         schema_store = {}
     inputValidator = getValidator(inputSchema, schema_store)
     outputValidator = getValidator(outputSchema, schema_store)
 
+    def _validate(objects):
+        errors = []
+        for error in inputValidator.iter_errors(objects):
+            errors.append(error.message)
+        if errors:
+            raise InvalidRequestJSON(errors=errors, schema=inputSchema)
+
     def deco(original):
         @wraps(original)
         @_logging
         @_serialize(outputValidator)
         def loadAndDispatch(self, request, **routeArguments):
-            if request.method in (b"GET", b"DELETE"):
+            if request.method == b"GET" and inputSchema:
+                objects = dict(
+                    (key.decode("utf-8"), values[-1].decode("utf-8"))
+                    for key, values in request.args.items())
+                _validate(objects)
+            elif request.method in (b"GET", b"DELETE"):
                 objects = {}
             else:
                 contentType = request.requestHeaders.getRawHeaders(
@@ -188,11 +369,7 @@ def structured(inputSchema, outputSchema, schema_store=None):
                 except ValueError:
                     raise DECODING_ERROR
 
-                errors = []
-                for error in inputValidator.iter_errors(objects):
-                    errors.append(error.message)
-                if errors:
-                    raise InvalidRequestJSON(errors=errors, schema=inputSchema)
+                _validate(objects)
 
             eliot_action = JSON_REQUEST(_get_logger(self), json=objects.copy())
             with eliot_action.context():
@@ -211,6 +388,10 @@ def structured(inputSchema, outputSchema, schema_store=None):
                     if isinstance(result, EndpointResponse):
                         code = result.code
                         json = result.result
+                    if isinstance(json, GeneratorType):
+                        # Generated results are only available while they
+                        # are written:
+                        json = None
                     eliot_action.add_success_fields(code=code, json=json)
                     return result
                 d.addCallback(got_result)
@@ -223,6 +404,144 @@ def structured(inputSchema, outputSchema, schema_store=None):
     return deco
 
 
+class ResponseCache(object):
+    """
+    The most recently used encoded responses of L{conditional} endpoints.
+
+    @ivar hits: The number of requests answered from the cache.
+    @type hits: L{int}
+
+    @ivar misses: The number of requests whose response wasn't cached.
+    @type misses: L{int}
+
+    @ivar logger: The L{Logger} that L{log_statistics} writes to.
+
+    @ivar _responses: The responses, by key.
+    @type _responses: L{LRUCache}
+    """
+    def __init__(self, size=_RESPONSE_CACHE_SIZE):
+        """
+        @param size: The maximum number of responses to keep.
+        @type size: L{int}
+        """
+        self._responses = LRUCache(size)
+        self.hits = 0
+        self.misses = 0
+        self.logger = _logger
+
+    def __len__(self):
+        return len(self._responses)
+
+    def log_statistics(self):
+        """
+        Log the number of hits and misses so far and the number of responses
+        cached.
+        """
+        RESPONSE_CACHE_STATISTICS(
+            hits=self.hits, misses=self.misses, size=len(self)
+        ).write(self.logger)
+
+    def get(self, key):
+        """
+        Look up a response.
+
+        @param key: The key the response was stored with.
+
+        @return: The response, or C{None} if it isn't cached.
+        """
+        response = self._responses.get(key)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def set(self, key, response):
+        """
+        Store a response, evicting the least recently used response if there
+        are too many.
+
+        @param key: The key to store the response with.
+        @param response: The response.
+        """
+        self._responses.set(key, response)
+
+
+def conditional(get_generation):
+    """
+    Decorate a ``structured`` Klein-style endpoint method whose response
+    only depends on data with a generation number, so that clients can make
+    conditional requests for it.
+
+    The generation is sent in the ``X-Flocker-Generation`` header and as
+    part of the ``ETag`` header.  A request with an ``If-None-Match`` header
+    matching the current entity tag gets a *304 Not Modified* response
+    without the decorated method being called.  The encoded body and headers
+    of successful responses are kept and sent again for requests with the
+    same URI, also without calling the decorated method, until the
+    generation changes.
+
+    Responses are kept in the ``response_cache`` attribute of the object the
+    decorated method is bound to, a L{ResponseCache} which can be shared by
+    all its endpoints.  If there is no such attribute only the last response
+    is kept.
+
+    :param get_generation: A callable which is called with the object the
+        decorated method is bound to and returns an ``int`` which changes
+        whenever the response would change.
+    """
+    def deco(original):
+        # Map the objects without a response_cache attribute the method is
+        # bound to to a cache of the last response:
+        caches = WeakKeyDictionary()
+
+        @wraps(original)
+        def conditionally(self, request, **routeArguments):
+            generation = get_generation(self)
+            request.responseHeaders.setRawHeaders(
+                b"x-flocker-generation", [b"%d" % (generation,)])
+            etag = b'"%s-%d"' % (_PROCESS_TAG, generation)
+            request.responseHeaders.setRawHeaders(b"etag", [etag])
+            if_none_match = request.requestHeaders.getRawHeaders(
+                b"if-none-match", [])
+            tags = set(tag.strip() for header in if_none_match
+                       for tag in header.split(b","))
+            if etag in tags or b"*" in tags:
+                request.setResponseCode(NOT_MODIFIED)
+                return b""
+            cache = getattr(self, "response_cache", None)
+            if cache is None:
+                cache = caches.setdefault(self, ResponseCache(1))
+            key = (original.__name__, generation, request.uri)
+            cached = cache.get(key)
+            if cached is not None:
+                headers, body = cached
+                for name, values in headers:
+                    request.responseHeaders.setRawHeaders(name, values)
+                return body
+
+            def rendered(body):
+                if request.code == OK:
+                    # Streamed responses have been written already and have
+                    # an empty body, so they can't be cached:
+                    if body:
+                        cache.set(key, (
+                            list(request.responseHeaders.getAllRawHeaders()),
+                            body))
+                else:
+                    request.responseHeaders.removeHeader(b"etag")
+                    request.responseHeaders.removeHeader(
+                        b"x-flocker-generation")
+                return body
+            result = maybeDeferred(
+                original, self, request, **routeArguments)
+            result.addCallback(rendered)
+            return result
+
+        return conditionally
+    return deco
+
+
 def user_documentation(doc, examples=None):
     """
     Annotate a klein-style endpoint to include user-facing documentation.
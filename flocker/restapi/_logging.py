@@ -7,9 +7,10 @@ This module defines the Eliot log events emitted by the API implementation.
 __all__ = [
     "JSON_REQUEST",
     "REQUEST",
+    "RESPONSE_CACHE_STATISTICS",
     ]
 
-from eliot import Field, ActionType
+from eliot import Field, ActionType, MessageType
 
 LOG_SYSTEM = u"api"
 
@@ -38,3 +39,18 @@ JSON_REQUEST = ActionType(
     [JSON],
     [RESPONSE_CODE, JSON],
     u"A request containing JSON request and response bodies.")
+
+HITS = Field.forTypes(
+    u"hits", [int],
+    u"The number of requests answered from the response cache.")
+MISSES = Field.forTypes(
+    u"misses", [int],
+    u"The number of requests whose response wasn't cached.")
+SIZE = Field.forTypes(
+    u"size", [int],
+    u"The number of responses cached.")
+
+RESPONSE_CACHE_STATISTICS = MessageType(
+    LOG_SYSTEM + u":response_cache:statistics",
+    [HITS, MISSES, SIZE],
+    u"The effectiveness so far of a cache of encoded API responses.")
@@ -13,7 +13,8 @@ __all__ = [
     "resolveSchema",
 ]
 
-import copy
+from json import dumps
+from urlparse import urldefrag
 
 from jsonschema.validators import RefResolver, validator_for
 from jsonschema import draft4_format_checker
@@ -33,30 +34,55 @@ class LocalRefResolver(RefResolver):
         raise SchemaNotProvided(uri)
 
 
+# Map the encoded schema and the identity of the schema store to a tuple of
+# the schema store and the validator, so endpoints with the same schema
+# share a validator:
+_VALIDATORS = {}
+
+
 def getValidator(schema, schema_store):
     """
     Get a L{jsonschema} validator for C{schema}.
 
+    References in the schema are resolved once, when the validator is
+    created, rather than every time something is validated; only those in a
+    cycle are left for the validator to follow.  Validators are
+    cached, so the same validator is returned for equal schemas with the
+    same schema store.
+
     @param schema: The JSON Schema to validate against.
     @type schema: L{dict}
 
     @param dict schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure.
     """
+    key = (dumps(schema, sort_keys=True), id(schema_store))
+    cached = _VALIDATORS.get(key)
+    if cached is not None:
+        return cached[1]
+    resolved = resolveSchema(schema, schema_store)
     # The base_uri here isn't correct for the schema,
     # but does give proper relative paths.
     resolver = LocalRefResolver(
         base_uri=b'',
         referrer=schema, store=schema_store)
     resolver.resolution_scope = b''
-    return validator_for(schema)(
-        schema, resolver=resolver, format_checker=draft4_format_checker)
+    validator = validator_for(resolved)(
+        resolved, resolver=resolver, format_checker=draft4_format_checker)
+    # Keep a reference to the schema store so its identity isn't reused:
+    _VALIDATORS[key] = (schema_store, validator)
+    return validator
 
 
 def resolveSchema(schema, schemaStore):
     """
     Recursively resolve all I{$ref} JSON references in a JSON Schema.
 
+    The result is a new structure; neither C{schema} nor the schemas in
+    C{schemaStore} are modified.  A reference met again while it is being
+    resolved, as in a recursive schema, can't be replaced by its referent,
+    so it is kept as an absolute I{$ref} instead.
+
     @param schema: A L{dict} with a JSON Schema.
 
     @param schemaStore: A L{dict} mapping file paths to JSON Schema loaded
@@ -65,26 +91,31 @@ def resolveSchema(schema, schemaStore):
     @return: The resolved JSON Schema.
     @rtype: L{dict}
     """
-    result = copy.deepcopy(schema)
     resolver = LocalRefResolver(base_uri=b'', referrer=schema,
                                 store=schemaStore)
 
-    def resolve(obj):
+    def resolve(obj, resolving):
+        """
+        @param obj: Part of a schema.
+        @param resolving: The L{frozenset} of absolute references being
+            resolved, to detect cycles.
+
+        @return: A copy of C{obj} with its references resolved.
+        """
         if isinstance(obj, list):
-            for item in obj:
-                resolve(item)
-            return
-
-        if isinstance(obj, dict):
-            if "$ref" in obj:
-                with resolver.resolving(obj[u'$ref']) as resolved:
-                    resolve(resolved)
-                    obj.clear()
-                    obj.update(resolved)
-            else:
-                for value in obj.values():
-                    resolve(value)
-
-    resolve(result)
+            return [resolve(item, resolving) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if u"$ref" not in obj:
+            return {key: resolve(value, resolving)
+                    for key, value in obj.items()}
+        with resolver.resolving(obj[u"$ref"]) as resolved:
+            reference = (resolver.resolution_scope + u"#" +
+                         urldefrag(obj[u"$ref"])[1])
+            if reference in resolving:
+                return {u"$ref": reference}
+            return resolve(resolved, resolving | {reference})
+
+    result = resolve(schema, frozenset())
     result["$schema"] = "http://json-schema.org/draft-04/schema#"
     return result
@@ -14,12 +14,13 @@ from twisted.internet.defer import succeed, fail
 from twisted.web.http_headers import Headers
 from twisted.web.http import (
     BAD_REQUEST, INTERNAL_SERVER_ERROR, PAYMENT_REQUIRED, GONE,
-    NOT_ALLOWED, NOT_FOUND, OK)
+    NOT_ALLOWED, NOT_FOUND, NOT_MODIFIED, OK)
 
 from twisted.trial.unittest import SynchronousTestCase
 
 from .._infrastructure import (
-    EndpointResponse, user_documentation, structured)
+    EndpointResponse, user_documentation, structured, conditional,
+    ResponseCache)
 from .._logging import REQUEST, JSON_REQUEST
 from .._error import (
     ILLEGAL_CONTENT_TYPE_DESCRIPTION, DECODING_ERROR_DESCRIPTION,
@@ -485,6 +486,32 @@ class StructuredJSONTests(SynchronousTestCase):
              len(response[u'errors'])),
             (BAD_REQUEST, FAILED_INPUT_VALIDATION, 2))
 
+    @validateLogging(_assertRequestLogged(b"/foo/validation"))
+    def test_queryArguments(self, logger):
+        """
+        If the input schema is not empty, the last value of each query
+        argument of a I{GET} request is passed as a keyword argument to the
+        decorated function.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/validation?abc=1&abc=2&def=x", Headers(), b"")
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual({u"abc": u"2", u"def": u"x"}, app.kwargs)
+
+    @validateLogging(_assertRequestLogged(b"/foo/validation"))
+    def test_queryArgumentsValidationError(self, logger):
+        """
+        If the query arguments of a I{GET} request don't match the provided
+        schema, then the request automatically receives a I{BAD REQUEST}
+        response.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/validation?def=x", Headers(), b"")
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual((BAD_REQUEST, None), (request.code, app.kwargs))
+
     @validateLogging(_assertTracebackLogged(ValidationError))
     # See above
     # @validateLogging(_assertRequestLogged(b"/foo/badresponse"))
@@ -553,6 +580,164 @@ class StructuredJSONTests(SynchronousTestCase):
             {"jsonValue": True, "routingValue": "quux"}, app.kwargs)
 
 
+class OutputValidationIntervalTests(SynchronousTestCase):
+    """
+    Tests for sampling of output validation by L{structured}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self, results):
+            self.results = iter(results)
+
+        @app.route(b"/foo/bar")
+        @structured({}, {u"type": u"string"})
+        def foo(self):
+            return next(self.results)
+
+    def codes(self, application, requests):
+        """
+        Make some requests and return their response codes.
+
+        :param application: The ``Application``.
+        :param int requests: The number of requests to make.
+
+        :return: A ``list`` of the response codes.
+        """
+        codes = []
+        for _ in range(requests):
+            request = dummyRequest(b"GET", b"/foo/bar", Headers(), b"")
+            render(application.app.resource(), request)
+            codes.append(request.code)
+        return codes
+
+    def test_default(self):
+        """
+        By default every response is validated.
+        """
+        application = self.Application([{}, {}])
+        self.assertEqual([INTERNAL_SERVER_ERROR] * 2,
+                         self.codes(application, 2))
+
+    def test_interval(self):
+        """
+        If the application has an ``output_validation_interval`` only one in
+        that many responses are validated.
+        """
+        application = self.Application([{}] * 5)
+        application.output_validation_interval = 2
+        self.assertEqual(
+            [INTERNAL_SERVER_ERROR, OK, INTERNAL_SERVER_ERROR, OK,
+             INTERNAL_SERVER_ERROR],
+            self.codes(application, 5))
+
+
+class StreamingTests(SynchronousTestCase):
+    """
+    Tests for L{structured} endpoints which return generators.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self, logger, items):
+            self.logger = logger
+            self.items = items
+
+        @app.route(b"/foo/bar")
+        @structured({}, {u"type": u"array", u"items": {u"type": u"integer"}})
+        def foo(self):
+            for item in self.items:
+                if isinstance(item, Exception):
+                    raise item
+                if callable(item):
+                    item = item()
+                yield item
+
+    def request(self, application):
+        """
+        Make a request to the streaming endpoint.
+
+        :param application: The ``Application``.
+
+        :return: The rendered ``_DummyRequest``.
+        """
+        request = dummyRequest(b"GET", b"/foo/bar", Headers(), b"")
+        render(application.app.resource(), request)
+        return request
+
+    @validateLogging(None)
+    def test_encode(self, logger):
+        """
+        The generated items are encoded as a JSON array.
+        """
+        request = self.request(self.Application(logger, [1, 2, 3]))
+        self.assertEqual(
+            (OK, [b"application/json"], [1, 2, 3], True),
+            (request.code,
+             request.responseHeaders.getRawHeaders(b"content-type"),
+             loads(request._responseBody), request._finished))
+
+    @validateLogging(None)
+    def test_empty(self, logger):
+        """
+        A generator with no items is encoded as an empty JSON array.
+        """
+        request = self.request(self.Application(logger, []))
+        self.assertEqual([], loads(request._responseBody))
+
+    @validateLogging(None)
+    def test_paused(self, logger):
+        """
+        No more items are generated while the transport is paused, and the
+        rest are written once it resumes.
+        """
+        request = dummyRequest(b"GET", b"/foo/bar", Headers(), b"")
+
+        def pause():
+            request.transport.producer.pauseProducing()
+            return 2
+        render(self.Application(logger, [1, pause, 3]).app.resource(),
+               request)
+        written = request._responseBody
+        request.transport.producer.resumeProducing()
+        self.assertEqual(
+            (b"[1, 2", [1, 2, 3], True),
+            (written, loads(request._responseBody), request._finished))
+
+    @validateLogging(_assertTracebackLogged(ArbitraryException))
+    def test_first_item_failure(self, logger):
+        """
+        If getting the first item fails an error response is sent.
+        """
+        request = self.request(
+            self.Application(logger, [ArbitraryException()]))
+        self.assertEqual(INTERNAL_SERVER_ERROR, request.code)
+
+    @validateLogging(None)
+    def test_invalid_item(self, logger):
+        """
+        The items are validated against the schema of the array.
+        """
+        request = self.request(self.Application(logger, [u"one"]))
+        self.assertEqual(INTERNAL_SERVER_ERROR, request.code)
+        logger.flushTracebacks(ValidationError)
+
+    @validateLogging(_assertTracebackLogged(ArbitraryException))
+    def test_later_item_failure(self, logger):
+        """
+        If getting an item after the first fails the connection is aborted
+        and the failure logged.
+        """
+        request = dummyRequest(b"GET", b"/foo/bar", Headers(), b"")
+        aborted = []
+        request.transport.abortConnection = lambda: aborted.append(True)
+        render(
+            self.Application(logger, [1, ArbitraryException()]).app.resource(),
+            request)
+        self.assertEqual((OK, b"[1", [True]),
+                         (request.code, request._responseBody, aborted))
+
+
 class UserDocumentationTests(SynchronousTestCase):
     """
     Tests for L{user_documentation}.
@@ -570,6 +755,214 @@ class UserDocumentationTests(SynchronousTestCase):
         self.assertEqual(f.userDocumentation, "Some text")
 
 
+class ConditionalTests(SynchronousTestCase):
+    """
+    Tests for L{conditional}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self):
+            self.generation = 0
+            self.calls = 0
+            self.failing = False
+
+        @app.route(b"/foo/bar")
+        @conditional(lambda application: application.generation)
+        @structured({}, {})
+        def foo(self):
+            self.calls += 1
+            if self.failing:
+                raise BadRequest(GONE, u"gone")
+            return EndpointResponse(
+                OK, {u"generation": self.generation},
+                {b"link": [b"<?page=%d>" % (self.calls,)]})
+
+    def request(self, app, if_none_match=None, path=b"/foo/bar"):
+        """
+        Make a request to the conditional endpoint.
+
+        :param app: The ``Application``.
+        :param bytes if_none_match: The value of the ``If-None-Match``
+            header, or ``None`` for none.
+        :param bytes path: The path of the request.
+
+        :return: The rendered ``_DummyRequest``.
+        """
+        headers = Headers()
+        if if_none_match is not None:
+            headers.setRawHeaders(b"if-none-match", [if_none_match])
+        request = dummyRequest(b"GET", path, headers, b"")
+        render(app.app.resource(), request)
+        return request
+
+    def test_headers(self):
+        """
+        The response includes the generation and an entity tag for it.
+        """
+        app = self.Application()
+        app.generation = 3
+        request = self.request(app)
+        [etag] = request.responseHeaders.getRawHeaders(b"etag")
+        self.assertEqual(
+            (OK, [b"3"], True),
+            (request.code,
+             request.responseHeaders.getRawHeaders(b"x-flocker-generation"),
+             etag.endswith(b'-3"')))
+
+    def test_not_modified(self):
+        """
+        A request with the current entity tag in ``If-None-Match`` gets a
+        I{NOT MODIFIED} response without calling the endpoint.
+        """
+        app = self.Application()
+        [etag] = self.request(app).responseHeaders.getRawHeaders(b"etag")
+        request = self.request(app, etag)
+        self.assertEqual((NOT_MODIFIED, b"", 1),
+                         (request.code, request._responseBody, app.calls))
+
+    def test_not_modified_one_of_several(self):
+        """
+        A request with the current entity tag among several in
+        ``If-None-Match`` gets a I{NOT MODIFIED} response.
+        """
+        app = self.Application()
+        [etag] = self.request(app).responseHeaders.getRawHeaders(b"etag")
+        request = self.request(app, b'"something-else", ' + etag)
+        self.assertEqual(NOT_MODIFIED, request.code)
+
+    def test_modified(self):
+        """
+        A request with an old entity tag in ``If-None-Match`` gets the new
+        response.
+        """
+        app = self.Application()
+        [etag] = self.request(app).responseHeaders.getRawHeaders(b"etag")
+        app.generation += 1
+        request = self.request(app, etag)
+        self.assertEqual((OK, {u"generation": 1}),
+                         (request.code, loads(request._responseBody)))
+
+    def test_cached(self):
+        """
+        The response body and headers are reused without calling the endpoint
+        while the generation is unchanged.
+        """
+        app = self.Application()
+        first = self.request(app)
+        second = self.request(app)
+        self.assertEqual(
+            (first._responseBody, [b"application/json"], [b"<?page=1>"], 1),
+            (second._responseBody,
+             second.responseHeaders.getRawHeaders(b"content-type"),
+             second.responseHeaders.getRawHeaders(b"link"),
+             app.calls))
+
+    def test_cached_per_uri(self):
+        """
+        Responses are cached separately for each request URI.
+        """
+        app = self.Application()
+        self.request(app)
+        request = self.request(app, path=b"/foo/bar?page=2")
+        self.assertEqual(
+            ([b"<?page=2>"], 2),
+            (request.responseHeaders.getRawHeaders(b"link"), app.calls))
+
+    def test_cached_per_object(self):
+        """
+        Responses are cached separately for each object the endpoint is bound
+        to.
+        """
+        app = self.Application()
+        self.request(app)
+        other = self.Application()
+        self.request(other)
+        self.assertEqual(1, other.calls)
+
+    def test_response_cache(self):
+        """
+        If the object the endpoint is bound to has a ``response_cache`` it
+        is used to keep the responses for several URIs.
+        """
+        app = self.Application()
+        app.response_cache = ResponseCache()
+        for path in [b"/foo/bar", b"/foo/bar?page=2"] * 2:
+            self.request(app, path=path)
+        self.assertEqual(
+            (2, 2, 2),
+            (app.calls, app.response_cache.hits, app.response_cache.misses))
+
+    def test_error_not_cached(self):
+        """
+        An error response is not cached and has no entity tag.
+        """
+        app = self.Application()
+        app.failing = True
+        request = self.request(app)
+        self.request(app)
+        self.assertEqual(
+            (GONE, None, 2),
+            (request.code, request.responseHeaders.getRawHeaders(b"etag"),
+             app.calls))
+
+
+class ResponseCacheTests(SynchronousTestCase):
+    """
+    Tests for L{ResponseCache}.
+    """
+    def test_get(self):
+        """
+        A stored response is returned by C{get}.
+        """
+        cache = ResponseCache()
+        cache.set(u"key", b"response")
+        self.assertEqual(b"response", cache.get(u"key"))
+
+    def test_counters(self):
+        """
+        C{get} counts the hits and misses.
+        """
+        cache = ResponseCache()
+        cache.set(u"key", b"response")
+        cache.get(u"key")
+        cache.get(u"key")
+        cache.get(u"other")
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    @validateLogging(None)
+    def test_log_statistics(self, logger):
+        """
+        C{log_statistics} logs the hits, misses and number of responses
+        cached.
+        """
+        cache = ResponseCache()
+        cache.logger = logger
+        cache.set(u"key", b"response")
+        cache.get(u"key")
+        cache.get(u"other")
+        cache.log_statistics()
+        [message] = logger.messages
+        self.assertEqual(
+            (u"api:response_cache:statistics", 1, 1, 1),
+            (message[u"message_type"], message[u"hits"],
+             message[u"misses"], message[u"size"]))
+
+    def test_evict_least_recently_used(self):
+        """
+        Storing more than the given number of responses evicts the least
+        recently used response.
+        """
+        cache = ResponseCache(2)
+        cache.set(u"a", b"1")
+        cache.set(u"b", b"2")
+        cache.get(u"a")
+        cache.set(u"c", b"3")
+        self.assertEqual(
+            (2, b"1", None, b"3"),
+            (len(cache), cache.get(u"a"), cache.get(u"b"), cache.get(u"c")))
+
+
 class NotAllowedTests(SynchronousTestCase):
     """
     Tests for the HTTP method restriction functionality imposed by the routing
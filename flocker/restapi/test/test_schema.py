@@ -64,6 +64,39 @@ class GetValidatorTests(SynchronousTestCase):
                                  {'schema.json': {'type': 'string'}})
         self.assertRaises(ValidationError, validator.validate, {})
 
+    def test_cached(self):
+        """
+        L{getValidator} returns the same validator for equal schemas with the
+        same schema store.
+        """
+        store = {'schema.json': {'type': 'string'}}
+        self.assertIs(getValidator({u'$ref': u'schema.json'}, store),
+                      getValidator({u'$ref': u'schema.json'}, store))
+
+    def test_not_cached_for_other_store(self):
+        """
+        L{getValidator} returns a different validator for a schema with a
+        different schema store.
+        """
+        validator = getValidator({u'$ref': u'schema.json'},
+                                 {'schema.json': {'type': 'string'}})
+        other = getValidator({u'$ref': u'schema.json'},
+                             {'schema.json': {'type': 'integer'}})
+        other.validate(1)
+        self.assertRaises(ValidationError, validator.validate, 1)
+
+    def test_recursive(self):
+        """
+        L{getValidator} returns a validator for a schema which refers to
+        itself.
+        """
+        validator = getValidator(
+            {u'$ref': u'tree.json'},
+            {'tree.json': {'type': 'array',
+                           'items': {'$ref': 'tree.json'}}})
+        validator.validate([[], [[]]])
+        self.assertRaises(ValidationError, validator.validate, [[1]])
+
 
 class ResolveSchemaTests(SynchronousTestCase):
     """
@@ -189,6 +222,29 @@ class ResolveSchemaTests(SynchronousTestCase):
         resolveSchema(schema, self.STORE)
         self.assertEqual(schema, original)
 
+    def test_recursiveReference(self):
+        """
+        A reference met again while it is being resolved is left in place as
+        an absolute reference, rather than being resolved endlessly.
+        """
+        store = {"tree.json": {"type": "array",
+                               "items": {"$ref": "#"}}}
+        result = resolveSchema({"$ref": "tree.json"}, store)
+        self.assertEqual(result,
+                         {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "type": "array", "items": {"$ref": "tree.json#"}})
+
+    def test_referencedStoreUnmodified(self):
+        """
+        Schemas in the store which themselves contain references are not
+        modified by resolving references to them.
+        """
+        store = {"a.json": {"nested": {"key": {"$ref": "b.json"}}},
+                 "b.json": {"type": "string"}}
+        original = copy.deepcopy(store)
+        resolveSchema({"$ref": "a.json#/nested"}, store)
+        self.assertEqual(store, original)
+
     def test_storeUnmodified(self):
         """
         The store is not modified by resolution.
@@ -36,11 +36,12 @@ from twisted.internet.error import ConnectionDone
 from twisted.internet import reactor
 from twisted.trial.unittest import SynchronousTestCase, SkipTest
 from twisted.internet.protocol import Factory, Protocol
-from twisted.test.proto_helpers import MemoryReactor
+from twisted.test.proto_helpers import MemoryReactorClock
 from twisted.python.procutils import which
 from twisted.trial.unittest import TestCase
 from twisted.protocols.amp import AMP, InvalidSignature
 from twisted.python.log import msg
+from twisted.python.failure import Failure
 
 from characteristic import attributes
 
@@ -693,13 +694,13 @@ from twisted.internet.base import _ThreePhaseEvent
 
 
 @implementer(IReactorCore)
-class MemoryCoreReactor(MemoryReactor):
+class MemoryCoreReactor(MemoryReactorClock):
     """
-    Fake reactor with listenTCP and just enough of an implementation of
-    IReactorCore.
+    Fake reactor with listenTCP, IReactorTime and just enough of an
+    implementation of IReactorCore.
     """
     def __init__(self):
-        MemoryReactor.__init__(self)
+        MemoryReactorClock.__init__(self)
         self._triggers = {}
 
     def addSystemEventTrigger(self, phase, eventType, callable, *args, **kw):
@@ -717,6 +718,54 @@ class MemoryCoreReactor(MemoryReactor):
             event.fireEvent()
 
 
+class FakeThreadPool(object):
+    """
+    Fake of the parts of ``twisted.python.threadpool.ThreadPool`` used by
+    ``deferToThreadPool``, which runs calls in the current thread when told
+    to rather than in other threads.
+
+    :ivar list pending: ``(onResult, f, args, kwargs)`` tuples for calls
+        which have not yet been run.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.pending.append((onResult, f, args, kwargs))
+
+    def run_pending(self):
+        """
+        Run pending calls, including any made while doing so, until there are
+        none left.
+        """
+        while self.pending:
+            onResult, f, args, kwargs = self.pending.pop(0)
+            try:
+                result = f(*args, **kwargs)
+            except:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+
+
+class FakeThreadsReactor(Clock):
+    """
+    Fake reactor with just enough of ``IReactorThreads`` for
+    ``deferToThreadPool``, using a ``FakeThreadPool``.
+
+    :ivar FakeThreadPool threadpool: The reactor's thread pool.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.threadpool = FakeThreadPool()
+
+    def getThreadPool(self):
+        return self.threadpool
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
 def make_script_tests(executable):
     """
     Generate a test suite which applies to any Flocker-installed node script.